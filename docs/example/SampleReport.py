@@ -103,10 +103,18 @@ def main():
                          start=args.start,
                          end=args.end,
                          verbose=args.verbose,
-                         is_test=args.is_test)
-        s.run_report()
+                         is_test=args.is_test,
+                         plan=args.plan,
+                         backfill=args.backfill,
+                         backfill_dir=args.backfill_dir)
+        # Record the run's metrics even if it fails before send_report
+        with s.collect_metrics():
+            s.run_report()
         print "Yay, it worked!"
         sys.exit(0)
+    except ReportUtils.QueryPlanned:
+        # Started with --plan:  run_query printed the plan instead
+        sys.exit(0)
     except Exception as e:
         ReportUtils.runerror(args.config, e, traceback.format_exc(), '/tmp/logfile.junk')
         sys.exit(1)
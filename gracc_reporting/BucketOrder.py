@@ -0,0 +1,199 @@
+"""Ordering and top-k selection of aggregation buckets.  Works on raw bucket
+dicts (response.to_dict(), or the dicts in Pipeline batches) rather than
+elasticsearch_dsl AttrDicts, selects the top k with a heap instead of sorting
+every bucket, supports several sort keys with mixed directions, and can roll
+everything outside the top k up into an "Others" bucket.
+
+Orders are a field path or a list of them, where a leading '-' means
+descending, e.g. ['-CoreHours', 'key'].  A path is looked up in the bucket
+with dots separating levels; if it ends at a metric ({'value': ...}), the
+value is used.  '_key' and '_count' are aliases for 'key' and 'doc_count'.
+"""
+
+import heapq
+
+_ALIASES = {'_key': 'key', '_term': 'key', '_count': 'doc_count'}
+# Metric aggregations that the terms aggregation can order by
+_ORDERABLE_METRICS = ('sum', 'min', 'max', 'value_count', 'avg')
+
+
+class _Reversed(object):
+    """Wraps a value so that it sorts in reverse order"""
+    __slots__ = ('value', )
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def parse_order(order):
+    """Parse an order into (path, descending) pairs
+
+    :param order: Field path string, or list of them.  Prefix '-' for
+        descending
+    :return list: [(tuple of path components, bool descending), ...]
+    """
+    if isinstance(order, basestring):
+        order = [order, ]
+    parsed = []
+    for field in order:
+        descending = field.startswith('-')
+        path = field.lstrip('-+')
+        path = _ALIASES.get(path, path)
+        parsed.append((tuple(path.split('.')), descending))
+    return parsed
+
+
+def bucket_value(bucket, path):
+    """Look up a path in a raw bucket dict.  Metrics resolve to their value,
+    and missing fields to None.
+
+    :param dict bucket: Bucket
+    :param path: Tuple of path components, or dotted string
+    :return: Value at path
+    """
+    if isinstance(path, basestring):
+        path = tuple(_ALIASES.get(path, path).split('.'))
+    value = bucket
+    for part in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    if isinstance(value, dict) and 'value' in value:
+        value = value['value']
+    return value
+
+
+def sort_key(order):
+    """Key function that sorts raw buckets by order
+
+    :param order: See parse_order
+    :return function: bucket -> comparable tuple
+    """
+    parsed = parse_order(order)
+
+    def key(bucket):
+        out = []
+        for path, descending in parsed:
+            value = bucket_value(bucket, path)
+            out.append(_Reversed(value) if descending else value)
+        return tuple(out)
+    return key
+
+
+def top_buckets(agg, order, k=None, others=None, sum_fields=None):
+    """Order an aggregation's buckets and keep the first k.  With k, a heap
+    is used, so this is O(n log k) rather than a full sort.
+
+    :param agg: Aggregation with buckets:  a raw dict, an elasticsearch_dsl
+        AttrDict/AggResponse, or a list of raw buckets
+    :param order: See parse_order
+    :param int k: Number of buckets to keep.  None keeps all of them
+    :param str others: If given, append a bucket with this key that rolls up
+        everything outside the top k (including sum_other_doc_count of a
+        terms aggregation), if there's anything to roll up
+    :param list sum_fields: Metrics (field paths) to sum into the others
+        bucket.  Defaults to every top-level metric of the buckets, so give
+        this explicitly if some metrics aren't additive (avg, max, ...)
+    :return list: Raw bucket dicts
+    """
+    if hasattr(agg, 'to_dict'):
+        agg = agg.to_dict()
+    if isinstance(agg, dict):
+        buckets = agg.get('buckets', [])
+        other_docs = agg.get('sum_other_doc_count', 0)
+    else:
+        buckets, other_docs = agg, 0
+    if isinstance(buckets, dict):   # Keyed buckets (filters aggregation)
+        buckets = [dict(b, key=key) for key, b in buckets.iteritems()]
+
+    key = sort_key(order)
+    if k is None or k >= len(buckets):
+        top = sorted(buckets, key=key)
+    else:
+        top = heapq.nsmallest(k, buckets, key=key)
+
+    if others is not None:
+        kept = set(id(b) for b in top)
+        rest = [b for b in buckets if id(b) not in kept]
+        if rest or other_docs:
+            top.append(rollup_buckets(rest, others, sum_fields, other_docs))
+    return top
+
+
+def rollup_buckets(buckets, key, sum_fields=None, extra_doc_count=0):
+    """Sum several raw buckets into one
+
+    :param list buckets: Raw bucket dicts
+    :param key: Key of the new bucket
+    :param list sum_fields: Metrics (field paths) to sum.  Defaults to every
+        top-level metric ({'value': ...}) in the buckets
+    :param int extra_doc_count: Documents to count that aren't in buckets
+    :return dict: Raw bucket
+    """
+    if sum_fields is None:
+        sum_fields = sorted(set(
+            name for b in buckets for name, v in b.iteritems()
+            if isinstance(v, dict) and 'value' in v))
+    rolled = {'key': key, 'doc_count': extra_doc_count +
+              sum(b.get('doc_count', 0) for b in buckets)}
+    for field in sum_fields:
+        total = 0
+        for b in buckets:
+            value = bucket_value(b, field)
+            if value is not None:
+                total += value
+        node = rolled
+        parts = field.split('.')
+        if parts[-1] == 'value':
+            parts = parts[:-1]
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = {'value': total}
+    return rolled
+
+
+def push_down(terms_agg, order, k):
+    """Have Elasticsearch do the ordering and top-k selection, by setting
+    the order and size of a terms aggregation, if that's safe:  a single
+    sort key that is the term, the doc count (descending), or a
+    single-value metric sub-aggregation (descending).  Ascending counts and
+    metrics are left alone, since shard-level top-k is unreliable for
+    them.  Don't push down if you need an others bucket with metrics, since
+    Elasticsearch only reports the doc count of the buckets it leaves out.
+
+    :param terms_agg: elasticsearch_dsl terms aggregation (A('terms', ...))
+    :param order: See parse_order
+    :param int k: Number of buckets wanted
+    :return bool: True if the agg was changed.  If False, order the
+        buckets with top_buckets
+    """
+    parsed = parse_order(order)
+    if k is None or len(parsed) != 1 or \
+            getattr(terms_agg, 'name', None) != 'terms':
+        return False
+    path, descending = parsed[0]
+    direction = 'desc' if descending else 'asc'
+
+    if path == ('key', ):
+        es_order = {'_term': direction}
+    elif path == ('doc_count', ):
+        if not descending:
+            return False
+        es_order = {'_count': 'desc'}
+    else:
+        sub = terms_agg._params.get('aggs', {})
+        if len(path) not in (1, 2) or path[0] not in sub or \
+                (len(path) == 2 and path[1] != 'value') or not descending or \
+                getattr(sub[path[0]], 'name', None) not in _ORDERABLE_METRICS:
+            return False
+        es_order = {path[0]: 'desc'}
+
+    terms_agg._params['order'] = es_order
+    terms_agg._params['size'] = k
+    return True
@@ -0,0 +1,179 @@
+"""Checkpoint and resume for long scans.  Instead of a scroll, whose context
+can expire, CheckpointedScan pages through the hits with search_after on a
+unique sort (EndTime, then _uid), so that the last hit's sort values are a
+cursor that stays valid.  Every interval seconds, the cursor and the partial
+state built from the hits so far (anything picklable) are written to a
+checkpoint file.  If the scan fails and the same query is run again, it picks
+up from the last checkpoint instead of starting over.  The checkpoint is
+removed once the scan finishes."""
+
+import cPickle
+import hashlib
+import json
+import os
+import time
+
+DEFAULT_SORT = ('EndTime', '_uid')
+DEFAULT_INTERVAL = 60   # seconds
+DEFAULT_PAGE_SIZE = 1000
+
+
+def fingerprint(search):
+    """Hash identifying a query, so that a checkpoint is only resumed by the
+    same query
+
+    :param search: elasticsearch_dsl Search, or its body as a dict
+    :return str: Hex digest
+    """
+    body = search.to_dict() if hasattr(search, 'to_dict') else search
+    body = dict((k, v) for k, v in body.iteritems() if k != 'search_after')
+    return hashlib.md5(json.dumps(body, sort_keys=True,
+                                  default=str)).hexdigest()
+
+
+class Checkpoint(object):
+    """Checkpoint file holding a scan's cursor and partial state
+
+    :param str path: Checkpoint file
+    :param str key: Fingerprint of the query.  A checkpoint written for a
+        different key is ignored
+    """
+    def __init__(self, path, key=None):
+        self.path = path
+        self.key = key
+
+    def load(self):
+        """Read the checkpoint
+
+        :return dict: {'cursor', 'state', 'records', 'saved'}, or None if
+            there's no usable checkpoint
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                saved = cPickle.load(f)
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            return None
+        if not isinstance(saved, dict) or saved.get('key') != self.key:
+            return None
+        return saved
+
+    def save(self, cursor, state, records):
+        """Write the checkpoint, replacing any older one atomically
+
+        :param list cursor: Sort values of the last hit processed
+        :param state: Partial state (picklable)
+        :param int records: Number of hits processed
+        """
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        tmp = '{0}.tmp'.format(self.path)
+        with open(tmp, 'wb') as f:
+            cPickle.dump({'key': self.key, 'cursor': cursor, 'state': state,
+                          'records': records, 'saved': time.time()},
+                         f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, self.path)
+
+    def clear(self):
+        """Remove the checkpoint"""
+        for path in (self.path, '{0}.tmp'.format(self.path)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def search_after_pages(search, sort=DEFAULT_SORT, size=DEFAULT_PAGE_SIZE,
+                       after=None, execute=None):
+    """Page through all hits of a Search with search_after
+
+    :param Search search: elasticsearch_dsl Search
+    :param sort: Sort fields.  Must identify hits uniquely (end with _uid)
+    :param int size: Hits per page
+    :param list after: Sort values to start after, or None to start at the
+        beginning
+    :param execute: Function that takes a Search and returns a Response (e.g.
+        Reporter.executor.execute).  Defaults to Search.execute
+    :return generator: (list of hit _source dicts, sort values of the last
+        hit) per page
+    """
+    execute = execute if execute is not None else lambda s: s.execute()
+    base = search.sort(*sort)[0:size]
+    while True:
+        s = base.extra(search_after=after) if after is not None else base
+        hits = execute(s).to_dict()['hits']['hits']
+        if not hits:
+            return
+        after = hits[-1]['sort']
+        yield [h.get('_source', {}) for h in hits], after
+        if len(hits) < size:
+            return
+
+
+class CheckpointedScan(object):
+    """Scan a Search's hits into a state, checkpointing as it goes
+
+    :param Search search: elasticsearch_dsl Search
+    :param Checkpoint checkpoint: Where to keep the checkpoint.  Its key
+        defaults to the Search's fingerprint
+    :param sort: Sort fields for search_after
+    :param int size: Hits per page
+    :param float interval: Seconds between checkpoints
+    :param execute: Function that takes a Search and returns a Response
+    :param logger: logging.Logger
+    """
+    def __init__(self, search, checkpoint, sort=DEFAULT_SORT,
+                 size=DEFAULT_PAGE_SIZE, interval=DEFAULT_INTERVAL,
+                 execute=None, logger=None):
+        self.search = search
+        self.checkpoint = checkpoint
+        if self.checkpoint.key is None:
+            self.checkpoint.key = fingerprint(search)
+        self.sort = sort
+        self.size = size
+        self.interval = interval
+        self.execute = execute
+        self.logger = logger
+        self.records = 0
+        self.resumed_from = 0
+        self._clock = time.time
+
+    def run(self, state, consume, prepare=None):
+        """Run the scan
+
+        :param state: Initial state.  Replaced by the checkpointed state when
+            resuming
+        :param consume: Function taking (state, list of hit dicts), that
+            adds the hits to the state
+        :param prepare: Function taking the state, called before each
+            checkpoint (e.g. to spill in-memory data to disk)
+        :return: Final state
+        """
+        cursor = None
+        saved = self.checkpoint.load()
+        if saved is not None:
+            state, cursor = saved['state'], saved['cursor']
+            self.records = self.resumed_from = saved['records']
+            self.__log("Resuming scan from checkpoint {0} after {1} "
+                       "records".format(self.checkpoint.path, self.records))
+
+        last_save = self._clock()
+        for hits, cursor in search_after_pages(self.search, self.sort,
+                                               self.size, cursor,
+                                               self.execute):
+            consume(state, hits)
+            self.records += len(hits)
+            if self._clock() - last_save >= self.interval:
+                if prepare is not None:
+                    prepare(state)
+                self.checkpoint.save(cursor, state, self.records)
+                last_save = self._clock()
+                self.__log("Checkpointed scan after {0} records".format(
+                    self.records))
+
+        self.checkpoint.clear()
+        return state
+
+    def __log(self, msg):
+        if self.logger is not None:
+            self.logger.info(msg)
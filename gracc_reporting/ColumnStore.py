@@ -0,0 +1,453 @@
+"""Local columnar cache of raw usage records, for investigations that
+re-aggregate the same records many different ways.  Each UTC day of scanned
+records is stored as a directory of flat column files:  the record time and
+each metric as float64 arrays, and each dimension (Site, VO, User, ...) as
+int32 codes into a per-day dictionary of its values.  Columns are memory
+mapped when aggregated, so only the pages in use are held in memory, and
+group-by sums are vectorized with numpy if it is installed.  Without numpy,
+the columns are read in blocks with the array module instead (slower, but
+memory use is still bounded).
+
+Days are refreshed the same way as in RollupStore:  a cheap per-day
+fingerprint (doc count and metric sums) is compared with the stored one,
+and only days that changed are scanned again."""
+
+import array
+import hashlib
+import json
+import mmap
+import os
+import re
+import sys
+import tempfile
+from calendar import timegm
+from datetime import datetime, timedelta
+from shutil import rmtree
+
+from dateutil import parser, tz
+from elasticsearch_dsl import Search
+
+from Checkpoint import search_after_pages
+from RollupStore import day_list, epoch_ms_to_day, MISSING
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DEFAULT_INDEX = 'gracc.osg.raw'
+DEFAULT_METRICS = ['CoreHours', 'Njobs']
+DEFAULT_PAGE_SIZE = 5000
+# Rows per block when aggregating without numpy
+BLOCK_ROWS = 65536
+
+_NAME_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_.]*$')
+_SWAP = sys.byteorder != 'little'   # Column files are little-endian
+
+
+class ColumnStore(object):
+    """Daily columnar files of raw records
+
+    :param str path: Directory of the store
+    :param list dimensions: String fields to keep (e.g. ['OIM_Site',
+        'VOName', 'CommonName'])
+    :param list metrics: Numeric fields to keep
+    :param str index: Index (pattern) to scan records from
+    :param str time_field: Date field used to assign records to days
+    :param int page_size: Hits per search_after page when scanning
+    """
+    def __init__(self, path, dimensions, metrics=None, index=DEFAULT_INDEX,
+                 time_field='EndTime', page_size=DEFAULT_PAGE_SIZE):
+        self.metrics = list(metrics) if metrics is not None \
+            else list(DEFAULT_METRICS)
+        self.dimensions = list(dimensions)
+        for name in self.dimensions + self.metrics:
+            if not _NAME_RE.match(name):
+                raise ValueError("Invalid column name {0}".format(name))
+        self.index = index
+        self.time_field = time_field
+        self.page_size = page_size
+        # One directory per distinct store definition
+        self.path = os.path.join(path, 'columns_{0}'.format(hashlib.md5(
+            json.dumps([index, time_field, self.dimensions,
+                        self.metrics])).hexdigest()[:12]))
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def days(self):
+        """Days in the store
+
+        :return list: Day strings (YYYY-MM-DD) in order
+        """
+        return sorted(d for d in os.listdir(self.path)
+                      if not d.startswith('.'))
+
+    def refresh(self, client, start, end, execute=None):
+        """Make sure the store holds up-to-date records for every day
+        touched by [start, end).  Only days whose fingerprint changed since
+        they were last scanned are scanned again.
+
+        :param client: elasticsearch.Elasticsearch client
+        :param datetime start: Start of range (UTC)
+        :param datetime end: End of range (UTC)
+        :param execute: Function that takes a Search and returns a Response
+            (e.g. Reporter.executor.execute).  Defaults to Search.execute
+        :return list: Days (YYYY-MM-DD) that were (re)scanned
+        """
+        days = day_list(start, end)
+        if not days:
+            return []
+        fingerprints = self.__fetch_fingerprints(client, days, execute)
+        stale = [d for d in days
+                 if self.__meta(d).get('fingerprint') != fingerprints.get(d)]
+        for day in stale:
+            if fingerprints.get(day) is None:
+                # No records any more
+                rmtree(os.path.join(self.path, day), ignore_errors=True)
+                continue
+            self.__scan_day(client, day, fingerprints[day], execute)
+        return stale
+
+    def aggregate(self, start, end, group_by, metrics=None, where=None):
+        """Sum metrics over the records in [start, end), grouped by some of
+        the store's dimensions
+
+        :param datetime start: Start of range (UTC)
+        :param datetime end: End of range (UTC)
+        :param list group_by: Dimensions to group by
+        :param list metrics: Metrics to sum.  Defaults to all of them
+        :param dict where: {dimension: value or list of values} to filter on
+        :return list: Tuples of (group_by values..., metric sums...), ordered
+            by the group_by values
+        """
+        metrics = metrics if metrics is not None else self.metrics
+        for name in list(group_by) + list(where or {}):
+            if name not in self.dimensions:
+                raise ValueError("{0} is not a dimension of this column "
+                                 "store".format(name))
+        for name in metrics:
+            if name not in self.metrics:
+                raise ValueError("{0} is not a metric of this column "
+                                 "store".format(name))
+        where = dict((k, set(v) if isinstance(v, (list, tuple, set))
+                      else set([v])) for k, v in (where or {}).iteritems())
+        lo, hi = _epoch(start), _epoch(end)
+
+        totals = {}
+        for day in day_list(start, end):
+            d = _Day(os.path.join(self.path, day))
+            if d.meta is None or not d.meta['rows']:
+                continue
+            # Only the days at the ends of the range need a time filter
+            day_lo = timegm(datetime.strptime(day, '%Y-%m-%d').timetuple())
+            times = (lo, hi) if lo > day_lo or hi < day_lo + 86400 else None
+            try:
+                groups = d.group_sums(group_by, metrics, where, times)
+            finally:
+                d.close()
+            for key, sums in groups.iteritems():
+                total = totals.get(key)
+                if total is None:
+                    totals[key] = list(sums)
+                else:
+                    for i, value in enumerate(sums):
+                        total[i] += value
+        return [key + tuple(sums) for key, sums in sorted(totals.iteritems())]
+
+    def columns(self, start, end, group_by, metrics=None, where=None):
+        """Same as aggregate, but return the result as a dict of columns,
+        ready to be returned by Reporter.format_report
+
+        :return dict: {column name: [values]}
+        """
+        metrics = metrics if metrics is not None else self.metrics
+        names = list(group_by) + list(metrics)
+        cols = dict((name, []) for name in names)
+        for row in self.aggregate(start, end, group_by, metrics, where):
+            for name, value in zip(names, row):
+                cols[name].append(value)
+        return cols
+
+    # Non-public methods
+    def __meta(self, day):
+        try:
+            with open(os.path.join(self.path, day, 'meta.json')) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def __day_search(self, client, start, end):
+        return Search(using=client, index=self.index).filter(
+            'range', **{self.time_field: {'gte': start.isoformat(),
+                                          'lt': end.isoformat()}})
+
+    def __fetch_fingerprints(self, client, days, execute):
+        """Get {day: fingerprint} for days, where the fingerprint is the
+        day's doc count and metric sums"""
+        start = datetime.strptime(days[0], '%Y-%m-%d')
+        end = datetime.strptime(days[-1], '%Y-%m-%d') + timedelta(days=1)
+        s = self.__day_search(client, start, end)[0:0]
+        daily = s.aggs.bucket('day', 'date_histogram', field=self.time_field,
+                              interval='day')
+        for m in self.metrics:
+            daily.metric(m, 'sum', field=m)
+        response = (execute(s) if execute is not None else s.execute())\
+            .to_dict()
+
+        fingerprints = {}
+        for b in response['aggregations']['day']['buckets']:
+            if b['doc_count']:
+                fingerprints[epoch_ms_to_day(b['key'])] = json.dumps(
+                    [b['doc_count']] + [round(b[m]['value'] or 0, 6)
+                                        for m in self.metrics])
+        return fingerprints
+
+    def __scan_day(self, client, day, fingerprint, execute):
+        """Scan one day's records into a new day directory"""
+        start = datetime.strptime(day, '%Y-%m-%d')
+        s = self.__day_search(client, start, start + timedelta(days=1))\
+            .source([self.time_field] + self.dimensions + self.metrics)
+        writer = _DayWriter(self.path, day, self.time_field, self.dimensions,
+                            self.metrics)
+        try:
+            for hits, _ in search_after_pages(
+                    s, sort=(self.time_field, '_uid'), size=self.page_size,
+                    execute=execute):
+                writer.append(hits)
+            writer.finish(fingerprint)
+        except BaseException:
+            writer.abort()
+            raise
+
+
+class _DayWriter(object):
+    """Writes one day's column files into a temporary directory, and moves
+    it into place when done"""
+    def __init__(self, path, day, time_field, dimensions, metrics):
+        self.path = path
+        self.day = day
+        self.time_field = time_field
+        self.dimensions = dimensions
+        self.metrics = metrics
+        self.rows = 0
+        self.dictionaries = [{} for _ in dimensions]
+        self.tmpdir = tempfile.mkdtemp(dir=path, prefix='.{0}.'.format(day))
+        self.files = {'time': open(os.path.join(self.tmpdir, 'time.f8'), 'wb')}
+        for i in range(len(metrics)):
+            self.files['m{0}'.format(i)] = open(
+                os.path.join(self.tmpdir, 'm{0}.f8'.format(i)), 'wb')
+        for i in range(len(dimensions)):
+            self.files['d{0}'.format(i)] = open(
+                os.path.join(self.tmpdir, 'd{0}.i4'.format(i)), 'wb')
+
+    def append(self, hits):
+        """Append a page of hit dicts to the columns"""
+        _write(self.files['time'], array.array(
+            'd', (_epoch(h.get(self.time_field)) for h in hits)))
+        for i, name in enumerate(self.metrics):
+            _write(self.files['m{0}'.format(i)], array.array(
+                'd', (h.get(name) or 0.0 for h in hits)))
+        for i, name in enumerate(self.dimensions):
+            codes = self.dictionaries[i]
+            col = array.array('i')
+            for h in hits:
+                value = h.get(name)
+                value = MISSING if value is None else value
+                code = codes.get(value)
+                if code is None:
+                    code = codes[value] = len(codes)
+                col.append(code)
+            _write(self.files['d{0}'.format(i)], col)
+        self.rows += len(hits)
+
+    def finish(self, fingerprint):
+        for f in self.files.itervalues():
+            f.close()
+        meta = {'rows': self.rows, 'fingerprint': fingerprint,
+                'metrics': self.metrics, 'dimensions': self.dimensions,
+                'dictionaries': [sorted(d, key=d.get)
+                                 for d in self.dictionaries]}
+        with open(os.path.join(self.tmpdir, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        dest = os.path.join(self.path, self.day)
+        if os.path.exists(dest):
+            old = tempfile.mkdtemp(dir=self.path, prefix='.old.')
+            os.rename(dest, os.path.join(old, self.day))
+            os.rename(self.tmpdir, dest)
+            rmtree(old)
+        else:
+            os.rename(self.tmpdir, dest)
+
+    def abort(self):
+        for f in self.files.itervalues():
+            f.close()
+        rmtree(self.tmpdir, ignore_errors=True)
+
+
+class _Day(object):
+    """Memory-mapped columns of one day"""
+    def __init__(self, path):
+        self.path = path
+        self._maps = []
+        try:
+            with open(os.path.join(path, 'meta.json')) as f:
+                self.meta = json.load(f)
+        except (IOError, ValueError):
+            self.meta = None
+
+    def column(self, fname):
+        """mmap of a column file"""
+        with open(os.path.join(self.path, fname), 'rb') as f:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(m)
+        return m
+
+    def close(self):
+        for m in self._maps:
+            m.close()
+        self._maps = []
+
+    def group_sums(self, group_by, metrics, where, times):
+        """Sum metrics by the group_by values
+
+        :param list group_by: Dimension names
+        :param list metrics: Metric names
+        :param dict where: {dimension: set of values}
+        :param tuple times: (lo, hi) epoch seconds to keep, or None for all
+        :return dict: {tuple of group_by values: [metric sums]}
+        """
+        dims = self.meta['dimensions']
+        mets = self.meta['metrics']
+        dicts = self.meta['dictionaries']
+        group_idx = [dims.index(g) for g in group_by]
+        metric_files = ['m{0}.f8'.format(mets.index(m)) for m in metrics]
+        # Filters as sets of codes.  A value that isn't in the day's
+        # dictionary matches nothing.
+        filters = []
+        for name, values in sorted(where.iteritems()):
+            i = dims.index(name)
+            codes = set(c for c, v in enumerate(dicts[i]) if v in values)
+            if not codes:
+                return {}
+            filters.append(('d{0}.i4'.format(i), codes))
+
+        agg = _group_sums_numpy if numpy is not None else _group_sums_blocks
+        sums = agg(self, ['d{0}.i4'.format(i) for i in group_idx],
+                   [len(dicts[i]) for i in group_idx], metric_files, filters,
+                   times)
+        return dict((tuple(dicts[i][c] for i, c in zip(group_idx, codes)),
+                     values) for codes, values in sums.iteritems())
+
+
+def _group_sums_numpy(day, group_files, cards, metric_files, filters, times):
+    """Vectorized group-by sums with numpy
+
+    :return dict: {tuple of group codes: [metric sums]}
+    """
+    rows = day.meta['rows']
+
+    def col(fname, dtype):
+        return numpy.frombuffer(day.column(fname), dtype=dtype, count=rows)
+
+    mask = None
+    if times is not None:
+        t = col('time.f8', '<f8')
+        mask = (t >= times[0]) & (t < times[1])
+    for fname, codes in filters:
+        m = numpy.in1d(col(fname, '<i4'), numpy.array(sorted(codes)))
+        mask = m if mask is None else mask & m
+    selected = numpy.flatnonzero(mask) if mask is not None else None
+
+    def pick(a):
+        return a if selected is None else a[selected]
+
+    # Combine the group codes into one integer key per row
+    group_cols = [pick(col(f, '<i4')) for f in group_files]
+    nrows = rows if selected is None else len(selected)
+    if not nrows:
+        return {}
+    key = numpy.zeros(nrows, dtype=numpy.int64)
+    span = 1
+    for codes, card in zip(group_cols, cards):
+        if span * card >= 2 ** 62:
+            # Renumber the combined keys densely before they overflow
+            key = numpy.unique(key, return_inverse=True)[1].astype(
+                numpy.int64)
+            span = int(key.max()) + 1
+        key = key * card + codes
+        span *= card
+    uniq, first, inverse = numpy.unique(key, return_index=True,
+                                        return_inverse=True)
+    sums = [numpy.bincount(inverse, weights=pick(col(f, '<f8')),
+                           minlength=len(uniq)) for f in metric_files]
+    groups = zip(*[codes[first].tolist() for codes in group_cols]) \
+        if group_cols else [()] * len(uniq)
+    return dict((g, [float(s[i]) for s in sums])
+                for i, g in enumerate(groups))
+
+
+def _group_sums_blocks(day, group_files, cards, metric_files, filters,
+                       times):
+    """Group-by sums reading the columns in blocks with the array module
+
+    :return dict: {tuple of group codes: [metric sums]}
+    """
+    rows = day.meta['rows']
+    maps = dict((f, day.column(f)) for f in
+                set(group_files + metric_files + [f for f, _ in filters] +
+                    (['time.f8'] if times is not None else [])))
+    sums = {}
+    nmetrics = len(metric_files)
+    for start in xrange(0, rows, BLOCK_ROWS):
+        end = min(start + BLOCK_ROWS, rows)
+
+        def block(fname):
+            a = array.array('d' if fname.endswith('.f8') else 'i')
+            a.fromstring(maps[fname][start * a.itemsize:end * a.itemsize])
+            if _SWAP:
+                a.byteswap()
+            return a
+
+        keep = None
+        if times is not None:
+            lo, hi = times
+            keep = [lo <= t < hi for t in block('time.f8')]
+        for fname, codes in filters:
+            col = block(fname)
+            keep = [c in codes for c in col] if keep is None else \
+                [k and c in codes for k, c in zip(keep, col)]
+        groups = zip(*[block(f) for f in group_files]) if group_files \
+            else [()] * (end - start)
+        values = zip(*[block(f) for f in metric_files]) if metric_files \
+            else [()] * (end - start)
+        for i, (g, v) in enumerate(zip(groups, values)):
+            if keep is not None and not keep[i]:
+                continue
+            total = sums.get(g)
+            if total is None:
+                sums[g] = list(v) if nmetrics else []
+            else:
+                for j in xrange(nmetrics):
+                    total[j] += v[j]
+    return sums
+
+
+def _write(f, a):
+    """Write an array to a column file, little-endian"""
+    if _SWAP:
+        a.byteswap()
+    f.write(a.tostring())
+
+
+def _epoch(value):
+    """Convert a datetime, date string, or epoch ms number to epoch seconds.
+    Naive datetimes are UTC"""
+    if value is None:
+        return 0.0
+    if isinstance(value, (int, long, float)):
+        return value / 1000.0
+    if not isinstance(value, datetime):
+        value = parser.parse(value)
+    if value.tzinfo is not None:
+        value = value.astimezone(tz.tzutc()).replace(tzinfo=None)
+    return timegm(value.timetuple()) + value.microsecond / 1e6
@@ -0,0 +1,267 @@
+"""Named intermediate datasets shared between reports.  A dataset is a query
+(a function of a Reporter returning a Search) plus a function that turns the
+query's results, and the values of any datasets it depends on, into a value.
+Reports list the datasets they use in their `datasets` class attribute and
+get them with Reporter.dataset(name).
+
+Run on its own, a report computes the datasets it needs itself.  Run in a
+batch with DatasetRunner, each dataset is computed once per time window,
+index pattern and VO, in dependency order, and shared in memory by every
+report that uses it, then dropped once the last of those reports has run.
+
+    def site_vo_query(report):
+        s = Search(using=report.client, index=report.indexpattern)...
+        return s
+
+    @Datasets.dataset('corehours_by_site_vo', query=site_vo_query)
+    def corehours_by_site_vo(results, deps):
+        return dict(((b.key, vo.key), vo.CoreHours.value) for b in ...)
+
+    class SiteReport(Reporter):
+        datasets = ('corehours_by_site_vo', )
+        ...
+        data = self.dataset('corehours_by_site_vo')
+"""
+
+import logging
+import traceback
+
+_registry = {}
+
+
+class Dataset(object):
+    """A named intermediate dataset
+
+    :param str name: Name of dataset
+    :param query: Function taking a Reporter and returning the Search to run,
+        or None for datasets computed only from other datasets
+    :param process: Function taking (query results, {dependency name:
+        value}) and returning the dataset's value.  If None, the query
+        results themselves are the value
+    :param depends: Names of datasets this one is computed from
+    """
+    def __init__(self, name, query=None, process=None, depends=()):
+        if query is None and process is None:
+            raise ValueError("Dataset {0} needs a query or a process "
+                             "function".format(name))
+        self.name = name
+        self.query = query
+        self.process = process
+        self.depends = tuple(depends)
+
+    def compute(self, report, deps):
+        """Compute the dataset for a report's time range
+
+        :param Reporter report: Report whose client, time range, and index
+            pattern the query uses
+        :param dict deps: {name: value} of the datasets in self.depends
+        :return: Value of dataset
+        """
+        results = None
+        if self.query is not None:
+            results = report.run_query(
+                overridequery=lambda: self.query(report))
+        if self.process is None:
+            return results
+        return self.process(results, deps)
+
+
+def register(ds):
+    """Add a Dataset to the registry, replacing any with the same name
+
+    :param Dataset ds: Dataset
+    :return Dataset: ds
+    """
+    _registry[ds.name] = ds
+    return ds
+
+
+def dataset(name, query=None, depends=()):
+    """Decorator that registers the decorated function as the process
+    function of a dataset
+
+    :param str name: Name of dataset
+    :param query: Function taking a Reporter and returning a Search
+    :param depends: Names of datasets this one is computed from
+    """
+    def decorator(process):
+        register(Dataset(name, query=query, process=process, depends=depends))
+        return process
+    return decorator
+
+
+def get(name, registry=None):
+    """Look up a dataset by name
+
+    :param str name: Name of dataset
+    :param dict registry: {name: Dataset}.  Defaults to the module registry
+    :return Dataset:
+    """
+    registry = registry if registry is not None else _registry
+    try:
+        return registry[name]
+    except KeyError:
+        raise KeyError("No dataset named {0} is registered".format(name))
+
+
+def toposort(names, registry=None):
+    """Order datasets so that each one comes after its dependencies,
+    including the dependencies themselves
+
+    :param names: Names of datasets that are needed
+    :param dict registry: {name: Dataset}.  Defaults to the module registry
+    :return list: Dataset names, dependencies first
+    """
+    order = []
+    state = {}     # name -> 'visiting' or 'done'
+
+    def visit(name, path):
+        if state.get(name) == 'done':
+            return
+        if state.get(name) == 'visiting':
+            raise ValueError("Dataset dependency cycle: {0}".format(
+                ' -> '.join(path + [name])))
+        state[name] = 'visiting'
+        for dep in get(name, registry).depends:
+            visit(dep, path + [name])
+        state[name] = 'done'
+        order.append(name)
+
+    for name in names:
+        visit(name, [])
+    return order
+
+
+def compute(names, report, cache, registry=None):
+    """Compute datasets (and their dependencies) for a report, skipping any
+    already in cache
+
+    :param names: Names of datasets to compute
+    :param Reporter report: Report to run queries with
+    :param dict cache: {name: value}.  New values are added to it
+    :param dict registry: {name: Dataset}.  Defaults to the module registry
+    :return dict: cache
+    """
+    for name in toposort(names, registry):
+        if name not in cache:
+            ds = get(name, registry)
+            cache[name] = ds.compute(
+                report, dict((dep, cache[dep]) for dep in ds.depends))
+    return cache
+
+
+def report_scope(report):
+    """What a report's datasets depend on besides their names:  its time
+    window, index pattern, and VO.  Reports with the same scope share
+    datasets.
+
+    :param Reporter report: Report
+    :return tuple: (start_time, end_time, indexpattern, vo)
+    """
+    return (report.start_time, report.end_time, report.indexpattern,
+            report.vo)
+
+
+class DatasetRunner(object):
+    """Runs a batch of reports, computing the datasets they use once per
+    scope (time window, index pattern, and VO) and sharing them
+
+    :param list reports: Reporter instances, run in this order (after the
+        datasets they need)
+    :param dict registry: {name: Dataset}.  Defaults to the module registry
+    :param logger: logging.Logger
+    """
+    def __init__(self, reports, registry=None, logger=None):
+        self.reports = list(reports)
+        self.registry = registry
+        self.logger = logger or logging.getLogger('datasets')
+
+    def plan(self):
+        """Order of execution
+
+        :return list: ('dataset', name, scope) and ('report', index)
+            steps, where scope is a report's (start_time, end_time,
+            indexpattern, vo) (see report_scope).  Each dataset comes after
+            its dependencies, and each report after its datasets
+        """
+        steps = []
+        planned = set()
+        for i, report in enumerate(self.reports):
+            scope = report_scope(report)
+            for name in toposort(getattr(report, 'datasets', ()),
+                                 self.registry):
+                if (name, scope) not in planned:
+                    planned.add((name, scope))
+                    steps.append(('dataset', name, scope))
+            steps.append(('report', i))
+        return steps
+
+    def run(self):
+        """Compute the datasets and run the reports.  A failed dataset
+        fails the reports that need it, and a failed (or exiting) report
+        fails only itself, not the rest of the batch.
+
+        :return dict: {report index: exception} for reports that failed
+        """
+        steps = self.plan()
+        users = {}      # (name, scope) -> number of reports still to run
+        for i, report in enumerate(self.reports):
+            scope = report_scope(report)
+            for name in toposort(getattr(report, 'datasets', ()),
+                                 self.registry):
+                users[(name, scope)] = users.get((name, scope), 0) + 1
+
+        values = {}     # (name, scope) -> value
+        errors = {}     # (name, scope) -> exception
+        failures = {}
+        for step in steps:
+            if step[0] == 'dataset':
+                _, name, scope = step
+                ds = get(name, self.registry)
+                failed = [dep for dep in ds.depends if (dep, scope) in errors]
+                if failed:
+                    errors[(name, scope)] = errors[(failed[0], scope)]
+                    continue
+                host = self.__host_report(scope)
+                try:
+                    values[(name, scope)] = ds.compute(host, dict(
+                        (dep, values[(dep, scope)]) for dep in ds.depends))
+                    self.logger.info("Computed dataset {0} for {1} - "
+                                     "{2}".format(name, *scope[:2]))
+                except Exception as e:
+                    self.logger.error("Dataset {0} failed: {1}\n{2}".format(
+                        name, e, traceback.format_exc()))
+                    errors[(name, scope)] = e
+                continue
+
+            i = step[1]
+            report = self.reports[i]
+            scope = report_scope(report)
+            needed = toposort(getattr(report, 'datasets', ()), self.registry)
+            try:
+                for name in needed:
+                    if (name, scope) in errors:
+                        raise errors[(name, scope)]
+                report._datasets = dict((name, values[(name, scope)])
+                                        for name in needed)
+                with report.collect_metrics():
+                    report.run_report()
+            except (Exception, SystemExit) as e:
+                self.logger.error("Report {0} failed: {1}".format(
+                    report.report_type, e))
+                failures[i] = e
+            finally:
+                report._datasets = None
+                for name in needed:
+                    users[(name, scope)] -= 1
+                    if users[(name, scope)] == 0:
+                        values.pop((name, scope), None)
+        return failures
+
+    def __host_report(self, scope):
+        """First report with this scope, whose client runs the scope's
+        dataset queries"""
+        for report in self.reports:
+            if report_scope(report) == scope:
+                return report
+
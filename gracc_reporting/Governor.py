@@ -0,0 +1,300 @@
+"""Limits on the load all reports together put on Elasticsearch.  One
+Governor is shared by every Reporter in a process that has the same
+[governor] settings.  It caps the number of queries in flight and of open
+scroll contexts, and paces the queries sent to each host with a token
+bucket.  With lock_dir set, the caps and the token buckets are shared with
+every other process using the same directory, through lock files:  each
+in-flight query holds an flock on one of max_queries slot files, and each
+host's bucket is kept in a file updated under an flock.  Locks held by a
+process that dies are released by the kernel, so slots can't leak.
+
+[governor]
+    max_queries = 8         # Queries in flight at once
+    max_scrolls = 4         # Scroll contexts open at once
+    rate = 5.0              # Queries per second, per host
+    burst = 10              # Queries a host may get at once after idling
+    lock_dir = '/var/lib/gracc/governor'  # Share limits between processes
+    wait_timeout = 600      # Seconds to wait for a slot before giving up
+"""
+
+import errno
+import fcntl
+import os
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds between attempts to get a slot held by another process
+_POLL_INTERVAL = 0.05
+
+_governors = {}
+_governors_lock = threading.Lock()
+
+
+class GovernorTimeout(Exception):
+    """Waited longer than wait_timeout for a query or scroll slot"""
+    pass
+
+
+class TokenBucket(object):
+    """Token bucket rate limiter.  Thread safe, and shared between
+    processes if given a path.
+
+    :param float rate: Tokens added per second
+    :param float burst: Size of bucket
+    :param str path: File to keep the bucket in, so that every process
+        using the same file draws from the same bucket.  None keeps it in
+        memory
+    """
+    def __init__(self, rate, burst=None, path=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(rate, 1))
+        self.path = path
+        self.tokens = self.burst
+        self.updated = None
+        self._lock = threading.Lock()
+        self._clock = time.time
+        self._sleep = time.sleep
+
+    def acquire(self, tokens=1):
+        """Take tokens from the bucket, waiting for them if needed
+
+        :param float tokens: Tokens to take
+        :return float: Seconds waited
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                wait = self.__take(tokens)
+            if wait <= 0:
+                return waited
+            self._sleep(wait)
+            waited += wait
+
+    def __take(self, tokens):
+        """Take tokens if there are enough
+
+        :return float: 0 if the tokens were taken, otherwise seconds until
+            there will be enough
+        """
+        if self.path is None:
+            return self.__take_locked(tokens)
+        with open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    self.tokens, self.updated = \
+                        [float(v) for v in f.read().split()]
+                except ValueError:
+                    self.tokens, self.updated = self.burst, None
+                wait = self.__take_locked(tokens)
+                f.seek(0)
+                f.truncate()
+                f.write('{0!r} {1!r}\n'.format(self.tokens, self.updated))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return wait
+
+    def __take_locked(self, tokens):
+        now = self._clock()
+        if self.updated is not None:
+            self.tokens = min(self.burst, self.tokens +
+                              (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return 0.0
+        return (tokens - self.tokens) / self.rate
+
+
+class SlotDir(object):
+    """Counting semaphore shared between processes, made of slot files in a
+    directory.  A slot is held by holding an flock on its file.
+
+    :param str path: Directory for the slot files
+    :param str name: Prefix of slot file names
+    :param int slots: Number of slots
+    """
+    def __init__(self, path, name, slots):
+        _makedirs(path)
+        self.paths = [os.path.join(path, '{0}.{1}.lock'.format(name, i))
+                      for i in xrange(slots)]
+        self._sleep = time.sleep
+        self._clock = time.time
+
+    def acquire(self, timeout=None):
+        """Hold a free slot, waiting for one if needed
+
+        :param float timeout: Seconds to wait.  None waits forever
+        :return file: Open slot file, to pass to release
+        """
+        deadline = self._clock() + timeout if timeout is not None else None
+        while True:
+            # Start at a random slot, so that waiters don't all contend for
+            # the first one
+            first = random.randrange(len(self.paths))
+            for path in self.paths[first:] + self.paths[:first]:
+                f = open(path, 'a')
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return f
+                except IOError as e:
+                    f.close()
+                    if e.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+            if deadline is not None and self._clock() >= deadline:
+                raise GovernorTimeout("No free slot in {0} after {1}s".format(
+                    os.path.dirname(self.paths[0]), timeout))
+            self._sleep(_POLL_INTERVAL * random.uniform(0.5, 1.5))
+
+    @staticmethod
+    def release(f):
+        """Give up a slot
+
+        :param file f: Return value of acquire
+        """
+        fcntl.flock(f, fcntl.LOCK_UN)
+        f.close()
+
+
+class Governor(object):
+    """Caps in-flight queries and scroll contexts, and rate limits queries
+    per host
+
+    :param int max_queries: Queries in flight at once.  None for no cap
+    :param int max_scrolls: Scroll contexts open at once.  None for no cap
+    :param float rate: Queries per second per host.  None for no limit
+    :param float burst: Token bucket size.  Defaults to rate
+    :param str lock_dir: Directory of lock files to share the limits with
+        other processes.  None limits this process only
+    :param float wait_timeout: Seconds to wait for a slot before raising
+        GovernorTimeout.  None waits forever
+    """
+    def __init__(self, max_queries=None, max_scrolls=None, rate=None,
+                 burst=None, lock_dir=None, wait_timeout=None):
+        self.max_queries = max_queries
+        self.max_scrolls = max_scrolls
+        self.rate = rate
+        self.burst = burst
+        self.lock_dir = lock_dir
+        self.wait_timeout = wait_timeout
+        if lock_dir is not None:
+            # For the token bucket files, even without slot files
+            _makedirs(lock_dir)
+        self._queries = self.__semaphore('query', max_queries)
+        self._scrolls = self.__semaphore('scroll', max_scrolls)
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self.waited = 0.0     # Total seconds spent waiting on limits
+
+    def __semaphore(self, name, slots):
+        """In-process semaphore, and slot directory if lock_dir is set, for
+        a cap of slots"""
+        if slots is None:
+            return None
+        slot_dir = SlotDir(self.lock_dir, name, slots) \
+            if self.lock_dir is not None else None
+        return threading.BoundedSemaphore(slots), slot_dir
+
+    def bucket(self, host):
+        """Token bucket of a host, or None if there's no rate limit"""
+        if self.rate is None:
+            return None
+        with self._lock:
+            if host not in self._buckets:
+                path = os.path.join(self.lock_dir, 'rate.{0}'.format(
+                    re.sub(r'[^A-Za-z0-9_.-]', '_', host))) \
+                    if self.lock_dir is not None else None
+                self._buckets[host] = TokenBucket(self.rate, self.burst, path)
+            return self._buckets[host]
+
+    @contextmanager
+    def query(self, host='default'):
+        """Hold a query slot and a token of host's bucket for the block
+
+        :param str host: Host the query goes to
+        """
+        with self.__hold(self._queries):
+            bucket = self.bucket(host)
+            if bucket is not None:
+                waited = bucket.acquire()
+                with self._lock:
+                    self.waited += waited
+            yield
+
+    @contextmanager
+    def scroll(self, host='default'):
+        """Hold a scroll slot for the block, and take a token of host's
+        bucket to open the scroll
+
+        :param str host: Host the scroll is opened on
+        """
+        with self.__hold(self._scrolls):
+            bucket = self.bucket(host)
+            if bucket is not None:
+                waited = bucket.acquire()
+                with self._lock:
+                    self.waited += waited
+            yield
+
+    @contextmanager
+    def __hold(self, semaphore):
+        if semaphore is None:
+            yield
+            return
+        local, slot_dir = semaphore
+        t0 = time.time()
+        if self.wait_timeout is None:
+            local.acquire()
+        else:
+            # threading semaphores can't time out in python 2
+            while not local.acquire(False):
+                if time.time() - t0 >= self.wait_timeout:
+                    raise GovernorTimeout("No free slot after {0}s".format(
+                        self.wait_timeout))
+                time.sleep(_POLL_INTERVAL)
+        try:
+            f = None
+            if slot_dir is not None:
+                remaining = None if self.wait_timeout is None else \
+                    max(0, self.wait_timeout - (time.time() - t0))
+                f = slot_dir.acquire(remaining)
+            with self._lock:
+                self.waited += time.time() - t0
+            try:
+                yield
+            finally:
+                if f is not None:
+                    SlotDir.release(f)
+        finally:
+            local.release()
+
+
+def _makedirs(path):
+    """Create directory path if it doesn't exist yet"""
+    if not os.path.exists(path):
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+
+def get_governor(config):
+    """Governor shared by every report in this process with the same
+    settings
+
+    :param dict config: [governor] section of the config file
+    :return Governor: Governor, or None if the section is empty
+    """
+    if not config:
+        return None
+    key = tuple(sorted(config.iteritems()))
+    with _governors_lock:
+        if key not in _governors:
+            _governors[key] = Governor(**config)
+        return _governors[key]
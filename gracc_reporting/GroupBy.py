@@ -0,0 +1,210 @@
+"""Bounded-memory group-by for reports that scan raw records.  Records
+(e.g. hits from Search.scan()) are grouped by a set of key fields and reduced
+with sum, count, min, and max.  When the estimated size of the in-memory
+groups passes a memory ceiling, they're sorted and spilled to a temporary
+file.  At the end, the spilled runs are merged with what's left in memory."""
+
+import cPickle
+import heapq
+import os
+import sys
+import tempfile
+from itertools import groupby
+from operator import itemgetter
+
+DEFAULT_MEMORY_LIMIT = 256 * 1024 * 1024    # bytes
+_SPILL_CHUNK = 1000     # groups per pickle in spill files
+_DICT_ENTRY_OVERHEAD = 100     # rough bytes per dict slot
+
+
+def _add(a, b):
+    return a + b
+
+
+def _min(a, b):
+    return b if a is None else a if b is None else min(a, b)
+
+
+def _max(a, b):
+    return b if a is None else a if b is None else max(a, b)
+
+
+# reducer: (value for one record, function to combine two partial values)
+REDUCERS = {
+    'sum': (lambda v: v if v is not None else 0, _add),
+    'count': (lambda v: 1 if v is not None else 0, _add),
+    'min': (lambda v: v, _min),
+    'max': (lambda v: v, _max),
+}
+
+
+class ExternalGroupBy(object):
+    """Group records by key fields and reduce other fields, spilling sorted
+    partial results to disk to stay under a memory ceiling
+
+    :param list keys: Fields to group by
+    :param list reducers: (output name, reducer, field) tuples, where reducer
+        is one of 'sum', 'count', 'min', 'max'.  For 'count', field may be
+        None to count records
+    :param int memory_limit: Approximate maximum bytes to hold in memory
+    :param str tmpdir: Directory to write spill files to
+    """
+    def __init__(self, keys, reducers, memory_limit=DEFAULT_MEMORY_LIMIT,
+                 tmpdir=None):
+        for name, reducer, field in reducers:
+            if reducer not in REDUCERS:
+                raise ValueError("Invalid reducer {0} for {1}.  Must be one "
+                                 "of {2}".format(reducer, name,
+                                                 ', '.join(sorted(REDUCERS))))
+        self.keys = list(keys)
+        self.reducers = list(reducers)
+        self.memory_limit = memory_limit
+        self.tmpdir = tmpdir
+        self.header = self.keys + [name for name, _, _ in self.reducers]
+
+        self._inits = [REDUCERS[r][0] for _, r, _ in self.reducers]
+        self._combines = [REDUCERS[r][1] for _, r, _ in self.reducers]
+        self._fields = [f for _, _, f in self.reducers]
+        self._groups = {}
+        self._est_bytes = 0
+        self._runs = []
+        self.nrecords = 0
+
+    def __getstate__(self):
+        # The reducer functions can't be pickled.  They're looked up again
+        # from self.reducers on unpickling
+        state = self.__dict__.copy()
+        del state['_inits'], state['_combines']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._inits = [REDUCERS[r][0] for _, r, _ in self.reducers]
+        self._combines = [REDUCERS[r][1] for _, r, _ in self.reducers]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, record):
+        """Add a single record (dict or elasticsearch_dsl Hit)
+
+        :param record: Record to add
+        :return None:
+        """
+        key = tuple(_get(record, k) for k in self.keys)
+        values = [init(_get(record, f) if f is not None else True)
+                  for init, f in zip(self._inits, self._fields)]
+        self.nrecords += 1
+
+        current = self._groups.get(key)
+        if current is None:
+            self._groups[key] = values
+            self._est_bytes += _estimate_size(key, values)
+            if self._est_bytes > self.memory_limit:
+                self.spill()
+        else:
+            self._groups[key] = [c(a, b) for c, a, b in
+                                 zip(self._combines, current, values)]
+
+    def consume(self, records):
+        """Add all records from an iterable (e.g. Search.scan())
+
+        :param records: Iterable of records
+        :return ExternalGroupBy: self, for chaining
+        """
+        for record in records:
+            self.add(record)
+        return self
+
+    def spill(self):
+        """Write the in-memory groups, sorted by key, to a temporary file
+        and clear them from memory
+
+        :return None:
+        """
+        if not self._groups:
+            return
+        fd, path = tempfile.mkstemp(prefix='gracc-groupby-', suffix='.run',
+                                    dir=self.tmpdir)
+        with os.fdopen(fd, 'wb') as f:
+            items = sorted(self._groups.iteritems(), key=itemgetter(0))
+            for i in xrange(0, len(items), _SPILL_CHUNK):
+                cPickle.dump(items[i:i + _SPILL_CHUNK], f,
+                             cPickle.HIGHEST_PROTOCOL)
+        self._runs.append(path)
+        self._groups = {}
+        self._est_bytes = 0
+
+    @property
+    def nruns(self):
+        """Number of runs spilled to disk so far"""
+        return len(self._runs)
+
+    def results(self):
+        """Merge spilled runs and in-memory groups
+
+        :return generator: (key tuple, list of reduced values), in key order
+        """
+        sources = [_read_run(path) for path in self._runs]
+        sources.append(iter(sorted(self._groups.iteritems(),
+                                   key=itemgetter(0))))
+        for key, items in groupby(heapq.merge(*sources), key=itemgetter(0)):
+            values = None
+            for _, v in items:
+                values = v if values is None else \
+                    [c(a, b) for c, a, b in zip(self._combines, values, v)]
+            yield key, values
+
+    def columns(self):
+        """Merged results as a dict of columns, keyed by key field and
+        reducer output name (self.header), ready to be returned by
+        Reporter.format_report
+
+        :return dict: {column name: [values]}
+        """
+        cols = dict((name, []) for name in self.header)
+        for key, values in self.results():
+            for name, value in zip(self.header, key + tuple(values)):
+                cols[name].append(value)
+        return cols
+
+    def close(self):
+        """Remove any spill files and drop in-memory groups"""
+        for path in self._runs:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self._runs = []
+        self._groups = {}
+        self._est_bytes = 0
+
+
+def _get(record, field):
+    """Get a field from a dict or an elasticsearch_dsl Hit, or None"""
+    try:
+        return record[field]
+    except KeyError:
+        return None
+
+
+def _estimate_size(key, values):
+    """Rough estimate of the memory used by one group"""
+    return (sys.getsizeof(key) + sum(sys.getsizeof(k) for k in key) +
+            sys.getsizeof(values) + sum(sys.getsizeof(v) for v in values) +
+            _DICT_ENTRY_OVERHEAD)
+
+
+def _read_run(path):
+    """Generator over the (key, values) items of a spill file"""
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                chunk = cPickle.load(f)
+            except EOFError:
+                return
+            for item in chunk:
+                yield item
@@ -0,0 +1,237 @@
+"""Catalog of the indices that exist on the cluster, so that a report's index
+pattern can be narrowed down to exactly the indices that hold data for its
+time range.  The catalog comes from _cat/indices (name, open/closed, doc
+count) plus a terms aggregation on _index for the minimum and maximum of the
+time field in each index, and is cached in a local JSON file for ttl
+seconds.
+
+A cached catalog can be out of date:  indices still being written to have
+newer data than their cached maximum, and indices created since the fetch
+are missing.  So the newest index of each pattern, and any index whose
+maximum is within ttl of the fetch, are taken to hold data up to now, and
+ranges that end after the fetch use the pattern as-is."""
+
+import json
+import os
+import re
+import time
+from calendar import timegm
+from fnmatch import fnmatch
+
+from elasticsearch_dsl import Search
+
+DEFAULT_TTL = 3600      # seconds
+# Longest comma-separated index list to send.  Longer lists would make the
+# request line too long, so the wildcard pattern is used instead
+MAX_INDEX_LIST_CHARS = 3000
+
+
+class IndexCatalog(object):
+    """Cached list of the indices on a cluster
+
+    :param client: elasticsearch.Elasticsearch client
+    :param str cache_path: JSON file to cache the catalog in.  None disables
+        caching
+    :param int ttl: Seconds before the cached catalog is fetched again
+    :param str time_field: Field whose min and max are recorded per index
+    :param str pattern: Indices to catalog
+    :param str cache_key: Identifies the cluster (e.g. its URL), so that a
+        cache written for another cluster isn't used
+    :param execute: Function that takes a Search and returns a Response
+        (e.g. Reporter.executor.execute), for the min/max query.  Defaults
+        to Search.execute
+    """
+    def __init__(self, client, cache_path=None, ttl=DEFAULT_TTL,
+                 time_field='EndTime', pattern='*', cache_key=None,
+                 execute=None):
+        self.client = client
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.time_field = time_field
+        self.pattern = pattern
+        self.cache_key = cache_key
+        self.execute = execute
+        self.fetched = None     # Epoch seconds the catalog was fetched at
+        self._indices = None
+
+    def indices(self, refresh=False):
+        """The catalog, from memory, the cache file, or the cluster
+
+        :param bool refresh: Fetch from the cluster even if the cache is
+            fresh
+        :return dict: {index name: {'status': 'open' or 'close', 'docs': int,
+            'min': epoch ms or None, 'max': epoch ms or None}}
+        """
+        if not refresh:
+            if self._indices is None:
+                self._indices = self.__load_cache()
+            if self._indices is not None:
+                return self._indices
+        self._indices = self.fetch()
+        self.fetched = time.time()
+        self.__save_cache(self._indices)
+        return self._indices
+
+    def fetch(self):
+        """Fetch the catalog from the cluster
+
+        :return dict: See indices()
+        """
+        rows = self.client.cat.indices(index=self.pattern, format='json',
+                                       h='index,status,docs.count')
+        catalog = {}
+        for row in rows:
+            try:
+                docs = int(row.get('docs.count') or 0)
+            except ValueError:
+                docs = 0
+            catalog[row['index']] = {'status': row.get('status', 'open'),
+                                     'docs': docs, 'min': None, 'max': None}
+
+        searchable = [name for name, info in catalog.iteritems()
+                      if info['status'] == 'open' and info['docs'] > 0]
+        if searchable:
+            body = {'size': 0, 'aggs': {'indices': {
+                'terms': {'field': '_index', 'size': len(searchable)},
+                'aggs': {'min': {'min': {'field': self.time_field}},
+                         'max': {'max': {'field': self.time_field}}}}}}
+            s = Search(using=self.client, index=self.pattern)\
+                .update_from_dict(body).params(ignore_unavailable=True)
+            response = (self.execute(s) if self.execute is not None
+                        else s.execute()).to_dict()
+            for b in response['aggregations']['indices']['buckets']:
+                if b['key'] in catalog:
+                    catalog[b['key']]['min'] = _as_int(b['min']['value'])
+                    catalog[b['key']]['max'] = _as_int(b['max']['value'])
+        return catalog
+
+    def resolve(self, pattern, start, end):
+        """Indices matching pattern that are open and hold data in
+        [start, end).  Indices without the time field are kept if they have
+        any documents.  Indices that may still be written to (the newest
+        matching each part of pattern, and those with data from within ttl
+        of the fetch) are taken to hold data up to now.
+
+        :param str pattern: Index pattern, possibly with wildcards and commas
+        :param datetime start: Start of range (UTC)
+        :param datetime end: End of range (UTC)
+        :return list: Sorted index names
+        """
+        start_ms, end_ms = _epoch_ms(start), _epoch_ms(end)
+        globs = [p.strip() for p in pattern.split(',') if p.strip()]
+        indices = self.indices()
+        live_ms = (self.fetched - self.ttl) * 1000 \
+            if self.fetched is not None else None
+        newest = set()
+        for g in globs:
+            maxes = [(info['max'], name) for name, info in indices.iteritems()
+                     if fnmatch(name, g) and info['max'] is not None]
+            if maxes:
+                newest.add(max(maxes)[1])
+
+        resolved = []
+        for name, info in indices.iteritems():
+            if not any(fnmatch(name, g) for g in globs):
+                continue
+            if info['status'] != 'open' or info['docs'] == 0:
+                continue
+            if info['min'] is not None and info['min'] >= end_ms:
+                continue
+            live = name in newest or (live_ms is not None and
+                                      info['max'] is not None and
+                                      info['max'] >= live_ms)
+            if info['max'] is not None and info['max'] < start_ms and \
+                    not live:
+                continue
+            resolved.append(name)
+        return sorted(resolved)
+
+    def index_pattern(self, pattern, start, end, logger=None):
+        """Narrow an index pattern down to the indices that hold data in
+        [start, end), as a comma-separated list.  Falls back to pattern
+        itself if no catalogued index matches (e.g. it's an alias), the
+        list would be too long, or the range ends after the catalog was
+        fetched (indices may have been created since).
+
+        :param str pattern: Index pattern
+        :param datetime start: Start of range (UTC)
+        :param datetime end: End of range (UTC)
+        :param logger: logging.Logger for debug messages
+        :return str: Index pattern to pass to Elasticsearch
+        """
+        resolved = self.resolve(pattern, start, end)
+        if self.fetched is None or _epoch_ms(end) > self.fetched * 1000:
+            if logger is not None:
+                logger.debug("{0} ends after the index catalog was fetched."
+                             "  Using the pattern as-is".format(end))
+            return pattern
+        joined = ','.join(resolved)
+        if not resolved:
+            if logger is not None:
+                logger.warning("No catalogued indices matching {0} hold data "
+                               "between {1} and {2}.  Using the pattern "
+                               "as-is".format(pattern, start, end))
+            return pattern
+        if len(joined) > MAX_INDEX_LIST_CHARS:
+            if logger is not None:
+                logger.debug("{0} indices match {1}.  Using the pattern "
+                             "as-is".format(len(resolved), pattern))
+            return pattern
+        return joined
+
+    def __load_cache(self):
+        """Catalog from the cache file, or None if it's missing or stale"""
+        if self.cache_path is None:
+            return None
+        try:
+            with open(self.cache_path, 'r') as f:
+                cached = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if cached.get('cache_key') != self.cache_key or \
+                cached.get('pattern') != self.pattern or \
+                cached.get('time_field') != self.time_field or \
+                time.time() - cached.get('fetched', 0) > self.ttl:
+            return None
+        self.fetched = cached['fetched']
+        return cached['indices']
+
+    def __save_cache(self, catalog):
+        """Write the catalog to the cache file"""
+        if self.cache_path is None:
+            return
+        dirname = os.path.dirname(os.path.abspath(self.cache_path))
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        tmp = '{0}.tmp'.format(self.cache_path)
+        with open(tmp, 'w') as f:
+            json.dump({'fetched': self.fetched, 'cache_key': self.cache_key,
+                       'pattern': self.pattern,
+                       'time_field': self.time_field, 'indices': catalog},
+                      f, sort_keys=True, indent=2)
+        os.rename(tmp, self.cache_path)
+
+
+def catalog_pattern(patterns):
+    """Pattern of the indices to catalog for some index patterns:  their
+    date parts (strftime codes) become wildcards
+
+    :param list patterns: Index patterns, e.g. ['gracc.osg.raw-%Y.%m']
+    :return str: Comma-separated pattern, e.g. 'gracc.osg.raw-*'
+    """
+    globs = []
+    for pattern in patterns:
+        for p in pattern.split(','):
+            glob = re.sub(r'\*(?:[._-]?\*)+', '*', re.sub(r'%.', '*', p.strip()))
+            if glob and glob not in globs:
+                globs.append(glob)
+    return ','.join(globs)
+
+
+def _epoch_ms(dt):
+    """Epoch milliseconds of a UTC (or naive UTC) datetime"""
+    return timegm(dt.utctimetuple()) * 1000 + dt.microsecond // 1000
+
+
+def _as_int(value):
+    return int(value) if value is not None else None
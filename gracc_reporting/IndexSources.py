@@ -0,0 +1,205 @@
+"""Choosing between several index patterns that hold the same data at
+different costs, e.g. the small daily summary index and the large raw
+indices.  Each IndexSource says which fields it has, the time granularity of
+its records, how far behind real time it lags, and its relative cost.
+plan_sources picks the cheapest sources that can answer a query over a time
+range, splitting the range where a cheap source can only answer part of it
+(e.g. the summary index can't answer partial days, or the last days that
+haven't been summarized yet).  The source with the least lag (usually the
+raw indices) answers whatever is left up to the end of the range, even past
+its lag or its latest record:  lag and known data ends only decide which
+source answers which part."""
+
+import re
+from calendar import timegm
+from datetime import datetime, timedelta
+from fnmatch import fnmatch
+
+from dateutil import tz
+
+from TimeUtils import parse_duration, epoch_to_datetime
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=tz.tzutc())
+
+
+class NoIndexSourceError(ValueError):
+    """Raised when no configured source can answer part of a range"""
+    pass
+
+
+class IndexSource(object):
+    """One index pattern that queries can be sent to
+
+    :param str pattern: Index pattern.  May be date-dependent (see
+        IndexPattern.indexpattern_generate)
+    :param list fields: Fields the records have.  None means all fields
+    :param str granularity: Time resolution of the records (e.g. '1d' for a
+        daily summary), as a duration.  None means exact
+    :param str lag: How far behind now the most recent complete data is
+    :param float cost: Relative cost of querying.  Cheaper sources are
+        preferred
+    """
+    def __init__(self, pattern, fields=None, granularity=None, lag=None,
+                 cost=1.0):
+        self.pattern = pattern
+        self.fields = frozenset(fields) if fields is not None else None
+        self.granularity = parse_duration(granularity) \
+            if granularity is not None else None
+        self.lag = parse_duration(lag) if lag is not None else timedelta(0)
+        self.cost = cost
+
+    @classmethod
+    def from_config(cls, cfg):
+        """Build an IndexSource from a config table
+
+        :param dict cfg: Table with pattern, and optionally fields,
+            granularity, lag, cost
+        :return IndexSource:
+        """
+        try:
+            return cls(**cfg)
+        except TypeError as e:
+            raise ValueError("Invalid index source {0}: {1}".format(cfg, e))
+
+    def provides(self, fields=None, granularity=None):
+        """Can this source answer a query that needs fields, bucketed by
+        granularity?
+
+        :param list fields: Fields the query uses.  None means unknown, which
+            only sources with all fields can answer
+        :param timedelta granularity: Finest time bucket of the query (e.g. a
+            date_histogram interval).  None means no time bucketing
+        :return bool:
+        """
+        if self.fields is not None and \
+                (fields is None or not set(fields) <= self.fields):
+            return False
+        if self.granularity is not None and granularity is not None and \
+                _seconds(granularity) % _seconds(self.granularity) != 0:
+            return False
+        return True
+
+    def usable_range(self, start, end, now=None, available_until=None,
+                     open_ended=False):
+        """Part of [start, end) this source can answer:  whole granules,
+        and nothing after its lag
+
+        :param datetime start: Start of range (UTC)
+        :param datetime end: End of range (UTC)
+        :param datetime now: Current time (UTC)
+        :param datetime available_until: End of the source's data, if known
+            (e.g. from IndexCatalog).  Otherwise, now - lag
+        :param bool open_ended: Answer up to end, whatever the lag or end of
+            data (see freshest)
+        :return tuple: (start, end), or None if there's no such part
+        """
+        if open_ended:
+            limit = end
+        elif available_until is not None:
+            limit = available_until
+        else:
+            limit = (now or datetime.now(tz.tzutc())) - self.lag
+        a, b = start, min(end, limit)
+        if self.granularity is not None:
+            a = _ceil(a, self.granularity)
+            b = _floor(b, self.granularity)
+        if a >= b:
+            return None
+        return a, b
+
+
+def freshest(sources):
+    """The source with the least lag (exact records before granular ones,
+    then the cheapest).  It answers ranges up to now, as data that hasn't
+    arrived anywhere yet can't come from any other source either.
+
+    :param list sources: IndexSources
+    :return IndexSource: Source, or None if there are no sources
+    """
+    if not sources:
+        return None
+    return min(sources, key=lambda s: (s.lag, s.granularity is not None,
+                                       s.cost))
+
+
+def plan_sources(sources, start, end, fields=None, granularity=None,
+                 now=None, available=None):
+    """Cover [start, end) with the cheapest sources that can answer the
+    query.  The cheapest source takes the largest part of the range it can,
+    and the rest is covered by the next cheapest sources.  The freshest of
+    them takes the rest up to end, even if that's after now.
+
+    :param list sources: IndexSources
+    :param datetime start: Start of range (UTC)
+    :param datetime end: End of range (UTC)
+    :param list fields: Fields the query uses
+    :param timedelta granularity: Finest time bucket of the query
+    :param datetime now: Current time (UTC)
+    :param dict available: {pattern: datetime} known ends of sources' data
+    :return list: (IndexSource, start, end) pieces, in time order
+    """
+    candidates = sorted((s for s in sources if s.provides(fields,
+                                                          granularity)),
+                        key=lambda s: s.cost)
+    available = available or {}
+    fresh = freshest(candidates)
+
+    def plan(a, b, candidates):
+        if a >= b:
+            return []
+        for i, source in enumerate(candidates):
+            rng = source.usable_range(a, b, now,
+                                      available.get(source.pattern),
+                                      open_ended=source is fresh)
+            if rng is not None:
+                rest = candidates[i + 1:]
+                return plan(a, rng[0], rest) + [(source, ) + rng] + \
+                    plan(rng[1], b, rest)
+        raise NoIndexSourceError(
+            "No index source can answer a query on fields {0} between {1} "
+            "and {2}".format(sorted(fields) if fields is not None else 'all',
+                             a, b))
+
+    return plan(start, end, candidates)
+
+
+def available_from_catalog(catalog, sources):
+    """Ends of the sources' data according to an IndexCatalog:  the latest
+    time field value in any open index matching each source's pattern
+
+    :param IndexCatalog.IndexCatalog catalog: Index catalog
+    :param list sources: IndexSources
+    :return dict: {pattern: datetime}, for plan_sources
+    """
+    indices = catalog.indices()
+    ends = {}
+    for source in sources:
+        glob = re.sub(r'%.', '*', source.pattern)
+        latest = [info['max'] for name, info in indices.iteritems()
+                  if fnmatch(name, glob) and info['status'] == 'open' and
+                  info['max'] is not None]
+        if latest:
+            ends[source.pattern] = epoch_to_datetime(max(latest),
+                                                     unit='millisecond')
+    return ends
+
+
+def _seconds(td):
+    return td.days * 86400 + td.seconds
+
+
+def _floor(dt, granularity):
+    """Round a UTC datetime down to a multiple of granularity since the
+    epoch"""
+    step = _seconds(granularity)
+    secs = timegm(dt.utctimetuple())
+    return _EPOCH + timedelta(seconds=secs - secs % step)
+
+
+def _ceil(dt, granularity):
+    """Round a UTC datetime up to a multiple of granularity since the
+    epoch"""
+    floor = _floor(dt, granularity)
+    if floor < dt:
+        floor += granularity
+    return floor
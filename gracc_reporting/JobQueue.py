@@ -0,0 +1,438 @@
+"""Shared queue of report jobs, so that a batch of reports can be spread over
+several worker hosts.  A job is a report class, its time range and its
+kwargs.  Jobs live in a SQLite database on shared storage (which must
+support POSIX file locks, as SQLite needs them).  Workers claim a job with a
+lease, renew the lease while the report runs, and record the outcome.  If a
+worker dies, its lease runs out and the job goes back to the queue for
+another worker, until it has been tried max_attempts times.  Submitting a
+job identical to one that is pending, running or done is a no-op, so the
+batch can be submitted from more than one host.
+
+[jobqueue]
+    path = '/shared/gracc/jobs.sqlite'
+    lease = 300             # Seconds a claim lasts without being renewed
+    max_attempts = 3        # Tries per job, counting worker deaths
+    poll_interval = 10      # Seconds between claims when the queue is empty
+
+Submit the scheduled reports for a time range, then run workers:
+
+    python -m gracc_reporting.JobQueue -c config.toml -s START -e END submit
+    python -m gracc_reporting.JobQueue -c config.toml work
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+
+import ReportUtils
+from Scheduler import WarmClients, import_report, load_schedules
+from TimeUtils import parse_datetime
+
+DEFAULT_LEASE = 300
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_POLL_INTERVAL = 10
+
+PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+
+
+def job_key(report, start, end, kwargs=None):
+    """Key that identical jobs share.  The times are compared as the report
+    would parse them, so '2018-07-01 06:30', '2018-07-01 06:30:00' and
+    datetime(2018, 7, 1, 6, 30) are the same start.
+
+    :param str report: Report class, as 'module:ClassName'
+    :param start: Start of report range (str or datetime)
+    :param end: End of report range (str or datetime)
+    :param dict kwargs: Other kwargs for the report class
+    :return str: Hex digest
+    """
+    start, end = (parse_datetime(t).isoformat() for t in (start, end))
+    return hashlib.sha1(json.dumps([report, start, end, kwargs or {}],
+                                   sort_keys=True)).hexdigest()
+
+
+def report_spec(report):
+    """'module:ClassName' of a report class (or spec)"""
+    if isinstance(report, basestring):
+        return report
+    return '{0}:{1}'.format(report.__module__, report.__name__)
+
+
+class JobQueue(object):
+    """Report jobs in a SQLite database
+
+    :param str path: Database file
+    :param float lease: Seconds a claim lasts without being renewed
+    :param int max_attempts: Tries per job
+    """
+    def __init__(self, path, lease=DEFAULT_LEASE,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        dirname = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        # Transactions are managed explicitly, with BEGIN IMMEDIATE so that
+        # claims from different hosts can't interleave
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self._clock = time.time
+        self.__create_tables()
+
+    def submit(self, report, start, end, kwargs=None, force=False):
+        """Add a job, unless an identical one is pending, running, or done
+
+        :param report: Report class, or 'module:ClassName'
+        :param start: Start of report range
+        :param end: End of report range
+        :param dict kwargs: Other kwargs for the report class
+        :param bool force: Add the job even if an identical one exists
+        :return tuple: (job id, whether a new job was added)
+        """
+        report = report_spec(report)
+        key = job_key(report, start, end, kwargs)
+        with self.__transaction() as c:
+            if not force:
+                row = c.execute(
+                    'SELECT id FROM jobs WHERE key = ? AND state IN (?, ?, ?)'
+                    ' ORDER BY id DESC LIMIT 1',
+                    (key, PENDING, RUNNING, DONE)).fetchone()
+                if row is not None:
+                    return row['id'], False
+            cur = c.execute(
+                'INSERT INTO jobs (key, report, start, "end", kwargs, state, '
+                'attempts, max_attempts, created) VALUES (?, ?, ?, ?, ?, ?, '
+                '0, ?, ?)', (key, report, str(start), str(end),
+                             json.dumps(kwargs or {}, sort_keys=True),
+                             PENDING, self.max_attempts, self._clock()))
+            return cur.lastrowid, True
+
+    def claim(self, worker):
+        """Claim the oldest pending job.  Jobs whose lease ran out are put
+        back in the queue (or failed, if they're out of attempts) first.
+
+        :param str worker: Name of the claiming worker
+        :return dict: Job ({'id', 'report', 'start', 'end', 'kwargs',
+            'attempts', ...}), or None if there's nothing to do
+        """
+        now = self._clock()
+        with self.__transaction() as c:
+            self.__expire(c, now)
+            row = c.execute('SELECT * FROM jobs WHERE state = ? ORDER BY id '
+                            'LIMIT 1', (PENDING, )).fetchone()
+            if row is None:
+                return None
+            c.execute('UPDATE jobs SET state = ?, worker = ?, lease_until = ?,'
+                      ' attempts = attempts + 1, started = ? WHERE id = ?',
+                      (RUNNING, worker, now + self.lease, now, row['id']))
+        job = _job(row)
+        job.update(state=RUNNING, worker=worker, attempts=job['attempts'] + 1)
+        return job
+
+    def renew(self, job_id, worker):
+        """Extend the lease of a running job
+
+        :return bool: False if the worker no longer holds the job (its lease
+            ran out and it was given to another worker)
+        """
+        with self.__transaction() as c:
+            return c.execute(
+                'UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? '
+                'AND state = ?', (self._clock() + self.lease, job_id, worker,
+                                  RUNNING)).rowcount == 1
+
+    def complete(self, job_id, worker, duration=None):
+        """Record that a job succeeded
+
+        :return bool: False if the worker no longer held the job
+        """
+        with self.__transaction() as c:
+            return c.execute(
+                'UPDATE jobs SET state = ?, finished = ?, duration = ?, '
+                'error = NULL WHERE id = ? AND worker = ? AND state = ?',
+                (DONE, self._clock(), duration, job_id, worker,
+                 RUNNING)).rowcount == 1
+
+    def fail(self, job_id, worker, error, duration=None):
+        """Record that a job failed.  It's put back in the queue if it has
+        attempts left.
+
+        :return bool: False if the worker no longer held the job
+        """
+        with self.__transaction() as c:
+            return c.execute(
+                'UPDATE jobs SET state = CASE WHEN attempts < max_attempts '
+                'THEN ? ELSE ? END, worker = NULL, finished = ?, duration = ?,'
+                ' error = ? WHERE id = ? AND worker = ? AND state = ?',
+                (PENDING, FAILED, self._clock(), duration, error, job_id,
+                 worker, RUNNING)).rowcount == 1
+
+    def counts(self):
+        """Number of jobs in each state
+
+        :return dict: {state: count}
+        """
+        with self.__transaction() as c:
+            self.__expire(c, self._clock())
+            return dict((row[0], row[1]) for row in c.execute(
+                'SELECT state, COUNT(*) FROM jobs GROUP BY state'))
+
+    def jobs(self, state=None):
+        """Jobs, oldest first
+
+        :param str state: Only jobs in this state
+        :return list: Job dicts
+        """
+        if state is None:
+            rows = self.conn.execute('SELECT * FROM jobs ORDER BY id')
+        else:
+            rows = self.conn.execute('SELECT * FROM jobs WHERE state = ? '
+                                     'ORDER BY id', (state, ))
+        return [_job(row) for row in rows]
+
+    def close(self):
+        """Close the database connection"""
+        self.conn.close()
+
+    # Non-public methods
+    def __create_tables(self):
+        with self.__transaction() as c:
+            c.execute('CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY '
+                      'KEY AUTOINCREMENT, key TEXT, report TEXT, start TEXT, '
+                      '"end" TEXT, kwargs TEXT, state TEXT, attempts INTEGER,'
+                      ' max_attempts INTEGER, worker TEXT, lease_until REAL, '
+                      'created REAL, started REAL, finished REAL, duration '
+                      'REAL, error TEXT)')
+            c.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs '
+                      '(state, id)')
+            c.execute('CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key)')
+
+    @staticmethod
+    def __expire(c, now):
+        """Requeue (or fail) running jobs whose lease ran out"""
+        c.execute('UPDATE jobs SET state = CASE WHEN attempts < max_attempts '
+                  'THEN ? ELSE ? END, error = ?, worker = NULL WHERE state = ? '
+                  'AND lease_until < ?',
+                  (PENDING, FAILED, 'Lease expired (worker lost)', RUNNING,
+                   now))
+
+    def __transaction(self):
+        return _Transaction(self.conn)
+
+
+class _Transaction(object):
+    """BEGIN IMMEDIATE ... COMMIT (or ROLLBACK on error)"""
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute('ROLLBACK' if exc_type is not None else 'COMMIT')
+        return False
+
+
+def _job(row):
+    job = dict(zip(row.keys(), row))
+    job['kwargs'] = json.loads(job['kwargs'] or '{}')
+    return job
+
+
+class Worker(object):
+    """Claims jobs from a JobQueue and runs them, one at a time.  Run
+    several worker processes (on one or more hosts) for parallelism.
+
+    :param JobQueue queue: Job queue
+    :param str config_file: Filename of toml configuration file
+    :param str name: Name of this worker.  Defaults to host:pid
+    :param dict report_kwargs: Kwargs to pass to every report (e.g.
+        is_test), overriding the jobs'
+    :param float poll_interval: Seconds to wait when the queue is empty
+    :param logger: logging.Logger to log to
+    """
+    def __init__(self, queue, config_file, name=None, report_kwargs=None,
+                 poll_interval=DEFAULT_POLL_INTERVAL, logger=None):
+        self.queue = queue
+        self.config_file = config_file
+        self.name = name or '{0}:{1}'.format(socket.gethostname(),
+                                             os.getpid())
+        self.report_kwargs = dict(report_kwargs or {})
+        self.poll_interval = poll_interval
+        self.logger = logger or logging.getLogger('jobqueue')
+        config = ReportUtils.Reporter._parse_config(config_file) \
+            if config_file is not None else {}
+        self.warm_clients = WarmClients(config)
+
+    def run_one(self):
+        """Claim and run one job
+
+        :return dict: The job, with 'success' added, or None if the queue
+            had nothing to do
+        """
+        job = self.queue.claim(self.name)
+        if job is None:
+            return None
+        self.logger.info("Worker {0} running job {1}: {2} {3} - {4} (attempt"
+                         " {5})".format(self.name, job['id'], job['report'],
+                                        job['start'], job['end'],
+                                        job['attempts']))
+        stop = threading.Event()
+        renewer = threading.Thread(target=self.__renew, args=(job, stop))
+        renewer.daemon = True
+        renewer.start()
+        t0 = time.time()
+        try:
+            kwargs = dict(job['kwargs'])
+            kwargs.update(self.report_kwargs)
+            althost_key = kwargs.get('althost_key')
+            warm = self.warm_clients.get(althost_key)
+            if warm is not None and not kwargs.get('host_clients'):
+                kwargs['host_clients'] = warm
+            report = import_report(job['report'])(
+                config_file=self.config_file, start=job['start'],
+                end=job['end'], **kwargs)
+            # Keep the clients warm for later jobs on the same hosts
+            self.warm_clients.keep(getattr(report, 'host_clients', None),
+                                   althost_key)
+            with report.collect_metrics():
+                report.run_report()
+            job['success'] = True
+        except ReportUtils.QueryPlanned:
+            # Started with --plan:  the plan was printed instead of a run
+            job['success'] = True
+        except (Exception, SystemExit) as e:
+            job['success'] = False
+            job['error'] = '{0}: {1}'.format(type(e).__name__, e)
+            self.logger.error("Job {0} failed: {1}\n{2}".format(
+                job['id'], e, traceback.format_exc()))
+        finally:
+            stop.set()
+            renewer.join()
+        duration = round(time.time() - t0, 3)
+        if job['success']:
+            held = self.queue.complete(job['id'], self.name, duration)
+        else:
+            held = self.queue.fail(job['id'], self.name, job['error'],
+                                   duration)
+        if not held:
+            self.logger.warning("Job {0} was taken over by another worker "
+                                "after its lease ran out".format(job['id']))
+        return job
+
+    def serve(self, until_empty=False):
+        """Run jobs until interrupted
+
+        :param bool until_empty: Return once no jobs are pending or running
+        :return int: Number of jobs run
+        """
+        n = 0
+        try:
+            while True:
+                if self.run_one() is not None:
+                    n += 1
+                    continue
+                if until_empty:
+                    counts = self.queue.counts()
+                    if not counts.get(PENDING) and not counts.get(RUNNING):
+                        return n
+                time.sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            self.logger.info("Worker {0} stopping".format(self.name))
+        return n
+
+    def __renew(self, job, stop):
+        """Renew the job's lease until stop is set"""
+        # The renewer thread gets its own connection, as sqlite3 connections
+        # can't be shared between threads
+        queue = JobQueue(self.queue.path, self.queue.lease,
+                         self.queue.max_attempts)
+        try:
+            while not stop.wait(self.queue.lease / 3.0):
+                if not queue.renew(job['id'], self.name):
+                    return
+        finally:
+            queue.close()
+
+
+def open_queue(config, path=None):
+    """Open the JobQueue configured in the [jobqueue] section
+
+    :param dict config: Parsed config file
+    :param str path: Database file, overriding the config
+    :return JobQueue:
+    """
+    cfg = config.get('jobqueue', {})
+    path = path or cfg.get('path') or \
+        ReportUtils.get_state_path(config, 'jobs.sqlite')
+    return JobQueue(path, lease=cfg.get('lease', DEFAULT_LEASE),
+                    max_attempts=cfg.get('max_attempts',
+                                         DEFAULT_MAX_ATTEMPTS))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        parents=[ReportUtils.get_report_parser()],
+        description="Submit gracc reports to a shared job queue, or run "
+                    "workers that take jobs from it")
+    parser.add_argument("command", choices=['submit', 'work', 'status'],
+                        help="submit the scheduled reports for -s/-e, work "
+                             "on jobs, or show job counts")
+    parser.add_argument("-r", "--report", dest="reports", action="append",
+                        default=None,
+                        help="Schedule to submit (repeatable).  Defaults to "
+                             "all schedules")
+    parser.add_argument("--queue", dest="queue", default=None,
+                        help="Job database, overriding [jobqueue] path")
+    parser.add_argument("--until-empty", dest="until_empty",
+                        action="store_true", default=False,
+                        help="Stop working once the queue is empty")
+    args = parser.parse_args()
+
+    logger = logging.getLogger('jobqueue')
+    logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+    handler = logging.FileHandler(args.logfile) if args.logfile \
+        else logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(
+        "%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+    logger.addHandler(handler)
+
+    config = ReportUtils.Reporter._parse_config(args.config)
+    queue = open_queue(config, args.queue)
+
+    if args.command == 'submit':
+        if not args.start or not args.end:
+            parser.error("submit needs a time range (-s and -e)")
+        schedules = load_schedules(config)
+        for name in args.reports or sorted(schedules):
+            sched = schedules[name]
+            job_id, added = queue.submit(sched.report_cls, args.start,
+                                         args.end, sched.kwargs)
+            logger.info("{0} job {1} for {2}".format(
+                "Submitted" if added else "Already queued", job_id, name))
+    elif args.command == 'work':
+        report_kwargs = dict((k, getattr(args, k)) for k in (
+            'verbose', 'is_test', 'no_email', 'template', 'logfile')
+            if getattr(args, k))
+        Worker(queue, args.config, report_kwargs=report_kwargs,
+               poll_interval=config.get('jobqueue', {}).get(
+                   'poll_interval', DEFAULT_POLL_INTERVAL),
+               logger=logger).serve(until_empty=args.until_empty)
+    else:
+        counts = queue.counts()
+        print json.dumps(counts, sort_keys=True)
+        sys.exit(1 if counts.get(FAILED) else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,309 @@
+"""Load test for running many reports at once.  A weighted mix of the
+scheduled reports runs at each of several concurrency levels, against a
+recording of Elasticsearch responses (see Replay) rather than the real
+cluster.  For each level, the harness measures report throughput, latency
+percentiles, CPU use, and peak memory, and then prints the scaling curve.
+Use the curve to choose the size of the scheduler's worker pool, or the
+parallelism of batch runs.
+
+Reports run on threads that share one set of clients, the same way the
+Scheduler runs them.  Emails are never sent.  The test is configured like
+this:
+
+[loadtest]
+    recording = '/var/lib/gracc/recording.jsonl'  # see Replay.RecordingClient
+    concurrency = [1, 2, 4, 8]  # Concurrency levels to run
+    runs = 20                   # Report runs per level
+    start = '2018-03-28 06:30'  # Report range.  Must match the recording
+    end = '2018-03-29 06:30'
+    latency = 'recorded'        # Replay delay: 'recorded' (the took), or seconds
+    standin = false             # Serve the recording over local HTTP
+    [loadtest.mix]
+        osg_daily = 3           # [schedule.<name>] = relative weight
+        osg_project = 1
+"""
+
+import argparse
+import csv
+import logging
+import os
+import sys
+import time
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+import ReportUtils
+import TextUtils
+from MemProfile import peak_rss, reset_peak
+from Replay import Recording, ReplayClient, StandInServer
+from Scheduler import load_schedules
+from Transport import client_kwargs
+
+DEFAULT_LEVELS = [1, 2, 4, 8]
+DEFAULT_RUNS = 20
+# A level is worth its extra workers while each worker still does at least
+# this fraction of the work of a single worker
+DEFAULT_MIN_EFFICIENCY = 0.7
+
+CURVE_FIELDS = ['concurrency', 'runs', 'errors', 'wall', 'throughput',
+                'efficiency', 'p50', 'p90', 'p99', 'mean', 'cpu_cores',
+                'peak_rss_mb']
+
+
+def percentile(values, p):
+    """p-th percentile of values (nearest rank)
+
+    :param list values: Numbers
+    :param float p: Percentile, 0 to 100
+    :return float: Percentile, or None if there are no values
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    idx = min(int(round(p / 100.0 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[idx]
+
+
+def weighted_jobs(mix, runs):
+    """Sequence of runs that follows the weights of a mix, interleaved
+    rather than grouped by report
+
+    :param list mix: (name, weight) pairs
+    :param int runs: Length of sequence
+    :return list: Names
+    """
+    total = float(sum(weight for _, weight in mix))
+    if total <= 0:
+        raise ValueError("Load test mix has no positive weights")
+    credit = dict((name, 0.0) for name, _ in mix)
+    jobs = []
+    for _ in xrange(runs):
+        # Smooth weighted round robin
+        for name, weight in mix:
+            credit[name] += weight
+        name = max(mix, key=lambda m: credit[m[0]])[0]
+        credit[name] -= total
+        jobs.append(name)
+    return jobs
+
+
+def best_concurrency(curve, min_efficiency=DEFAULT_MIN_EFFICIENCY):
+    """Highest concurrency level that is still efficient, and without
+    errors
+
+    :param list curve: Results of LoadTest.run
+    :param float min_efficiency: Lowest acceptable efficiency
+    :return int: Concurrency, or None if no level qualifies
+    """
+    good = [r for r in curve if not r['errors'] and
+            r['efficiency'] >= min_efficiency]
+    return max(r['concurrency'] for r in good) if good else None
+
+
+class LoadTest(object):
+    """Runs a mix of reports at increasing concurrency
+
+    :param str config_file: Filename of toml configuration file
+    :param list mix: (schedule name, weight) pairs
+    :param OrderedDict host_clients: {hostname: client} to give every
+        report, e.g. {'replay': ReplayClient}
+    :param start: Start of report range
+    :param end: End of report range
+    :param list levels: Concurrency levels
+    :param int runs: Report runs per level
+    :param dict report_kwargs: Kwargs to pass to every report
+    :param logger: logging.Logger to log to
+    """
+    def __init__(self, config_file, mix, host_clients, start, end,
+                 levels=None, runs=DEFAULT_RUNS, report_kwargs=None,
+                 logger=None):
+        self.config_file = config_file
+        self.config = ReportUtils.Reporter._parse_config(config_file)
+        self.schedules = load_schedules(self.config)
+        for name, _ in mix:
+            if name not in self.schedules:
+                raise KeyError("Load test mix names unknown schedule "
+                               "{0}".format(name))
+        self.mix = mix
+        self.host_clients = host_clients
+        self.start = start
+        self.end = end
+        self.levels = levels or DEFAULT_LEVELS
+        self.runs = runs
+        self.report_kwargs = dict(report_kwargs or {})
+        self.report_kwargs['no_email'] = True
+        self.logger = logger or logging.getLogger('loadtest')
+
+    def run(self):
+        """Run every concurrency level
+
+        :return list: Result dict per level, with the keys in CURVE_FIELDS
+        """
+        curve = []
+        for n in self.levels:
+            result = self.run_level(n)
+            base = curve[0] if curve else result
+            result['efficiency'] = round(
+                result['throughput'] * base['concurrency'] /
+                (base['throughput'] * n), 3) if base['throughput'] else 0.0
+            curve.append(result)
+            self.logger.info("Concurrency {concurrency}: {throughput} "
+                             "reports/s, p90 {p90}s, {errors} errors".format(
+                                 **result))
+        return curve
+
+    def run_level(self, concurrency):
+        """Run the mix's jobs on a pool of concurrency threads
+
+        :param int concurrency: Number of threads
+        :return dict: Measurements of this level (efficiency is left out)
+        """
+        jobs = weighted_jobs(self.mix, self.runs)
+        reset_peak()
+        cpu0 = os.times()
+        t0 = time.time()
+        pool = ThreadPool(concurrency)
+        try:
+            results = pool.map(self._run_one, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        wall = time.time() - t0
+        cpu1 = os.times()
+
+        latencies = [latency for latency, ok in results]
+        cpu = (cpu1[0] - cpu0[0]) + (cpu1[1] - cpu0[1])
+        return {'concurrency': concurrency,
+                'runs': len(jobs),
+                'errors': sum(1 for _, ok in results if not ok),
+                'wall': round(wall, 3),
+                'throughput': round(len(jobs) / wall, 3) if wall else 0.0,
+                'p50': round(percentile(latencies, 50), 3),
+                'p90': round(percentile(latencies, 90), 3),
+                'p99': round(percentile(latencies, 99), 3),
+                'mean': round(sum(latencies) / len(latencies), 3),
+                'cpu_cores': round(cpu / wall, 2) if wall else 0.0,
+                'peak_rss_mb': round((peak_rss() or 0) / 1048576.0, 1)}
+
+    def _run_one(self, name):
+        """Run one report
+
+        :return tuple: (seconds, whether it succeeded)
+        """
+        sched = self.schedules[name]
+        kwargs = dict(sched.kwargs)
+        kwargs.update(self.report_kwargs)
+        kwargs['host_clients'] = self.host_clients
+        t0 = time.time()
+        try:
+            report = sched.report_cls(config_file=self.config_file,
+                                      start=self.start, end=self.end,
+                                      **kwargs)
+            with report.collect_metrics():
+                report.run_report()
+            ok = True
+        except ReportUtils.QueryPlanned:
+            ok = True
+        except (Exception, SystemExit) as e:
+            self.logger.warning("Report {0} failed: {1}".format(name, e))
+            ok = False
+        return time.time() - t0, ok
+
+
+def format_curve(curve):
+    """Scaling curve as a text table
+
+    :param list curve: Results of LoadTest.run
+    :return str:
+    """
+    columns = OrderedDict((field, [r[field] for r in curve])
+                          for field in CURVE_FIELDS)
+    return TextUtils.TextUtils(CURVE_FIELDS).printAsTextTable('text', columns)
+
+
+def write_curve(curve, path):
+    """Write the scaling curve to a CSV file
+
+    :param list curve: Results of LoadTest.run
+    :param str path: CSV file
+    """
+    with open(path, 'wb') as f:
+        writer = csv.DictWriter(f, CURVE_FIELDS)
+        writer.writeheader()
+        for result in curve:
+            writer.writerow(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        parents=[ReportUtils.get_report_parser()],
+        description="Run a mix of gracc reports at increasing concurrency "
+                    "against recorded Elasticsearch responses")
+    parser.add_argument("--concurrency", dest="concurrency", default=None,
+                        help="Comma-separated concurrency levels")
+    parser.add_argument("--runs", dest="runs", type=int, default=None,
+                        help="Report runs per concurrency level")
+    parser.add_argument("--recording", dest="recording", default=None,
+                        help="Recorded responses (JSON lines)")
+    parser.add_argument("--standin", dest="standin", action="store_true",
+                        default=None,
+                        help="Serve the recording over local HTTP instead "
+                             "of replaying it in process")
+    parser.add_argument("-o", "--out", dest="out", default=None,
+                        help="Write the scaling curve to this CSV file")
+    args = parser.parse_args()
+
+    logger = logging.getLogger('loadtest')
+    logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+    handler = logging.FileHandler(args.logfile) if args.logfile \
+        else logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(
+        "%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+    logger.addHandler(handler)
+
+    config = ReportUtils.Reporter._parse_config(args.config)
+    cfg = config.get('loadtest', {})
+    levels = [int(n) for n in args.concurrency.split(',')] \
+        if args.concurrency else cfg.get('concurrency', DEFAULT_LEVELS)
+    runs = args.runs or cfg.get('runs', DEFAULT_RUNS)
+    standin = args.standin if args.standin is not None \
+        else cfg.get('standin', False)
+    recording = Recording(args.recording or cfg['recording'])
+    latency = cfg.get('latency', 'recorded')
+    start = args.start or cfg.get('start')
+    end = args.end or cfg.get('end')
+    mix = sorted(cfg.get('mix', {}).iteritems())
+
+    server = None
+    if standin:
+        from elasticsearch import Elasticsearch
+        server = StandInServer(recording, latency=latency).start()
+        # Same transport options as the reports would use against the
+        # cluster, with enough connections for the highest level
+        options = client_kwargs(config.get('elasticsearch', {}))
+        options['maxsize'] = max(levels)
+        host_clients = OrderedDict([(server.url, Elasticsearch(
+            [server.url], **options))])
+    else:
+        host_clients = OrderedDict([('replay', ReplayClient(
+            recording, latency=latency))])
+
+    report_kwargs = dict((k, getattr(args, k)) for k in (
+        'verbose', 'is_test', 'template', 'logfile') if getattr(args, k))
+    try:
+        test = LoadTest(args.config, mix, host_clients, start, end, levels,
+                        runs, report_kwargs=report_kwargs, logger=logger)
+        curve = test.run()
+    finally:
+        if server is not None:
+            server.stop()
+
+    print format_curve(curve)
+    print "Suggested concurrency: {0}".format(best_concurrency(curve))
+    if args.out:
+        write_curve(curve, args.out)
+    sys.exit(1 if any(r['errors'] for r in curve) else 0)
+
+
+if __name__ == '__main__':
+    main()
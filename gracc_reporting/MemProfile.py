@@ -0,0 +1,201 @@
+"""Optional memory instrumentation for reports.  MemoryProfiler.phase is a
+context manager that measures the peak resident set size (RSS) of the process
+during a phase of a report (running the query, formatting, rendering,
+sending), logs it, and raises MemoryBudgetExceeded if it went over a budget.
+If the tracemalloc module is available, the top allocation sites of each
+phase can be logged too.
+
+Per-phase peaks come from VmHWM in /proc/self/status, which is reset at the
+start of each phase through /proc/self/clear_refs.  Where that isn't
+possible, the peak since the process started is reported instead.  The peak
+belongs to the whole process, so while phases are open in other threads
+(e.g. reports run by the Scheduler's thread pool) it isn't reset, and the
+peak since the last reset is reported."""
+
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+_MB = 1024 * 1024
+_STATUS_FILE = '/proc/self/status'
+_CLEAR_REFS_FILE = '/proc/self/clear_refs'
+
+# Open phases per thread, so that one thread's phase doesn't reset the peak
+# under another's
+_open_phases = {}
+_open_lock = threading.Lock()
+
+
+class MemoryBudgetExceeded(Exception):
+    """Raised when a report phase uses more memory than its budget"""
+    pass
+
+
+def _read_status(field):
+    """Value of a kB field of /proc/self/status, in bytes, or None"""
+    try:
+        with open(_STATUS_FILE, 'r') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError, IndexError):
+        pass
+    return None
+
+
+def current_rss():
+    """Current resident set size of this process in bytes, or None if it
+    can't be read"""
+    return _read_status('VmRSS')
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes, since it started or
+    since the last reset_peak()"""
+    peak = _read_status('VmHWM')
+    if peak is not None:
+        return peak
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kB on Linux, and bytes on macOS
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def reset_peak():
+    """Reset the peak RSS (Linux 4.0+)
+
+    :return bool: True if the peak was reset
+    """
+    try:
+        with open(_CLEAR_REFS_FILE, 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+class MemoryProfiler(object):
+    """Measures and logs memory use of report phases
+
+    :param logger: logging.Logger to log to (e.g. Reporter.logger, so that
+        lines are tagged with the VO)
+    :param int budget: Maximum peak RSS in bytes.  None means no budget
+    :param int tracemalloc_top: Log this many top allocation sites of each
+        phase, if tracemalloc is available.  0 disables tracemalloc
+    """
+    def __init__(self, logger, budget=None, tracemalloc_top=0):
+        self.logger = logger
+        self.budget = budget
+        self.tracemalloc_top = tracemalloc_top
+        self.phases = []
+        self._stack = []
+
+        if tracemalloc_top and tracemalloc is None:
+            self.logger.warning("tracemalloc is not available in this Python. "
+                                "Only peak RSS will be recorded")
+            self.tracemalloc_top = 0
+
+    @contextmanager
+    def phase(self, name):
+        """Measure the memory used while the block runs.  Phases can nest;
+        an outer phase's peak includes its inner phases.
+
+        :param str name: Name of phase, for the log
+        """
+        frame = {'name': name, 'child_peak': 0, 'snapshot': None,
+                 'rss_before': current_rss(), 'start': time.time()}
+        if self._stack:
+            # The reset below loses the enclosing phase's peak so far
+            parent = self._stack[-1]
+            parent['child_peak'] = max(parent['child_peak'], peak_rss())
+        frame['exact'] = _open_phase() and reset_peak()
+        if self.tracemalloc_top:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            frame['snapshot'] = tracemalloc.take_snapshot()
+        self._stack.append(frame)
+
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            _close_phase()
+            self._stack.pop()
+            record = self.__finish(frame)
+            if self._stack:
+                parent = self._stack[-1]
+                parent['child_peak'] = max(parent['child_peak'],
+                                           record['peak_rss'])
+            if not failed:
+                self.__check_budget(record)
+
+    def __finish(self, frame):
+        """Record and log the memory use of a finished phase"""
+        peak = max(peak_rss(), frame['child_peak'])
+        record = {'phase': frame['name'],
+                  'peak_rss': peak,
+                  'rss_before': frame['rss_before'],
+                  'rss_after': current_rss(),
+                  'exact': frame['exact'],
+                  'seconds': time.time() - frame['start']}
+        self.phases.append(record)
+
+        self.logger.info(
+            "Memory: {0}: peak RSS {1}{2}, RSS before {3}, after {4}, "
+            "{5:.2f}s".format(record['phase'], _fmt_mb(peak),
+                              '' if frame['exact'] else ' (not reset)',
+                              _fmt_mb(record['rss_before']),
+                              _fmt_mb(record['rss_after']),
+                              record['seconds']))
+
+        if frame['snapshot'] is not None:
+            diff = tracemalloc.take_snapshot().compare_to(frame['snapshot'],
+                                                          'lineno')
+            for stat in diff[:self.tracemalloc_top]:
+                self.logger.info("Memory: {0}: {1}".format(frame['name'],
+                                                           stat))
+        return record
+
+    def __check_budget(self, record):
+        """Raise MemoryBudgetExceeded if a phase went over budget"""
+        if self.budget is not None and record['peak_rss'] > self.budget:
+            msg = "Report used {0} of memory during {1}, which is over its " \
+                  "budget of {2}".format(_fmt_mb(record['peak_rss']),
+                                         record['phase'],
+                                         _fmt_mb(self.budget))
+            self.logger.error(msg)
+            raise MemoryBudgetExceeded(msg)
+
+
+def _open_phase():
+    """Note that the current thread opened a phase
+
+    :return bool: True if no other thread has a phase open, so the peak can
+        be reset
+    """
+    me = threading.current_thread().ident
+    with _open_lock:
+        _open_phases[me] = _open_phases.get(me, 0) + 1
+        return len(_open_phases) == 1
+
+
+def _close_phase():
+    """Note that the current thread closed a phase"""
+    me = threading.current_thread().ident
+    with _open_lock:
+        _open_phases[me] -= 1
+        if not _open_phases[me]:
+            del _open_phases[me]
+
+
+def _fmt_mb(nbytes):
+    """Format a number of bytes in MB"""
+    return 'unknown' if nbytes is None else '{0:.1f} MB'.format(
+        float(nbytes) / _MB)
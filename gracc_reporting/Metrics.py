@@ -0,0 +1,195 @@
+"""Per-run metrics of reports, written in the Prometheus text format for
+node_exporter's textfile collector:  how long each phase of the run took,
+Elasticsearch's took time against the wall time of the queries, response
+sizes, bucket and row counts, email size, and whether the run succeeded.
+Each report (and VO) gets its own .prom file, which is replaced atomically at
+the end of each run, so node_exporter never reads a partial file."""
+
+import os
+import re
+import time
+from contextlib import contextmanager
+
+from MemProfile import peak_rss
+
+PREFIX = 'gracc_report'
+
+# name: (help text, has a phase label)
+_METRICS = [
+    ('last_run_timestamp_seconds', "Time the last run finished", False),
+    ('last_run_success', "1 if the last run succeeded, 0 if it failed",
+     False),
+    ('run_duration_seconds', "Wall time of the last run", False),
+    ('phase_duration_seconds', "Wall time of each phase of the last run",
+     True),
+    ('queries', "Elasticsearch queries in the last run", False),
+    ('query_wall_seconds', "Wall time of the last run's queries", False),
+    ('query_took_seconds', "Time Elasticsearch reported for the last run's "
+                           "queries", False),
+    ('response_bytes', "Size of the last run's query responses", False),
+    ('buckets', "Aggregation buckets returned to the last run", False),
+    ('rows', "Rows in the last run's report tables", False),
+    ('email_bytes', "Size of the reports emailed by the last run", False),
+    ('peak_rss_bytes', "Peak resident set size of the process", False),
+]
+
+
+def count_buckets(aggs):
+    """Number of buckets in raw aggregation results, at every level
+
+    :param dict aggs: Raw aggregations (or a bucket)
+    :return int:
+    """
+    n = 0
+    for value in aggs.itervalues():
+        if not isinstance(value, dict):
+            continue
+        buckets = value.get('buckets')
+        if isinstance(buckets, dict):
+            buckets = buckets.values()
+        if buckets is None:
+            # Single-bucket aggregations (filter) can hold more buckets
+            if 'doc_count' in value:
+                n += count_buckets(value)
+            continue
+        n += len(buckets)
+        for bucket in buckets:
+            n += count_buckets(bucket)
+    return n
+
+
+class RunMetrics(object):
+    """Metrics of one report run
+
+    :param dict labels: Labels to put on every metric, e.g. {'report':
+        'osg', 'vo': 'cms'}
+    """
+    def __init__(self, labels=None):
+        self.labels = labels or {}
+        self.start = time.time()
+        self.values = dict((name, 0) for name, _, phased in _METRICS
+                           if not phased)
+        self.phases = {}
+        self._depth = {}
+
+    def add(self, name, value):
+        """Add to a counter of this run
+
+        :param str name: Metric name, without prefix
+        :param value: Amount to add
+        """
+        self.values[name] += value
+
+    def observe_query(self, wall, took=None, response_bytes=0, buckets=0):
+        """Record a query
+
+        :param float wall: Wall time of the query, in seconds
+        :param float took: Elasticsearch's took, in milliseconds
+        :param int response_bytes: Size of the response
+        :param int buckets: Buckets in the response
+        """
+        self.values['queries'] += 1
+        self.values['query_wall_seconds'] += wall
+        self.values['query_took_seconds'] += (took or 0) / 1000.0
+        self.values['response_bytes'] += response_bytes
+        self.values['buckets'] += buckets
+
+    @contextmanager
+    def phase(self, name, inner=None):
+        """Time a phase of the run.  Time in nested phases of the same name
+        is only counted once.
+
+        :param str name: Name of phase
+        :param inner: Another context manager to run the block in (e.g. a
+            MemoryProfiler phase)
+        """
+        depth = self._depth.get(name, 0)
+        self._depth[name] = depth + 1
+        start = time.time()
+        try:
+            if inner is None:
+                yield
+            else:
+                with inner:
+                    yield
+        finally:
+            self._depth[name] = depth
+            if depth == 0:
+                # Only the outermost phase of a name is timed
+                self.phases[name] = self.phases.get(name, 0.0) + \
+                    time.time() - start
+
+    def finish(self, success):
+        """Record the end of the run
+
+        :param bool success: Whether the run succeeded
+        """
+        now = time.time()
+        self.values['last_run_timestamp_seconds'] = now
+        self.values['last_run_success'] = 1 if success else 0
+        self.values['run_duration_seconds'] = now - self.start
+        self.values['peak_rss_bytes'] = peak_rss() or 0
+
+    def format(self):
+        """Metrics in the Prometheus text format
+
+        :return str:
+        """
+        lines = []
+        for name, help_text, phased in _METRICS:
+            full = '{0}_{1}'.format(PREFIX, name)
+            lines.append('# HELP {0} {1}'.format(full, help_text))
+            lines.append('# TYPE {0} gauge'.format(full))
+            if phased:
+                for phase in sorted(self.phases):
+                    lines.append('{0}{1} {2}'.format(
+                        full, _labels(self.labels, phase=phase),
+                        _number(self.phases[phase])))
+            else:
+                lines.append('{0}{1} {2}'.format(
+                    full, _labels(self.labels), _number(self.values[name])))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Write the metrics to a textfile collector file, atomically
+
+        :param str path: File to write (should end in .prom)
+        """
+        dirname = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        # The temporary file must not end in .prom, or node_exporter might
+        # read it half-written
+        tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(self.format())
+        os.rename(tmp, path)
+
+
+def textfile_name(report_type, vo=None):
+    """Name of a report's .prom file
+
+    :param str report_type: Report type
+    :param str vo: VO, for VO reports
+    :return str:
+    """
+    parts = [PREFIX, report_type] + ([vo] if vo else [])
+    return '{0}.prom'.format(re.sub(r'[^A-Za-z0-9_.-]', '_',
+                                    '_'.join(parts).lower()))
+
+
+def _labels(labels, **extra):
+    """Format labels as {name="value",...}"""
+    merged = dict(labels, **extra)
+    if not merged:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(
+        k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace(
+            '\n', '\\n')) for k, v in sorted(merged.iteritems())) + '}'
+
+
+def _number(value):
+    """Format a number for the text format"""
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
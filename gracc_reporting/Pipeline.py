@@ -0,0 +1,629 @@
+"""Small framework for building record-processing pipelines out of coroutines
+(see ReportUtils.coroutine).  A source generates batches of records (e.g. the
+hits of Search.scan(), or pages of terms buckets), which are pushed through
+stages (map, filter, re-batch, reduce) into a sink (columns for
+TextUtils/format_report, a CSV file, a pickle cache, or a gzipped NDJSON
+export).  Records travel in
+batches, so the per-record cost of the coroutine machinery is paid once per
+batch.  Each stage counts the batches and records it sees and the time it
+spends, not including the time spent in the stages after it.
+
+Example:
+
+    p = Pipeline([Filter(lambda r: r['CoreHours'] > 0),
+                  Reduce(['VOName'], [('CoreHours', 'sum', 'CoreHours')])],
+                 ColumnsSink(['VOName', 'CoreHours']))
+    columns = p.run(scan_source(self.run_query()))
+    p.log_stats(self.logger)
+"""
+
+import cPickle
+import csv
+import json
+import os
+import tempfile
+import time
+import zlib
+from calendar import timegm
+from datetime import datetime
+from itertools import islice
+
+from dateutil import parser, tz
+
+from elasticsearch_dsl import A
+
+import TextUtils
+from ReportUtils import coroutine, nest_aggs
+from GroupBy import ExternalGroupBy, DEFAULT_MEMORY_LIMIT
+
+DEFAULT_BATCH_SIZE = 1000
+# Uncompressed bytes of records in each gzip member of an NDJSON export
+DEFAULT_CHUNK_BYTES = 4 * 1024 * 1024
+
+
+class StageStats(object):
+    """Counters and timing for one stage of a pipeline
+
+    :param str name: Name of stage
+    """
+    header = ['Stage', 'Batches', 'Records In', 'Records Out', 'Seconds']
+
+    def __init__(self, name):
+        self.name = name
+        self.batches = 0
+        self.records_in = 0
+        self.records_out = 0
+        self.seconds = 0.0
+
+    def row(self):
+        """Stats as a list of values in the order of StageStats.header"""
+        return [self.name, self.batches, self.records_in, self.records_out,
+                round(self.seconds, 3)]
+
+
+# Sources.  Generators of batches (lists) of records
+def iter_source(records, batch_size=DEFAULT_BATCH_SIZE):
+    """Batch up any iterable of records
+
+    :param records: Iterable of records
+    :param int batch_size: Records per batch
+    :return generator: Lists of records
+    """
+    records = iter(records)
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def scan_source(search, batch_size=DEFAULT_BATCH_SIZE, scan=None):
+    """Scan all hits of a Search, as plain dicts
+
+    :param Search search: elasticsearch_dsl Search (e.g. the return value of
+        Reporter.run_query for a non-aggregated query)
+    :param int batch_size: Records per batch
+    :param scan: Function that takes a Search and returns its hits (e.g.
+        Reporter.executor.scan, to scan under the governor's limits).
+        Defaults to Search.scan
+    :return generator: Lists of hit dicts
+    """
+    hits = scan(search) if scan is not None else search.scan()
+    return iter_source((hit.to_dict() for hit in hits), batch_size)
+
+
+def terms_pages_source(search, field, num_partitions, size=10000,
+                       execute=None):
+    """Page through the buckets of a terms aggregation on field, one
+    partition of the terms at a time.  The Search's own aggregations are run
+    underneath the terms aggregation.  (Elasticsearch 5 has no composite
+    aggregation, so partitioned terms are the way to page.)
+
+    :param Search search: elasticsearch_dsl Search whose aggregations are
+        computed for each term
+    :param str field: Field to page through the terms of
+    :param int num_partitions: Number of pages.  Pick enough that each page
+        has fewer than size terms
+    :param int size: Maximum number of terms per page
+    :param execute: Function that takes a Search and returns a Response (e.g.
+        Reporter.executor.execute).  Defaults to Search.execute
+    :return generator: Lists of bucket dicts
+    """
+    execute = execute if execute is not None else lambda s: s.execute()
+    for partition in xrange(num_partitions):
+        outer = A('terms', field=field, size=size,
+                  include={'partition': partition,
+                           'num_partitions': num_partitions})
+        response = execute(nest_aggs(search[0:0], 'page', outer))
+        buckets = response.aggregations.page.to_dict()['buckets']
+        if buckets:
+            yield buckets
+
+
+def cache_source(path):
+    """Read back the batches written by a CacheSink
+
+    :param str path: Cache file
+    :return generator: Lists of records
+    """
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield cPickle.load(f)
+            except EOFError:
+                return
+
+
+def ndjson_source(path, start=None, end=None):
+    """Read back the records written by an NDJSONSink, decompressing only
+    the chunks that overlap [start, end) according to the index file
+
+    :param str path: Export file
+    :param start: Only records at or after this time (datetime, date
+        string, or epoch ms).  Naive datetimes are UTC
+    :param end: Only records before this time
+    :return generator: Lists of records, one per chunk
+    """
+    index = read_ndjson_index(path)
+    time_field = index['time_field']
+    lo = _epoch_ms(start) if start is not None else None
+    hi = _epoch_ms(end) if end is not None else None
+    with open(path, 'rb') as f:
+        for chunk in index['chunks']:
+            if chunk['start'] is not None and (
+                    (hi is not None and chunk['start'] >= hi) or
+                    (lo is not None and chunk['end'] < lo)):
+                continue
+            f.seek(chunk['offset'])
+            data = zlib.decompress(f.read(chunk['length']),
+                                   16 + zlib.MAX_WBITS)
+            records = [json.loads(line) for line in data.splitlines()]
+            if lo is not None or hi is not None:
+                records = [r for r in records if _in_range(
+                    r.get(time_field), lo, hi)]
+            if records:
+                yield records
+
+
+def read_ndjson_index(path):
+    """Read the index file of an NDJSONSink export
+
+    :param str path: Export file (not the index file)
+    :return dict: {'fields', 'time_field', 'records', 'chunks': [{'offset',
+        'length', 'records', 'start', 'end'}]}.  start and end are the
+        chunk's earliest and latest times, in epoch ms
+    """
+    with open(path + '.idx', 'r') as f:
+        return json.load(f)
+
+
+# Stages
+class Stage(object):
+    """Base class for pipeline stages.  Subclasses override process, which
+    gets each incoming batch, and optionally finish, which is called once
+    the source is exhausted.  Both pass their output on with emit.  A stage
+    instance can only be used in one pipeline run.
+
+    :param str name: Name for stats.  Defaults to the class name
+    """
+    def __init__(self, name=None):
+        self.stats = StageStats(name or type(self).__name__)
+        self._target = None
+        self._downstream = 0.0
+        self._aborted = False
+
+    def process(self, batch):
+        """Handle one batch of records.  Passes the batch through by
+        default"""
+        self.emit(batch)
+
+    def finish(self):
+        """Called after the last batch"""
+        pass
+
+    def cleanup(self):
+        """Called if the pipeline fails, to release any resources"""
+        pass
+
+    def emit(self, batch):
+        """Send a batch of records to the next stage"""
+        if not batch or self._target is None:
+            return
+        self.stats.records_out += len(batch)
+        t0 = time.time()
+        self._target.send(batch)
+        self._downstream += time.time() - t0
+
+    def abort(self):
+        """Stop without running finish, and clean up"""
+        self._aborted = True
+        self.cleanup()
+
+    @coroutine
+    def coroutine(self, target):
+        """Coroutine that runs this stage, sending its output to target
+
+        :param target: Next stage's coroutine, or None for a sink
+        """
+        self._target = target
+        try:
+            while True:
+                batch = (yield)
+                self.stats.batches += 1
+                self.stats.records_in += len(batch)
+                self.__timed(self.process, batch)
+        except GeneratorExit:
+            if self._aborted:
+                return
+            self.__timed(self.finish)
+            if target is not None:
+                target.close()
+
+    def __timed(self, func, *args):
+        """Call func, adding the time spent in it, minus the time spent in
+        later stages, to this stage's stats"""
+        t0, down0 = time.time(), self._downstream
+        func(*args)
+        self.stats.seconds += (time.time() - t0) - (self._downstream - down0)
+
+
+class Map(Stage):
+    """Apply a function to every record
+
+    :param func: Function taking a record and returning a new record
+    """
+    def __init__(self, func, name=None):
+        super(Map, self).__init__(name)
+        self.func = func
+
+    def process(self, batch):
+        self.emit(map(self.func, batch))
+
+
+class MapBatch(Stage):
+    """Apply a function to whole batches, for transforms that are cheaper
+    on many records at once
+
+    :param func: Function taking a list of records and returning a list of
+        records
+    """
+    def __init__(self, func, name=None):
+        super(MapBatch, self).__init__(name)
+        self.func = func
+
+    def process(self, batch):
+        self.emit(self.func(batch))
+
+
+class Filter(Stage):
+    """Only pass on records for which a predicate is true
+
+    :param predicate: Function taking a record and returning a bool
+    """
+    def __init__(self, predicate, name=None):
+        super(Filter, self).__init__(name)
+        self.predicate = predicate
+
+    def process(self, batch):
+        self.emit([r for r in batch if self.predicate(r)])
+
+
+class Batch(Stage):
+    """Re-chunk records into batches of batch_size (the last may be
+    smaller), e.g. after a filter has thinned them out, or before a sink that
+    writes in chunks
+
+    :param int batch_size: Records per output batch
+    """
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE, name=None):
+        super(Batch, self).__init__(name)
+        self.batch_size = batch_size
+        self._buffer = []
+
+    def process(self, batch):
+        self._buffer.extend(batch)
+        while len(self._buffer) >= self.batch_size:
+            self.emit(self._buffer[:self.batch_size])
+            del self._buffer[:self.batch_size]
+
+    def finish(self):
+        self.emit(self._buffer)
+        self._buffer = []
+
+
+class Reduce(Stage):
+    """Group records by key fields and reduce other fields (see
+    GroupBy.ExternalGroupBy, which spills to disk past memory_limit).  Emits
+    one dict per group, in key order, once the source is exhausted.
+
+    :param list keys: Fields to group by
+    :param list reducers: (output name, reducer, field) tuples
+    :param int memory_limit: Approximate maximum bytes of groups in memory
+    :param str tmpdir: Directory for spill files
+    :param int batch_size: Groups per output batch
+    """
+    def __init__(self, keys, reducers, memory_limit=DEFAULT_MEMORY_LIMIT,
+                 tmpdir=None, batch_size=DEFAULT_BATCH_SIZE, name=None):
+        super(Reduce, self).__init__(name)
+        self.gb = ExternalGroupBy(keys, reducers, memory_limit=memory_limit,
+                                  tmpdir=tmpdir)
+        self.batch_size = batch_size
+
+    def process(self, batch):
+        self.gb.consume(batch)
+
+    def finish(self):
+        header = self.gb.header
+        try:
+            groups = (dict(zip(header, key + tuple(values)))
+                      for key, values in self.gb.results())
+            for batch in iter_source(groups, self.batch_size):
+                self.emit(batch)
+        finally:
+            self.gb.close()
+
+    def cleanup(self):
+        self.gb.close()
+
+
+# Sinks
+class Sink(Stage):
+    """Base class for the last stage of a pipeline.  result() is returned
+    by Pipeline.run"""
+    def result(self):
+        return None
+
+
+class ColumnsSink(Sink):
+    """Collect records into a dict of columns, as used by TextUtils and
+    returned by Reporter.format_report
+
+    :param list header: Column names (record fields)
+    """
+    def __init__(self, header, name=None):
+        super(ColumnsSink, self).__init__(name)
+        self.header = list(header)
+        self.columns = dict((col, []) for col in self.header)
+
+    def process(self, batch):
+        for col in self.header:
+            self.columns[col].extend(r.get(col) for r in batch)
+
+    def result(self):
+        return self.columns
+
+
+class CSVSink(Sink):
+    """Write records to a CSV file, with a header row
+
+    :param str path: CSV file to write
+    :param list header: Columns (record fields) to write
+    """
+    def __init__(self, path, header, name=None):
+        super(CSVSink, self).__init__(name)
+        self.path = path
+        self.header = list(header)
+        self.nrows = 0
+        self._file = open(path, 'wb')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow([_csv_value(col) for col in self.header])
+
+    def process(self, batch):
+        self._writer.writerows([_csv_value(r.get(col)) for col in self.header]
+                               for r in batch)
+        self.nrows += len(batch)
+
+    def finish(self):
+        self._file.close()
+
+    def cleanup(self):
+        self._file.close()
+
+    def result(self):
+        return self.path
+
+
+class CacheSink(Sink):
+    """Pickle batches to a cache file that cache_source can read back.
+    The file is written under a temporary name and renamed into place at
+    the end, so a failed run never leaves a partial cache behind.
+
+    :param str path: Cache file
+    """
+    def __init__(self, path, name=None):
+        super(CacheSink, self).__init__(name)
+        self.path = path
+        fd, self._tmppath = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)),
+            prefix=os.path.basename(path) + '.')
+        self._file = os.fdopen(fd, 'wb')
+
+    def process(self, batch):
+        cPickle.dump(batch, self._file, cPickle.HIGHEST_PROTOCOL)
+
+    def finish(self):
+        self._file.close()
+        os.rename(self._tmppath, self.path)
+
+    def cleanup(self):
+        self._file.close()
+        try:
+            os.remove(self._tmppath)
+        except OSError:
+            pass
+
+    def result(self):
+        return self.path
+
+
+class NDJSONSink(Sink):
+    """Write records as gzipped newline-delimited JSON.  Records are
+    buffered up to chunk_bytes (uncompressed), and each full buffer is
+    written as a separate gzip member, so memory use stays bounded and
+    the file still reads as one stream with zcat or gzip.open.  An index
+    file (path + '.idx') lists the byte offset, length and time range of
+    every member, so that ndjson_source can seek to a time range without
+    decompressing the rest.  Both files are written under temporary names
+    and renamed into place at the end.
+
+    :param str path: Export file, e.g. 'cms-2018-03.ndjson.gz'
+    :param list fields: Fields of each record to write.  None writes
+        whole records
+    :param str time_field: Field whose range each chunk's index entry
+        records.  Always written, so that records can be filtered by time
+        when read back
+    :param int chunk_bytes: Uncompressed bytes per gzip member
+    :param int level: gzip compression level
+    """
+    def __init__(self, path, fields=None, time_field='EndTime',
+                 chunk_bytes=DEFAULT_CHUNK_BYTES, level=6, name=None):
+        super(NDJSONSink, self).__init__(name)
+        self.path = path
+        self.fields = list(fields) if fields is not None else None
+        if self.fields is not None and time_field not in self.fields:
+            self.fields.append(time_field)
+        self.time_field = time_field
+        self.chunk_bytes = chunk_bytes
+        self.level = level
+        self.chunks = []
+        self.nrecords = 0
+        self._buffer = []
+        self._buffered = 0
+        self._times = None
+        self._offset = 0
+        fd, self._tmppath = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)),
+            prefix=os.path.basename(path) + '.')
+        self._file = os.fdopen(fd, 'wb')
+
+    def process(self, batch):
+        for r in batch:
+            if self.fields is not None:
+                r = dict((f, r[f]) for f in self.fields if f in r)
+            line = json.dumps(r, sort_keys=True, default=_json_default)
+            self._buffer.append(line)
+            self._buffered += len(line) + 1
+            t = r.get(self.time_field)
+            if t is not None:
+                t = _epoch_ms(t)
+                self._times = (t, t) if self._times is None else \
+                    (min(self._times[0], t), max(self._times[1], t))
+            if self._buffered >= self.chunk_bytes:
+                self.__flush()
+        self.nrecords += len(batch)
+
+    def __flush(self):
+        """Write the buffer as one gzip member, and index it"""
+        if not self._buffer:
+            return
+        gz = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        data = gz.compress('\n'.join(self._buffer) + '\n') + gz.flush()
+        self._file.write(data)
+        start, end = self._times if self._times is not None else (None, None)
+        self.chunks.append({'offset': self._offset, 'length': len(data),
+                            'records': len(self._buffer), 'start': start,
+                            'end': end})
+        self._offset += len(data)
+        self._buffer = []
+        self._buffered = 0
+        self._times = None
+
+    def finish(self):
+        self.__flush()
+        self._file.close()
+        index = {'fields': self.fields, 'time_field': self.time_field,
+                 'records': self.nrecords, 'chunks': self.chunks}
+        with open(self._tmppath + '.idx', 'w') as f:
+            json.dump(index, f, sort_keys=True)
+        os.rename(self._tmppath, self.path)
+        os.rename(self._tmppath + '.idx', self.path + '.idx')
+
+    def cleanup(self):
+        self._file.close()
+        for path in (self._tmppath, self._tmppath + '.idx'):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def result(self):
+        return self.path
+
+
+class Pipeline(object):
+    """A chain of stages ending in a sink
+
+    :param list stages: Stage instances, in order
+    :param Sink sink: Last stage
+    """
+    def __init__(self, stages, sink):
+        self.stages = list(stages)
+        self.sink = sink
+        self.source_stats = StageStats('source')
+
+    @property
+    def stats(self):
+        """StageStats for the source, each stage, and the sink"""
+        return [self.source_stats] + \
+            [stage.stats for stage in self.stages + [self.sink]]
+
+    def run(self, source):
+        """Push every batch from source through the pipeline
+
+        :param source: Iterable of batches (lists) of records
+        :return: Return value of the sink's result()
+        """
+        target = self.sink.coroutine(None)
+        for stage in reversed(self.stages):
+            target = stage.coroutine(target)
+
+        source = iter(source)
+        try:
+            while True:
+                t0 = time.time()
+                try:
+                    batch = next(source)
+                except StopIteration:
+                    break
+                finally:
+                    self.source_stats.seconds += time.time() - t0
+                self.source_stats.batches += 1
+                self.source_stats.records_out += len(batch)
+                target.send(batch)
+            target.close()
+        except BaseException:
+            for stage in self.stages + [self.sink]:
+                stage.abort()
+            raise
+        return self.sink.result()
+
+    def stats_table(self):
+        """Stats of each stage as a text table"""
+        rows = [s.row() for s in self.stats]
+        columns = dict((col, [row[i] for row in rows])
+                       for i, col in enumerate(StageStats.header))
+        return TextUtils.TextUtils(StageStats.header).printAsTextTable(
+            'text', columns)
+
+    def log_stats(self, logger):
+        """Log the stats of each stage at INFO level
+
+        :param logger: logging.Logger
+        """
+        for s in self.stats:
+            logger.info("Pipeline stage {0}: {1} batches, {2} records in, {3} "
+                        "records out, {4:.3f}s".format(
+                            s.name, s.batches, s.records_in, s.records_out,
+                            s.seconds))
+
+
+def _epoch_ms(value):
+    """Convert a datetime, date string, or epoch ms number to epoch ms.
+    Naive datetimes are UTC"""
+    if isinstance(value, (int, long, float)):
+        return int(value)
+    if not isinstance(value, datetime):
+        value = parser.parse(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=tz.tzutc())
+    return timegm(value.utctimetuple()) * 1000 + value.microsecond // 1000
+
+
+def _in_range(value, lo, hi):
+    """Is a record's time in [lo, hi)?  Records without a time are kept"""
+    if value is None:
+        return True
+    t = _epoch_ms(value)
+    return (lo is None or t >= lo) and (hi is None or t < hi)
+
+
+def _json_default(value):
+    """Encode datetimes in exported records as ISO 8601"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError("{0!r} is not JSON serializable".format(value))
+
+
+def _csv_value(value):
+    """Encode unicode for the csv module"""
+    return value.encode('utf-8') if isinstance(value, unicode) else value
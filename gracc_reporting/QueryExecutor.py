@@ -0,0 +1,294 @@
+"""Execute elasticsearch_dsl Searches against one or more Elasticsearch hosts
+with per-query timeouts, retries with jittered exponential backoff on
+transient errors, and optional hedged requests:  if the first host hasn't
+answered by a percentile of its recent latencies, the same request is sent to
+the next fastest host, and whichever answers first wins.  An optional
+Governor caps the queries and scrolls in flight and rate limits each host."""
+
+import random
+import threading
+import time
+import Queue
+from collections import deque, OrderedDict
+
+from elasticsearch.exceptions import ConnectionError, TransportError
+from elasticsearch_dsl import Search
+from elasticsearch_dsl.connections import connections
+
+import QueryProfile
+
+TRANSIENT_STATUSES = (429, 502, 503, 504)
+_MIN_HEDGE_SAMPLES = 5
+
+
+def is_transient_error(e):
+    """Is this an error worth retrying?  Connection errors and timeouts,
+    and HTTP 429/502/503/504 responses.
+
+    :param Exception e: Exception raised while running a query
+    :return bool:
+    """
+    if isinstance(e, ConnectionError):
+        return True
+    return isinstance(e, TransportError) and \
+        e.status_code in TRANSIENT_STATUSES
+
+
+class HostStats(object):
+    """Latency tracker for one host
+
+    :param int window: Number of recent latencies to keep
+    :param float alpha: Weight of the newest sample in the moving average
+    """
+    def __init__(self, window=100, alpha=0.3):
+        self.samples = deque(maxlen=window)
+        self.alpha = alpha
+        self.ewma = None
+        self.errors = 0
+
+    def record(self, latency):
+        """Record a successful request's latency in seconds"""
+        self.samples.append(latency)
+        self.ewma = latency if self.ewma is None \
+            else self.alpha * latency + (1 - self.alpha) * self.ewma
+
+    def record_error(self):
+        """Record a failed request.  Counts as a slow request, so that the
+        host is tried after healthier ones"""
+        self.errors += 1
+        if self.samples:
+            self.record(max(self.samples) * 2)
+
+    def percentile(self, p):
+        """p-th percentile of recent latencies, or None if there are too few
+        samples to say"""
+        if len(self.samples) < _MIN_HEDGE_SAMPLES:
+            return None
+        ordered = sorted(self.samples)
+        idx = min(int(round(p / 100.0 * (len(ordered) - 1))), len(ordered) - 1)
+        return ordered[idx]
+
+
+class QueryExecutor(object):
+    """Runs Searches on the fastest of a set of Elasticsearch clients
+
+    :param clients: OrderedDict of {host: elasticsearch.Elasticsearch}, or a
+        single client
+    :param float timeout: Default per-request timeout, in seconds
+    :param int retries: Number of retries on transient errors
+    :param float backoff: Base backoff, in seconds.  Retry n sleeps for a
+        random time between 0 and min(backoff * 2**n, backoff_max)
+    :param float backoff_max: Maximum backoff, in seconds
+    :param float hedge_percentile: If set, send a duplicate request to the
+        next fastest host once the first host's request has been outstanding
+        for this percentile of its recent latencies.  None disables hedging
+    :param Governor.Governor governor: Limits to run queries and scrolls
+        under.  None for no limits
+    """
+    def __init__(self, clients, timeout=60, retries=0, backoff=1.0,
+                 backoff_max=30.0, hedge_percentile=None, governor=None):
+        if not isinstance(clients, dict):
+            clients = OrderedDict([('default', clients)])
+        self.clients = clients
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.hedge_percentile = hedge_percentile
+        self.governor = governor
+        self.stats = dict((host, HostStats()) for host in clients)
+        self._lock = threading.Lock()
+        self._sleep = time.sleep
+
+    def ranked_hosts(self):
+        """Hosts ordered fastest first.  Hosts with no latency samples yet
+        come first, in configured order, so that every host gets measured
+
+        :return list: Host names
+        """
+        with self._lock:
+            order = dict((h, i) for i, h in enumerate(self.clients))
+            return sorted(self.clients, key=lambda h: (
+                self.stats[h].ewma is not None, self.stats[h].ewma, order[h]))
+
+    def execute(self, search, timeout=None, raw=False):
+        """Execute the search, retrying on transient errors.  Searches
+        built with one of our clients (or none) may be sent to any host;
+        searches using some other client are run on that client.
+
+        :param Search search: elasticsearch_dsl Search to execute
+        :param float timeout: Timeout for this request, in seconds.  Defaults
+            to self.timeout
+        :param bool raw: Return the decoded response body as a plain dict,
+            without wrapping it in an elasticsearch_dsl Response
+        :return Response: elasticsearch_dsl Response, or dict if raw
+        """
+        timeout = timeout if timeout is not None else self.timeout
+        search = search.params(request_timeout=timeout)
+        own = search._using == 'default' or \
+            any(search._using is c for c in self.clients.itervalues())
+        attempt = 0
+        while True:
+            try:
+                if not own:
+                    return self.__execute_on(None, search, raw)
+                if self.hedge_percentile is not None and len(self.clients) > 1:
+                    return self.__execute_hedged(search, raw)
+                return self.__execute_on(self.ranked_hosts()[0], search, raw)
+            except Exception as e:
+                if attempt >= self.retries or not is_transient_error(e):
+                    raise
+                self._sleep(random.uniform(
+                    0, min(self.backoff * 2 ** attempt, self.backoff_max)))
+                attempt += 1
+
+    def __execute_on(self, host, search, raw=False):
+        """Execute search on host, and record the latency.  If host is
+        None, run it on the search's own client"""
+        if host is None:
+            with self.__governed('query', 'default'):
+                return _raw_search(search) if raw else search.execute()
+        start = time.time()
+        try:
+            search = search.using(self.clients[host])
+            with self.__governed('query', host):
+                response = _raw_search(search) if raw else search.execute()
+        except Exception:
+            with self._lock:
+                self.stats[host].record_error()
+            raise
+        with self._lock:
+            self.stats[host].record(time.time() - start)
+        return response
+
+    def scan(self, search):
+        """Scan all hits of a Search, holding a scroll slot of the governor
+        while the scroll is open.  Searches built with one of our clients
+        (or none) are scanned on the fastest host.
+
+        :param Search search: elasticsearch_dsl Search to scan
+        :return generator: Hits, as Search.scan returns them
+        """
+        host = 'default'
+        if search._using == 'default' or \
+                any(search._using is c for c in self.clients.itervalues()):
+            host = self.ranked_hosts()[0]
+            search = search.using(self.clients[host])
+        with self.__governed('scroll', host):
+            # Search's own scan, since an ExecutorSearch's comes back here
+            for hit in Search.scan(search):
+                yield hit
+
+    def __governed(self, kind, host):
+        """Governor's query or scroll context for host, or a no-op context
+        if there's no governor"""
+        if self.governor is None:
+            return _NullContext()
+        return getattr(self.governor, kind)(host)
+
+    def __execute_hedged(self, search, raw=False):
+        """Execute search on the fastest host, and if it hasn't answered by
+        its hedge_percentile latency, on the next fastest as well.  Return
+        the first successful response, or raise the last error if all fail.
+        The winning request's decode time and response size go to the
+        calling thread's LatencyTimer, if there is one"""
+        hosts = self.ranked_hosts()
+        results = Queue.Queue()
+        timer = QueryProfile.current_timer()
+
+        def worker(host):
+            # The caller's timer is thread-local, so time the request here
+            own_timer = QueryProfile.LatencyTimer()
+            try:
+                with own_timer:
+                    response = self.__execute_on(host, search, raw)
+                results.put((True, response, own_timer))
+            except Exception as e:
+                results.put((False, e, None))
+
+        def start(host):
+            t = threading.Thread(target=worker, args=(host, ))
+            t.daemon = True
+            t.start()
+
+        with self._lock:
+            delay = self.stats[hosts[0]].percentile(self.hedge_percentile)
+        start(hosts[0])
+        outstanding = 1
+        hedged = False
+
+        error = None
+        while outstanding:
+            try:
+                ok, value, own_timer = results.get(
+                    timeout=delay if not hedged and delay is not None
+                    else None)
+            except Queue.Empty:
+                # First host is slow.  Hedge.
+                start(hosts[1])
+                outstanding += 1
+                hedged = True
+                continue
+            outstanding -= 1
+            if ok:
+                if timer is not None:
+                    timer.add(own_timer)
+                return value
+            error = value
+            if not hedged:
+                # First host failed outright.  Try the next one now.
+                start(hosts[1])
+                outstanding += 1
+                hedged = True
+        raise error
+
+
+class ExecutorSearch(Search):
+    """Search whose scan() runs through a QueryExecutor, so that the scroll
+    goes to the fastest host and holds a scroll slot of the governor.
+    Copies made by the Search methods (filter, params, ...) keep the
+    executor.  Use wrap() to make one from a Search."""
+    executor = None
+
+    @classmethod
+    def wrap(cls, search, executor):
+        """ExecutorSearch with the same request as search
+
+        :param Search search: elasticsearch_dsl Search
+        :param QueryExecutor executor: Executor to scan with
+        :return ExecutorSearch:
+        """
+        s = cls(using=search._using, index=search._index,
+                doc_type=search._doc_type)
+        s.update_from_dict(search.to_dict())
+        s._doc_type_map = search._doc_type_map.copy()
+        s._params = search._params.copy()
+        s._response_class = search._response_class
+        s.executor = executor
+        return s
+
+    def _clone(self):
+        s = super(ExecutorSearch, self)._clone()
+        s.executor = self.executor
+        return s
+
+    def scan(self):
+        if self.executor is None:
+            return super(ExecutorSearch, self).scan()
+        return self.executor.scan(self)
+
+
+class _NullContext(object):
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+
+def _raw_search(search):
+    """Run a Search with its client's search method, like Search.execute
+    does, but return the decoded body without wrapping it in a Response"""
+    es = connections.get_connection(search._using)
+    return es.search(index=search._index, doc_type=search._doc_type,
+                     body=search.to_dict(), **search._params)
@@ -0,0 +1,262 @@
+"""Cost estimates for a report's query, from a cheap probe instead of the full
+aggregation:  a size=0 search for the query's hit count, with a cardinality
+aggregation on the field of each terms aggregation.  From these, the number
+of buckets at each level of the aggregation and the size of the response are
+estimated, and a number of partitions is suggested for paging through the
+outermost terms aggregation (see Pipeline.terms_pages_source).
+
+Cardinality aggregations are approximate (HyperLogLog), and nested levels
+are estimated as if every combination of terms occurred (bounded by the
+number of hits), so the estimates are upper bounds rather than predictions.
+"""
+
+import math
+
+from elasticsearch_dsl import Search
+
+import TextUtils
+from TimeUtils import parse_duration
+
+# Rough JSON sizes in bytes, for response size estimates
+BUCKET_BYTES = 60
+METRIC_BYTES = 40
+HIT_BYTES = 1000
+# Buckets a single response should hold before the query is paged
+DEFAULT_MAX_BUCKETS = 10000
+
+# Calendar intervals of date_histogram, in seconds (months and years are
+# taken at their longest)
+_CALENDAR_INTERVALS = {'minute': 60, '1m': 60, 'hour': 3600, '1h': 3600,
+                       'day': 86400, '1d': 86400, 'week': 7 * 86400,
+                       '1w': 7 * 86400, 'month': 31 * 86400,
+                       '1M': 31 * 86400, 'quarter': 92 * 86400,
+                       '1q': 92 * 86400, 'year': 366 * 86400,
+                       '1y': 366 * 86400}
+_BUCKET_AGGS = ('terms', 'date_histogram', 'histogram', 'filters', 'filter',
+                'range', 'date_range')
+
+
+class AggLevel(object):
+    """Estimate for one bucket aggregation in the aggregation tree
+
+    :param str path: Names of the aggregation and its parents, joined by
+        '>'
+    :param str atype: Aggregation type (terms, date_histogram, ...)
+    :param str field: Field bucketed on, if any
+    :param int per_parent: Estimated buckets in each parent bucket
+    :param int metrics: Number of metric aggregations in each bucket
+    """
+    def __init__(self, path, atype, field, per_parent, metrics):
+        self.path = path
+        self.atype = atype
+        self.field = field
+        self.per_parent = per_parent
+        self.metrics = metrics
+        self.cardinality = None
+        self.buckets = None
+
+
+class QueryPlan(object):
+    """Estimated cost of a query
+
+    :param list indices: Indices the query is sent to
+    :param int hits: Number of documents the query matches
+    :param list levels: AggLevels, parents before children
+    :param int size: Number of hits the query returns
+    :param int max_buckets: Buckets a single response should hold
+    """
+    def __init__(self, indices, hits, levels, size=0,
+                 max_buckets=DEFAULT_MAX_BUCKETS):
+        self.indices = indices
+        self.hits = hits
+        self.levels = levels
+        self.size = size
+        self.max_buckets = max_buckets
+
+    @property
+    def buckets(self):
+        """Estimated number of buckets in the response"""
+        return sum(level.buckets for level in self.levels)
+
+    @property
+    def response_bytes(self):
+        """Estimated size of the response body in bytes"""
+        agg_bytes = sum(level.buckets * (BUCKET_BYTES +
+                                         METRIC_BYTES * level.metrics)
+                        for level in self.levels)
+        return agg_bytes + min(self.size, self.hits) * HIT_BYTES
+
+    @property
+    def partitions(self):
+        """Suggested num_partitions for paging through the outermost terms
+        aggregation, so that each page holds at most max_buckets buckets.
+        1 means the query can run in one piece"""
+        if not self.levels or self.levels[0].atype != 'terms':
+            return 1
+        return max(1, int(math.ceil(float(self.buckets) / self.max_buckets)))
+
+    def to_dict(self):
+        """Plan as a JSON-able dict"""
+        return {'indices': self.indices, 'hits': self.hits,
+                'buckets': self.buckets,
+                'response_bytes': self.response_bytes,
+                'partitions': self.partitions,
+                'levels': [{'path': l.path, 'type': l.atype,
+                            'field': l.field, 'cardinality': l.cardinality,
+                            'per_parent': l.per_parent,
+                            'buckets': l.buckets, 'metrics': l.metrics}
+                           for l in self.levels]}
+
+    def format(self):
+        """Plan as text, for printing
+
+        :return str:
+        """
+        lines = ["Indices: {0}".format(', '.join(self.indices) or 'none'),
+                 "Hits: {0}".format(self.hits),
+                 "Estimated buckets: {0}".format(self.buckets),
+                 "Estimated response size: {0:.1f} kB".format(
+                     self.response_bytes / 1024.0),
+                 "Suggested partitions: {0}".format(self.partitions)]
+        if self.levels:
+            header = ['Aggregation', 'Type', 'Field', 'Cardinality',
+                      'Per parent', 'Buckets']
+            columns = dict((col, []) for col in header)
+            for l in self.levels:
+                for col, value in zip(header, (
+                        l.path, l.atype, l.field or '',
+                        l.cardinality if l.cardinality is not None else '',
+                        l.per_parent, l.buckets)):
+                    columns[col].append(value)
+            lines.append(TextUtils.TextUtils(header).printAsTextTable(
+                'text', columns))
+        return '\n'.join(lines)
+
+
+class QueryPlanner(object):
+    """Estimates the cost of Searches with cheap probe queries
+
+    :param client: elasticsearch.Elasticsearch client to probe with
+    :param int max_buckets: Buckets a single response should hold
+    :param execute: Function that takes a Search and returns a Response
+        (e.g. Reporter.executor.execute).  Defaults to Search.execute
+    """
+    def __init__(self, client, max_buckets=DEFAULT_MAX_BUCKETS,
+                 execute=None):
+        self.client = client
+        self.max_buckets = max_buckets
+        self.execute = execute
+
+    def plan(self, search, start=None, end=None):
+        """Estimate the cost of a Search without running its aggregations
+
+        :param Search search: elasticsearch_dsl Search
+        :param datetime start: Start of the query's time range, for
+            date_histogram bucket counts
+        :param datetime end: End of the query's time range
+        :return QueryPlan:
+        """
+        body = search.to_dict()
+        indices = _index_list(search._index)
+        query = body.get('query', {'match_all': {}})
+        levels = agg_levels(body.get('aggs', {}), start, end)
+
+        # One probe:  its total hits, and the cardinality of each terms
+        # field
+        fields = sorted(set(l.field for l in levels if l.atype == 'terms'))
+        probe = {'size': 0, 'query': query}
+        if fields:
+            probe['aggs'] = dict(
+                ('c{0}'.format(i), {'cardinality': {'field': f}})
+                for i, f in enumerate(fields))
+        s = Search(using=self.client, index=indices or None)\
+            .update_from_dict(probe)
+        response = (self.execute(s) if self.execute is not None
+                    else s.execute()).to_dict()
+        hits = response['hits']['total']
+
+        if fields:
+            cards = dict((f, response['aggregations']['c{0}'.format(i)]
+                          ['value']) for i, f in enumerate(fields))
+            for level in levels:
+                if level.atype == 'terms':
+                    level.cardinality = cards[level.field]
+                    level.per_parent = min(level.per_parent,
+                                           level.cardinality)
+
+        # Buckets at each level:  buckets per parent times the parent's
+        # buckets, but never more than one bucket per hit (except for
+        # aggregations that always return all their buckets)
+        totals = {}
+        for level in levels:
+            parent = level.path.rpartition('>')[0]
+            level.buckets = level.per_parent * totals.get(parent, 1)
+            if level.atype in ('terms', 'date_histogram', 'histogram'):
+                level.buckets = min(level.buckets, hits)
+            totals[level.path] = level.buckets
+
+        return QueryPlan(indices, hits, levels, size=body.get('size', 10),
+                         max_buckets=self.max_buckets)
+
+
+def agg_levels(aggs, start=None, end=None, parent=''):
+    """Bucket aggregations in an aggregation tree, with the number of
+    buckets each one makes per parent bucket, before any probes
+
+    :param dict aggs: 'aggs' part of a Search body
+    :param datetime start: Start of the query's time range
+    :param datetime end: End of the query's time range
+    :param str parent: Path of the parent aggregation
+    :return list: AggLevels, parents before children
+    """
+    levels = []
+    for name in sorted(aggs):
+        spec = dict(aggs[name])
+        sub = spec.pop('aggs', {})
+        spec.pop('meta', None)
+        atype, params = spec.items()[0]
+        if atype not in _BUCKET_AGGS:
+            continue
+        path = '{0}>{1}'.format(parent, name) if parent else name
+        metrics = len([n for n, s in sub.iteritems()
+                       if not set(s) & set(_BUCKET_AGGS)])
+        level = AggLevel(path, atype, params.get('field'),
+                         _per_parent(atype, params, start, end), metrics)
+        levels.append(level)
+        levels.extend(agg_levels(sub, start, end, path))
+    return levels
+
+
+def _per_parent(atype, params, start, end):
+    """Most buckets an aggregation can make in each parent bucket"""
+    if atype == 'terms':
+        return params.get('size', 10)
+    if atype == 'filter':
+        return 1
+    if atype == 'filters':
+        return len(params['filters']) + (1 if params.get('other_bucket')
+                                         else 0)
+    if atype in ('range', 'date_range'):
+        return len(params.get('ranges', []))
+    if atype == 'date_histogram' and start is not None and end is not None:
+        step = _interval_seconds(params.get('interval'))
+        span = (end - start).total_seconds()
+        return int(math.ceil(span / step)) + 1
+    return 1
+
+
+def _interval_seconds(interval):
+    """Length of a date_histogram interval in seconds"""
+    if interval in _CALENDAR_INTERVALS:
+        return _CALENDAR_INTERVALS[interval]
+    return parse_duration(interval).total_seconds()
+
+
+def _index_list(index):
+    """Index names from a Search's _index (None, a string, or a list)"""
+    if index is None:
+        return []
+    if isinstance(index, basestring):
+        index = [index, ]
+    return [i.strip() for part in index for i in part.split(',') if i.strip()]
+
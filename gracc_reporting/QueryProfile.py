@@ -0,0 +1,226 @@
+"""Diagnosing slow queries.  Two pieces:
+
+* A latency breakdown of each query:  the time Elasticsearch says the
+  search took, the time spent decoding the JSON response, and the rest of
+  the wall time (network, queueing, and client overhead).  Decode time is
+  measured by wrapping the deserializer of the clients' transports.
+  The timer belongs to the thread that started it; code that runs a query
+  in another thread (e.g. QueryExecutor's hedged requests) times it there
+  with a LatencyTimer of its own and hands the result back with
+  LatencyTimer.add.
+* Condensed results of Elasticsearch's profile API (a search with
+  "profile": true):  the slowest shards, and the slowest query, collector,
+  and aggregation components across all shards.
+"""
+
+import json
+import os
+import threading
+import time
+
+_local = threading.local()
+
+
+class _TimingDeserializer(object):
+    """Wraps a transport's deserializer, adding the time spent decoding
+    responses to the current thread's LatencyTimer, if there is one"""
+    def __init__(self, wrapped):
+        self.wrapped = wrapped
+
+    def loads(self, s, mimetype=None):
+        timer = getattr(_local, 'timer', None)
+        if timer is None:
+            return self.wrapped.loads(s, mimetype)
+        start = time.time()
+        try:
+            return self.wrapped.loads(s, mimetype)
+        finally:
+            timer.decode += time.time() - start
+            timer.response_bytes += len(s)
+
+
+def install(client):
+    """Time the response decoding of an elasticsearch.Elasticsearch client.
+    Does nothing for clients without a transport (e.g. test fakes), or
+    that are already instrumented.
+
+    :param client: elasticsearch.Elasticsearch client
+    """
+    transport = getattr(client, 'transport', None)
+    if transport is None or \
+            isinstance(transport.deserializer, _TimingDeserializer):
+        return
+    transport.deserializer = _TimingDeserializer(transport.deserializer)
+
+
+def current_timer():
+    """LatencyTimer running in the current thread, or None"""
+    return getattr(_local, 'timer', None)
+
+
+class LatencyTimer(object):
+    """Context manager timing a query in the current thread.  After the
+    block, set took (ms, from the response) to get the breakdown.
+
+    :param list clients: elasticsearch.Elasticsearch clients the query may
+        run on
+    """
+    def __init__(self, clients=()):
+        for client in clients:
+            install(client)
+        self.wall = 0.0
+        self.decode = 0.0
+        self.response_bytes = 0
+        self.took = None
+        self._start = None
+        self._outer = None
+
+    def __enter__(self):
+        self._outer = getattr(_local, 'timer', None)
+        _local.timer = self
+        self._start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.wall = time.time() - self._start
+        _local.timer = self._outer
+        return False
+
+    def add(self, other):
+        """Count the decode time and response bytes of a timer that ran in
+        another thread (see current_timer) as part of this one
+
+        :param LatencyTimer other: Timer to add
+        """
+        self.decode += other.decode
+        self.response_bytes += other.response_bytes
+
+    def breakdown(self):
+        """Latency breakdown in milliseconds
+
+        :return dict: {'wall', 'took', 'network', 'decode'}.  network is the
+            wall time not accounted for by took and decode
+        """
+        wall = self.wall * 1000
+        decode = self.decode * 1000
+        took = self.took if self.took is not None else 0
+        return {'wall': wall, 'took': self.took, 'decode': decode,
+                'network': max(wall - took - decode, 0.0)}
+
+    def format(self):
+        """Breakdown for the log"""
+        b = self.breakdown()
+        return "wall {0:.0f} ms, took {1} ms, network {2:.0f} ms, decode " \
+               "{3:.0f} ms".format(b['wall'], b['took'] if b['took'] is
+                                   not None else '?', b['network'],
+                                   b['decode'])
+
+
+def _ms(nanos):
+    return nanos / 1e6
+
+
+def _nanos(node):
+    """Time of a profile node in nanoseconds.  Some Elasticsearch 5.x
+    versions only give a string time, like 1.234ms"""
+    if 'time_in_nanos' in node:
+        return node['time_in_nanos']
+    text = str(node.get('time', '0ms'))
+    for unit, scale in (('nanos', 1), ('micros', 1e3), ('ms', 1e6),
+                        ('s', 1e9)):
+        if text.endswith(unit):
+            try:
+                return float(text[:-len(unit)]) * scale
+            except ValueError:
+                break
+    return 0
+
+
+def _components(nodes, kind, shard, out, depth=0):
+    """Flatten a profile tree (query or aggregation nodes) into out"""
+    for node in nodes:
+        name = node.get('description') or node.get('name', '')
+        out.append({'shard': shard, 'kind': kind,
+                    'type': node.get('type', node.get('reason', '')),
+                    'description': name[:200], 'depth': depth,
+                    'time_ms': _ms(_nanos(node))})
+        _components(node.get('children', []), kind, shard, out, depth + 1)
+
+
+def summarize_profile(profile, top=10):
+    """Condense the profile section of a response:  the slowest shards, and
+    the slowest components (query nodes, collectors, aggregations) across
+    all shards.  Child components' times are included in their parents'.
+
+    :param dict profile: 'profile' of a search response made with
+        "profile": true
+    :param int top: Number of shards and components to keep
+    :return dict: {'shards': [{'id', 'query_ms', 'collector_ms',
+        'rewrite_ms', 'aggregation_ms', 'total_ms'}, ...], 'components':
+        [{'shard', 'kind', 'type', 'description', 'depth', 'time_ms'}, ...]}
+    """
+    shards = []
+    components = []
+    for shard in profile.get('shards', []):
+        sid = shard.get('id')
+        query_ns = collector_ns = rewrite_ns = 0
+        for search in shard.get('searches', []):
+            query_ns += sum(_nanos(q) for q in search.get('query', []))
+            rewrite_ns += search.get('rewrite_time', 0)
+            collector_ns += sum(_nanos(c)
+                                for c in search.get('collector', []))
+            _components(search.get('query', []), 'query', sid, components)
+            _components(search.get('collector', []), 'collector', sid,
+                        components)
+        agg_ns = sum(_nanos(a) for a in shard.get('aggregations', []))
+        _components(shard.get('aggregations', []), 'aggregation', sid,
+                    components)
+        shards.append({'id': sid, 'query_ms': _ms(query_ns),
+                       'collector_ms': _ms(collector_ns),
+                       'rewrite_ms': _ms(rewrite_ns),
+                       'aggregation_ms': _ms(agg_ns),
+                       'total_ms': _ms(query_ns + rewrite_ns + agg_ns)})
+
+    shards.sort(key=lambda s: s['total_ms'], reverse=True)
+    components.sort(key=lambda c: c['time_ms'], reverse=True)
+    return {'shards': shards[:top], 'components': components[:top]}
+
+
+class ProfileLog(object):
+    """JSON file collecting the profile summaries of a report run's queries.
+    The file is rewritten (atomically) after each query.
+
+    :param str path: File to write
+    """
+    def __init__(self, path):
+        self.path = path
+        self.queries = []
+
+    def add(self, query, timer, profile=None, top=10):
+        """Add a query's latency breakdown and profile summary, and rewrite
+        the file
+
+        :param dict query: Search body
+        :param LatencyTimer timer: Timer of the query
+        :param dict profile: 'profile' section of the response, if any
+        :param int top: Number of shards and components to keep
+        :return dict: Entry that was added
+        """
+        entry = {'time': time.time(), 'query': query,
+                 'latency_ms': timer.breakdown(),
+                 'response_bytes': timer.response_bytes}
+        if profile:
+            entry.update(summarize_profile(profile, top))
+        self.queries.append(entry)
+        self.write()
+        return entry
+
+    def write(self):
+        """Write the file"""
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        tmp = '{0}.tmp'.format(self.path)
+        with open(tmp, 'w') as f:
+            json.dump({'queries': self.queries}, f, sort_keys=True, indent=2)
+        os.rename(tmp, self.path)
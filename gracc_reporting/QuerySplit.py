@@ -0,0 +1,285 @@
+"""Helpers for running an aggregation query in pieces:  splitting a time
+range, recognizing the errors that splitting can fix, merging the partial
+aggregations back together, and remembering how finely a report's range had
+to be split so later runs can start there.  After a number of runs in a row
+succeed at the remembered depth, the next run tries one level shallower, so
+a report that once needed splitting doesn't pay for it forever."""
+
+import json
+import math
+import os
+from datetime import timedelta
+
+from elasticsearch.exceptions import ConnectionTimeout, TransportError
+
+# Aggregations whose partial results can be combined
+_METRIC_MERGES = {
+    'sum': lambda a, b: (a or 0) + (b or 0),
+    'value_count': lambda a, b: (a or 0) + (b or 0),
+    'min': lambda a, b: b if a is None else a if b is None else min(a, b),
+    'max': lambda a, b: b if a is None else a if b is None else max(a, b),
+}
+_MULTI_BUCKET_AGGS = ('terms', 'date_histogram', 'histogram', 'range',
+                      'date_range', 'filters')
+_SINGLE_BUCKET_AGGS = ('filter', 'missing', 'global', 'nested',
+                       'reverse_nested')
+_SPLIT_ERROR_MARKERS = ('too_many_buckets', 'timed_out', 'timeout')
+# Runs in a row that must succeed at the recorded split depth before trying
+# one level shallower
+DEFAULT_RELAX_AFTER = 5
+
+
+class UnmergeableAggregationError(ValueError):
+    pass
+
+
+def split_range(start, end, n):
+    """Split the time range [start, end) into n consecutive equal pieces
+
+    :param datetime start: Start of range
+    :param datetime end: End of range
+    :param int n: Number of pieces
+    :return list: (start, end) tuples
+    """
+    n = max(int(n), 1)
+    step = (end - start) / n
+    bounds = [start + step * i for i in range(n)] + [end, ]
+    return zip(bounds[:-1], bounds[1:])
+
+
+def is_split_error(e):
+    """Is this an error that running the query over a smaller time range
+    might fix?  That's a client-side timeout, or Elasticsearch complaining
+    about too many buckets or timing out.
+
+    :param Exception e: Exception raised while running a query
+    :return bool:
+    """
+    if isinstance(e, ConnectionTimeout):
+        return True
+    if isinstance(e, TransportError):
+        text = '{0} {1}'.format(e.error, json.dumps(e.info, default=str)) \
+            if len(e.args) > 2 else str(e)
+        return any(m in text for m in _SPLIT_ERROR_MARKERS)
+    return False
+
+
+def merge_aggs(spec, a, b):
+    """Merge two partial aggregation results for the same aggregation spec
+    (e.g. from the same query run over two halves of a time range).
+
+    Bucket doc_counts and sum/value_count metrics are added, min/max take
+    the min/max, and buckets are matched up by key.  Other metrics (avg,
+    cardinality, ...) can't be merged exactly, and raise
+    UnmergeableAggregationError.
+
+    Merged terms buckets are cut back to the aggregation's size, so the
+    result is approximate, like terms over several shards:  a term that
+    missed the top size of each part but would make the top size overall
+    is missing, and the counts of terms that only made some parts' top
+    size are too low.  Give terms aggregations a size large enough to hold
+    every term (or to leave a margin) when that matters.
+
+    :param dict spec: Aggregations part of the query (Search.to_dict()['aggs'])
+    :param dict a: Aggregations part of the first response
+    :param dict b: Aggregations part of the second response
+    :return dict: Merged aggregations
+    """
+    merged = {}
+    for name, agg_spec in spec.iteritems():
+        if name not in a or name not in b:
+            merged[name] = a.get(name, b.get(name))
+            continue
+        agg_type, params = _agg_type(agg_spec)
+        sub = agg_spec.get('aggs', {})
+        if agg_type in _METRIC_MERGES:
+            merged[name] = {'value': _METRIC_MERGES[agg_type](
+                a[name].get('value'), b[name].get('value'))}
+        elif agg_type in _SINGLE_BUCKET_AGGS:
+            merged[name] = _merge_bucket(sub, a[name], b[name])
+        elif agg_type in _MULTI_BUCKET_AGGS:
+            merged[name] = _merge_multi_bucket(agg_type, params, sub,
+                                               a[name], b[name])
+        else:
+            raise UnmergeableAggregationError(
+                "Can't merge partial results of {0} aggregation {1}".format(
+                    agg_type, name))
+    return merged
+
+
+def is_mergeable(spec):
+    """Can merge_aggs merge partial results of these aggregations?  False if
+    any of them, or any of their sub-aggregations, is a metric like avg or
+    cardinality that can't be merged exactly.
+
+    :param dict spec: Aggregations part of the query (Search.to_dict()['aggs'])
+    :return bool:
+    """
+    for agg_spec in spec.itervalues():
+        agg_type, _ = _agg_type(agg_spec)
+        if agg_type not in _METRIC_MERGES and \
+                agg_type not in _SINGLE_BUCKET_AGGS and \
+                agg_type not in _MULTI_BUCKET_AGGS:
+            return False
+        if not is_mergeable(agg_spec.get('aggs', {})):
+            return False
+    return True
+
+
+def _agg_type(agg_spec):
+    """Return (type, params) of an aggregation spec dict"""
+    for k, v in agg_spec.iteritems():
+        if k not in ('aggs', 'meta'):
+            return k, v
+
+
+def _merge_bucket(sub, a, b):
+    """Merge two buckets of the same key"""
+    merged = dict(a)
+    merged['doc_count'] = a.get('doc_count', 0) + b.get('doc_count', 0)
+    merged.update(merge_aggs(sub, a, b))
+    return merged
+
+
+def _merge_multi_bucket(agg_type, params, sub, a, b):
+    """Merge two multi-bucket aggregation results"""
+    merged = dict(a)
+    for k in ('sum_other_doc_count', 'doc_count_error_upper_bound'):
+        if k in a or k in b:
+            merged[k] = a.get(k, 0) + b.get(k, 0)
+
+    if isinstance(a['buckets'], dict):
+        # Keyed buckets, like named filters
+        buckets = dict(a['buckets'])
+        for key, bucket in b['buckets'].iteritems():
+            buckets[key] = _merge_bucket(sub, buckets[key], bucket) \
+                if key in buckets else bucket
+        merged['buckets'] = buckets
+        return merged
+
+    if agg_type == 'filters':
+        # Anonymous filters: buckets line up by position
+        merged['buckets'] = [_merge_bucket(sub, x, y)
+                             for x, y in zip(a['buckets'], b['buckets'])]
+        return merged
+
+    buckets = {}
+    order = []
+    for bucket in a['buckets'] + b['buckets']:
+        key = bucket['key']
+        if key in buckets:
+            buckets[key] = _merge_bucket(sub, buckets[key], bucket)
+        else:
+            buckets[key] = bucket
+            order.append(key)
+    merged['buckets'] = [buckets[key] for key in order]
+
+    if agg_type in ('date_histogram', 'histogram'):
+        merged['buckets'].sort(key=lambda x: x['key'])
+    elif agg_type == 'terms':
+        merged['buckets'] = _sort_terms(merged['buckets'], params)
+    return merged
+
+
+def _sort_terms(buckets, params):
+    """Re-apply a terms aggregation's order and size to merged buckets.
+    This drops buckets, so see the caveat in merge_aggs"""
+    order = params.get('order', {'_count': 'desc'})
+    if isinstance(order, list):
+        order = order[0]
+    (okey, odir), = order.items()
+    if okey in ('_key', '_term'):
+        getter = lambda x: x['key']
+    elif okey == '_count':
+        getter = lambda x: x['doc_count']
+    else:
+        getter = lambda x: x[okey]['value']
+    buckets = sorted(buckets, key=lambda x: x['key'])
+    buckets.sort(key=getter, reverse=(odir == 'desc'))
+    return buckets[:params.get('size', len(buckets))]
+
+
+class SplitHistory(object):
+    """JSON file recording, per report, how small a time slice its
+    aggregation query last had to be split into to succeed, and how many
+    runs in a row have succeeded at that depth since.  Once relax_after
+    runs have, the next run starts one level shallower (slices twice as
+    long).  If that works, the shallower depth is recorded.  If not, it's
+    tried again after another relax_after runs.
+
+    :param str path: Filename of the JSON history file
+    :param int relax_after: Runs to succeed at the recorded depth before
+        trying one level shallower
+    """
+    def __init__(self, path, relax_after=DEFAULT_RELAX_AFTER):
+        self.path = path
+        self.relax_after = relax_after
+        try:
+            with open(path, 'r') as f:
+                self.history = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.history = {}
+
+    def get_span(self, key):
+        """Slice length that last succeeded for key
+
+        :param str key: Report identifier
+        :return timedelta: Slice length, or None if nothing is recorded
+        """
+        try:
+            return timedelta(seconds=self.history[key]['span_seconds'])
+        except KeyError:
+            return None
+
+    def initial_slices(self, key, start, end):
+        """Number of slices to split [start, end) into from the outset
+
+        :return int: Number of slices
+        """
+        span = self.get_span(key)
+        if not span:
+            return 1
+        if self.__relaxing(key):
+            span *= 2
+        return max(int(math.ceil(_seconds(end - start) / _seconds(span))), 1)
+
+    def record(self, key, depth, span):
+        """Record the split depth and slice length that succeeded for key,
+        and save the history file.  A run that succeeded at the recorded
+        slice length counts towards trying a shallower depth.
+
+        :param str key: Report identifier
+        :param int depth: Number of halvings needed
+        :param timedelta span: Length of the smallest slice that succeeded
+        :return None:
+        """
+        old = self.get_span(key)
+        if depth == 0:
+            self.history.pop(key, None)
+        elif old is not None and not self.__relaxing(key) and \
+                _seconds(span) >= 0.75 * _seconds(old):
+            # As deep as last time:  one more success at this depth
+            self.history[key]['successes'] = \
+                self.history[key].get('successes', 0) + 1
+        else:
+            # Deeper, shallower, or a failed attempt at shallower:  start
+            # counting again
+            self.history[key] = {'depth': depth,
+                                 'span_seconds': _seconds(span),
+                                 'successes': 0}
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        tmp = '{0}.tmp'.format(self.path)
+        with open(tmp, 'w') as f:
+            json.dump(self.history, f, sort_keys=True, indent=2)
+        os.rename(tmp, self.path)
+
+    def __relaxing(self, key):
+        """Is the next run of key to try one level shallower?"""
+        return self.history.get(key, {}).get('successes', 0) >= \
+            self.relax_after
+
+
+def _seconds(td):
+    return td.days * 86400 + td.seconds + td.microseconds / 1e6
@@ -0,0 +1,86 @@
+"""Helpers for walking aggregation results as plain dicts (run_query with
+raw=True, or raw_response = True on the report class).  elasticsearch_dsl
+wraps every dict it hands out in a new AttrDict or Bucket object on each
+attribute access, which adds up for large nested aggregations.  These
+functions only do dict lookups.
+
+    aggs = self.run_query(raw=True)
+    for (site, vo), bucket in RawAggs.walk(aggs, ['Site', 'VO']):
+        hours = RawAggs.value(bucket, 'CoreHours')
+"""
+
+
+def buckets(agg):
+    """Buckets of a bucket aggregation as a list.  Keyed buckets (filters
+    aggregation) come back as a list too, with their keys added.
+
+    :param dict agg: Raw aggregation result, e.g. aggs['Site']
+    :return list: Bucket dicts
+    """
+    b = agg.get('buckets', [])
+    if isinstance(b, dict):
+        return [dict(bucket, key=key) for key, bucket in sorted(b.iteritems())]
+    return b
+
+
+def walk(aggs, path):
+    """Walk nested bucket aggregations
+
+    :param dict aggs: Raw aggregations (or a bucket) containing path[0]
+    :param list path: Names of the nested bucket aggregations, outermost
+        first, e.g. ['Site', 'VO']
+    :return generator: (tuple of keys, innermost bucket dict) for every
+        innermost bucket
+    """
+    name = path[0]
+    rest = path[1:]
+    for bucket in buckets(aggs[name]):
+        if rest:
+            for keys, inner in walk(bucket, rest):
+                yield (bucket['key'], ) + keys, inner
+        else:
+            yield (bucket['key'], ), bucket
+
+
+def value(bucket, name, default=None):
+    """Value of a single-value metric in a bucket
+
+    :param dict bucket: Raw bucket
+    :param str name: Name of the metric aggregation
+    :param default: Returned if the metric is missing or null
+    :return: Value of metric
+    """
+    metric = bucket.get(name)
+    if metric is None:
+        return default
+    v = metric.get('value')
+    return default if v is None else v
+
+
+def columns(aggs, path, metrics, key_names=None, doc_count=None):
+    """Nested bucket aggregations as a dict of columns, ready to return from
+    format_report
+
+    :param dict aggs: Raw aggregations
+    :param list path: Names of the nested bucket aggregations (see walk)
+    :param list metrics: Names of the metrics of the innermost buckets to
+        add as columns
+    :param list key_names: Column names for the keys.  Defaults to path
+    :param str doc_count: If given, add each bucket's doc count as a column
+        with this name
+    :return dict: {column name: [values]}
+    """
+    key_names = key_names if key_names is not None else path
+    names = list(key_names) + list(metrics) + \
+        ([doc_count] if doc_count is not None else [])
+    cols = dict((name, []) for name in names)
+    key_cols = [cols[name] for name in key_names]
+    metric_cols = [(cols[name], name) for name in metrics]
+    for keys, bucket in walk(aggs, path):
+        for col, key in zip(key_cols, keys):
+            col.append(key)
+        for col, name in metric_cols:
+            col.append(value(bucket, name))
+        if doc_count is not None:
+            cols[doc_count].append(bucket['doc_count'])
+    return cols
@@ -0,0 +1,272 @@
+"""Recorded Elasticsearch responses, for load tests and benchmarks that
+shouldn't touch the real cluster.  RecordingClient wraps a real client and
+writes every search request and its response to a JSON lines file.
+ReplayClient answers the same searches from such a file, in process, after
+the recorded (or a fixed) latency.  StandInServer serves them over HTTP on
+localhost, so that reports can connect to it with a normal Elasticsearch
+client and go through the whole transport (HTTP, JSON encoding and decoding).
+
+Requests are matched on their index and body.  A request that wasn't
+recorded gets a 404.  The server takes gzipped request bodies, and gzips its
+responses for clients that accept it, like Elasticsearch with
+http.compression enabled.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import json
+import socket
+import threading
+import time
+import urlparse
+import zlib
+
+from elasticsearch.exceptions import TransportError
+
+
+def request_key(index, body):
+    """Key that a search request is recorded and replayed under
+
+    :param index: Index pattern (string or list)
+    :param dict body: Search body
+    :return str:
+    """
+    if isinstance(index, (list, tuple)):
+        index = ','.join(index)
+    return json.dumps([index or '', body or {}], sort_keys=True)
+
+
+class Recording(object):
+    """Search requests and their responses
+
+    :param str path: JSON lines file of {'index', 'body', 'response'}
+        records.  None for an empty recording
+    """
+    def __init__(self, path=None):
+        self.responses = {}
+        if path is not None:
+            with open(path, 'r') as f:
+                for line in f:
+                    if line.strip():
+                        rec = json.loads(line)
+                        self.add(rec['index'], rec['body'], rec['response'])
+
+    def add(self, index, body, response):
+        """Add a request and its response.  Later responses to the same
+        request replace earlier ones."""
+        self.responses[request_key(index, body)] = response
+
+    def lookup(self, index, body):
+        """Recorded response to a request
+
+        :return dict: Response, or None if the request wasn't recorded
+        """
+        return self.responses.get(request_key(index, body))
+
+    def requests(self):
+        """Recorded requests, in a stable order
+
+        :return list: (index, body) pairs
+        """
+        return [tuple(json.loads(key)) for key in sorted(self.responses)]
+
+    def __len__(self):
+        return len(self.responses)
+
+
+class RecordingClient(object):
+    """Wraps an elasticsearch.Elasticsearch client, appending each search
+    and its response to a JSON lines file.  Everything else is passed
+    through to the wrapped client.
+
+    :param client: Client to wrap
+    :param str path: File to append to
+    """
+    def __init__(self, client, path):
+        self._client = client
+        self._path = path
+        self._lock = threading.Lock()
+
+    def search(self, index=None, doc_type=None, body=None, **kwargs):
+        response = self._client.search(index=index, doc_type=doc_type,
+                                       body=body, **kwargs)
+        line = json.dumps({'index': index, 'body': body,
+                           'response': response}, sort_keys=True)
+        with self._lock:
+            with open(self._path, 'a') as f:
+                f.write(line + '\n')
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+class ReplayClient(object):
+    """Stand-in for elasticsearch.Elasticsearch that answers searches from a
+    Recording
+
+    :param Recording recording: Recorded responses
+    :param latency: Seconds to wait before answering, or 'recorded' to wait
+        for each response's took
+    """
+    def __init__(self, recording, latency='recorded'):
+        self.recording = recording
+        self.latency = latency
+        self.requests = 0
+
+    def search(self, index=None, doc_type=None, body=None, **kwargs):
+        self.requests += 1
+        response = self.recording.lookup(index, body)
+        if response is None:
+            raise TransportError(404, 'not_recorded',
+                                 {'index': index, 'body': body})
+        delay = response.get('took', 0) / 1000.0 \
+            if self.latency == 'recorded' else self.latency
+        if delay:
+            time.sleep(delay)
+        return response
+
+    def count(self, index=None, doc_type=None, body=None, **kwargs):
+        response = self.search(index=index, body=dict(body or {}, size=0))
+        return {'count': response['hits']['total']}
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    """Threaded HTTP server that keeps track of its open connections, so
+    that keep-alive connections can be closed when it stops"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, *args, **kwargs):
+        BaseHTTPServer.HTTPServer.__init__(self, *args, **kwargs)
+        self.open_requests = set()
+        self.requests_lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        with self.requests_lock:
+            self.open_requests.add(request)
+        SocketServer.ThreadingMixIn.process_request(self, request,
+                                                    client_address)
+
+    def shutdown_request(self, request):
+        with self.requests_lock:
+            self.open_requests.discard(request)
+        BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+    def close_requests(self):
+        """Close every open connection"""
+        with self.requests_lock:
+            requests = list(self.open_requests)
+        for request in requests:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves recorded searches.  self.server.standin is the StandInServer"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        self.__send(200, '')
+
+    def do_GET(self):
+        self.__handle()
+
+    def do_POST(self):
+        self.__handle()
+
+    def __handle(self):
+        url = urlparse.urlparse(self.path)
+        length = int(self.headers.getheader('content-length') or 0)
+        raw = self.rfile.read(length) if length else ''
+        if raw and self.headers.getheader('content-encoding') == 'gzip':
+            raw = zlib.decompress(raw, 16 + zlib.MAX_WBITS)
+        parts = [p for p in url.path.split('/') if p]
+        standin = self.server.standin
+
+        if not parts:
+            return self.__send(200, json.dumps({'version': {
+                'number': '5.6.0'}, 'tagline': 'You Know, for Search'}))
+        if parts == ['_cluster', 'health']:
+            return self.__send(200, json.dumps({'status': 'green'}))
+        if parts[-1] not in ('_search', '_count'):
+            return self.__send(404, json.dumps({'error': 'not supported'}))
+
+        index = parts[0] if len(parts) > 1 else None
+        body = json.loads(raw) if raw else {}
+        if parts[-1] == '_count':
+            body = dict(body, size=0)
+        response = standin.recording.lookup(index, body)
+        if response is None:
+            return self.__send(404, json.dumps({'error': 'not_recorded'}))
+        if standin.latency:
+            time.sleep(response.get('took', 0) / 1000.0
+                       if standin.latency == 'recorded' else standin.latency)
+        if parts[-1] == '_count':
+            response = {'count': response['hits']['total']}
+        self.__send(200, json.dumps(response))
+
+    def __send(self, status, data):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        if data and 'gzip' in (self.headers.getheader('accept-encoding') or
+                               ''):
+            gz = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            data = gz.compress(data) + gz.flush()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+class StandInServer(object):
+    """Local HTTP server answering searches from a Recording, in a
+    background thread
+
+    :param Recording recording: Recorded responses
+    :param latency: Seconds to wait before answering, 'recorded', or 0
+    :param int port: Port to listen on.  0 picks a free port
+    """
+    def __init__(self, recording, latency=0, port=0):
+        self.recording = recording
+        self.latency = latency
+        self.httpd = _ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+        self.httpd.standin = self
+        self._thread = None
+
+    @property
+    def url(self):
+        """URL to connect clients to"""
+        return 'http://127.0.0.1:{0}'.format(self.httpd.server_address[1])
+
+    def start(self):
+        """Start serving in a daemon thread
+
+        :return StandInServer: self
+        """
+        self._thread = threading.Thread(target=self.httpd.serve_forever,
+                                        kwargs={'poll_interval': 0.05})
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving"""
+        self.httpd.shutdown()
+        self.httpd.close_requests()
+        self.httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
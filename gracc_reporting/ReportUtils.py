@@ -1,6 +1,8 @@
 import abc
 import argparse
-from datetime import datetime
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import math
 import sys
 import smtplib
 from email.mime.text import MIMEText
@@ -11,17 +13,62 @@ import pkg_resources
 import json
 import toml
 import copy
+import hashlib
+import cPickle
 import httplib
+import multiprocessing
+from calendar import timegm
+from collections import OrderedDict
 
 from elasticsearch import Elasticsearch, client
+from elasticsearch_dsl import A, Q
+from elasticsearch_dsl.search import AggsProxy
+from elasticsearch_dsl.utils import AttrDict
 
 import TextUtils
 import TimeUtils
 from IndexPattern import indexpattern_generate
-
-__all__ = ['Reporter', 'runerror', 'coroutine', 'get_report_parser']
+from IndexCatalog import IndexCatalog, DEFAULT_TTL, catalog_pattern
+import IndexSources
+from RollupStore import RollupStore
+from ColumnStore import ColumnStore
+from GroupBy import ExternalGroupBy, DEFAULT_MEMORY_LIMIT
+import QuerySplit
+from QueryExecutor import QueryExecutor, ExecutorSearch
+from Governor import get_governor
+import BucketOrder
+import Datasets
+from MemProfile import MemoryProfiler
+from Checkpoint import Checkpoint, CheckpointedScan, fingerprint, \
+    search_after_pages, DEFAULT_INTERVAL as DEFAULT_CHECKPOINT_INTERVAL
+from QueryPlanner import QueryPlanner, DEFAULT_MAX_BUCKETS
+import QueryProfile
+import Transport
+import Metrics
+
+__all__ = ['Reporter', 'QueryPlanned', 'runerror', 'coroutine',
+           'get_report_parser']
 
 OK_ES_STATUSES=['green',]
+DEFAULT_ES_HOST = 'https://gracc.opensciencegrid.org/q'
+
+# Parsed config files, keyed by (path, mtime, size), so long-running processes don't
+# re-parse them for every report
+_config_cache = {}
+
+# Reporter attributes that are never sent to render processes (see
+# Reporter.render_job)
+_RENDER_EXCLUDE = ('client', 'host_clients', 'executor', 'logger',
+                   'smtp_connection', '_prefetched', 'memprofiler',
+                   '_datasets', 'metrics')
+
+
+class QueryPlanned(Exception):
+    """Raised by Reporter.run_query instead of running the query when the
+    report was started with --plan.  The query's QueryPlan is in .plan"""
+    def __init__(self, plan):
+        super(QueryPlanned, self).__init__(plan.format())
+        self.plan = plan
 
 
 class ContextFilter(logging.Filter):
@@ -38,10 +85,30 @@ class ContextFilter(logging.Filter):
         :param LogRecord record: Logger record to append info to
         :return bool: Success or not
         """
-        record.vo = self.vo
+        if not hasattr(record, 'vo'):
+            # Records from a ReportLogger already carry their VO
+            record.vo = self.vo
         return True
 
 
+class ReportLogger(logging.LoggerAdapter):
+    """A report type's logger, as used by one Reporter instance.  Records
+    carry the instance's VO, so instances sharing the logger (e.g. in the
+    Scheduler's thread pool) don't relabel each other's log lines.  Other
+    attributes (handlers, setLevel, ...) are those of the logger.
+
+    :param logging.Logger logger: Logger of the report type
+    :param str vo: VO to inject into records
+    """
+    def __init__(self, logger, vo=None):
+        logging.LoggerAdapter.__init__(self, logger, {'vo': vo})
+
+    def __getattr__(self, name):
+        if name == 'logger':
+            raise AttributeError(name)
+        return getattr(self.logger, name)
+
+
 class Reporter(object):
     """
     Base class for all OSG reports
@@ -57,9 +124,34 @@ class Reporter(object):
     :param str althost_key: Alternate Elasticsearch Host key from config file.
         Must be specified in [elasticsearch] section of
         config file by name (e.g. my_es_cluster="https://hostname.me")
+    :param OrderedDict host_clients: {hostname: Elasticsearch client} of
+        already established clients (e.g. another Reporter's host_clients)
+        to use instead of connecting to the cluster
+    :param smtplib.SMTP smtp_connection: Open SMTP connection to send emails
+        through, instead of connecting to the smtphost for each email
+    :param bool plan: If true, run_query prints an estimate of the query's
+        cost (see plan_query) and raises QueryPlanned instead of running the
+        query
+    :param bool query_profile: If true, run queries with Elasticsearch's
+        profile API, and save a summary of each next to the log file
+    :param str backfill: If set (e.g. '1w'), send_report runs the report for
+        each period of this length in the time range, with one query (see
+        run_backfill)
+    :param str backfill_dir: Write backfilled reports to this directory
+        instead of emailing them
     """
     __metaclass__ = abc.ABCMeta
 
+    # Names of the Datasets this report uses (see Reporter.dataset)
+    datasets = ()
+    # Fields and finest time bucket (e.g. '1d') the report's query needs, used
+    # to pick between the report's index_sources.  None means unknown
+    query_fields = None
+    query_granularity = None
+    # If True, run_query returns aggregations as plain dicts (see RawAggs)
+    # instead of elasticsearch_dsl AttrDicts
+    raw_response = False
+
     __optional_kwargs = {
         'althost_key': None,
         'index_key': 'index_pattern',
@@ -68,7 +160,13 @@ class Reporter(object):
         'logfile': None,
         'is_test': False,
         'no_email': False, 
-        'verbose': False        
+        'verbose': False,
+        'host_clients': None,
+        'smtp_connection': None,
+        'plan': False,
+        'query_profile': False,
+        'backfill': None,
+        'backfill_dir': None
     }
 
     def __init__(self, report_type, config_file, start, end, **kwargs):
@@ -82,13 +180,33 @@ class Reporter(object):
         self.end_time = TimeUtils.parse_datetime(end)
 
         self.header = []
+        self._prefetched = None
+        self._datasets = None
+        self.index_catalog = None
+        self._source_plan = None
+        self._profile_log = None
+        self.index_sources = self.__get_index_sources()
         if self.vo is not None: 
             self.vo = self.__check_vo(self.vo)
         self.indexpattern = self.indexpattern_generate(self.index_key,
                                                        start=self.start_time,
                                                        end=self.end_time)
         self.email_info = self.__get_email_info()
-        self.client = self.__establish_client()
+        if self.host_clients:
+            # Reuse warm clients.  The first one is the default.
+            self.client = self.host_clients.values()[0]
+        else:
+            self.host_clients = OrderedDict()
+            self.client = self.__establish_client()
+        self.executor = self.__get_executor()
+        self.memprofiler = self.__get_memory_profiler()
+        self.metrics = self.__new_metrics()
+        self._collecting_metrics = False
+        self.index_catalog = self.__get_index_catalog()
+        if self.index_catalog is not None:
+            # Now that we can ask the cluster, narrow the index pattern down
+            self.indexpattern = self.indexpattern_generate(
+                self.index_key, start=self.start_time, end=self.end_time)
 
     # Report methods that must or should be implemented in subclasses
     @abc.abstractmethod
@@ -102,16 +220,44 @@ class Reporter(object):
         in the Reporter and report-specific class.  Must be overridden."""
         pass
 
-    def run_query(self, overridequery=None):
+    def run_query(self, overridequery=None, timeout=None, raw=None):
         """Execute the query and check the status code before returning the
         relevant info
 
+        :param overridequery: Function returning the Search to run, instead
+            of self.query
+        :param float timeout: Timeout for this query, in seconds.  Defaults
+            to query_timeout in the report's config section, then to the
+            [elasticsearch] timeout
+        :param bool raw: Run the query through the low-level client and
+            return the aggregations as the plain decoded dict, skipping
+            elasticsearch_dsl's Response wrappers.  Defaults to the
+            raw_response class attribute
+
         :return Response.aggregations OR ES Search object: If the results are
         aggregated (response has aggregations property), returns aggregations
         property of elasticsearch response (most reports).  If not, return the
         search object itself, so it can be scanned using .scan() (JSR, for
-        example)
+        example).  Its scan runs through the QueryExecutor, within the
+        governor's scroll cap
         """
+        raw = self.raw_response if raw is None else raw
+        if overridequery is None and self._prefetched is not None:
+            # Results were already fetched for us (e.g. by run_vo_fanout)
+            return _wrap_aggs(self._prefetched, raw)
+
+        if self.plan:
+            plan = self.plan_query(overridequery)
+            print plan.format()
+            self.logger.info("Query plan: {0}".format(
+                json.dumps(plan.to_dict(), sort_keys=True)))
+            raise QueryPlanned(plan)
+
+        if overridequery is None and self._source_plan is not None and \
+                len(self._source_plan) > 1:
+            results = self.__run_query_sources(timeout)
+            if results is not None:
+                return _wrap_aggs(results, raw)
 
         s = overridequery() if overridequery is not None else self.query()
 
@@ -122,25 +268,507 @@ class Reporter(object):
         else:
             self.logger.debug(json.dumps(t, sort_keys=True))
 
-        try:
-            response = s.execute()
-            if not response.success():
-                raise Exception("Error accessing Elasticsearch")
-
-            if self.verbose:
-                print json.dumps(response.to_dict(), sort_keys=True, indent=4)
+        report_config = self.config.get(self.report_type.lower(), {})
+        if timeout is None:
+            timeout = report_config.get('query_timeout')
+        profiling = self.query_profile or \
+            report_config.get('query_profile', False)
+        if profiling:
+            s = s.extra(profile=True)
 
-            if hasattr(response, 'aggregations') and response.aggregations:
-                results = response.aggregations
-            else:
-                results = s
+        clients = self.host_clients.values()
+        if s._using != 'default':
+            clients.append(s._using)
 
-            self.logger.info('Ran elasticsearch query successfully')
+        try:
+            with self._phase('run_query'):
+                with QueryProfile.LatencyTimer(clients) as timer:
+                    response = self.executor.execute(s, timeout=timeout,
+                                                     raw=raw)
+                body = response if raw else response.to_dict()
+                timer.took = body.get('took')
+                shards = body.get('_shards', {})
+                if shards.get('total') != shards.get('successful') or \
+                        body.get('timed_out'):
+                    raise Exception("Error accessing Elasticsearch")
+
+                if self.verbose:
+                    print json.dumps(body, sort_keys=True, indent=4)
+
+                if body.get('aggregations'):
+                    results = body['aggregations'] if raw \
+                        else response.aggregations
+                else:
+                    # Scans of it go through the executor too
+                    results = ExecutorSearch.wrap(s, self.executor)
+
+            self.logger.info('Ran elasticsearch query successfully '
+                             '({0})'.format(timer.format()))
+            if self.metrics is not None:
+                self.metrics.observe_query(
+                    timer.wall, timer.took, timer.response_bytes,
+                    Metrics.count_buckets(body.get('aggregations') or {}))
+            if profiling:
+                self.__record_profile(t, timer, body.get('profile'))
             return results
         except Exception as e:
             self.logger.exception(e)
             raise
 
+    def __record_profile(self, query, timer, profile):
+        """Add a profiled query's summary to the profile file next to the
+        log file (<log name>.profile.json, or <report>.profile.json in the
+        state directory if there's no log file), and log its slowest shard"""
+        if self._profile_log is None:
+            if self.logfile is not None:
+                path = '{0}.profile.json'.format(
+                    os.path.splitext(self.logfile)[0])
+            else:
+                path = self.get_state_path('{0}.profile.json'.format(
+                    self.report_type.lower()))
+            self._profile_log = QueryProfile.ProfileLog(path)
+
+        top = self.config.get(self.report_type.lower(), {}).get(
+            'query_profile_top', 10)
+        entry = self._profile_log.add(query, timer, profile, top)
+        if entry.get('shards'):
+            slowest = entry['shards'][0]
+            self.logger.info(
+                "Slowest shard {0}: {1:.1f} ms (query {2:.1f} ms, "
+                "aggregations {3:.1f} ms).  Profile written to {4}".format(
+                    slowest['id'], slowest['total_ms'], slowest['query_ms'],
+                    slowest['aggregation_ms'], self._profile_log.path))
+
+    def __run_query_sources(self, timeout=None):
+        """Run the aggregation query on each piece of the index source
+        plan, and merge the results (see QuerySplit.merge_aggs).
+
+        :return dict: Merged aggregations, or None if the query has no
+            aggregations or has ones that can't be merged (e.g. avg), so it
+            has to run on one source
+        """
+        spec = self.query().to_dict().get('aggs')
+        if not spec:
+            return None
+        if not QuerySplit.is_mergeable(spec):
+            self.logger.debug("The query's aggregations can't be merged "
+                              "across index sources.  Running it on "
+                              "{0}".format(self.indexpattern))
+            return None
+
+        merged = None
+        for source, start, end in self._source_plan:
+            self.logger.info("Querying {0} for {1} - {2}".format(
+                source.pattern, start, end))
+            with self.time_window(start, end, sources=False):
+                self.indexpattern = self.__source_pattern(source, start, end)
+                part = self.run_query(timeout=timeout, raw=True)
+            merged = part if merged is None \
+                else QuerySplit.merge_aggs(spec, merged, part)
+        return merged
+
+    def plan_query(self, overridequery=None):
+        """Estimate the cost of the query with cheap probes (a count of the
+        hits, and the cardinality of each terms aggregation's field), without
+        running its aggregations.  Reports can use the estimate to decide
+        whether to page through the query, e.g.
+
+            plan = self.plan_query()
+            if plan.partitions > 1:
+                pages = Pipeline.terms_pages_source(
+                    self.query(), 'ProbeName', plan.partitions)
+
+        The number of buckets a response should hold is max_buckets in the
+        [elasticsearch] section of the config file.
+
+        :param overridequery: Function returning the Search to estimate,
+            instead of self.query
+        :return QueryPlanner.QueryPlan: Estimate
+        """
+        s = overridequery() if overridequery is not None else self.query()
+        client = s._using if s._using != 'default' else self.client
+        max_buckets = self.config.get('elasticsearch', {}).get(
+            'max_buckets', DEFAULT_MAX_BUCKETS)
+        return QueryPlanner(client, max_buckets=max_buckets,
+                            execute=self.executor.execute).plan(
+            s, self.start_time, self.end_time)
+
+    def run_query_adaptive(self, min_span=timedelta(hours=1), remember=True):
+        """Run the aggregation query, splitting the report's time range in
+        half and retrying each half whenever the query times out or trips
+        Elasticsearch's bucket limit, down to min_span.  Partial results are
+        merged (see QuerySplit.merge_aggs).
+
+        If remember is True, the slice length that succeeded is recorded, and
+        later runs of the same report start out split into slices of that
+        length.
+
+        :param timedelta min_span: Don't split time slices smaller than this
+        :param bool remember: Use and update the split history file
+        :return AttrDict: Merged aggregations, with the same attribute access
+            as run_query's return value (e.g. results.Site.buckets).  A plain
+            dict if raw_response is set
+        """
+        spec = self.query().to_dict().get('aggs')
+        if not spec:
+            raise ValueError("run_query_adaptive only works on queries with "
+                             "aggregations")
+
+        key = self.report_type.lower() if self.vo is None \
+            else '{0}.{1}'.format(self.report_type.lower(), self.vo.lower())
+        history = QuerySplit.SplitHistory(
+            self.get_state_path('split_history.json'))
+        nslices = history.initial_slices(key, self.start_time, self.end_time) \
+            if remember else 1
+
+        start, end = self.start_time, self.end_time
+        merged = None
+        spans = []
+        for sl_start, sl_end in QuerySplit.split_range(start, end, nslices):
+            part = self.__run_split(spec, sl_start, sl_end, min_span, spans)
+            merged = part if merged is None \
+                else QuerySplit.merge_aggs(spec, merged, part)
+
+        smallest = min(spans)
+        depth = 0 if smallest >= end - start else int(round(math.log(
+            QuerySplit._seconds(end - start) / QuerySplit._seconds(smallest),
+            2)))
+        self.logger.info("Query succeeded with time slices of {0} (split "
+                         "depth {1})".format(smallest, depth))
+        if remember:
+            history.record(key, depth, smallest)
+        return _wrap_aggs(merged, self.raw_response)
+
+    def __run_split(self, spec, start, end, min_span, spans):
+        """Run the query over [start, end), recursively splitting the range
+        in half on timeouts and bucket-limit errors.
+
+        :param list spans: Lengths of the slices that succeeded get
+            appended here
+        :return dict: Aggregations over [start, end)
+        """
+        try:
+            with self.time_window(start, end):
+                results = self.run_query(raw=True)
+            spans.append(end - start)
+            return results
+        except Exception as e:
+            if not QuerySplit.is_split_error(e) or (end - start) / 2 < min_span:
+                raise
+            self.logger.warning("Query over {0} - {1} failed with {2}. "
+                                "Splitting time range in half".format(
+                                    start, end, e))
+        mid = start + (end - start) / 2
+        return QuerySplit.merge_aggs(
+            spec,
+            self.__run_split(spec, start, mid, min_span, spans),
+            self.__run_split(spec, mid, end, min_span, spans))
+
+    def run_query_group_by(self, keys, reducers, overridequery=None,
+                           memory_limit=DEFAULT_MEMORY_LIMIT, tmpdir=None,
+                           checkpoint=False):
+        """Scan the (non-aggregated) query's hits into a bounded-memory
+        ExternalGroupBy, instead of accumulating them in dicts
+
+        :param list keys: Fields to group by
+        :param list reducers: (output name, reducer, field) tuples.  See
+            GroupBy.ExternalGroupBy
+        :param overridequery: Function returning the Search to run, instead
+            of self.query
+        :param int memory_limit: Approximate maximum bytes of groups to hold
+            in memory before spilling to disk
+        :param str tmpdir: Directory for spill files
+        :param bool checkpoint: Checkpoint the scan (see
+            run_query_checkpointed), so that a failed run can be resumed.
+            Spill files then go in the checkpoint directory
+        :return GroupBy.ExternalGroupBy: Filled group-by.  Call .columns() or
+            .results() on it, and .close() when done
+        """
+        if checkpoint:
+            tmpdir = tmpdir or self.get_state_path('checkpoints')
+            if not os.path.exists(tmpdir):
+                os.makedirs(tmpdir)
+            gb = ExternalGroupBy(keys, reducers, memory_limit=memory_limit,
+                                 tmpdir=tmpdir)
+            # Groups in memory are spilled before each checkpoint, so the
+            # checkpoint only has to hold the list of spill files
+            gb = self.run_query_checkpointed(
+                lambda state, hits: state.consume(hits), gb,
+                name='group_by', overridequery=overridequery,
+                prepare=lambda state: state.spill())
+            self.logger.info("Grouped {0} records ({1} spilled run(s))".format(
+                gb.nrecords, gb.nruns))
+            return gb
+
+        s = self.run_query(overridequery)
+        gb = ExternalGroupBy(keys, reducers, memory_limit=memory_limit,
+                             tmpdir=tmpdir)
+        try:
+            gb.consume(self.executor.scan(s))
+        except Exception:
+            gb.close()
+            raise
+        self.logger.info("Grouped {0} records ({1} spilled run(s))".format(
+            gb.nrecords, gb.nruns))
+        return gb
+
+    def run_query_checkpointed(self, consume, state, name='scan',
+                               overridequery=None, prepare=None):
+        """Scan the (non-aggregated) query's hits into a state, with
+        search_after paging instead of a scroll, writing a checkpoint of the
+        cursor and state every checkpoint_interval seconds (report config
+        section, default 60).  If a run of the same query (same report, VO
+        and time range) failed, the scan resumes from its last checkpoint.
+        See Checkpoint.CheckpointedScan.
+
+        :param consume: Function taking (state, list of hit dicts), that adds
+            the hits to the state
+        :param state: Initial state.  Must be picklable
+        :param str name: Name of the scan, to tell apart several checkpointed
+            scans in one report
+        :param overridequery: Function returning the Search to run, instead
+            of self.query
+        :param prepare: Function taking the state, called before each
+            checkpoint
+        :return: Final state
+        """
+        s = self.run_query(overridequery)
+        key = fingerprint(s)
+        path = self.get_state_path(os.path.join('checkpoints', '{0}-{1}-{2}'
+                                                '.ckpt'.format(
+                                                    self.report_type.lower(),
+                                                    name, key[:16])))
+        interval = self.config.get(self.report_type.lower(), {}).get(
+            'checkpoint_interval', DEFAULT_CHECKPOINT_INTERVAL)
+        scan = CheckpointedScan(s, Checkpoint(path, key), interval=interval,
+                                execute=self.executor.execute,
+                                logger=self.logger)
+        state = scan.run(state, consume, prepare)
+        self.logger.info("Scanned {0} records ({1} from checkpoint)".format(
+            scan.records, scan.resumed_from))
+        return state
+
+    def export_hits(self, path, fields=None, time_field='EndTime',
+                    overridequery=None, chunk_bytes=None):
+        """Stream the (non-aggregated) query's hits to a gzipped NDJSON
+        file, with an index file of each chunk's byte offset and time range
+        (see Pipeline.NDJSONSink and Pipeline.ndjson_source).  Hits are
+        paged in time order with search_after, so chunks cover consecutive
+        time ranges, and only one page and one chunk are held in memory.
+
+        :param str path: Export file, e.g. 'cms-2018-03.ndjson.gz'
+        :param list fields: Top-level fields to export.  None exports whole
+            records.  time_field is always exported
+        :param str time_field: Field to sort by and index chunks on
+        :param overridequery: Function returning the Search to run, instead
+            of self.query
+        :param int chunk_bytes: Uncompressed bytes per gzip member.
+            Defaults to export_chunk_bytes in the report's config section,
+            then Pipeline.DEFAULT_CHUNK_BYTES
+        :return dict: Index of the export (see Pipeline.read_ndjson_index)
+        """
+        # Pipeline imports this module
+        from Pipeline import Pipeline, NDJSONSink, read_ndjson_index, \
+            DEFAULT_CHUNK_BYTES
+
+        s = self.run_query(overridequery)
+        if fields is not None:
+            s = s.source(sorted(set(fields) | {time_field}))
+        if chunk_bytes is None:
+            chunk_bytes = self.config.get(self.report_type.lower(), {}).get(
+                'export_chunk_bytes', DEFAULT_CHUNK_BYTES)
+        pages = search_after_pages(s, sort=(time_field, '_uid'),
+                                   execute=self.executor.execute)
+        p = Pipeline([], NDJSONSink(path, fields, time_field=time_field,
+                                    chunk_bytes=chunk_bytes))
+        with self._phase('export'):
+            p.run(hits for hits, _ in pages)
+        p.log_stats(self.logger)
+        index = read_ndjson_index(path)
+        self.logger.info("Exported {0} records in {1} chunks to {2}".format(
+            index['records'], len(index['chunks']), path))
+        return index
+
+    def run_query_vo_fanout(self, vos=None, field='VOName'):
+        """Run self.query() once for several VOs, with the VO as an outer
+        filters aggregation, and split the results per VO.
+
+        self.vo_list is set to the union of the VOs' valid_vos while the
+        query is built, so query() must filter on self.vo_list (as VO reports
+        already do) for this to work.
+
+        :param list vos: VOs to run the query for.  Defaults to all VOs in
+            configured_vos that have a section under this report's config
+        :param str field: Elasticsearch field the VO names are stored in
+        :return dict: {vo: aggregations for that VO}.  Each value supports the
+            same access as run_query's return value (e.g. results.Site.buckets)
+        """
+        vos = vos if vos is not None else self.get_fanout_vos()
+        vo_lists = dict((vo, self.__get_vo_list(vo)) for vo in vos)
+
+        orig_vo_list = getattr(self, 'vo_list', None)
+        self.vo_list = sorted(set(v for l in vo_lists.itervalues() for v in l))
+        try:
+            s = self.query()
+        finally:
+            self.vo_list = orig_vo_list
+
+        fanout = A('filters', filters=dict(
+            (vo, Q('terms', **{field: vo_lists[vo]})) for vo in vos))
+        s = nest_aggs(s, 'vo_fanout', fanout)
+
+        results = self.run_query(overridequery=lambda: s, raw=True)
+        buckets = results['vo_fanout']['buckets']
+        return dict((vo, _wrap_aggs(buckets[vo], self.raw_response))
+                    for vo in vos)
+
+    def run_vo_fanout(self, vos=None, field='VOName', title=None,
+                      processes=1):
+        """Run the report for several VOs with a single Elasticsearch query.
+        For each VO, this instance is switched over to that VO (vo, vo_list,
+        email recipients, log tag) and send_report is called, with
+        run_query returning that VO's slice of the fanned-out results.
+
+        :param list vos: VOs to run the report for.  See run_query_vo_fanout
+        :param str field: Elasticsearch field the VO names are stored in
+        :param str title: Title for each VO's report.  May contain {vo},
+            which will be replaced by the VO name.  If None, self.title is used
+        :param int processes: If not 1, run format_report and render the
+            VOs' reports in a pool of this many processes (None for one per
+            CPU), and send them once they're all rendered.  See render_reports
+        :return None:
+        """
+        vos = vos if vos is not None else self.get_fanout_vos()
+        results = self.run_query_vo_fanout(vos, field)
+
+        orig = dict((k, self.__dict__[k]) for k in
+                    ('vo', 'vo_list', 'email_info') if k in self.__dict__)
+        try:
+            jobs = []
+            for vo in vos:
+                self.__switch_vo(vo)
+                self._prefetched = results[vo]
+                _title = title.format(vo=vo) if title is not None else None
+                if processes == 1:
+                    self.send_report(title=_title)
+                else:
+                    jobs.append(self.render_job(title=_title))
+
+            if jobs:
+                # Render every VO's slice in the pool, then send in order
+                for vo, rendered in zip(vos, render_reports(jobs, processes)):
+                    self.__switch_vo(vo)
+                    if not self.check_no_email(self.email_info['to']['email']):
+                        self.send_rendered(rendered)
+        finally:
+            self._prefetched = None
+            for k in ('vo', 'vo_list', 'email_info'):
+                if k in orig:
+                    setattr(self, k, orig[k])
+                else:
+                    self.__dict__.pop(k, None)
+            self.logger.extra['vo'] = self.vo
+        return
+
+    def run_backfill(self, interval, start=None, end=None, outdir=None,
+                     title=None, time_field='EndTime'):
+        """Run the report for each period of length interval in [start,
+        end) (e.g. each week of a year), with a single query.  The query's
+        aggregations are nested under a date_histogram with one bucket per
+        period, and for each period, the instance's time range is set to
+        the period and send_report (or write_report, with outdir) is called
+        with run_query returning that period's slice of the results.
+
+        Only works for reports whose format_report gets its data by calling
+        run_query() with no override.  Periods with no data are skipped.
+
+        :param str interval: Length of periods, e.g. '1d' or '1w'
+        :param datetime start: Start of first period.  Defaults to
+            self.start_time
+        :param datetime end: End of last period.  Defaults to self.end_time.
+            The last period is cut short at end
+        :param str outdir: Write each period's report here instead of
+            emailing it
+        :param str title: Title for each period's report.  May contain
+            {start} and {end}, e.g. '{start:%Y-%m-%d} report'.  If None,
+            self.title is used
+        :param str time_field: Field to bucket on
+        :return list: (period start, period end) of the reports that were run
+        """
+        start = start if start is not None else self.start_time
+        end = end if end is not None else self.end_time
+        step = int(TimeUtils.parse_duration(interval).total_seconds())
+        start_s = timegm(start.utctimetuple())
+        periods = []
+        pstart = start
+        while pstart < end:
+            periods.append((pstart, min(pstart + timedelta(seconds=step),
+                                        end)))
+            pstart += timedelta(seconds=step)
+
+        with self.time_window(start, end):
+            s = self.query()
+            if not s.to_dict().get('aggs'):
+                raise ValueError("Backfill needs a query with aggregations")
+            hist = A('date_histogram', field=time_field,
+                     interval='{0}s'.format(step),
+                     offset='{0}s'.format(start_s % step), min_doc_count=1)
+            s = nest_aggs(s, 'backfill', hist)
+            results = self.run_query(overridequery=lambda: s, raw=True)
+        buckets = dict((int(b['key']), b)
+                       for b in results['backfill']['buckets'])
+
+        orig_title = getattr(self, 'title', None)
+        done = []
+        try:
+            for pstart, pend in periods:
+                bucket = buckets.get(timegm(pstart.utctimetuple()) * 1000)
+                if bucket is None or not bucket.get('doc_count'):
+                    self.logger.info("No data for {0} - {1}.  "
+                                     "Skipping".format(pstart, pend))
+                    continue
+                _title = title.format(start=pstart, end=pend) \
+                    if title is not None else orig_title
+                self._prefetched = bucket
+                with self.time_window(pstart, pend, sources=False):
+                    if outdir is not None:
+                        self.write_report(outdir, title=_title)
+                    else:
+                        self.send_report(title=_title)
+                done.append((pstart, pend))
+        finally:
+            self._prefetched = None
+            self.title = orig_title
+        self.logger.info("Backfilled {0} of {1} periods".format(
+            len(done), len(periods)))
+        return done
+
+    def dataset(self, name):
+        """Get a named intermediate dataset (see Datasets).  When the report
+        is run by a Datasets.DatasetRunner, this is the value shared with the
+        other reports in the batch.  Otherwise, it's computed here (along
+        with the datasets it depends on) and kept for later calls.
+
+        :param str name: Name of dataset
+        :return: Value of dataset
+        """
+        if self._datasets is None:
+            self._datasets = {}
+        if name not in self._datasets:
+            Datasets.compute([name], self, self._datasets)
+        return self._datasets[name]
+
+    def get_fanout_vos(self):
+        """Get the VOs that this report is configured for: those in
+        configured_vos that also have a section under the report's section
+        of the config file.
+
+        :return list: VO names
+        """
+        report_cfg = self.config.get(self.report_type.lower(), {})
+        return [vo for vo in self.config.get('configured_vos', [])
+                if vo.lower() in report_cfg]
+
     def generate_report_file(self):
         """Method to generate the report file, if format_report below is not
         used."""
@@ -156,15 +784,66 @@ class Reporter(object):
 
         :param str title: Title of report, overrides self.title
         """
-        successmessage = successmessage if successmessage is not None \
-            else "Report sent successfully."
+        with self.collect_metrics():
+            if self.backfill is not None and self._prefetched is None:
+                return self.run_backfill(self.backfill,
+                                         outdir=self.backfill_dir,
+                                         title=title)
 
-        text = {}
-        content = self.format_report()
+            with self._phase('format_report'):
+                content = self.format_report()
 
-        if self.check_no_email(self.email_info['to']['email']):
-            return
+            if self.check_no_email(self.email_info['to']['email']):
+                return
 
+            with self._phase('render_report'):
+                rendered = self.render_report(content, title=title)
+            self.send_rendered(rendered, successmessage)
+        return
+
+    def write_report(self, outdir, title=None, basename=None):
+        """Render the report and write it to files instead of emailing it
+
+        :param str outdir: Directory to write to
+        :param str title: Title of report, overrides self.title
+        :param str basename: Name of files, without extension.  Defaults to
+            <report type>-<start time>
+        :return list: Paths of the files written (.txt, .csv, .html)
+        """
+        with self._phase('format_report'):
+            content = self.format_report()
+        with self._phase('render_report'):
+            rendered = self.render_report(content, title=title)
+
+        if not os.path.exists(outdir):
+            os.makedirs(outdir)
+        if basename is None:
+            basename = '{0}-{1:%Y%m%d%H%M}'.format(self.report_type.lower(),
+                                                   self.start_time)
+        paths = []
+        for fmt, ext in (('text', 'txt'), ('csv', 'csv'), ('html', 'html')):
+            if fmt not in rendered['text']:
+                continue
+            text = rendered['text'][fmt]
+            if isinstance(text, unicode):
+                text = text.encode('utf-8')
+            path = os.path.join(outdir, '{0}.{1}'.format(basename, ext))
+            with open(path, 'w') as f:
+                f.write(text)
+            paths.append(path)
+        self.logger.info("Wrote report to {0}".format(', '.join(paths)))
+        return paths
+
+    def render_report(self, content, title=None):
+        """Render format_report's content as text, csv, and html tables
+
+        :param dict content: {column name: [values]} returned by
+            format_report.  If None, self.text must have been set to the
+            report's HTML elsewhere
+        :param str title: Title of report, overrides self.title
+        :return dict: {'title': title, 'text': {format: rendered table},
+            'html_template': whether the html is a full page from a template}
+        """
         if title is not None: self.title = title
         if self.title is None: self.title = u"GRACC Report"
 
@@ -174,28 +853,19 @@ class Reporter(object):
             # Assume all necessary operations are handled elsewhere, and all we
             # need to do is send the email.  Need self.title, self.text to be
             # set prior to calling this
-            try:
-                TextUtils.sendEmail(
-                    (self.email_info['to']['name'],
-                     self.email_info['to']['email']),
-                    self.title,
-                    {"html": self.text},
-                    (self.email_info['from']['name'],
-                     self.email_info['from']['email']),
-                    self.email_info['smtphost'])
-
-                self.logger.info(successmessage)
-                return
-
-            except Exception as e:
-                self.logger.info(e)
-                raise
+            return {'title': self.title, 'text': {"html": self.text},
+                    'html_template': False}
 
         if not content:  # Check for any other falsy values like {}
             self.logger.error("There is no content being passed to generate a "
                               "report file")
             sys.exit(1)
 
+        if self.metrics is not None:
+            self.metrics.add('rows', max(len(col) for col in
+                                         content.itervalues()))
+
+        text = {}
         emailReport = TextUtils.TextUtils(self.header)
         text["text"] = emailReport.printAsTextTable("text", content)
         text["csv"] = emailReport.printAsTextTable("csv", content)
@@ -220,32 +890,304 @@ class Reporter(object):
             text["html"] = u"<html><body><h2>{0}</h2><table border=1>{1}</table></body></html>".format(
                 self.title, htmldata)
 
-        TextUtils.sendEmail((self.email_info['to']['name'],
-                             self.email_info['to']['email']),
-                            self.title, text,
-                            (self.email_info['from']['name'],
-                             self.email_info['from']['email']),
-                            self.email_info['smtphost'],
-                            html_template=self.template)
-        self.logger.info("Sent reports to {0}".format(
-            ", ".join(self.email_info['to']['email'])))
+        return {'title': self.title, 'text': text,
+                'html_template': bool(self.template)}
+
+    def send_rendered(self, rendered, successmessage=None):
+        """Email a report rendered by render_report
+
+        :param dict rendered: Return value of render_report
+        :param str successmessage: Message to log once the email is sent
+        :return None:
+        """
+        self.title = rendered['title']
+        try:
+            with self._phase('send_email'):
+                TextUtils.sendEmail(
+                    (self.email_info['to']['name'],
+                     self.email_info['to']['email']),
+                    rendered['title'], rendered['text'],
+                    (self.email_info['from']['name'],
+                     self.email_info['from']['email']),
+                    self.email_info['smtphost'],
+                    html_template=rendered['html_template'],
+                    smtp_connection=self.smtp_connection)
+        except Exception as e:
+            self.logger.info(e)
+            raise
+
+        if self.metrics is not None:
+            self.metrics.add('email_bytes', sum(
+                len(t) for t in rendered['text'].itervalues() if t))
+        self.logger.info(successmessage if successmessage is not None else
+                         "Sent reports to {0}".format(
+                             ", ".join(self.email_info['to']['email'])))
         return
 
+    def render_job(self, title=None):
+        """Run the report's query here, and package up what another process
+        needs to run format_report and render_report:  the report class,
+        this instance's picklable attributes, and the aggregations as a
+        plain dict.  No elasticsearch_dsl objects are included.  See
+        render_reports.
+
+        :param str title: Title of report, overrides self.title
+        :return tuple: (class, attributes, raw aggregations dict, title)
+        """
+        results = self.run_query(raw=True)
+        if not isinstance(results, dict):
+            raise ValueError("Only reports whose query returns aggregations "
+                             "can be rendered in another process")
+
+        state = {}
+        for attr, value in self.__dict__.iteritems():
+            if attr in _RENDER_EXCLUDE:
+                continue
+            try:
+                cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+            except Exception:
+                self.logger.debug("Not sending attribute {0} to render "
+                                  "process".format(attr))
+                continue
+            state[attr] = value
+        return type(self), state, results, title
+
     # Other methods
+    @contextmanager
+    def time_window(self, start, end, sources=True):
+        """Context manager that temporarily sets the report's time range
+        (start_time, end_time and indexpattern), so that self.query() builds
+        the query for [start, end).
+
+        :param datetime start: Start of window (UTC)
+        :param datetime end: End of window (UTC)
+        :param bool sources: Plan index sources for the window.  If False,
+            the query runs on a single index pattern
+        """
+        orig = (self.start_time, self.end_time, self.indexpattern,
+                self._source_plan)
+        self.start_time, self.end_time = start, end
+        self.indexpattern = self.indexpattern_generate(self.index_key,
+                                                       start=start, end=end)
+        if not sources:
+            self._source_plan = None
+        try:
+            yield
+        finally:
+            self.start_time, self.end_time, self.indexpattern, \
+                self._source_plan = orig
+
+    @contextmanager
+    def collect_metrics(self):
+        """Context manager around a run of the report.  When it exits, the
+        run's metrics are written to a .prom file in the [metrics]
+        textfile_dir, for node_exporter's textfile collector, whether the
+        run succeeded or not.  send_report runs in one, and so do the
+        Scheduler and JobQueue workers around run_report, so that failed
+        runs are recorded too.  A block inside another is part of the
+        outer run.  Does nothing if metrics are off.
+        """
+        if self.metrics is None or self._collecting_metrics:
+            yield
+            return
+        self._collecting_metrics = True
+        success = False
+        try:
+            yield
+            success = True
+        except QueryPlanned:
+            success = True
+            raise
+        except SystemExit as e:
+            success = e.code in (None, 0)
+            raise
+        finally:
+            self._collecting_metrics = False
+            self.metrics.finish(success)
+            path = os.path.join(self.config['metrics']['textfile_dir'],
+                                Metrics.textfile_name(self.report_type,
+                                                      self.vo))
+            try:
+                self.metrics.write(path)
+            except (IOError, OSError) as e:
+                self.logger.warning("Couldn't write metrics to {0}: "
+                                    "{1}".format(path, e))
+            # Start afresh for the next run
+            self.metrics = self.__new_metrics()
+
+    def _phase(self, name):
+        """Context manager that measures the memory used by a phase of the
+        report, if memory profiling is turned on in the config file ([memory]
+        profile = true), and its duration, if metrics are turned on
+        ([metrics] textfile_dir).  Does nothing otherwise.
+
+        :param str name: Name of phase
+        """
+        phase = _no_phase() if self.memprofiler is None \
+            else self.memprofiler.phase(name)
+        if self.metrics is None:
+            return phase
+        return self.metrics.phase(name, phase)
+
     def indexpattern_generate(self, index_key, **kwargs):
         """Returns the Elasticsearch index pattern based on the class
         variables of start time and end time, and the index pattern fed in.
 
+        If the index catalog is turned on ([elasticsearch] index_catalog =
+        true), the pattern is narrowed down to the indices that actually hold
+        data between start and end.
+
+        If the report's section has index_sources, the cheapest source
+        that can answer the query (see IndexSources) is used instead.  If the
+        range has to be split between sources, the plan is kept for
+        run_query, and the pattern returned is one that can answer the whole
+        range.
+
         :param str index_key: Config file key name under report section that
             points to the index pattern to be passed in
         :return str: Index pattern to be used in report
         """
+        start, end = kwargs.get('start'), kwargs.get('end')
+        if self.index_sources and index_key == self.index_key and \
+                start is not None and end is not None:
+            return self.__plan_index_sources(start, end)
+
         try:
             pat = self.config[self.report_type.lower()][index_key]
         except KeyError:
-            return 'gracc.osg.summary'
+            pat = None
+
+        pattern = indexpattern_generate(pattern=pat, **kwargs) \
+            if pat is not None else 'gracc.osg.summary'
+        if start is not None and end is not None and \
+                self.__catalog_loaded():
+            pattern = self.index_catalog.index_pattern(pattern, start, end,
+                                                       logger=self.logger)
+        return pattern
+
+    def __plan_index_sources(self, start, end):
+        """Plan which index sources answer [start, end), keep the plan in
+        self._source_plan, and return the index pattern for the whole range
 
-        return indexpattern_generate(pattern=pat, **kwargs)
+        :return str: Index pattern
+        """
+        granularity = TimeUtils.parse_duration(self.query_granularity) \
+            if self.query_granularity is not None else None
+        available = IndexSources.available_from_catalog(
+            self.index_catalog, self.index_sources) \
+            if self.__catalog_loaded() else None
+        plan = IndexSources.plan_sources(
+            self.index_sources, start, end, fields=self.query_fields,
+            granularity=granularity, available=available)
+        self._source_plan = plan
+        if len(plan) > 1:
+            self.logger.debug("Splitting {0} - {1} between index sources "
+                              "{2}".format(start, end, ', '.join(
+                                  source.pattern for source, _, _ in plan)))
+
+        # Pattern for queries that can't be split (e.g. scans):  the
+        # cheapest source that covers the whole range by itself
+        source = plan[0][0]
+        if len(plan) > 1:
+            candidates = [s for s in self.index_sources
+                          if s.provides(self.query_fields, granularity)]
+            fresh = IndexSources.freshest(candidates)
+            whole = [s for s in sorted(candidates, key=lambda s: s.cost)
+                     if s.usable_range(start, end, available_until=(
+                         available or {}).get(s.pattern),
+                         open_ended=s is fresh) == (start, end)]
+            source = whole[0] if whole else plan[-1][0]
+        return self.__source_pattern(source, start, end)
+
+    def __source_pattern(self, source, start, end):
+        """Index pattern for one index source over [start, end)"""
+        pattern = indexpattern_generate(pattern=source.pattern, start=start,
+                                        end=end)
+        if self.__catalog_loaded():
+            pattern = self.index_catalog.index_pattern(pattern, start, end,
+                                                       logger=self.logger)
+        return pattern
+
+    def get_rollup_store(self, name='default'):
+        """Open the local daily rollup store configured in the
+        [rollups.<name>] section of the config file.  Keys are dimensions
+        (required), metrics, index, time_field, and path (defaults to
+        rollups.sqlite in the state directory - see get_state_path).
+
+        :param str name: Name of rollup store in config file
+        :return RollupStore.RollupStore: Rollup store
+        """
+        try:
+            cfg = copy.deepcopy(self.config['rollups'][name])
+        except KeyError:
+            raise KeyError("Rollup store {0} is not configured in the config"
+                           " file {1}".format(name, self.configfile))
+
+        path = cfg.pop('path', None) or self.get_state_path('rollups.sqlite')
+        return RollupStore(path, **cfg)
+
+    def rollup(self, group_by, name='default', metrics=None, where=None):
+        """Answer a daily-rollup aggregation over the report's time range
+        from the local rollup store, refreshing any days that changed first.
+        Days are whole UTC days, so the report range should be day-aligned.
+
+        :param list group_by: Dimensions to group by
+        :param str name: Name of rollup store in config file
+        :param list metrics: Metrics to sum.  Defaults to all of them
+        :param dict where: {dimension: value(s)} to filter on
+        :return dict: {column name: [values]}, suitable for format_report
+        """
+        store = self.get_rollup_store(name)
+        try:
+            refreshed = store.refresh(self.client, self.start_time,
+                                      self.end_time,
+                                      execute=self.executor.execute)
+            self.logger.info("Refreshed {0} day(s) in rollup store {1}".format(
+                len(refreshed), name))
+            return store.columns(self.start_time, self.end_time, group_by,
+                                 metrics, where)
+        finally:
+            store.close()
+
+    def get_column_store(self, name='default'):
+        """Open the local columnar cache of raw records configured in the
+        [column_stores.<name>] section of the config file.  Keys are
+        dimensions (required), metrics, index, time_field, page_size, and
+        path (defaults to the columns directory in the state directory).
+
+        :param str name: Name of column store in config file
+        :return ColumnStore.ColumnStore: Column store
+        """
+        try:
+            cfg = copy.deepcopy(self.config['column_stores'][name])
+        except KeyError:
+            raise KeyError("Column store {0} is not configured in the config"
+                           " file {1}".format(name, self.configfile))
+
+        path = cfg.pop('path', None) or self.get_state_path('columns')
+        return ColumnStore(path, **cfg)
+
+    def column_sums(self, group_by, name='default', metrics=None, where=None):
+        """Sum raw records over the report's time range, grouped by some
+        dimensions, from the local column store, scanning any days that
+        changed first
+
+        :param list group_by: Dimensions to group by
+        :param str name: Name of column store in config file
+        :param list metrics: Metrics to sum.  Defaults to all of them
+        :param dict where: {dimension: value(s)} to filter on
+        :return dict: {column name: [values]}, suitable for format_report
+        """
+        store = self.get_column_store(name)
+        with self._phase('column_refresh'):
+            refreshed = store.refresh(self.client, self.start_time,
+                                      self.end_time,
+                                      execute=self.executor.execute)
+        self.logger.info("Refreshed {0} day(s) in column store {1}".format(
+            len(refreshed), name))
+        with self._phase('column_sums'):
+            return store.columns(self.start_time, self.end_time, group_by,
+                                 metrics, where)
 
     @staticmethod
     def sorted_buckets(agg, key=operator.attrgetter('key')):
@@ -258,6 +1200,24 @@ class Reporter(object):
         """
         return sorted(agg.buckets, key=key)
 
+    @staticmethod
+    def top_buckets(agg, order, k=None, others=None, sum_fields=None):
+        """Order the Elasticsearch Aggregation buckets by one or more fields
+        and keep the top k, optionally with an "Others" bucket rolling up the
+        rest.  Uses a heap rather than a full sort, and returns raw bucket
+        dicts.  See BucketOrder.top_buckets.
+
+        :param agg: Aggregations attribute of ES response containing buckets
+        :param order: Field path or list of them, '-' prefix for descending,
+            e.g. ['-CoreHours', 'key']
+        :param int k: Number of buckets to keep.  None keeps all
+        :param str others: Key of the rollup bucket, or None for no rollup
+        :param list sum_fields: Metrics to sum into the rollup bucket
+        :return list: Raw bucket dicts
+        """
+        return BucketOrder.top_buckets(agg, order, k=k, others=others,
+                                       sum_fields=sum_fields)
+
     def check_no_email(self, emails):
         """
         Checks to see if the no_email flag is True, and takes actions if so.
@@ -334,6 +1294,18 @@ class Reporter(object):
             filepath = os.path.join(os.getcwd(), filename)
         return filepath
 
+    def get_state_path(self, filename):
+        """
+        Gets the path of a file in the state directory, where caches and
+        other files that persist between report runs live.  That's the
+        default_statedir from the config file, or $HOME/gracc-reporting.
+        The directory is created if it doesn't exist.
+
+        :param str filename: Name of the state file
+        :return str: Path to the state file
+        """
+        return get_state_path(self.config, filename)
+
     # Non-public methods
 
     @staticmethod
@@ -346,14 +1318,18 @@ class Reporter(object):
         """
         print "Using config file ", configfile
         if os.path.exists(configfile):
-            try:
-                with open(configfile, 'r') as f:
-                    config = toml.loads(f.read())
-            except toml.TomlDecodeError as e:
-                print "Cannot decode toml file"
-                print e
-                raise
-            return config
+            cache_key = (os.path.abspath(configfile),
+                         os.path.getmtime(configfile),
+                         os.path.getsize(configfile))
+            if cache_key not in _config_cache:
+                try:
+                    with open(configfile, 'r') as f:
+                        _config_cache[cache_key] = toml.loads(f.read())
+                except toml.TomlDecodeError as e:
+                    print "Cannot decode toml file"
+                    print e
+                    raise
+            return copy.deepcopy(_config_cache[cache_key])
         else:
             raise OSError("Cannot find file {0:s}".format(configfile))
 
@@ -381,17 +1357,37 @@ class Reporter(object):
             raise KeyError(key_error_msg_fmt.format(vo, self.configfile))
 
         else:
-            self.vo_list = self.config[vo.lower()]['valid_vos'] \
-                if vo.lower() in self.config else [vo.lower(), ]
+            self.vo_list = self.__get_vo_list(vo)
             return vo
 
+    def __get_vo_list(self, vo):
+        """Get the list of VO names to query for a VO from the 'valid_vos'
+        key of its config section, falling back to the VO itself
+
+        :param str vo: VO name
+        :return list: VO names to filter on
+        """
+        return self.config[vo.lower()]['valid_vos'] \
+            if vo.lower() in self.config else [vo.lower(), ]
+
+    def __switch_vo(self, vo):
+        """Point this instance at a different VO:  validate it, and reset
+        vo_list, email recipients, and the VO tag in the log file
+
+        :param str vo: VO to switch to
+        :return None:
+        """
+        self.vo = self.__check_vo(vo)
+        self.email_info = self.__get_email_info()
+        self.logger.extra['vo'] = self.vo
+
     def __establish_client(self):
         """Initialize and return the elasticsearch client
 
         :return: elasticsearch.Elasticsearch object
         """
         _fallback_ok = ['green', ]
-        _default_host = 'https://gracc.opensciencegrid.org/q'
+        _default_host = DEFAULT_ES_HOST
 
         if self.verbose:
             httplib.HTTPConnection.debuglevel = 1
@@ -403,13 +1399,18 @@ class Reporter(object):
                 print hostname
             _client = Elasticsearch(hostname,
                                     verify_certs=False,
-                                    timeout=60)
+                                    timeout=_timeout,
+                                    **_transport_kwargs)
 
             _cat_client = client.CatClient(_client)
             assert _cat_client.health(h=["status",]).strip()\
                 in ok_statuses
             return _client
 
+        _timeout = self.config.get('elasticsearch', {}).get('timeout', 60)
+        _transport_kwargs = Transport.client_kwargs(
+            self.config.get('elasticsearch', {}))
+
         try:
             try:
                 _es_part = self.config['elasticsearch']
@@ -417,7 +1418,9 @@ class Reporter(object):
                 # ES hosts not configured in config file, so use default values
                 _hostname = _default_host
                 _ok_statuses = _fallback_ok
-                return __start_client(_hostname, _ok_statuses)
+                self.host_clients[_hostname] = __start_client(_hostname,
+                                                              _ok_statuses)
+                return self.host_clients[_hostname]
 
             _ok_statuses = self.config['elasticsearch'].get(
                 'ok_statuses', _fallback_ok)
@@ -429,16 +1432,141 @@ class Reporter(object):
                     raise KeyError("Reporter class instantiated with althost_key" 
                         " \'{0}\' that isn't set in the configuration file.".format(
                             self.althost_key))
+            elif 'hosts' in self.config['elasticsearch']:
+                # Multiple hosts.  Use the ones that are up.
+                for _hostname in self.config['elasticsearch']['hosts']:
+                    try:
+                        self.host_clients[_hostname] = __start_client(
+                            _hostname, _ok_statuses)
+                    except Exception as e:
+                        self.logger.warning("Skipping Elasticsearch host {0}."
+                                            " Error: {1}".format(_hostname, e))
+                if not self.host_clients:
+                    raise Exception("None of the configured Elasticsearch "
+                                    "hosts are available")
+                return self.host_clients.values()[0]
             else:
                 _hostname = self.config['elasticsearch'].get(
                     'hostname', _default_host)
-            
-            return __start_client(_hostname, _ok_statuses)
+
+            self.host_clients[_hostname] = __start_client(_hostname,
+                                                          _ok_statuses)
+            return self.host_clients[_hostname]
         except Exception as e:
             self.logger.exception("Couldn't initialize Elasticsearch instance."
                                   " Error: {0}".format(e))
             sys.exit(1)
 
+    def __get_executor(self):
+        """Set up the QueryExecutor that runs queries on self.host_clients,
+        with timeout, retries, backoff, backoff_max, and hedge_percentile
+        settings from the [elasticsearch] section of the config file, and
+        the process's Governor for the [governor] section
+
+        :return QueryExecutor.QueryExecutor: Query executor
+        """
+        _es_part = self.config.get('elasticsearch', {})
+        return QueryExecutor(self.host_clients,
+                             timeout=_es_part.get('timeout', 60),
+                             retries=_es_part.get('retries', 0),
+                             backoff=_es_part.get('backoff', 1.0),
+                             backoff_max=_es_part.get('backoff_max', 30.0),
+                             hedge_percentile=_es_part.get('hedge_percentile'),
+                             governor=get_governor(self.config.get('governor')))
+
+    def __get_index_sources(self):
+        """Index sources from the index_sources tables of the report's
+        section of the config file
+
+        :return list: IndexSources.IndexSource objects, or None
+        """
+        cfgs = self.config.get(self.report_type.lower(), {}).get(
+            'index_sources')
+        if not cfgs:
+            return None
+        return [IndexSources.IndexSource.from_config(cfg) for cfg in cfgs]
+
+    def __catalog_loaded(self):
+        """Whether the index catalog is turned on and could be loaded.  If
+        it can't be (e.g. _cat/indices or the min/max query fails), log a
+        warning and turn the catalog off, so that index patterns are used
+        as-is
+
+        :return bool: True if self.index_catalog can be used
+        """
+        if self.index_catalog is None:
+            return False
+        try:
+            self.index_catalog.indices()
+        except Exception as e:
+            self.logger.warning("Couldn't load the index catalog:  {0}.  "
+                                "Using index patterns as-is".format(e))
+            self.index_catalog = None
+            return False
+        return True
+
+    def __get_index_catalog(self):
+        """Set up the index catalog if index_catalog is true in the
+        [elasticsearch] section of the config file, with
+        index_catalog_ttl (seconds), index_catalog_time_field, and
+        index_catalog_pattern settings.  The pattern defaults to the
+        report's own index patterns, with wildcards for their dates.
+
+        :return IndexCatalog.IndexCatalog: Catalog, or None
+        """
+        _es_part = self.config.get('elasticsearch', {})
+        if not _es_part.get('index_catalog', False):
+            return None
+        pattern = _es_part.get('index_catalog_pattern')
+        if pattern is None:
+            patterns = [self.config.get(self.report_type.lower(), {}).get(
+                self.index_key, 'gracc.osg.summary')]
+            patterns += [source.pattern for source in
+                         self.index_sources or []]
+            pattern = catalog_pattern(patterns)
+        # One cache file per pattern, so reports over different indices
+        # don't keep replacing each other's catalog
+        cache_name = 'index_catalog_{0}.json'.format(
+            hashlib.md5(pattern).hexdigest()[:8])
+        return IndexCatalog(
+            self.client,
+            cache_path=self.get_state_path(cache_name),
+            ttl=_es_part.get('index_catalog_ttl', DEFAULT_TTL),
+            time_field=_es_part.get('index_catalog_time_field', 'EndTime'),
+            pattern=pattern,
+            cache_key=self.host_clients.keys()[0] if self.host_clients
+            else None,
+            execute=self.executor.execute)
+
+    def __get_memory_profiler(self):
+        """Set up memory profiling from the [memory] section of the config
+        file.  The budget can be overridden by memory_budget_mb in the
+        report's section.
+
+        :return MemProfile.MemoryProfiler: Profiler, or None if profiling is
+            off and there's no budget
+        """
+        _mem_part = self.config.get('memory', {})
+        budget_mb = self.config.get(self.report_type.lower(), {}).get(
+            'memory_budget_mb', _mem_part.get('budget_mb'))
+        if not _mem_part.get('profile', False) and budget_mb is None:
+            return None
+        return MemoryProfiler(
+            self.logger,
+            budget=int(budget_mb * 1024 * 1024) if budget_mb is not None
+            else None,
+            tracemalloc_top=_mem_part.get('tracemalloc_top', 0))
+
+    def __new_metrics(self):
+        """RunMetrics for the next run, or None if metrics are off (no
+        [metrics] textfile_dir in the config file)"""
+        if not self.config.get('metrics', {}).get('textfile_dir'):
+            return None
+        labels = {'report': self.report_type}
+        if self.vo is not None:
+            labels['vo'] = self.vo
+        return Metrics.RunMetrics(labels)
+
     def __get_email_info(self):
         """
         Parses config file to grab email-related information.
@@ -505,7 +1633,7 @@ class Reporter(object):
 
         For verbose use, use INFO level or above for messages to show on screen
 
-        :return: logging.getLogger object
+        :return: ReportLogger of the logging.getLogger object
         """
         logger = logging.getLogger(self.report_type)
         logger.setLevel(logging.DEBUG)
@@ -517,8 +1645,14 @@ class Reporter(object):
         else:
             ch.setLevel(logging.WARNING)
 
-        if self.logfile is not None:
-            # FileHandler
+        logpath = os.path.abspath(self.logfile) \
+            if self.logfile is not None else None
+        if logpath is not None and not any(
+                isinstance(h, logging.FileHandler) and
+                h.baseFilename == logpath for h in logger.handlers):
+            # FileHandler.  The logger is shared by every report of this
+            # type in the process (e.g. in the Scheduler), so only add one
+            # per file.
             fh = logging.FileHandler(self.logfile)
             fh.setLevel(logging.DEBUG)
 
@@ -542,6 +1676,7 @@ class Reporter(object):
         else:
             logger.addHandler(ch)
 
+        logger = ReportLogger(logger, self.vo)
         if self.is_test:
             logger.info("Running in test mode")
 
@@ -591,6 +1726,124 @@ def runerror(config, error, traceback, logfile):
     return
 
 
+def get_state_path(config, filename):
+    """
+    Gets the path of a file in the state directory:  default_statedir from
+    the config, or $HOME/gracc-reporting.  The directory is created if it
+    doesn't exist.
+
+    :param dict config: Parsed config file
+    :param str filename: Name of the state file
+    :return str: Path to the state file
+    """
+    statedir = config.get(
+        'default_statedir',
+        os.path.join(os.path.expanduser('~'), 'gracc-reporting'))
+    if not os.path.exists(statedir):
+        os.makedirs(statedir)
+    return os.path.join(statedir, filename)
+
+
+def get_es_hosts(config, althost_key=None):
+    """
+    Gets the Elasticsearch hosts a Reporter with this config and
+    althost_key connects to (or tries, with several configured hosts).
+
+    :param dict config: Parsed config file
+    :param str althost_key: Reporter's althost_key
+    :return tuple: Hostnames, or None if althost_key isn't configured
+    """
+    es_config = config.get('elasticsearch')
+    if es_config is None:
+        return (DEFAULT_ES_HOST, )
+    if althost_key is not None:
+        return (es_config[althost_key], ) if althost_key in es_config \
+            else None
+    if 'hosts' in es_config:
+        return tuple(es_config['hosts'])
+    return (es_config.get('hostname', DEFAULT_ES_HOST), )
+
+
+@contextmanager
+def _no_phase():
+    """Stand-in for MemoryProfiler.phase when memory profiling is off"""
+    yield
+
+
+def render_reports(jobs, processes=None):
+    """Run format_report and render_report for several reports (or VO
+    slices of one report) in a pool of processes.  Querying and sending stay
+    in this process; only the jobs' plain attributes and raw aggregation
+    dicts are shipped to the workers.
+
+    :param list jobs: Return values of Reporter.render_job
+    :param int processes: Size of process pool.  None means one per CPU.
+        With one process or one job, render here instead
+    :return list: render_report return values, in the same order as jobs
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(jobs))
+    if processes <= 1:
+        return map(_render_worker, jobs)
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(_render_worker, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def run_reports_parallel(reports, processes=None, titles=None):
+    """Equivalent of calling send_report on each report, but with the
+    reports' format_report and rendering done in a process pool.  Queries
+    are run one after another in this process, and emails are sent in the
+    order of reports.
+
+    :param list reports: Reporter instances whose queries return
+        aggregations
+    :param int processes: Size of process pool.  None means one per CPU
+    :param list titles: Title for each report, overriding its self.title
+    :return None:
+    """
+    titles = titles if titles is not None else [None] * len(reports)
+    jobs = [report.render_job(title=title)
+            for report, title in zip(reports, titles)]
+    for report, rendered in zip(reports, render_reports(jobs, processes)):
+        if not report.check_no_email(report.email_info['to']['email']):
+            report.send_rendered(rendered)
+    return
+
+
+def _render_worker(job):
+    """Rebuild a report from a Reporter.render_job tuple without any
+    Elasticsearch or SMTP connections, and render it"""
+    cls, state, raw, title = job
+    report = cls.__new__(cls)
+    report.__dict__.update(state)
+    report.logger = ReportLogger(logging.getLogger(report.report_type),
+                                 report.vo)
+    report.client = report.executor = report.smtp_connection = None
+    report.memprofiler = report.metrics = None
+    report.host_clients = OrderedDict()
+    report._prefetched = raw
+    try:
+        return report.render_report(report.format_report(), title=title)
+    except SystemExit as e:
+        # A SystemExit would take down the pool's worker process
+        raise RuntimeError("Rendering {0} report exited with status "
+                           "{1}".format(report.report_type, e.code))
+
+
+def _wrap_aggs(aggs, raw):
+    """Aggregations as a plain dict if raw, or as an AttrDict otherwise.
+    Neither way copies them."""
+    if isinstance(aggs, AttrDict):
+        return aggs.to_dict() if raw else aggs
+    return aggs if raw else AttrDict(aggs)
+
+
 def validate_and_add_kwargs_for_instance(instance, valid_kwargs, given_kwargs, add_arg_defaults_to_instance=True):
     if add_arg_defaults_to_instance:
         for key, value in valid_kwargs.iteritems():
@@ -607,6 +1860,27 @@ def validate_and_add_kwargs_for_instance(instance, valid_kwargs, given_kwargs, a
                 ', '.join(valid_kwargs.iterkeys())))
 
 
+def nest_aggs(search, name, outer):
+    """Move all of a Search's top-level aggregations underneath a new
+    bucket aggregation.  For example, to run the same aggregations once per
+    filter or per time period in a single query.
+
+    :param Search search: elasticsearch_dsl Search object
+    :param str name: Name to give the new outer aggregation
+    :param outer: elasticsearch_dsl bucket aggregation (e.g. A('filters', ...))
+    :return Search: Copy of search with the nested aggregations
+    """
+    # Rebuild the aggregations from the request body, so that neither
+    # search nor outer is modified
+    nested = A(outer.to_dict())
+    for agg_name, agg in search.to_dict().get('aggs', {}).iteritems():
+        nested[agg_name] = A(agg)
+    s = search._clone()
+    s.aggs = AggsProxy(s)
+    s.aggs.bucket(name, nested)
+    return s
+
+
 def coroutine(func):
     """Decorator to prime coroutines by advancing them to their first yield
     point.  From http://www.dabeaz.com/coroutines/Coroutines.pdf
@@ -646,6 +1920,14 @@ def get_report_parser(no_time_options=False):
     always_include.add_argument("-L", "--logfile", dest="logfile",
                         default=None, help="Specify non-standard location"
                         "for logfile")
+    always_include.add_argument("-P", "--plan", dest="plan",
+                        action="store_true", default=False,
+                        help="Estimate the cost of the report's query and "
+                             "exit without running it")
+    always_include.add_argument("--query-profile", dest="query_profile",
+                        action="store_true", default=False,
+                        help="Profile queries with the Elasticsearch profile "
+                             "API and save a summary next to the logfile")
     if no_time_options:
         return parser
 
@@ -656,5 +1938,12 @@ def get_report_parser(no_time_options=False):
     parser.add_argument("-e", "--end", dest="end",
                         help="report end date YYYY/MM/DD HH:mm:SS or "
                                 "YYYY-MM-DD HH:mm:SS")
+    time_options.add_argument("-B", "--backfill", dest="backfill",
+                        default=None, metavar="INTERVAL",
+                        help="run the report for each period of this length "
+                             "(e.g. 1w) between start and end, with one query")
+    time_options.add_argument("--backfill-dir", dest="backfill_dir",
+                        default=None, help="write backfilled reports to this "
+                                           "directory instead of emailing them")
 
     return parser
@@ -0,0 +1,291 @@
+"""Local SQLite store of daily GRACC rollups.  Reports that are different
+slices of the same daily aggregations (CoreHours and job counts by site, VO,
+project, user, ...) can answer them from this store instead of each
+re-deriving them from the summary index.
+
+Each day is fetched from Elasticsearch once per set of dimensions.  On
+refresh, a cheap per-day fingerprint (doc count and metric sums) is compared
+against the stored one, and only days that changed are fetched again.  Changed
+days are fetched in batches of at most batch_days days, so that one request
+never holds the nested terms buckets of a whole month."""
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+from datetime import datetime, timedelta
+
+from elasticsearch_dsl import Search
+from dateutil import tz
+
+DEFAULT_INDEX = 'gracc.osg.summary'
+DEFAULT_METRICS = ['CoreHours', 'Njobs']
+MISSING = 'N/A'
+MAXINT = 2**31 - 1
+DEFAULT_BATCH_DAYS = 1
+
+_NAME_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+class RollupStore(object):
+    """Daily rollups of a set of metrics, grouped by a set of dimensions,
+    stored in a SQLite database
+
+    :param str path: Filename of the SQLite database
+    :param list dimensions: Fields to group by (e.g. ['OIM_Site', 'VOName'])
+    :param list metrics: Numeric fields to sum
+    :param str index: Index (pattern) to pull rollups from
+    :param str time_field: Date field used to assign records to days
+    :param int batch_days: Most days to fetch rollups for in one query
+    """
+    def __init__(self, path, dimensions, metrics=None, index=DEFAULT_INDEX,
+                 time_field='EndTime', batch_days=DEFAULT_BATCH_DAYS):
+        self.metrics = list(metrics) if metrics is not None \
+            else list(DEFAULT_METRICS)
+        self.dimensions = list(dimensions)
+        for name in self.dimensions + self.metrics:
+            if not _NAME_RE.match(name):
+                raise ValueError("Invalid rollup field name {0}".format(name))
+        self.path = path
+        self.index = index
+        self.time_field = time_field
+        self.batch_days = max(int(batch_days), 1)
+        # One table per distinct rollup definition
+        self.table = 'rollup_{0}'.format(hashlib.md5(json.dumps(
+            [index, time_field, sorted(self.dimensions),
+             sorted(self.metrics)])).hexdigest()[:12])
+
+        dirname = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.conn = sqlite3.connect(path)
+        self.__create_tables()
+
+    def refresh(self, client, start, end, execute=None):
+        """Make sure the store holds up-to-date rollups for every day touched
+        by [start, end).  Only days whose fingerprint changed since they were
+        last fetched are pulled again, a batch of days at a time.  Each batch
+        is stored as soon as it's fetched.
+
+        :param client: elasticsearch.Elasticsearch client
+        :param datetime start: Start of range (UTC)
+        :param datetime end: End of range (UTC)
+        :param execute: Function that takes a Search and returns a Response
+            (e.g. Reporter.executor.execute).  Defaults to Search.execute
+        :return list: Days (YYYY-MM-DD) that were (re)fetched
+        """
+        days = day_list(start, end)
+        if not days:
+            return []
+        fingerprints = self.__fetch_fingerprints(client, days, execute)
+        stored = dict(self.conn.execute(
+            'SELECT day, fingerprint FROM rollup_days WHERE dimset = ?',
+            (self.table, )).fetchall())
+
+        stale = [d for d in days if stored.get(d) != fingerprints.get(d)]
+        if not stale:
+            return []
+
+        cols = ['day'] + self.dimensions + self.metrics
+        for batch in day_batches(stale, self.batch_days):
+            rows = self.__fetch_rollups(client, batch, execute)
+            with self.conn:
+                self.conn.executemany(
+                    'DELETE FROM "{0}" WHERE day = ?'.format(self.table),
+                    [(d, ) for d in batch])
+                self.conn.executemany(
+                    'INSERT INTO "{0}" ({1}) VALUES ({2})'.format(
+                        self.table,
+                        ', '.join('"{0}"'.format(c) for c in cols),
+                        ', '.join('?' * len(cols))),
+                    rows)
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO rollup_days VALUES (?, ?, ?)',
+                    [(self.table, d, fingerprints.get(d)) for d in batch])
+        return stale
+
+    def aggregate(self, start, end, group_by, metrics=None, where=None):
+        """Sum metrics over the days touched by [start, end), grouped by
+        some of the store's dimensions
+
+        :param datetime start: Start of range (UTC)
+        :param datetime end: End of range (UTC)
+        :param list group_by: Dimensions to group by.  Must be a subset of
+            the store's dimensions
+        :param list metrics: Metrics to sum.  Defaults to all of them
+        :param dict where: {dimension: value or list of values} to filter on
+        :return list: Tuples of (group_by values..., metric sums...), ordered
+            by the group_by values
+        """
+        metrics = metrics if metrics is not None else self.metrics
+        for name in group_by + list(where or {}):
+            if name not in self.dimensions:
+                raise ValueError("{0} is not a dimension of this rollup "
+                                 "store".format(name))
+        for name in metrics:
+            if name not in self.metrics:
+                raise ValueError("{0} is not a metric of this rollup "
+                                 "store".format(name))
+
+        days = day_list(start, end)
+        if not days:
+            return []
+        clauses = ['day >= ?', 'day <= ?']
+        args = [days[0], days[-1]]
+        for name, values in sorted((where or {}).iteritems()):
+            values = values if isinstance(values, (list, tuple)) \
+                else [values, ]
+            clauses.append('"{0}" IN ({1})'.format(
+                name, ', '.join('?' * len(values))))
+            args.extend(values)
+
+        select = ['"{0}"'.format(g) for g in group_by] + \
+            ['SUM("{0}")'.format(m) for m in metrics]
+        sql = 'SELECT {0} FROM "{1}" WHERE {2}'.format(
+            ', '.join(select), self.table, ' AND '.join(clauses))
+        if group_by:
+            groups = ', '.join('"{0}"'.format(g) for g in group_by)
+            sql += ' GROUP BY {0} ORDER BY {0}'.format(groups)
+        return self.conn.execute(sql, args).fetchall()
+
+    def columns(self, start, end, group_by, metrics=None, where=None):
+        """Same as aggregate, but return the result as a dict of columns,
+        ready to be returned by Reporter.format_report
+
+        :return dict: {column name: [values]}
+        """
+        metrics = metrics if metrics is not None else self.metrics
+        names = list(group_by) + list(metrics)
+        cols = dict((name, []) for name in names)
+        for row in self.aggregate(start, end, group_by, metrics, where):
+            for name, value in zip(names, row):
+                cols[name].append(value)
+        return cols
+
+    def close(self):
+        """Close the underlying SQLite connection"""
+        self.conn.close()
+
+    # Non-public methods
+    def __create_tables(self):
+        """Create the day-tracking table and this dimension set's table if
+        they don't already exist"""
+        cols = ['day TEXT'] + \
+            ['"{0}" TEXT'.format(d) for d in self.dimensions] + \
+            ['"{0}" REAL'.format(m) for m in self.metrics]
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS rollup_days (dimset TEXT, '
+                'day TEXT, fingerprint TEXT, PRIMARY KEY (dimset, day))')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS "{0}" ({1})'.format(
+                self.table, ', '.join(cols)))
+            self.conn.execute(
+                'CREATE INDEX IF NOT EXISTS "{0}_day" ON "{0}" (day)'.format(
+                    self.table))
+
+    def __search(self, client, days):
+        """Base Search over whole days, with a daily date_histogram"""
+        start = datetime.strptime(days[0], '%Y-%m-%d')
+        end = datetime.strptime(days[-1], '%Y-%m-%d') + timedelta(days=1)
+        s = Search(using=client, index=self.index)\
+            .filter('range', **{self.time_field: {
+                'gte': start.isoformat(), 'lt': end.isoformat()}})[0:0]
+        daily = s.aggs.bucket('day', 'date_histogram',
+                              field=self.time_field, interval='day')
+        return s, daily
+
+    def __fetch_fingerprints(self, client, days, execute):
+        """Get {day: fingerprint} for days, where the fingerprint is the
+        day's doc count and metric sums"""
+        s, daily = self.__search(client, days)
+        for m in self.metrics:
+            daily.metric(m, 'sum', field=m)
+        response = (execute(s) if execute is not None else s.execute())\
+            .to_dict()
+
+        fingerprints = {}
+        for b in response['aggregations']['day']['buckets']:
+            fingerprints[epoch_ms_to_day(b['key'])] = json.dumps(
+                [b['doc_count']] + [round(b[m]['value'] or 0, 6)
+                                    for m in self.metrics])
+        return fingerprints
+
+    def __fetch_rollups(self, client, days, execute):
+        """Get rows of (day, dimension values..., metric sums...) for days"""
+        s, agg = self.__search(client, days)
+        for d in self.dimensions:
+            agg = agg.bucket(d, 'terms', field=d, size=MAXINT, missing=MISSING)
+        for m in self.metrics:
+            agg.metric(m, 'sum', field=m)
+        response = (execute(s) if execute is not None else s.execute())\
+            .to_dict()
+
+        wanted = set(days)
+        rows = []
+        for b in response['aggregations']['day']['buckets']:
+            day = epoch_ms_to_day(b['key'])
+            if day in wanted:
+                rows.extend(self.__walk(b, 0, [day, ]))
+        return rows
+
+    def __walk(self, bucket, depth, prefix):
+        """Flatten nested terms buckets into rows"""
+        if depth == len(self.dimensions):
+            return [tuple(prefix + [bucket[m]['value'] for m in self.metrics])]
+        rows = []
+        for b in bucket[self.dimensions[depth]]['buckets']:
+            rows.extend(self.__walk(b, depth + 1, prefix + [b['key'], ]))
+        return rows
+
+
+def day_list(start, end):
+    """List the UTC days (YYYY-MM-DD) touched by the range [start, end)
+
+    :param datetime start: Start of range
+    :param datetime end: End of range
+    :return list: Day strings in order
+    """
+    start, end = _as_utc(start), _as_utc(end)
+    if end <= start:
+        return []
+    last = (end - timedelta(microseconds=1)).date()
+    d = start.date()
+    days = []
+    while d <= last:
+        days.append(d.strftime('%Y-%m-%d'))
+        d += timedelta(days=1)
+    return days
+
+
+def day_batches(days, size):
+    """Split sorted day strings into runs of consecutive days, each at most
+    size days long
+
+    :param list days: Day strings (YYYY-MM-DD) in order
+    :param int size: Most days per batch
+    :return list: Lists of day strings
+    """
+    batches = []
+    prev = None
+    for d in days:
+        date = datetime.strptime(d, '%Y-%m-%d')
+        if batches and len(batches[-1]) < size and \
+                date - prev == timedelta(days=1):
+            batches[-1].append(d)
+        else:
+            batches.append([d])
+        prev = date
+    return batches
+
+
+def epoch_ms_to_day(ms):
+    """Convert a date_histogram key (epoch milliseconds) to a UTC day string"""
+    return datetime.utcfromtimestamp(ms / 1000).strftime('%Y-%m-%d')
+
+
+def _as_utc(dt):
+    """Return dt as a naive UTC datetime"""
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(tz.tzutc()).replace(tzinfo=None)
+    return dt
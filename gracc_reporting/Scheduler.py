@@ -0,0 +1,384 @@
+"""Long-running scheduler for gracc reports.  Instead of starting a fresh
+process from cron for every report, the scheduler reads report schedules from
+the TOML config file and runs due reports on a bounded pool of worker threads.
+The Elasticsearch clients (and their connection pools), the parsed config, and
+per-worker SMTP connections stay warm between runs, and the duration and
+outcome of every run is recorded.
+
+Schedules are configured like this:
+
+[scheduler]
+    workers = 4             # Size of worker pool
+    poll_interval = 30      # Seconds between checks for due reports
+
+[schedule.osg_daily]
+    report = 'osg_reports.OSGReport:OSGReport'  # module:class
+    every = '1d'            # How often to run (s, m, h, d, w)
+    at = '06:30'            # Optional local time of day of the first run
+    period = '1d'           # Report range ends at the run time.  Defaults to every
+    [schedule.osg_daily.kwargs]
+        is_test = true      # Other kwargs to pass to the report class
+"""
+
+import argparse
+import importlib
+import json
+import logging
+import smtplib
+import socket
+import sys
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+
+import ReportUtils
+from TimeUtils import parse_duration
+
+_TIME_FMT = '%Y-%m-%d %H:%M:%S'
+
+
+def import_report(spec):
+    """Import a report class from a 'package.module:ClassName' string
+
+    :param str spec: Report class specification
+    :return class: Report class
+    """
+    try:
+        module_name, class_name = spec.split(':')
+    except ValueError:
+        raise ValueError("Invalid report {0}.  Must be of the form "
+                         "module:ClassName".format(spec))
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+class ScheduledReport(object):
+    """A report and when to run it
+
+    :param str name: Name of schedule
+    :param report: Report class, or 'module:ClassName' string
+    :param str every: How often to run, e.g. '1d'
+    :param str period: Length of the report's time range, which ends at the
+        run time.  Defaults to every
+    :param str at: Local time of day (HH:MM) of the first run
+    :param dict kwargs: Other keyword arguments for the report class
+    """
+    def __init__(self, name, report, every, period=None, at=None,
+                 kwargs=None):
+        self.name = name
+        self.report_cls = import_report(report) \
+            if isinstance(report, basestring) else report
+        self.every = parse_duration(every)
+        self.period = parse_duration(period) if period is not None \
+            else self.every
+        self.at = datetime.strptime(at, '%H:%M').time() \
+            if at is not None else None
+        self.kwargs = dict(kwargs or {})
+
+    def first_run(self, now, last_run=None):
+        """Time of the first run after the scheduler starts
+
+        :param datetime now: Current local time
+        :param datetime last_run: Scheduled time of the last recorded run
+        :return datetime: Local time to run at
+        """
+        if last_run is not None:
+            return last_run + self.every
+        if self.at is None:
+            return now
+        candidate = datetime.combine(now.date(), self.at)
+        if candidate < now:
+            candidate += timedelta(days=1)
+        return candidate
+
+    def window(self, run_time):
+        """Report time range for a run
+
+        :param datetime run_time: Scheduled local time of the run
+        :return tuple: (start, end) local datetimes
+        """
+        return run_time - self.period, run_time
+
+
+def load_schedules(config):
+    """Build ScheduledReports from the [schedule.<name>] sections of a
+    config
+
+    :param dict config: Parsed config file
+    :return dict: {name: ScheduledReport}
+    """
+    schedules = {}
+    for name, cfg in config.get('schedule', {}).iteritems():
+        cfg = dict(cfg)
+        try:
+            report = cfg.pop('report')
+            every = cfg.pop('every')
+        except KeyError as e:
+            raise KeyError("Schedule {0} is missing {1}".format(name, e))
+        schedules[name] = ScheduledReport(name, report, every, **cfg)
+    return schedules
+
+
+class WarmClients(object):
+    """Elasticsearch clients of earlier reports, kept for later reports that
+    connect to the same hosts.  Thread safe.
+
+    :param dict config: Parsed config file
+    """
+    def __init__(self, config):
+        self.config = config
+        self.clients = {}
+        self._lock = threading.Lock()
+
+    def get(self, althost_key=None):
+        """Clients for a report with this althost_key
+
+        :return OrderedDict: {hostname: client}, or None if there are none
+            yet
+        """
+        hosts = ReportUtils.get_es_hosts(self.config, althost_key)
+        with self._lock:
+            return self.clients.get(hosts)
+
+    def keep(self, host_clients, althost_key=None):
+        """Keep a report's clients, unless there already are clients for
+        its hosts
+
+        :param OrderedDict host_clients: Reporter's host_clients
+        :param str althost_key: Reporter's althost_key
+        """
+        hosts = ReportUtils.get_es_hosts(self.config, althost_key)
+        if not host_clients or hosts is None:
+            return
+        with self._lock:
+            self.clients.setdefault(hosts, host_clients)
+
+
+class Scheduler(object):
+    """Runs scheduled reports on a bounded pool of worker threads, keeping
+    the config, Elasticsearch clients, and SMTP connections warm
+
+    :param str config_file: Filename of toml configuration file
+    :param dict schedules: {name: ScheduledReport}.  Defaults to the
+        schedules in the config file
+    :param int workers: Size of worker pool.  Defaults to [scheduler] workers
+        in the config file, then 2
+    :param dict report_kwargs: Kwargs to pass to every report (e.g. is_test)
+    :param logger: logging.Logger to log to
+    """
+    def __init__(self, config_file, schedules=None, workers=None,
+                 report_kwargs=None, logger=None):
+        self.config_file = config_file
+        self.config = ReportUtils.Reporter._parse_config(config_file)
+        sched_cfg = self.config.get('scheduler', {})
+        self.schedules = schedules if schedules is not None \
+            else load_schedules(self.config)
+        self.workers = workers or sched_cfg.get('workers', 2)
+        self.poll_interval = sched_cfg.get('poll_interval', 30)
+        self.reuse_smtp = sched_cfg.get('reuse_smtp', True)
+        self.history_path = sched_cfg.get('history_file') or \
+            ReportUtils.get_state_path(self.config, 'scheduler_runs.jsonl')
+        self.report_kwargs = dict(report_kwargs or {})
+        self.logger = logger or logging.getLogger('scheduler')
+
+        self.warm_clients = WarmClients(self.config)
+        self.pool = ThreadPool(self.workers)
+        self._lock = threading.Lock()
+        self._running = set()
+        self._local = threading.local()
+
+        last_runs = self.last_runs()
+        now = datetime.now()
+        self.next_runs = dict(
+            (name, sched.first_run(now, last_runs.get(name)))
+            for name, sched in self.schedules.iteritems())
+
+    def last_runs(self):
+        """Scheduled times of the last recorded run of each schedule
+
+        :return dict: {name: datetime}
+        """
+        last = {}
+        try:
+            with open(self.history_path, 'r') as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                        last[rec['name']] = datetime.strptime(
+                            rec['scheduled'], _TIME_FMT)
+                    except (ValueError, KeyError):
+                        continue
+        except IOError:
+            pass
+        return last
+
+    def tick(self, now=None):
+        """Submit every due report that isn't already running to the worker
+        pool.  Runs that were missed while a report was running (or the
+        scheduler was down) are collapsed into one.
+
+        :param datetime now: Current local time
+        :return list: AsyncResults of submitted runs
+        """
+        now = now or datetime.now()
+        submitted = []
+        for name, sched in sorted(self.schedules.iteritems()):
+            run_time = self.next_runs[name]
+            if run_time > now:
+                continue
+            with self._lock:
+                if name in self._running:
+                    continue
+                self._running.add(name)
+            while self.next_runs[name] <= now:
+                self.next_runs[name] += sched.every
+            start, end = sched.window(run_time)
+            submitted.append(self.pool.apply_async(
+                self.run_report, (name, start, end, run_time)))
+        return submitted
+
+    def serve_forever(self):
+        """Check for due reports every poll_interval seconds until
+        interrupted
+
+        :return None:
+        """
+        self.logger.info("Scheduler started with {0} schedule(s) and {1} "
+                         "worker(s)".format(len(self.schedules), self.workers))
+        try:
+            while True:
+                self.tick()
+                time.sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            self.logger.info("Scheduler stopping.  Waiting for running "
+                             "reports")
+        finally:
+            self.pool.close()
+            self.pool.join()
+
+    def run_report(self, name, start, end, scheduled=None, **kwargs):
+        """Run one report, and record how long it took and whether it
+        succeeded
+
+        :param str name: Name of schedule
+        :param datetime start: Start of report range (local time)
+        :param datetime end: End of report range (local time)
+        :param datetime scheduled: Scheduled time of this run
+        :param kwargs: Kwargs for this run, overriding the schedule's
+        :return dict: Run record
+        """
+        sched = self.schedules[name]
+        t0 = time.time()
+        record = {'name': name,
+                  'scheduled': (scheduled or datetime.now()).strftime(
+                      _TIME_FMT),
+                  'start': str(start), 'end': str(end)}
+        try:
+            report_kwargs = dict(sched.kwargs)
+            report_kwargs.update(self.report_kwargs)
+            report_kwargs.update(kwargs)
+            althost_key = report_kwargs.get('althost_key')
+            warm = self.warm_clients.get(althost_key)
+            if warm is not None and not report_kwargs.get('host_clients'):
+                report_kwargs['host_clients'] = warm
+            if not report_kwargs.get('no_email'):
+                report_kwargs['smtp_connection'] = self.__smtp_connection()
+
+            report = sched.report_cls(config_file=self.config_file,
+                                      start=start, end=end, **report_kwargs)
+            self.warm_clients.keep(getattr(report, 'host_clients', None),
+                                   althost_key)
+            with report.collect_metrics():
+                report.run_report()
+            record['success'] = True
+        except ReportUtils.QueryPlanned:
+            # Started with --plan:  the plan was printed instead of a run
+            record['success'] = True
+        except (Exception, SystemExit) as e:
+            record['success'] = False
+            record['error'] = str(e)
+            self.logger.exception("Report {0} failed: {1}".format(name, e))
+            try:
+                ReportUtils.runerror(self.config_file, e,
+                                     traceback.format_exc(),
+                                     self.history_path + '.errors')
+            except Exception as mail_err:
+                self.logger.error("Couldn't send error email for report {0}:"
+                                  " {1}".format(name, mail_err))
+        finally:
+            record['duration'] = round(time.time() - t0, 3)
+            with self._lock:
+                self._running.discard(name)
+                with open(self.history_path, 'a') as f:
+                    f.write(json.dumps(record, sort_keys=True) + '\n')
+            self.logger.info("Report {0} finished in {1}s (success={2})".format(
+                name, record['duration'], record['success']))
+        return record
+
+    def run_once(self, name, start=None, end=None, **kwargs):
+        """Run a single scheduled report now, in this thread (for testing).
+        If start and end aren't given, the range ends now and covers the
+        schedule's period.
+
+        :return dict: Run record
+        """
+        sched = self.schedules[name]
+        if start is None or end is None:
+            start, end = sched.window(datetime.now())
+        return self.run_report(name, start, end, **kwargs)
+
+    def __smtp_connection(self):
+        """Get this worker thread's SMTP connection, reconnecting if the
+        server dropped it.  Returns None if reuse is disabled or the server
+        can't be reached, so that the report connects on its own."""
+        if not self.reuse_smtp:
+            return None
+        conn = getattr(self._local, 'smtp', None)
+        if conn is not None:
+            try:
+                if conn.noop()[0] == 250:
+                    return conn
+            except (smtplib.SMTPException, socket.error):
+                pass
+        try:
+            conn = smtplib.SMTP(self.config['email']['smtphost'])
+        except Exception as e:
+            self.logger.warning("Couldn't open SMTP connection: {0}".format(e))
+            conn = None
+        self._local.smtp = conn
+        return conn
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        parents=[ReportUtils.get_report_parser()],
+        description="Run gracc reports on the schedules in the config file")
+    parser.add_argument("-r", "--report", dest="report", default=None,
+                        help="Run this scheduled report once and exit")
+    parser.add_argument("-w", "--workers", dest="workers", type=int,
+                        default=None, help="Size of worker pool")
+    args = parser.parse_args()
+
+    logger = logging.getLogger('scheduler')
+    logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+    handler = logging.FileHandler(args.logfile) if args.logfile \
+        else logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(
+        "%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+    logger.addHandler(handler)
+
+    report_kwargs = dict((k, getattr(args, k)) for k in (
+        'verbose', 'is_test', 'no_email', 'template', 'logfile', 'plan',
+        'query_profile', 'backfill', 'backfill_dir') if getattr(args, k))
+    scheduler = Scheduler(args.config, workers=args.workers,
+                          report_kwargs=report_kwargs, logger=logger)
+
+    if args.report is not None:
+        record = scheduler.run_once(args.report, args.start, args.end)
+        sys.exit(0 if record['success'] else 1)
+    scheduler.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -130,7 +130,8 @@ class TextUtils:
         return message
 
 
-def sendEmail(toList, subject, content, fromEmail=None, smtpServerHost=None, html_template=False):
+def sendEmail(toList, subject, content, fromEmail=None, smtpServerHost=None, html_template=False,
+              smtp_connection=None):
     """
     This turns the "report" into an email attachment and sends it to the EmailTarget(s).
     Args:
@@ -138,6 +139,8 @@ def sendEmail(toList, subject, content, fromEmail=None, smtpServerHost=None, htm
     content(str) - email content
     fromEmail (str) - from email address
     smtpServerHost(str) - smtpHost
+    smtp_connection(smtplib.SMTP) - already open connection to use instead of connecting to
+        smtpServerHost.  It is left open
     """
 
     Charset.add_charset('utf-8', Charset.QP, Charset.QP, 'utf-8')
@@ -185,9 +188,12 @@ def sendEmail(toList, subject, content, fromEmail=None, smtpServerHost=None, htm
     msg = msg.as_string()
 
     if len(toList[1]) != 0:
-        server = smtplib.SMTP(smtpServerHost)
-        server.sendmail(fromEmail[1], toList[1], msg)
-        server.quit()
+        if smtp_connection is not None:
+            smtp_connection.sendmail(fromEmail[1], toList[1], msg)
+        else:
+            server = smtplib.SMTP(smtpServerHost)
+            server.sendmail(fromEmail[1], toList[1], msg)
+            server.quit()
     else:
         # The email list isn't valid, so we write it to stderr and hope
         # it reaches somebody who cares.
@@ -4,11 +4,16 @@ reporting.  Note that in this module, parse_datetime is the only function
 that can accept non-UTC timestamps.  All other functions assume either epoch
 time or UTC timestamps"""
 
-from datetime import datetime, date
+import re
+from datetime import datetime, date, timedelta
 from calendar import timegm
 
 from dateutil import tz, parser
 
+_DURATION_RE = re.compile(r'^(\d+)\s*([smhdw])$')
+_DURATION_UNITS = {'s': 'seconds', 'm': 'minutes', 'h': 'hours', 'd': 'days',
+                   'w': 'weeks'}
+
 class InvalidUnitError(ValueError):
     pass
 
@@ -84,3 +89,16 @@ def get_epoch_time_range_utc_ms(start_time, end_time):
         return_dict[key] = timegm(return_dict[key].timetuple()) * 1000
 
     return return_dict["start_time"], return_dict["end_time"]
+
+
+def parse_duration(text):
+    """Parse a duration like '30m', '6h', '1d', or '1w'
+
+    :param str text: Duration
+    :return timedelta: Parsed duration
+    """
+    m = _DURATION_RE.match(str(text).strip())
+    if m is None:
+        raise ValueError("Invalid duration {0}.  Must be a number followed "
+                         "by one of s, m, h, d, w".format(text))
+    return timedelta(**{_DURATION_UNITS[m.group(2)]: int(m.group(1))})
@@ -0,0 +1,248 @@
+"""Elasticsearch transport tuned from the [elasticsearch] section of the
+config file:  gzip compression of responses (and optionally of requests),
+the number of connections kept open per host, and TCP keep-alive on those
+connections.  elasticsearch-py 5.5 has no http_compress option, so
+TunedHttpConnection adds it to the urllib3 connection:  it sends
+Accept-Encoding: gzip, and urllib3 inflates the response.  It also counts
+the bytes that actually went over the wire.
+
+[elasticsearch]
+    http_compress = true        # Ask for gzipped responses
+    compress_requests = false   # gzip request bodies too
+    maxsize = 10                # Connections kept open per host
+    pool_block = false          # Wait for a free connection rather than
+                                # opening one more than maxsize
+    tcp_keepalive = 60          # Idle seconds before TCP keep-alive probes
+
+Run this module to benchmark the options against recorded responses served
+by a local Replay.StandInServer:
+
+    python -m gracc_reporting.Transport --recording recording.jsonl
+"""
+
+import argparse
+import csv
+import gzip
+import socket
+import threading
+from collections import OrderedDict
+from cStringIO import StringIO
+
+from elasticsearch import Elasticsearch
+from elasticsearch.connection import Urllib3HttpConnection
+from urllib3.connection import HTTPConnection
+
+import QueryProfile
+import TextUtils
+from Replay import Recording, StandInServer
+
+# [elasticsearch] settings that are transport options
+TRANSPORT_OPTIONS = ('http_compress', 'compress_requests', 'maxsize',
+                     'pool_block', 'tcp_keepalive')
+
+# Option sets compared by benchmark
+DEFAULT_VARIANTS = OrderedDict([
+    ('plain', {}),
+    ('gzip responses', {'http_compress': True}),
+    ('gzip both', {'http_compress': True, 'compress_requests': True}),
+])
+
+BENCH_FIELDS = ['variant', 'requests', 'bytes_sent', 'bytes_received',
+                'decoded_bytes', 'compression', 'wall_ms', 'decode_ms']
+
+
+def gzip_bytes(data, level=6):
+    """gzip a string
+
+    :param str data: Data to compress
+    :param int level: Compression level, 1 (fast) to 9 (small)
+    :return str: Compressed data
+    """
+    buf = StringIO()
+    f = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=level)
+    f.write(data)
+    f.close()
+    return buf.getvalue()
+
+
+class WireStats(object):
+    """Byte counts of a connection's requests and responses"""
+    def __init__(self):
+        self.requests = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.decoded_bytes = 0
+        self._lock = threading.Lock()
+
+    def record(self, sent, received, decoded):
+        with self._lock:
+            self.requests += 1
+            self.bytes_sent += sent
+            self.bytes_received += received
+            self.decoded_bytes += decoded
+
+
+class TunedHttpConnection(Urllib3HttpConnection):
+    """Urllib3HttpConnection with gzip compression, TCP keep-alive, and
+    counts of the bytes on the wire (self.stats)
+
+    :param bool http_compress: Ask for gzipped responses
+    :param bool compress_requests: gzip request bodies
+    :param bool pool_block: Wait for a free connection instead of opening
+        more than maxsize
+    :param int tcp_keepalive: Idle seconds before TCP keep-alive probes.
+        None leaves keep-alive off
+    The other arguments are those of Urllib3HttpConnection (e.g. maxsize)
+    """
+    def __init__(self, http_compress=False, compress_requests=False,
+                 pool_block=False, tcp_keepalive=None, **kwargs):
+        super(TunedHttpConnection, self).__init__(**kwargs)
+        self.http_compress = http_compress
+        self.compress_requests = compress_requests
+        self.stats = WireStats()
+        if http_compress:
+            self.headers['accept-encoding'] = 'gzip,deflate'
+        self.pool.block = pool_block
+        if tcp_keepalive is not None:
+            self.pool.conn_kw['socket_options'] = \
+                HTTPConnection.default_socket_options + \
+                _keepalive_options(tcp_keepalive)
+        self.__urlopen = self.pool.urlopen
+        self.pool.urlopen = self.__counted_urlopen
+
+    def __counted_urlopen(self, method, url, body=None, headers=None, **kw):
+        if self.compress_requests and body:
+            if not isinstance(body, str):
+                body = body.encode('utf-8')
+            body = gzip_bytes(body, level=1)
+            headers = dict(headers or {}, **{'content-encoding': 'gzip'})
+        response = self.__urlopen(method, url, body, headers=headers, **kw)
+        # Content is preloaded, so the response has been read (and
+        # inflated) by now
+        self.stats.record(len(body or ''), response.tell(),
+                          len(response.data or ''))
+        return response
+
+
+def _keepalive_options(idle):
+    """Socket options turning on TCP keep-alive after idle seconds"""
+    options = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        options += [(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, int(idle)),
+                    (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL,
+                     max(int(idle) // 3, 1))]
+    return options
+
+
+def client_kwargs(es_config):
+    """Keyword arguments for elasticsearch.Elasticsearch that set up the
+    transport options in an [elasticsearch] config section
+
+    :param dict es_config: [elasticsearch] section of the config file
+    :return dict: Kwargs.  Empty if no transport options are set, so that
+        the client is built as before
+    """
+    options = dict((k, es_config[k]) for k in TRANSPORT_OPTIONS
+                   if k in es_config)
+    if not options:
+        return {}
+    options['connection_class'] = TunedHttpConnection
+    return options
+
+
+def wire_stats(client):
+    """Total byte counts of a client's TunedHttpConnections
+
+    :param client: elasticsearch.Elasticsearch client
+    :return WireStats: Totals, or None if the client doesn't count bytes
+    """
+    conns = [c for c in client.transport.connection_pool.connections
+             if isinstance(c, TunedHttpConnection)]
+    if not conns:
+        return None
+    total = WireStats()
+    for c in conns:
+        total.requests += c.stats.requests
+        total.bytes_sent += c.stats.bytes_sent
+        total.bytes_received += c.stats.bytes_received
+        total.decoded_bytes += c.stats.decoded_bytes
+    return total
+
+
+def benchmark(recording, variants=None, repeat=5, latency=0):
+    """Run every recorded search with each set of transport options,
+    against a local stand-in server
+
+    :param Recording recording: Recorded searches
+    :param OrderedDict variants: {name: transport options}.  Defaults to
+        DEFAULT_VARIANTS
+    :param int repeat: Times to run each search per variant
+    :param latency: Stand-in server's delay (see Replay.StandInServer)
+    :return list: Result dict per variant, with the keys in BENCH_FIELDS
+    """
+    variants = variants if variants is not None else DEFAULT_VARIANTS
+    results = []
+    with StandInServer(recording, latency=latency) as server:
+        for name, options in variants.iteritems():
+            es = Elasticsearch([server.url],
+                               connection_class=TunedHttpConnection,
+                               **options)
+            wall = decode = 0.0
+            for _ in xrange(repeat):
+                for index, body in recording.requests():
+                    with QueryProfile.LatencyTimer([es]) as timer:
+                        es.search(index=index or None, body=body)
+                    wall += timer.wall
+                    decode += timer.decode
+            stats = wire_stats(es)
+            n = stats.requests or 1
+            results.append({
+                'variant': name,
+                'requests': stats.requests,
+                'bytes_sent': stats.bytes_sent,
+                'bytes_received': stats.bytes_received,
+                'decoded_bytes': stats.decoded_bytes,
+                'compression': round(float(stats.decoded_bytes) /
+                                     stats.bytes_received, 2)
+                if stats.bytes_received else 0.0,
+                'wall_ms': round(wall * 1000 / n, 3),
+                'decode_ms': round(decode * 1000 / n, 3)})
+            es.transport.close()
+    return results
+
+
+def format_benchmark(results):
+    """Benchmark results as a text table
+
+    :param list results: Return value of benchmark
+    :return str:
+    """
+    columns = OrderedDict((field, [r[field] for r in results])
+                          for field in BENCH_FIELDS)
+    return TextUtils.TextUtils(BENCH_FIELDS).printAsTextTable('text', columns)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare Elasticsearch transport options on recorded "
+                    "responses served by a local stand-in")
+    parser.add_argument("--recording", dest="recording", required=True,
+                        help="Recorded responses (JSON lines)")
+    parser.add_argument("--repeat", dest="repeat", type=int, default=5,
+                        help="Times to run each recorded search per variant")
+    parser.add_argument("-o", "--out", dest="out", default=None,
+                        help="Write the results to this CSV file")
+    args = parser.parse_args()
+
+    results = benchmark(Recording(args.recording), repeat=args.repeat)
+    print format_benchmark(results)
+    if args.out:
+        with open(args.out, 'wb') as f:
+            writer = csv.DictWriter(f, BENCH_FIELDS)
+            writer.writeheader()
+            for result in results:
+                writer.writerow(result)
+
+
+if __name__ == '__main__':
+    main()
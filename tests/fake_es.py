@@ -0,0 +1,338 @@
+"""Minimal in-memory stand-in for elasticsearch.Elasticsearch, used by the
+unit tests.  It evaluates the small subset of the query DSL and aggregations
+that gracc-reporting builds against a list of record dicts."""
+
+import re
+import zlib
+from fnmatch import fnmatch
+from calendar import timegm
+from datetime import datetime, timedelta
+
+from dateutil import parser, tz
+
+_INTERVALS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}
+_NAMED_INTERVALS = {'second': '1s', 'minute': '1m', 'hour': '1h', 'day': '1d',
+                    'week': '1w'}
+
+
+_parsed = {}
+
+
+def to_epoch_ms(value):
+    """Convert a datetime, date string, or epoch ms number to epoch ms"""
+    if isinstance(value, (int, long, float)):
+        return int(value)
+    if not isinstance(value, datetime):
+        if value not in _parsed:
+            _parsed[value] = parser.parse(value)
+        value = _parsed[value]
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=tz.tzutc())
+    return timegm(value.utctimetuple()) * 1000 + value.microsecond // 1000
+
+
+def interval_ms(interval):
+    """Convert an ES interval ('1d', 'day', '3600s') to milliseconds"""
+    interval = _NAMED_INTERVALS.get(interval, interval)
+    m = re.match(r'^(\d+)([smhdw])$', interval)
+    return int(m.group(1)) * _INTERVALS[m.group(2)] * 1000
+
+
+class FakeElasticsearch(object):
+    """Fake Elasticsearch client over a list of records.
+
+    :param list records: Record dicts.  Time fields may be datetimes or
+        strings parseable by dateutil
+    :param list time_fields: Fields to treat as dates
+    """
+    def __init__(self, records=None, time_fields=('EndTime', )):
+        self.records = records if records is not None else []
+        self.time_fields = time_fields
+        self.calls = []
+        self.fail_with = None
+        self._scrolls = {}
+        # Indices with no records: {name: 'open' or 'close'}
+        self.extra_indices = {}
+        self.cat = FakeCatClient(self)
+
+    # Client API
+    def search(self, index=None, doc_type=None, body=None, scroll=None,
+               size=None, **kwargs):
+        body = body or {}
+        self.calls.append({'index': index, 'body': body, 'params': kwargs})
+        if self.fail_with is not None:
+            # fail_with(body) returns an exception to raise, or None
+            exc = self.fail_with(body)
+            if exc is not None:
+                raise exc
+
+        docs = [r for r in self.records if self._in_index(r, index) and
+                self._match(r, body.get('query'))]
+        response = {'took': 1, 'timed_out': False,
+                    '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+                    'hits': {'total': len(docs), 'hits': []}}
+        if 'aggs' in body:
+            response['aggregations'] = self._aggs(body['aggs'], docs)
+
+        docs = self._sort(docs, body.get('sort'))
+        if 'search_after' in body:
+            after = body['search_after']
+            keys = self._sort_keys(body.get('sort'))
+            docs = [d for d in docs if self._sort_value(d, keys) > after]
+        size = size if size is not None else body.get('size', 10)
+        if scroll is not None:
+            scroll_id = str(len(self._scrolls))
+            self._scrolls[scroll_id] = (docs[size:], size, body)
+            response['_scroll_id'] = scroll_id
+        response['hits']['hits'] = [self._hit(d, body) for d in docs[:size]]
+        return response
+
+    def scroll(self, scroll_id=None, scroll=None, body=None, **kwargs):
+        if scroll_id is None:
+            scroll_id = body['scroll_id']
+        docs, size, body = self._scrolls[scroll_id]
+        self._scrolls[scroll_id] = (docs[size:], size, body)
+        return {'_scroll_id': scroll_id, 'timed_out': False,
+                '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+                'hits': {'hits': [self._hit(d, body) for d in docs[:size]]}}
+
+    def clear_scroll(self, scroll_id=None, body=None, **kwargs):
+        return {}
+
+    def count(self, index=None, doc_type=None, body=None, **kwargs):
+        body = body or {}
+        return {'count': len([r for r in self.records
+                              if self._match(r, body.get('query'))])}
+
+    # Helpers
+    def _hit(self, doc, body):
+        source = doc
+        fields = body.get('_source')
+        if isinstance(fields, list):
+            source = dict((k, v) for k, v in doc.iteritems() if k in fields)
+        hit = {'_index': 'fake', '_type': 'doc', '_id': str(doc.get('_id')),
+               '_source': self._jsonable(source)}
+        if body.get('sort'):
+            hit['sort'] = list(self._sort_value(
+                doc, self._sort_keys(body['sort'])))
+        return hit
+
+    def _jsonable(self, doc):
+        return dict((k, v.isoformat() if isinstance(v, datetime) else v)
+                    for k, v in doc.iteritems() if k != '_id')
+
+    @staticmethod
+    def _in_index(doc, index):
+        """Records without an _index are in every index"""
+        if index is None or '_index' not in doc:
+            return True
+        if isinstance(index, (list, tuple)):
+            index = ','.join(index)
+        return any(fnmatch(doc['_index'], glob) for glob in index.split(','))
+
+    def _value(self, doc, field):
+        value = doc.get(field)
+        if value is not None and field in self.time_fields:
+            return to_epoch_ms(value)
+        return value
+
+    @staticmethod
+    def _sort_keys(sort):
+        keys = []
+        for elt in sort or []:
+            if isinstance(elt, dict):
+                field, opts = elt.items()[0]
+                order = opts if not isinstance(opts, dict) \
+                    else opts.get('order', 'asc')
+                keys.append((field, order))
+            else:
+                keys.append((elt, 'asc'))
+        return keys
+
+    def _sort_value(self, doc, keys):
+        values = []
+        for field, _ in keys:
+            if field in ('_uid', '_id'):
+                values.append('doc#{0}'.format(doc.get('_id')))
+            else:
+                values.append(self._value(doc, field))
+        return values
+
+    def _sort(self, docs, sort):
+        keys = self._sort_keys(sort)
+        for field, order in reversed(keys):
+            docs = sorted(docs, key=lambda d: self._sort_value(d, [(field, order)]),
+                          reverse=(order == 'desc'))
+        return docs
+
+    def _match(self, doc, query):
+        if not query:
+            return True
+        qtype, params = query.items()[0]
+        if qtype == 'match_all':
+            return True
+        if qtype == 'bool':
+            for clause in ('filter', 'must'):
+                subs = params.get(clause, [])
+                subs = subs if isinstance(subs, list) else [subs]
+                if not all(self._match(doc, q) for q in subs):
+                    return False
+            nots = params.get('must_not', [])
+            nots = nots if isinstance(nots, list) else [nots]
+            if any(self._match(doc, q) for q in nots):
+                return False
+            shoulds = params.get('should', [])
+            shoulds = shoulds if isinstance(shoulds, list) else [shoulds]
+            if shoulds and not any(self._match(doc, q) for q in shoulds):
+                return False
+            return True
+        field, value = params.items()[0]
+        if qtype == 'term':
+            value = value['value'] if isinstance(value, dict) else value
+            return self._value(doc, field) == value
+        if qtype == 'terms':
+            return self._value(doc, field) in value
+        if qtype == 'exists':
+            return doc.get(value) is not None
+        if qtype == 'range':
+            v = self._value(doc, field)
+            if v is None:
+                return False
+            conv = to_epoch_ms if field in self.time_fields else (lambda x: x)
+            checks = {'gte': lambda a, b: a >= b, 'gt': lambda a, b: a > b,
+                      'lte': lambda a, b: a <= b, 'lt': lambda a, b: a < b}
+            return all(checks[op](v, conv(bound))
+                       for op, bound in value.iteritems() if op in checks)
+        raise NotImplementedError(qtype)
+
+    def _aggs(self, aggs, docs):
+        result = {}
+        for name, spec in aggs.iteritems():
+            spec = dict(spec)
+            sub = spec.pop('aggs', None)
+            spec.pop('meta', None)
+            atype, params = spec.items()[0]
+            result[name] = self._agg(atype, params, sub, docs)
+        return result
+
+    def _bucket(self, key, docs, sub):
+        b = {'key': key, 'doc_count': len(docs)}
+        if sub:
+            b.update(self._aggs(sub, docs))
+        return b
+
+    def _agg(self, atype, params, sub, docs):
+        field = params.get('field')
+        values = [self._value(d, field) for d in docs] if field else []
+        values = [v for v in values if v is not None]
+        if atype == 'sum':
+            return {'value': float(sum(values))}
+        if atype == 'value_count':
+            return {'value': len(values)}
+        if atype == 'min':
+            return {'value': float(min(values)) if values else None}
+        if atype == 'max':
+            return {'value': float(max(values)) if values else None}
+        if atype == 'avg':
+            return {'value': float(sum(values)) / len(values)
+                    if values else None}
+        if atype == 'cardinality':
+            return {'value': len(set(values))}
+        if atype == 'filter':
+            matched = [d for d in docs if self._match(d, params)]
+            b = {'doc_count': len(matched)}
+            b.update(self._aggs(sub or {}, matched))
+            return b
+        if atype == 'filters':
+            buckets = {}
+            for key, q in params['filters'].iteritems():
+                matched = [d for d in docs if self._match(d, q)]
+                b = {'doc_count': len(matched)}
+                b.update(self._aggs(sub or {}, matched))
+                buckets[key] = b
+            return {'buckets': buckets}
+        if atype == 'terms':
+            groups = {}
+            missing = params.get('missing')
+            include = params.get('include')
+            for d in docs:
+                v = self._value(d, field)
+                if v is None:
+                    if missing is None:
+                        continue
+                    v = missing
+                if isinstance(include, dict) and \
+                        zlib.crc32(str(v)) % include['num_partitions'] != \
+                        include['partition']:
+                    continue
+                groups.setdefault(v, []).append(d)
+            buckets = [self._bucket(k, v, sub) for k, v in groups.iteritems()]
+            buckets.sort(key=lambda b: (-b['doc_count'], b['key']))
+            order = params.get('order')
+            if order:
+                okey, odir = order.items()[0]
+                if okey == '_key' or okey == '_term':
+                    getter = lambda b: b['key']
+                elif okey == '_count':
+                    getter = lambda b: b['doc_count']
+                else:
+                    getter = lambda b: b[okey]['value']
+                buckets.sort(key=getter, reverse=(odir == 'desc'))
+            buckets = buckets[:params.get('size', 10)]
+            return {'buckets': buckets, 'sum_other_doc_count': 0,
+                    'doc_count_error_upper_bound': 0}
+        if atype == 'date_histogram':
+            step = interval_ms(params['interval'])
+            offset = params.get('offset', 0)
+            if not isinstance(offset, (int, long)):
+                offset = (-1 if offset.startswith('-') else 1) * \
+                    interval_ms(offset.lstrip('+-'))
+            groups = {}
+            for d in docs:
+                v = self._value(d, field)
+                key = (v - offset) // step * step + offset
+                groups.setdefault(key, []).append(d)
+            if params.get('min_doc_count') == 0 and groups:
+                # Empty buckets between the first and last, as in
+                # Elasticsearch
+                for key in range(min(groups), max(groups), step):
+                    groups.setdefault(key, [])
+            buckets = []
+            for key in sorted(groups):
+                b = self._bucket(key, groups[key], sub)
+                b['key_as_string'] = datetime.utcfromtimestamp(
+                    key / 1000).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+                buckets.append(b)
+            return {'buckets': buckets}
+        raise NotImplementedError(atype)
+
+
+class FakeCatClient(object):
+    """Fake of the cat API.  Indices are the _index fields of the records,
+    plus FakeElasticsearch.extra_indices"""
+    def __init__(self, es):
+        self.es = es
+        self.calls = []
+
+    def indices(self, index=None, format=None, h=None, **kwargs):
+        self.calls.append({'index': index, 'params': kwargs})
+        counts = {}
+        for r in self.es.records:
+            if '_index' in r:
+                counts[r['_index']] = counts.get(r['_index'], 0) + 1
+        rows = [{'index': name, 'status': 'open', 'docs.count': str(n)}
+                for name, n in counts.iteritems()]
+        for name, status in self.es.extra_indices.iteritems():
+            rows.append({'index': name, 'status': status,
+                         'docs.count': '0' if status == 'open' else None})
+        return rows
+
+
+def day(year, month, dom, hour=0):
+    """Shortcut for a UTC datetime"""
+    return datetime(year, month, dom, hour, tzinfo=tz.tzutc())
+
+
+def day_range(start, ndays):
+    """List of UTC datetimes at noon of each of ndays days from start"""
+    return [start + timedelta(days=i, hours=12) for i in range(ndays)]
@@ -0,0 +1,86 @@
+"""Unit tests for BucketOrder"""
+
+import unittest
+
+from elasticsearch_dsl import A
+from elasticsearch_dsl.utils import AttrDict
+
+import gracc_reporting.BucketOrder as BucketOrder
+
+
+def bucket(key, doc_count, corehours, users):
+    return {'key': key, 'doc_count': doc_count,
+            'CoreHours': {'value': corehours}, 'Users': {'value': users}}
+
+
+AGG = {'sum_other_doc_count': 5,
+       'buckets': [bucket('A', 10, 50.0, 3), bucket('B', 20, 80.0, 1),
+                   bucket('C', 30, 80.0, 2), bucket('D', 40, 10.0, 4),
+                   bucket('E', 50, 20.0, 5)]}
+
+
+class TestTopBuckets(unittest.TestCase):
+    """Tests for BucketOrder.top_buckets"""
+    def keys(self, buckets):
+        return [b['key'] for b in buckets]
+
+    def test_matches_full_sort(self):
+        """Top k is the first k of a full sort, with mixed directions"""
+        order = ['-CoreHours', '-key']
+        full = BucketOrder.top_buckets(AGG, order)
+        self.assertListEqual(self.keys(full), ['C', 'B', 'A', 'E', 'D'])
+        for k in range(1, 6):
+            self.assertListEqual(BucketOrder.top_buckets(AGG, order, k=k),
+                                 full[:k])
+
+    def test_others(self):
+        """Everything outside the top k is rolled into one bucket, including
+        the terms aggregation's sum_other_doc_count"""
+        top = BucketOrder.top_buckets(AGG, '-_count', k=2, others='Others',
+                                      sum_fields=['CoreHours'])
+        self.assertListEqual(self.keys(top), ['E', 'D', 'Others'])
+        self.assertDictEqual(top[-1], {'key': 'Others', 'doc_count': 65,
+                                       'CoreHours': {'value': 210.0}})
+
+    def test_no_others_needed(self):
+        """No others bucket if everything fits"""
+        top = BucketOrder.top_buckets(AGG['buckets'], 'key', k=10,
+                                      others='Others')
+        self.assertListEqual(self.keys(top), ['A', 'B', 'C', 'D', 'E'])
+
+    def test_attrdict(self):
+        """elasticsearch_dsl AttrDicts are turned into raw buckets"""
+        top = BucketOrder.top_buckets(AttrDict(AGG), '-Users', k=1)
+        self.assertListEqual(top, [AGG['buckets'][4]])
+
+
+class TestPushDown(unittest.TestCase):
+    """Tests for BucketOrder.push_down"""
+    def agg(self):
+        a = A('terms', field='OIM_Site')
+        a.metric('CoreHours', 'sum', field='CoreHours')\
+            .metric('Users', 'cardinality', field='CommonName')
+        return a
+
+    def test_safe(self):
+        """Descending metric and term orders are pushed down"""
+        a = self.agg()
+        self.assertTrue(BucketOrder.push_down(a, '-CoreHours', 20))
+        self.assertDictContainsSubset({'order': {'CoreHours': 'desc'},
+                                       'size': 20}, a.to_dict()['terms'])
+        a = self.agg()
+        self.assertTrue(BucketOrder.push_down(a, 'key', 5))
+        self.assertEqual(a.to_dict()['terms']['order'], {'_term': 'asc'})
+
+    def test_unsafe(self):
+        """Ascending metrics, multiple keys, and unknown or multi-value
+        metrics are left alone"""
+        for order in ('CoreHours', ['-CoreHours', 'key'], '-Users',
+                      '-Missing', '_count'):
+            a = self.agg()
+            self.assertFalse(BucketOrder.push_down(a, order, 20))
+            self.assertNotIn('order', a.to_dict()['terms'])
+
+
+if __name__ == '__main__':
+    unittest.main()
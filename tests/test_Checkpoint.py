@@ -0,0 +1,95 @@
+"""Unit tests for Checkpoint"""
+
+import unittest
+import os
+import tempfile
+from shutil import rmtree
+
+from elasticsearch_dsl import Search
+
+from gracc_reporting.Checkpoint import Checkpoint, CheckpointedScan, \
+    search_after_pages, fingerprint
+from tests.fake_es import FakeElasticsearch, day, day_range
+
+
+class TestCheckpointBase(unittest.TestCase):
+    """Base class for Checkpoint tests"""
+    def setUp(self):
+        self.records = [{'_id': i, 'Site': 'S{0}'.format(i % 3),
+                         'EndTime': t, 'CoreHours': 1.0}
+                        for i, t in enumerate(day_range(day(2018, 7, 1), 10))]
+        self.client = FakeElasticsearch(self.records)
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'ckpt', 'test.ckpt')
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def search(self):
+        return Search(using=self.client, index='gracc.osg.raw-2018.07')
+
+
+class TestSearchAfterPages(TestCheckpointBase):
+    """Tests for Checkpoint.search_after_pages"""
+    def test_pages(self):
+        """Every hit comes back once, in sort order, without a scroll"""
+        pages = list(search_after_pages(self.search(), size=4))
+        self.assertListEqual([len(hits) for hits, _ in pages], [4, 4, 2])
+        self.assertEqual(sum(h['CoreHours'] for hits, _ in pages
+                             for h in hits), 10.0)
+        self.assertEqual(pages[0][1][1], 'doc#3')
+        self.assertNotIn('search_after', self.client.calls[0]['body'])
+        self.assertEqual(self.client.calls[1]['body']['search_after'],
+                         pages[0][1])
+
+
+class TestCheckpointedScan(TestCheckpointBase):
+    """Tests for Checkpoint.CheckpointedScan"""
+    def consume(self, state, hits):
+        if self.fail_after is not None and state['n'] >= self.fail_after:
+            raise IOError("Connection reset")
+        state['n'] += len(hits)
+        for h in hits:
+            state[h['Site']] = state.get(h['Site'], 0) + h['CoreHours']
+
+    def test_resume(self):
+        """A failed scan resumes from its last checkpoint, and ends with the
+        same state as an uninterrupted one"""
+        self.fail_after = 6
+        scan = CheckpointedScan(self.search(), Checkpoint(self.path),
+                                size=3, interval=0)
+        self.assertRaises(IOError, scan.run, {'n': 0}, self.consume)
+        self.assertEqual(scan.checkpoint.load()['records'], 6)
+
+        self.fail_after = None
+        ncalls = len(self.client.calls)
+        scan = CheckpointedScan(self.search(), Checkpoint(self.path),
+                                size=3, interval=0)
+        state = scan.run({'n': 0}, self.consume)
+        self.assertEqual(scan.resumed_from, 6)
+        self.assertDictEqual(state, {'n': 10, 'S0': 4.0, 'S1': 3.0,
+                                     'S2': 3.0})
+        # Only the pages after the checkpoint were fetched again
+        self.assertEqual(len(self.client.calls) - ncalls, 2)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_other_query_ignored(self):
+        """A checkpoint of a different query isn't resumed"""
+        Checkpoint(self.path, 'someotherquery').save(['x'], {'n': 99}, 99)
+        self.fail_after = None
+        scan = CheckpointedScan(self.search(), Checkpoint(self.path),
+                                interval=3600)
+        self.assertEqual(scan.run({'n': 0}, self.consume)['n'], 10)
+        self.assertEqual(scan.resumed_from, 0)
+
+    def test_fingerprint(self):
+        """Fingerprints depend on the query but not on search_after"""
+        s = self.search()
+        self.assertEqual(fingerprint(s),
+                         fingerprint(s.extra(search_after=[1, 'a'])))
+        self.assertNotEqual(fingerprint(s),
+                            fingerprint(s.filter('term', Site='S0')))
+
+
+if __name__ == '__main__':
+    unittest.main()
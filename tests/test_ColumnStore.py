@@ -0,0 +1,120 @@
+"""Unit tests for ColumnStore"""
+
+import unittest
+import os
+import tempfile
+import shutil
+from datetime import timedelta
+
+import gracc_reporting.ColumnStore as ColumnStore
+from tests.fake_es import FakeElasticsearch, day
+
+SITES = ['SiteA', 'SiteB', 'SiteC']
+VOS = ['vo1', 'vo2']
+
+
+def make_records():
+    """Three days of raw records, 100 a day, spread over each day"""
+    records = []
+    for dom in (1, 2, 3):
+        for i in range(100):
+            records.append({'_id': len(records),
+                            'EndTime': day(2018, 7, dom) +
+                            timedelta(minutes=14 * i),
+                            'OIM_Site': SITES[i % 3], 'VOName': VOS[i % 2],
+                            'CommonName': None if i % 10 else 'alice',
+                            'CoreHours': float(i), 'Njobs': 1})
+    return records
+
+
+def expected(records, group_by, start, end, where=None):
+    """Group-by sums of CoreHours and Njobs, computed the slow way"""
+    sums = {}
+    for r in records:
+        if not start <= r['EndTime'] < end:
+            continue
+        if any(r[k] not in v for k, v in (where or {}).iteritems()):
+            continue
+        key = tuple(r[g] if r[g] is not None else 'N/A' for g in group_by)
+        total = sums.setdefault(key, [0.0, 0.0])
+        total[0] += r['CoreHours']
+        total[1] += r['Njobs']
+    return [k + tuple(v) for k, v in sorted(sums.iteritems())]
+
+
+class TestColumnStore(unittest.TestCase):
+    """Tests for ColumnStore.ColumnStore"""
+    start = day(2018, 7, 1)
+    end = day(2018, 7, 4)
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.records = make_records()
+        self.client = FakeElasticsearch(self.records)
+        self.store = ColumnStore.ColumnStore(
+            self.tmpdir, dimensions=['OIM_Site', 'VOName', 'CommonName'],
+            page_size=60)
+        self.store.refresh(self.client, self.start, self.end)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def check_aggregates(self):
+        for group_by in (['OIM_Site'], ['VOName', 'OIM_Site'],
+                         ['CommonName'], []):
+            self.assertListEqual(
+                self.store.aggregate(self.start, self.end, group_by),
+                expected(self.records, group_by, self.start, self.end))
+        # Part of a day, and a filter
+        start, end = day(2018, 7, 1, 12), day(2018, 7, 2, 6)
+        self.assertListEqual(
+            self.store.aggregate(start, end, ['OIM_Site'],
+                                 where={'VOName': 'vo2'}),
+            expected(self.records, ['OIM_Site'], start, end,
+                     where={'VOName': ['vo2']}))
+
+    def test_aggregate(self):
+        """Group-by sums match sums over the raw records"""
+        self.check_aggregates()
+
+    def test_aggregate_blocks(self):
+        """Without numpy, the same sums come from reading blocks"""
+        numpy, block_rows = ColumnStore.numpy, ColumnStore.BLOCK_ROWS
+        ColumnStore.numpy, ColumnStore.BLOCK_ROWS = None, 7
+        try:
+            self.check_aggregates()
+        finally:
+            ColumnStore.numpy, ColumnStore.BLOCK_ROWS = numpy, block_rows
+
+    def test_files(self):
+        """Each day is a directory of column files and dictionaries"""
+        self.assertListEqual(self.store.days(),
+                             ['2018-07-01', '2018-07-02', '2018-07-03'])
+        daydir = os.path.join(self.store.path, '2018-07-01')
+        self.assertEqual(os.path.getsize(os.path.join(daydir, 'm0.f8')), 800)
+        self.assertEqual(os.path.getsize(os.path.join(daydir, 'd0.i4')), 400)
+
+    def test_refresh_changed(self):
+        """Only days that changed are scanned again"""
+        self.assertListEqual(
+            self.store.refresh(self.client, self.start, self.end), [])
+        self.records[150]['CoreHours'] += 1000
+        self.assertListEqual(
+            self.store.refresh(self.client, self.start, self.end),
+            ['2018-07-02'])
+        self.check_aggregates()
+        self.assertListEqual([d for d in os.listdir(self.store.path)
+                              if d.startswith('.')], [])
+
+    def test_columns(self):
+        """columns gives format_report-ready columns"""
+        cols = self.store.columns(self.start, self.end, ['VOName'],
+                                  metrics=['Njobs'])
+        self.assertDictEqual(cols, {'VOName': ['vo1', 'vo2'],
+                                    'Njobs': [150.0, 150.0]})
+        self.assertRaises(ValueError, self.store.aggregate, self.start,
+                          self.end, ['ProjectName'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+"""Unit tests for Datasets"""
+
+import unittest
+import sys
+
+from elasticsearch.exceptions import TransportError
+from elasticsearch_dsl import Search
+
+import gracc_reporting.Datasets as Datasets
+import tests.test_ReportUtils as test_ReportUtils
+from tests.fake_es import FakeElasticsearch
+
+RECORDS = [{'Site': site, 'VOName': vo, 'CoreHours': hours}
+           for site, vo, hours in (('A', 'vo1', 1.0), ('A', 'vo2', 2.0),
+                                   ('B', 'vo1', 4.0))]
+
+
+def site_vo_query(report):
+    s = Search(using=report.fake_client, index='fake')[0:0]
+    s.aggs.bucket('Site', 'terms', field='Site')\
+        .bucket('VO', 'terms', field='VOName')\
+        .metric('CoreHours', 'sum', field='CoreHours')
+    return s
+
+
+def site_vo(results, deps):
+    return dict(((site.key, vo.key), vo.CoreHours.value)
+                for site in results.Site.buckets for vo in site.VO.buckets)
+
+
+def total_by(position):
+    def process(results, deps):
+        totals = {}
+        for key, hours in deps['site_vo'].iteritems():
+            totals[key[position]] = totals.get(key[position], 0) + hours
+        return totals
+    return process
+
+
+class DatasetReport(test_ReportUtils.FakeESReport):
+    """Report that records the datasets it was given"""
+    def __init__(self, fake_client, datasets, **kwargs):
+        super(DatasetReport, self).__init__(fake_client, **kwargs)
+        self.datasets = datasets
+        self.got = None
+
+    def run_report(self):
+        self.got = dict((name, self.dataset(name)) for name in self.datasets)
+
+
+class TestDatasets(unittest.TestCase):
+    """Tests for Datasets.DatasetRunner and Reporter.dataset"""
+    def setUp(self):
+        self.registered = dict(Datasets._registry)
+        Datasets.register(Datasets.Dataset('site_vo', query=site_vo_query,
+                                           process=site_vo))
+        Datasets.dataset('by_site', depends=('site_vo', ))(total_by(0))
+        Datasets.dataset('by_vo', depends=('site_vo', ))(total_by(1))
+        self.client = FakeElasticsearch(RECORDS)
+
+    def tearDown(self):
+        Datasets._registry.clear()
+        Datasets._registry.update(self.registered)
+
+    def test_shared(self):
+        """Datasets are computed once, in dependency order, and shared"""
+        reports = [DatasetReport(self.client, ('by_site', )),
+                   DatasetReport(self.client, ('by_vo', 'site_vo'))]
+        runner = Datasets.DatasetRunner(reports)
+        scope = (reports[0].start_time, reports[0].end_time,
+                 reports[0].indexpattern, None)
+        self.assertListEqual(runner.plan()[:2], [
+            ('dataset', 'site_vo', scope), ('dataset', 'by_site', scope)])
+        self.assertDictEqual(runner.run(), {})
+        self.assertEqual(len(self.client.calls), 1)
+        self.assertDictEqual(reports[0].got['by_site'], {'A': 3.0, 'B': 4.0})
+        self.assertDictEqual(reports[1].got['by_vo'], {'vo1': 5.0, 'vo2': 2.0})
+        self.assertIsNone(reports[0]._datasets)
+
+    def test_standalone(self):
+        """Outside a runner, a report computes its own datasets"""
+        report = DatasetReport(self.client, ('by_site', 'by_vo'))
+        report.run_report()
+        self.assertDictEqual(report.got['by_vo'], {'vo1': 5.0, 'vo2': 2.0})
+        self.assertEqual(len(self.client.calls), 1)
+
+    def test_scopes(self):
+        """Reports over other indices or VOs get their own datasets"""
+        reports = [DatasetReport(self.client, ('by_site', )),
+                   DatasetReport(self.client, ('by_site', )),
+                   DatasetReport(self.client, ('by_site', ), vo='testVO')]
+        reports[1].indexpattern = 'gracc.osg.summary'
+        self.assertDictEqual(Datasets.DatasetRunner(reports).run(), {})
+        # site_vo is computed once per scope
+        self.assertEqual(len(self.client.calls), 3)
+
+    def test_exit_contained(self):
+        """A report that exits fails, and the rest of the batch runs"""
+        reports = [DatasetReport(self.client, ('by_site', )),
+                   DatasetReport(self.client, ('by_vo', ))]
+        reports[0].run_report = lambda: sys.exit(1)
+        failures = Datasets.DatasetRunner(reports).run()
+        self.assertListEqual(failures.keys(), [0])
+        self.assertIsInstance(failures[0], SystemExit)
+        self.assertDictEqual(reports[1].got['by_vo'], {'vo1': 5.0, 'vo2': 2.0})
+
+    def test_failure(self):
+        """A failed dataset fails only the reports that need it"""
+        Datasets.register(Datasets.Dataset('other', process=lambda r, d: 1))
+        self.client.fail_with = lambda body: TransportError(400, 'bad', {})
+        reports = [DatasetReport(self.client, ('by_site', )),
+                   DatasetReport(self.client, ('other', ))]
+        failures = Datasets.DatasetRunner(reports).run()
+        self.assertListEqual(failures.keys(), [0])
+        self.assertDictEqual(reports[1].got, {'other': 1})
+
+    def test_cycle(self):
+        """Dependency cycles are reported"""
+        Datasets.dataset('x', depends=('y', ))(lambda r, d: None)
+        Datasets.dataset('y', depends=('x', ))(lambda r, d: None)
+        self.assertRaises(ValueError, Datasets.toposort, ['x'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+"""Unit tests for Governor"""
+
+import unittest
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from shutil import rmtree
+
+from gracc_reporting.Governor import Governor, GovernorTimeout, SlotDir, \
+    TokenBucket, get_governor
+
+
+def hold_slots(path, held, done):
+    """Hold every slot of a SlotDir until done is set (in another
+    process)"""
+    slots = SlotDir(path, 'query', 2)
+    files = [slots.acquire(), slots.acquire()]
+    held.set()
+    done.wait(10)
+
+
+class TestTokenBucket(unittest.TestCase):
+    """Tests for Governor.TokenBucket"""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.now = [1000.0]
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def bucket(self, path=None):
+        b = TokenBucket(2.0, burst=3, path=path)
+        b._clock = lambda: self.now[0]
+
+        def sleep(t):
+            self.now[0] += t
+        b._sleep = sleep
+        return b
+
+    def test_rate(self):
+        """A full bucket allows a burst, then refills at the rate"""
+        b = self.bucket()
+        self.assertListEqual([b.acquire() for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(b.acquire(), 0.5)
+        self.now[0] += 10
+        self.assertEqual(b.acquire(), 0)
+
+    def test_shared_file(self):
+        """Buckets kept in the same file draw from the same tokens"""
+        path = os.path.join(self.tmpdir, 'rate.host')
+        b1, b2 = self.bucket(path), self.bucket(path)
+        b1.acquire()
+        b1.acquire()
+        self.assertEqual(b2.acquire(), 0)
+        self.assertAlmostEqual(b2.acquire(), 0.5)
+
+
+class TestSlotDir(unittest.TestCase):
+    """Tests for Governor.SlotDir"""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def test_slots(self):
+        """Only as many slots as configured can be held"""
+        slots = SlotDir(self.tmpdir, 'query', 2)
+        held = [slots.acquire(), slots.acquire()]
+        self.assertRaises(GovernorTimeout, slots.acquire, 0)
+        SlotDir.release(held.pop())
+        SlotDir.release(slots.acquire(0))
+
+    def test_other_process(self):
+        """Slots held by another process are unavailable until it dies"""
+        held, done = multiprocessing.Event(), multiprocessing.Event()
+        p = multiprocessing.Process(target=hold_slots,
+                                    args=(self.tmpdir, held, done))
+        p.start()
+        try:
+            self.assertTrue(held.wait(10))
+            slots = SlotDir(self.tmpdir, 'query', 2)
+            self.assertRaises(GovernorTimeout, slots.acquire, 0.1)
+        finally:
+            p.terminate()
+            p.join()
+        SlotDir.release(slots.acquire(5))
+
+
+class TestGovernor(unittest.TestCase):
+    """Tests for Governor.Governor"""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def run_queries(self, governor, n):
+        state = {'running': 0, 'max': 0}
+        lock = threading.Lock()
+
+        def query():
+            with governor.query('host'):
+                with lock:
+                    state['running'] += 1
+                    state['max'] = max(state['max'], state['running'])
+                time.sleep(0.05)
+                with lock:
+                    state['running'] -= 1
+
+        threads = [threading.Thread(target=query) for _ in range(n)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return state['max']
+
+    def test_max_queries(self):
+        """No more than max_queries run at once"""
+        self.assertEqual(self.run_queries(Governor(max_queries=2), 6), 2)
+
+    def test_max_queries_lock_dir(self):
+        """The cap holds with lock files too"""
+        governor = Governor(max_queries=2, lock_dir=self.tmpdir)
+        self.assertEqual(self.run_queries(governor, 6), 2)
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir,
+                                                    'query.0.lock')))
+
+    def test_scroll_timeout(self):
+        """Waiting too long for a scroll slot raises GovernorTimeout"""
+        governor = Governor(max_scrolls=1, wait_timeout=0.1)
+        with governor.scroll():
+            with self.assertRaises(GovernorTimeout):
+                with governor.scroll():
+                    pass
+        with governor.scroll():
+            pass
+
+    def test_rate_per_host(self):
+        """Each host gets its own bucket"""
+        governor = Governor(rate=1.0, burst=1)
+        self.assertIsNot(governor.bucket('a'), governor.bucket('b'))
+        self.assertIs(governor.bucket('a'), governor.bucket('a'))
+        self.assertIsNone(Governor().bucket('a'))
+
+    def test_rate_lock_dir(self):
+        """A rate limit alone creates lock_dir for the bucket files"""
+        lock_dir = os.path.join(self.tmpdir, 'governor')
+        governor = Governor(rate=10.0, lock_dir=lock_dir)
+        with governor.query('https://es.invalid'):
+            pass
+        self.assertListEqual(os.listdir(lock_dir),
+                             ['rate.https___es.invalid'])
+
+    def test_get_governor(self):
+        """Reports with the same settings share a governor"""
+        g = get_governor({'max_queries': 3})
+        self.assertIs(get_governor({'max_queries': 3}), g)
+        self.assertIsNot(get_governor({'max_queries': 4}), g)
+        self.assertIsNone(get_governor({}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+"""Unit tests for GroupBy"""
+
+import unittest
+import os
+import random
+import tempfile
+import shutil
+import cPickle
+from collections import defaultdict
+
+from gracc_reporting.GroupBy import ExternalGroupBy
+
+REDUCERS = [('CoreHours', 'sum', 'CoreHours'),
+            ('Jobs', 'count', None),
+            ('MinWall', 'min', 'WallDuration'),
+            ('MaxWall', 'max', 'WallDuration')]
+
+
+def make_records(n=2000, seed=42):
+    """Random raw-ish records"""
+    rng = random.Random(seed)
+    return [{'CommonName': 'user{0}'.format(rng.randint(0, 150)),
+             'Site': 'site{0}'.format(rng.randint(0, 5)),
+             'CoreHours': float(rng.randint(0, 100)),
+             'WallDuration': rng.randint(1, 10000)}
+            for _ in xrange(n)]
+
+
+def naive(records):
+    """Reference group-by with plain dicts"""
+    groups = defaultdict(lambda: [0, 0, None, None])
+    for r in records:
+        g = groups[(r['CommonName'], r['Site'])]
+        g[0] += r['CoreHours']
+        g[1] += 1
+        g[2] = r['WallDuration'] if g[2] is None \
+            else min(g[2], r['WallDuration'])
+        g[3] = max(g[3], r['WallDuration'])
+    return sorted((k, v) for k, v in groups.iteritems())
+
+
+class TestExternalGroupBy(unittest.TestCase):
+    """Tests for GroupBy.ExternalGroupBy"""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.records = make_records()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_in_memory(self):
+        """Without spilling, results match a plain dict group-by"""
+        with ExternalGroupBy(['CommonName', 'Site'], REDUCERS) as gb:
+            gb.consume(self.records)
+            self.assertEqual(gb.nruns, 0)
+            self.assertListEqual(list(gb.results()), naive(self.records))
+
+    def test_spill_and_merge(self):
+        """With a tiny memory limit, groups get spilled to disk, and merged
+        results still match a plain dict group-by"""
+        with ExternalGroupBy(['CommonName', 'Site'], REDUCERS,
+                             memory_limit=20000, tmpdir=self.tmpdir) as gb:
+            gb.consume(self.records)
+            self.assertGreater(gb.nruns, 1)
+            self.assertListEqual(list(gb.results()), naive(self.records))
+        self.assertListEqual(os.listdir(self.tmpdir), [])
+
+    def test_columns(self):
+        """Return columns keyed by key fields and reducer names"""
+        records = [{'Site': 'b', 'CoreHours': 1.0},
+                   {'Site': 'a', 'CoreHours': 2.0},
+                   {'Site': 'b', 'CoreHours': 3.0},
+                   {'Site': 'a'}]
+        answer = {'Site': ['a', 'b'], 'CoreHours': [2.0, 4.0], 'Jobs': [2, 2]}
+        with ExternalGroupBy(['Site'], [('CoreHours', 'sum', 'CoreHours'),
+                                        ('Jobs', 'count', None)]) as gb:
+            self.assertDictEqual(gb.consume(records).columns(), answer)
+
+    def test_pickle(self):
+        """A pickled group-by (e.g. in a checkpoint) carries on where it left
+        off, spill files included"""
+        half = len(self.records) // 2
+        gb = ExternalGroupBy(['CommonName', 'Site'], REDUCERS,
+                             memory_limit=20000, tmpdir=self.tmpdir)
+        gb.consume(self.records[:half])
+        with cPickle.loads(cPickle.dumps(gb, cPickle.HIGHEST_PROTOCOL)) as gb2:
+            gb2.consume(self.records[half:])
+            self.assertListEqual(list(gb2.results()), naive(self.records))
+
+    def test_bad_reducer(self):
+        """Raise ValueError for an unknown reducer"""
+        self.assertRaises(ValueError, ExternalGroupBy, ['Site'],
+                          [('x', 'median', 'CoreHours')])
+
+
+if __name__ == '__main__':
+    unittest.main()
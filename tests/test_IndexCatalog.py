@@ -0,0 +1,127 @@
+"""Unit tests for IndexCatalog"""
+
+import unittest
+import os
+import calendar
+import json
+import tempfile
+import time
+from datetime import datetime, timedelta
+from shutil import rmtree
+
+from gracc_reporting.IndexCatalog import IndexCatalog, catalog_pattern
+from tests.fake_es import FakeElasticsearch, day, day_range
+
+
+class TestIndexCatalog(unittest.TestCase):
+    """Tests for IndexCatalog.IndexCatalog"""
+    def setUp(self):
+        records = [{'_index': 'gracc.osg.raw-{0:%Y.%m.%d}'.format(t),
+                    'EndTime': t} for t in day_range(day(2018, 7, 1), 5)]
+        records.append({'_index': 'gracc.osg.other', 'Site': 'A'})
+        self.client = FakeElasticsearch(records)
+        self.client.extra_indices = {'gracc.osg.raw-2018.07.06': 'open',
+                                     'gracc.osg.raw-2018.06.30': 'close'}
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = os.path.join(self.tmpdir, 'state', 'catalog.json')
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def test_catalog(self):
+        """Catalog has status, doc counts, and time ranges"""
+        indices = IndexCatalog(self.client).indices()
+        self.assertEqual(len(indices), 8)
+        info = indices['gracc.osg.raw-2018.07.02']
+        self.assertEqual((info['status'], info['docs']), ('open', 1))
+        self.assertEqual(info['min'], info['max'])
+        self.assertEqual(indices['gracc.osg.raw-2018.06.30']['status'],
+                         'close')
+
+    def test_resolve(self):
+        """Only open, non-empty indices with data in the range are used"""
+        catalog = IndexCatalog(self.client)
+        self.assertListEqual(
+            catalog.resolve('gracc.osg.raw-2018*', day(2018, 6, 30),
+                            day(2018, 7, 3)),
+            ['gracc.osg.raw-2018.07.01', 'gracc.osg.raw-2018.07.02'])
+        self.assertEqual(
+            catalog.index_pattern('gracc.osg.raw-*,gracc.osg.other',
+                                  day(2018, 7, 5), day(2018, 7, 10)),
+            'gracc.osg.other,gracc.osg.raw-2018.07.05')
+
+    def test_fallback(self):
+        """Patterns matching nothing in the catalog (e.g. aliases) are left
+        alone"""
+        catalog = IndexCatalog(self.client)
+        self.assertEqual(catalog.index_pattern('gracc.osg.summary',
+                                               day(2018, 7, 1),
+                                               day(2018, 7, 2)),
+                         'gracc.osg.summary')
+
+    def test_cache_ttl(self):
+        """The catalog is cached, and fetched again once the TTL passes"""
+        IndexCatalog(self.client, cache_path=self.cache).indices()
+        IndexCatalog(self.client, cache_path=self.cache).indices()
+        self.assertEqual(len(self.client.cat.calls), 1)
+        IndexCatalog(self.client, cache_path=self.cache, ttl=-1).indices()
+        self.assertEqual(len(self.client.cat.calls), 2)
+        IndexCatalog(self.client, cache_path=self.cache,
+                     cache_key='other cluster').indices()
+        self.assertEqual(len(self.client.cat.calls), 3)
+
+    def cached_catalog(self, indices, age=0):
+        """Catalog read from a cache file written age seconds ago"""
+        with open(self.cache, 'w') as f:
+            json.dump({'fetched': time.time() - age, 'cache_key': None,
+                       'pattern': '*', 'time_field': 'EndTime',
+                       'indices': indices}, f)
+        return IndexCatalog(None, cache_path=self.cache)
+
+    def test_live_indices(self):
+        """The newest index, and indices with data from within ttl of the
+        fetch, may have newer data than the catalog says"""
+        now = datetime.utcnow()
+        ms = lambda dt: int(calendar.timegm(dt.utctimetuple()) * 1000)
+        info = lambda lo, hi: {'status': 'open', 'docs': 1, 'min': ms(lo),
+                               'max': ms(hi)}
+        os.makedirs(os.path.dirname(self.cache))
+        catalog = self.cached_catalog({
+            'raw-a': info(now - timedelta(days=60), now - timedelta(days=40)),
+            'raw-b': info(now - timedelta(days=40),
+                          now - timedelta(minutes=30)),
+            'raw-c': info(now - timedelta(days=10),
+                          now - timedelta(minutes=20))})
+        start = now - timedelta(minutes=10)
+        end = now - timedelta(minutes=5)
+        self.assertListEqual(catalog.resolve('raw-*', start, end),
+                             ['raw-b', 'raw-c'])
+        self.assertEqual(catalog.index_pattern('raw-*', start, end),
+                         'raw-b,raw-c')
+        # The newest index, long after its last record
+        catalog = IndexCatalog(self.client)
+        self.assertListEqual(
+            catalog.resolve('gracc.osg.raw-*', day(2018, 7, 8),
+                            day(2018, 7, 9)),
+            ['gracc.osg.raw-2018.07.05'])
+
+    def test_range_after_fetch(self):
+        """Ranges that end after the catalog was fetched use the pattern
+        as-is, as indices may have been created since"""
+        catalog = IndexCatalog(self.client)
+        catalog.indices()
+        catalog.fetched = calendar.timegm(day(2018, 7, 3).utctimetuple())
+        self.assertEqual(catalog.index_pattern('gracc.osg.raw-*',
+                                               day(2018, 7, 1),
+                                               day(2018, 7, 4)),
+                         'gracc.osg.raw-*')
+
+    def test_catalog_pattern(self):
+        """Date parts of index patterns become wildcards"""
+        self.assertEqual(catalog_pattern(['gracc.osg.raw-%Y.%m',
+                                          'gracc.osg.summary,gracc.osg.raw-*']),
+                         'gracc.osg.raw-*,gracc.osg.summary')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+"""Unit tests for IndexSources"""
+
+import unittest
+from datetime import timedelta
+
+import gracc_reporting.IndexSources as IndexSources
+from gracc_reporting.IndexCatalog import IndexCatalog
+from tests.fake_es import FakeElasticsearch, day
+
+
+class TestPlanSources(unittest.TestCase):
+    """Tests for IndexSources.plan_sources"""
+    def setUp(self):
+        self.summary = IndexSources.IndexSource(
+            'gracc.osg.summary', fields=['VOName', 'CoreHours'],
+            granularity='1d', lag='2d', cost=1)
+        self.raw = IndexSources.IndexSource('gracc.osg.raw-%Y.%m', cost=10)
+        self.sources = [self.raw, self.summary]
+        self.now = day(2018, 7, 10, 12)
+
+    def plan(self, start, end, **kwargs):
+        plan = IndexSources.plan_sources(self.sources, start, end,
+                                         now=self.now, **kwargs)
+        return [(s.pattern, a, b) for s, a, b in plan]
+
+    def test_split(self):
+        """Partial days at the edges and the lagging last days go to the
+        raw indices, the rest to the summary"""
+        start, end = day(2018, 7, 1, 6), day(2018, 7, 10, 6)
+        self.assertListEqual(self.plan(start, end, fields=['CoreHours']), [
+            ('gracc.osg.raw-%Y.%m', start, day(2018, 7, 2)),
+            ('gracc.osg.summary', day(2018, 7, 2), day(2018, 7, 8)),
+            ('gracc.osg.raw-%Y.%m', day(2018, 7, 8), end)])
+
+    def test_whole_days(self):
+        """Whole days within the summary's range only use the summary"""
+        self.assertListEqual(
+            self.plan(day(2018, 6, 1), day(2018, 7, 1), fields=['VOName']),
+            [('gracc.osg.summary', day(2018, 6, 1), day(2018, 7, 1))])
+
+    def test_fields_and_granularity(self):
+        """Queries needing other fields, finer time buckets, or unknown
+        fields use the raw indices"""
+        start, end = day(2018, 6, 1), day(2018, 7, 1)
+        raw = [('gracc.osg.raw-%Y.%m', start, end)]
+        self.assertListEqual(self.plan(start, end, fields=['Host']), raw)
+        self.assertListEqual(self.plan(start, end, fields=['VOName'],
+                                       granularity=timedelta(hours=1)), raw)
+        self.assertListEqual(self.plan(start, end), raw)
+
+    def test_no_source(self):
+        """Raise NoIndexSourceError if part of the range can't be answered"""
+        self.sources = [self.summary]
+        self.assertRaises(IndexSources.NoIndexSourceError, self.plan,
+                          day(2018, 7, 1, 6), day(2018, 7, 1, 12),
+                          fields=['VOName'])
+
+    def test_up_to_now(self):
+        """Ranges ending at or after now, or after the latest indexed
+        record, are answered up to their end by the freshest source"""
+        start = day(2018, 7, 9)
+        self.sources = [IndexSources.IndexSource('gracc.osg.raw-%Y.%m')]
+        for end in (self.now, self.now + timedelta(hours=1)):
+            self.assertListEqual(self.plan(start, end),
+                                 [('gracc.osg.raw-%Y.%m', start, end)])
+        available = {'gracc.osg.raw-%Y.%m': self.now - timedelta(minutes=5)}
+        self.assertListEqual(self.plan(start, self.now, available=available),
+                             [('gracc.osg.raw-%Y.%m', start, self.now)])
+        # With the summary too, the summary stops at its lag
+        self.sources = [self.raw, self.summary]
+        end = self.now + timedelta(hours=1)
+        self.assertListEqual(self.plan(day(2018, 7, 1), end,
+                                       fields=['VOName']), [
+            ('gracc.osg.summary', day(2018, 7, 1), day(2018, 7, 8)),
+            ('gracc.osg.raw-%Y.%m', day(2018, 7, 8), end)])
+
+    def test_available_from_catalog(self):
+        """The index catalog says where the summary's data ends"""
+        client = FakeElasticsearch([
+            {'_index': 'gracc.osg.summary', 'EndTime': day(2018, 7, d)}
+            for d in range(1, 6)])
+        available = IndexSources.available_from_catalog(
+            IndexCatalog(client), self.sources)
+        self.assertDictEqual(available, {'gracc.osg.summary': day(2018, 7, 5)})
+        self.assertEqual(
+            self.plan(day(2018, 7, 1), day(2018, 7, 7), fields=['VOName'],
+                      available=available)[0],
+            ('gracc.osg.summary', day(2018, 7, 1), day(2018, 7, 5)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,208 @@
+"""Unit tests for JobQueue"""
+
+import unittest
+import os
+import multiprocessing
+import tempfile
+import time
+from contextlib import contextmanager
+from shutil import rmtree
+from datetime import date, datetime, timedelta
+
+from gracc_reporting.JobQueue import JobQueue, Worker, job_key, report_spec
+
+REPORT = 'tests.test_JobQueue:FakeReport'
+A, B, C, D = '2018-07-01', '2018-07-02', '2018-07-03', '2018-07-04'
+
+
+class FakeReport(object):
+    """Stands in for a Reporter subclass.  Appends a line to its log file
+    each time it runs.  crash_once exits the process (as a dying worker
+    would) on the job's first run; fail raises every time.  Records the
+    host_clients it was given"""
+    clients = []
+
+    def __init__(self, config_file, start, end, log=None, crash_once=False,
+                 fail=False, delay=0.0, **kwargs):
+        self.host_clients = kwargs.get('host_clients') or {'host': object()}
+        FakeReport.clients.append(kwargs.get('host_clients'))
+        self.log = log
+        self.crash_once = crash_once
+        self.fail = fail
+        self.delay = delay
+        self.args = (start, end)
+
+    @contextmanager
+    def collect_metrics(self):
+        yield
+
+    def run_report(self):
+        time.sleep(self.delay)
+        if self.crash_once and not os.path.exists(self.log + '.crashed'):
+            open(self.log + '.crashed', 'w').close()
+            os._exit(1)
+        if self.fail:
+            raise Exception("Report failed")
+        with open(self.log, 'a') as f:
+            f.write('{0} {1} {2}\n'.format(os.getpid(), *self.args))
+
+
+def work(path, lease, until_empty=True):
+    """Worker process"""
+    queue = JobQueue(path, lease=lease)
+    Worker(queue, None, poll_interval=0.05).serve(until_empty=until_empty)
+    queue.close()
+
+
+class TestJobQueue(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'jobs.sqlite')
+        self.queue = JobQueue(self.path, lease=30, max_attempts=2)
+
+    def tearDown(self):
+        self.queue.close()
+        rmtree(self.tmpdir)
+
+    def test_job_key(self):
+        """Identical jobs share a key, whatever the order of kwargs"""
+        self.assertEqual(job_key(REPORT, A, B, {'x': 1, 'y': 2}),
+                         job_key(REPORT, A, B, {'y': 2, 'x': 1}))
+        self.assertNotEqual(job_key(REPORT, A, B),
+                            job_key(REPORT, A, C))
+        self.assertEqual(report_spec(FakeReport), REPORT)
+        # Times are compared as the report would parse them
+        self.assertEqual(job_key(REPORT, '2018-07-01 06:30', B),
+                         job_key(REPORT, datetime(2018, 7, 1, 6, 30, 0),
+                                 '2018-07-02 00:00:00'))
+
+    def test_submit_dedupe(self):
+        """An identical job is only queued once, unless forced"""
+        job_id, added = self.queue.submit(REPORT, A, B, {'vo': 'x'})
+        self.assertTrue(added)
+        self.assertEqual(self.queue.submit(REPORT, A, B, {'vo': 'x'}),
+                         (job_id, False))
+        self.assertTrue(self.queue.submit(REPORT, A, B, {'vo': 'y'})[1])
+        self.assertTrue(self.queue.submit(REPORT, A, B, {'vo': 'x'},
+                                          force=True)[1])
+        self.assertEqual(self.queue.counts(), {'pending': 3})
+
+    def test_claim_complete(self):
+        """A claimed job isn't claimed again, and done jobs dedupe"""
+        job_id, _ = self.queue.submit(REPORT, A, B, {'vo': 'x'})
+        job = self.queue.claim('w1')
+        self.assertEqual((job['id'], job['kwargs'], job['attempts']),
+                         (job_id, {'vo': 'x'}, 1))
+        self.assertIsNone(self.queue.claim('w2'))
+        self.assertFalse(self.queue.complete(job_id, 'w2'))
+        self.assertTrue(self.queue.complete(job_id, 'w1', 1.5))
+        self.assertEqual(self.queue.submit(REPORT, A, B, {'vo': 'x'}),
+                         (job_id, False))
+        self.assertEqual(self.queue.jobs('done')[0]['duration'], 1.5)
+
+    def test_fail_retries(self):
+        """A failed job is retried until it runs out of attempts"""
+        job_id, _ = self.queue.submit(REPORT, A, B)
+        self.queue.fail(self.queue.claim('w1')['id'], 'w1', 'boom')
+        self.assertEqual(self.queue.counts(), {'pending': 1})
+        job = self.queue.claim('w2')
+        self.assertEqual(job['attempts'], 2)
+        self.queue.fail(job_id, 'w2', 'boom again')
+        failed = self.queue.jobs('failed')
+        self.assertEqual([(j['id'], j['error']) for j in failed],
+                         [(job_id, 'boom again')])
+        # A failed job can be submitted again
+        self.assertTrue(self.queue.submit(REPORT, A, B)[1])
+
+    def test_lease_expiry(self):
+        """A job whose worker stops renewing its lease goes to another
+        worker, and the first worker can no longer finish it"""
+        now = [1000.0]
+        self.queue._clock = lambda: now[0]
+        job_id, _ = self.queue.submit(REPORT, A, B)
+        self.queue.claim('dead')
+        now[0] += 20
+        self.assertTrue(self.queue.renew(job_id, 'dead'))
+        now[0] += 29
+        self.assertIsNone(self.queue.claim('w2'))
+        now[0] += 2
+        job = self.queue.claim('w2')
+        self.assertEqual((job['id'], job['attempts']), (job_id, 2))
+        self.assertFalse(self.queue.renew(job_id, 'dead'))
+        self.assertFalse(self.queue.complete(job_id, 'dead'))
+        # Out of attempts once this lease runs out too
+        now[0] += 31
+        self.assertIsNone(self.queue.claim('w3'))
+        self.assertEqual(self.queue.counts(), {'failed': 1})
+
+    def test_worker_runs_jobs(self):
+        """A worker runs jobs and records success and failure"""
+        log = os.path.join(self.tmpdir, 'runs.log')
+        self.queue.submit(REPORT, A, B, {'log': log})
+        self.queue.submit(REPORT, C, D, {'log': log, 'fail': True})
+        worker = Worker(self.queue, None, name='w1', poll_interval=0)
+        self.assertEqual(worker.serve(until_empty=True), 3)
+        with open(log) as f:
+            self.assertEqual([line.split()[1:] for line in f],
+                             [[A, B]])
+        self.assertEqual(self.queue.counts(), {'done': 1, 'failed': 1})
+        self.assertIn('Report failed', self.queue.jobs('failed')[0]['error'])
+
+    def test_worker_warm_clients(self):
+        """Later jobs reuse the clients of earlier jobs on the same hosts,
+        but not those of other hosts"""
+        cfg = os.path.join(self.tmpdir, 'config.toml')
+        with open(cfg, 'w') as f:
+            f.write("[elasticsearch]\n"
+                    "    hostname = 'https://es.invalid'\n"
+                    "    other_host = 'https://other.invalid'\n")
+        log = os.path.join(self.tmpdir, 'runs.log')
+        FakeReport.clients = []
+        self.queue.submit(REPORT, A, B, {'log': log})
+        self.queue.submit(REPORT, A, B, {'log': log,
+                                         'althost_key': 'other_host'})
+        self.queue.submit(REPORT, C, D, {'log': log,
+                                         'althost_key': 'other_host'})
+        worker = Worker(self.queue, cfg, poll_interval=0)
+        worker.serve(until_empty=True)
+        self.assertListEqual(FakeReport.clients[:2], [None, None])
+        self.assertIs(FakeReport.clients[2],
+                      worker.warm_clients.get('other_host'))
+        self.assertIsNot(worker.warm_clients.get('other_host'),
+                         worker.warm_clients.get())
+
+    def test_worker_processes(self):
+        """Several worker processes share the queue:  every job runs once,
+        and the job of a worker that dies is rerun by another"""
+        log = os.path.join(self.tmpdir, 'runs.log')
+        ranges = [(str(day), str(day + timedelta(days=1)))
+                  for day in (date(2018, 7, 1) + timedelta(days=i)
+                              for i in xrange(12))]
+        for start, end in ranges:
+            self.queue.submit(REPORT, start, end, {'log': log, 'delay': 0.05})
+        crash = ('2018-08-01', '2018-08-02')
+        self.queue.submit(REPORT, crash[0], crash[1],
+                          {'log': log, 'crash_once': True})
+
+        procs = [multiprocessing.Process(target=work, args=(self.path, 1))
+                 for _ in xrange(3)]
+        for p in procs:
+            p.start()
+        # The worker that crashed exited early, but the others wait for its
+        # job's lease to run out and then rerun it
+        for p in procs:
+            p.join(60)
+        self.assertEqual(sorted(p.exitcode for p in procs), [0, 0, 1])
+
+        with open(log) as f:
+            runs = [line.split() for line in f]
+        self.assertEqual(sorted((start, end) for _, start, end in runs),
+                         sorted(ranges + [crash]))
+        self.assertGreater(len(set(pid for pid, _, _ in runs)), 1)
+        self.assertEqual(self.queue.counts(), {'done': 13})
+        crashed = [j for j in self.queue.jobs() if j['start'] == crash[0]][0]
+        self.assertEqual(crashed['attempts'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
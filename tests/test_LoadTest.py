@@ -0,0 +1,126 @@
+"""Unit tests for LoadTest"""
+
+import unittest
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from shutil import rmtree
+
+from gracc_reporting.LoadTest import LoadTest, weighted_jobs, percentile, \
+    best_concurrency, write_curve, format_curve, CURVE_FIELDS
+from gracc_reporting.Replay import Recording, ReplayClient
+
+CONFIG = """
+[schedule.big]
+    report = 'tests.test_LoadTest:FakeReport'
+    every = '1d'
+    [schedule.big.kwargs]
+        vo = 'big'
+
+[schedule.small]
+    report = 'tests.test_LoadTest:FakeReport'
+    every = '1d'
+    [schedule.small.kwargs]
+        vo = 'small'
+"""
+
+
+class FakeReport(object):
+    """Stands in for a Reporter subclass.  Runs one search on its client"""
+    runs = []
+    lock = threading.Lock()
+
+    def __init__(self, config_file, start, end, **kwargs):
+        self.client = kwargs['host_clients'].values()[0]
+        self.vo = kwargs['vo']
+        self.no_email = kwargs['no_email']
+
+    @contextmanager
+    def collect_metrics(self):
+        yield
+
+    def run_report(self):
+        self.client.search(index='gracc.osg.raw-*',
+                           body={'query': {'term': {'VO': self.vo}}})
+        with self.lock:
+            FakeReport.runs.append(self.vo)
+
+
+class TestHelpers(unittest.TestCase):
+    """Tests for the LoadTest helper functions"""
+    def test_weighted_jobs(self):
+        """Jobs follow the weights, interleaved"""
+        jobs = weighted_jobs([('big', 3), ('small', 1)], 8)
+        self.assertEqual(jobs.count('big'), 6)
+        self.assertEqual(jobs[:4].count('small'), 1)
+        self.assertRaises(ValueError, weighted_jobs, [('big', 0)], 1)
+
+    def test_percentile(self):
+        self.assertEqual(percentile(range(101), 90), 90)
+        self.assertIsNone(percentile([], 50))
+
+    def test_best_concurrency(self):
+        """The highest efficient level without errors is suggested"""
+        curve = [{'concurrency': 1, 'efficiency': 1.0, 'errors': 0},
+                 {'concurrency': 2, 'efficiency': 0.9, 'errors': 0},
+                 {'concurrency': 4, 'efficiency': 0.5, 'errors': 0},
+                 {'concurrency': 8, 'efficiency': 0.9, 'errors': 1}]
+        self.assertEqual(best_concurrency(curve), 2)
+
+
+class TestLoadTest(unittest.TestCase):
+    """Tests for LoadTest.LoadTest"""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cfg = os.path.join(self.tmpdir, 'config.toml')
+        with open(self.cfg, 'w') as f:
+            f.write(CONFIG)
+        recording = Recording()
+        for vo in ('big', 'small'):
+            recording.add('gracc.osg.raw-*', {'query': {'term': {'VO': vo}}},
+                          {'took': 50, 'hits': {'total': 0, 'hits': []}})
+        self.client = ReplayClient(recording)
+        FakeReport.runs = []
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def test_curve(self):
+        """Every level runs the whole mix, and more threads finish the same
+        runs sooner"""
+        test = LoadTest(self.cfg, [('big', 3), ('small', 1)],
+                        OrderedDict([('replay', self.client)]),
+                        '2018-07-01', '2018-07-02', levels=[1, 4], runs=8)
+        curve = test.run()
+        self.assertEqual(len(FakeReport.runs), 16)
+        self.assertEqual(FakeReport.runs.count('small'), 4)
+        self.assertListEqual([r['errors'] for r in curve], [0, 0])
+        self.assertGreaterEqual(curve[0]['p50'], 0.05)
+        self.assertGreater(curve[1]['throughput'],
+                           2 * curve[0]['throughput'])
+        self.assertEqual(curve[0]['efficiency'], 1.0)
+
+        path = os.path.join(self.tmpdir, 'curve.csv')
+        write_curve(curve, path)
+        with open(path) as f:
+            self.assertEqual(f.readline().strip(), ','.join(CURVE_FIELDS))
+        self.assertIn('throughput', format_curve(curve))
+
+    def test_errors_counted(self):
+        """Reports whose searches weren't recorded count as errors"""
+        self.client.recording.responses.clear()
+        test = LoadTest(self.cfg, [('small', 1)],
+                        OrderedDict([('replay', self.client)]),
+                        '2018-07-01', '2018-07-02', levels=[2], runs=3)
+        self.assertEqual(test.run()[0]['errors'], 3)
+
+    def test_unknown_schedule(self):
+        self.assertRaises(KeyError, LoadTest, self.cfg, [('nope', 1)],
+                          OrderedDict(), None, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+"""Unit tests for MemProfile"""
+
+import unittest
+import logging
+import threading
+
+import gracc_reporting.MemProfile as MemProfile
+
+
+class ListHandler(logging.Handler):
+    """Keeps log messages in a list"""
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class TestMemoryProfiler(unittest.TestCase):
+    """Tests for MemProfile.MemoryProfiler"""
+    def setUp(self):
+        self.logger = logging.getLogger('test_memprofile')
+        self.logger.setLevel(logging.DEBUG)
+        self.handler = ListHandler()
+        self.logger.addHandler(self.handler)
+        self.peak_rss = MemProfile.peak_rss
+        self.reset_peak = MemProfile.reset_peak
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        MemProfile.peak_rss = self.peak_rss
+        MemProfile.reset_peak = self.reset_peak
+
+    def fake_peak(self):
+        """Replace the process's peak RSS with self.peak, which resets
+        count in self.resets"""
+        self.peak = 100
+        self.resets = 0
+
+        def reset_peak():
+            self.resets += 1
+            self.peak = 100
+            return True
+        MemProfile.peak_rss = lambda: self.peak
+        MemProfile.reset_peak = reset_peak
+
+    def test_phase_logged(self):
+        """Each phase's peak RSS is recorded and logged"""
+        prof = MemProfile.MemoryProfiler(self.logger)
+        with prof.phase('format_report'):
+            data = ['x' * 1024 for _ in xrange(1024)]
+        del data
+        self.assertEqual(prof.phases[0]['phase'], 'format_report')
+        self.assertTrue(prof.phases[0]['peak_rss'] > 0)
+        self.assertTrue(any(m.startswith('Memory: format_report: peak RSS')
+                            for m in self.handler.messages))
+
+    def test_nested_peak(self):
+        """An outer phase's peak is at least its inner phase's peak"""
+        prof = MemProfile.MemoryProfiler(self.logger)
+        with prof.phase('outer'):
+            with prof.phase('inner'):
+                pass
+        inner, outer = prof.phases
+        self.assertEqual((inner['phase'], outer['phase']), ('inner', 'outer'))
+        self.assertTrue(outer['peak_rss'] >= inner['peak_rss'])
+
+    def test_nested_reset(self):
+        """An inner phase's reset doesn't lose the outer phase's peak from
+        before it"""
+        self.fake_peak()
+        prof = MemProfile.MemoryProfiler(self.logger)
+        with prof.phase('outer'):
+            self.peak = 900
+            with prof.phase('inner'):
+                self.peak = 300
+        inner, outer = prof.phases
+        self.assertEqual((inner['peak_rss'], outer['peak_rss']), (300, 900))
+        self.assertEqual(self.resets, 2)
+
+    def test_threads_no_reset(self):
+        """The peak isn't reset while another thread has a phase open"""
+        self.fake_peak()
+        opened, done = threading.Event(), threading.Event()
+
+        def other():
+            with MemProfile.MemoryProfiler(self.logger).phase('other'):
+                opened.set()
+                done.wait(10)
+        t = threading.Thread(target=other)
+        t.start()
+        opened.wait(10)
+        prof = MemProfile.MemoryProfiler(self.logger)
+        try:
+            with prof.phase('run_query'):
+                pass
+        finally:
+            done.set()
+            t.join()
+        self.assertEqual(self.resets, 1)
+        self.assertFalse(prof.phases[0]['exact'])
+
+    def test_budget_exceeded(self):
+        """Going over budget fails with a message naming the phase"""
+        prof = MemProfile.MemoryProfiler(self.logger, budget=1)
+        with self.assertRaises(MemProfile.MemoryBudgetExceeded) as cm:
+            with prof.phase('run_query'):
+                pass
+        self.assertIn('during run_query', str(cm.exception))
+
+    def test_error_not_masked(self):
+        """Errors raised inside a phase aren't replaced by budget errors"""
+        prof = MemProfile.MemoryProfiler(self.logger, budget=1)
+        with self.assertRaises(KeyError):
+            with prof.phase('run_query'):
+                raise KeyError('x')
+        self.assertEqual(len(prof.phases), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+"""Unit tests for Metrics"""
+
+import unittest
+import os
+import tempfile
+import time
+from shutil import rmtree
+
+from gracc_reporting.Metrics import RunMetrics, count_buckets, textfile_name
+
+
+class TestCountBuckets(unittest.TestCase):
+    """Tests for Metrics.count_buckets"""
+    def test_nested(self):
+        """Buckets at every level are counted, through filter aggregations
+        and keyed buckets"""
+        aggs = {'Site': {'buckets': [
+                    {'key': 'A', 'doc_count': 2, 'CoreHours': {'value': 1.0},
+                     'VO': {'buckets': [{'key': 'x', 'doc_count': 2}]}},
+                    {'key': 'B', 'doc_count': 1}]},
+                'Payload': {'doc_count': 3, 'Status': {'buckets': {
+                    'ok': {'doc_count': 2}, 'failed': {'doc_count': 1}}}},
+                'Total': {'value': 3.0}}
+        self.assertEqual(count_buckets(aggs), 5)
+
+
+class TestRunMetrics(unittest.TestCase):
+    """Tests for Metrics.RunMetrics"""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def test_format(self):
+        """Every metric has HELP and TYPE lines and the run's labels, and
+        phase durations have a phase label"""
+        m = RunMetrics({'report': 'osg', 'vo': 'c"m\\s'})
+        with m.phase('run_query'):
+            pass
+        m.observe_query(2.0, took=1500, response_bytes=100, buckets=7)
+        m.observe_query(1.0, took=500, response_bytes=50, buckets=3)
+        m.add('rows', 12)
+        m.finish(True)
+        lines = m.format().splitlines()
+        samples = dict(l.rsplit(' ', 1) for l in lines
+                       if not l.startswith('#'))
+        labels = '{report="osg",vo="c\\"m\\\\s"}'
+        self.assertEqual(samples['gracc_report_queries' + labels], '2')
+        self.assertEqual(samples['gracc_report_query_took_seconds' + labels],
+                         '2.0')
+        self.assertEqual(samples['gracc_report_buckets' + labels], '10')
+        self.assertEqual(samples['gracc_report_last_run_success' + labels],
+                         '1')
+        self.assertIn('gracc_report_phase_duration_seconds{phase="run_query",'
+                      'report="osg",vo="c\\"m\\\\s"}', samples)
+        self.assertIn('# TYPE gracc_report_rows gauge', lines)
+
+    def test_failed_phase(self):
+        """Phases that raise are still timed"""
+        m = RunMetrics()
+        with self.assertRaises(ValueError):
+            with m.phase('format_report'):
+                raise ValueError
+        self.assertIn('format_report', m.phases)
+
+    def test_nested_phase(self):
+        """Time in nested phases of the same name is counted once"""
+        m = RunMetrics()
+        with m.phase('run_query'):
+            with m.phase('run_query'):
+                time.sleep(0.05)
+        self.assertLess(m.phases['run_query'], 0.09)
+        with m.phase('run_query'):
+            pass
+        self.assertGreaterEqual(m.phases['run_query'], 0.05)
+
+    def test_write(self):
+        """The file is replaced without leaving temporary files"""
+        path = os.path.join(self.tmpdir, 'textfile', textfile_name('OSG',
+                                                                   'cms'))
+        self.assertTrue(path.endswith('gracc_report_osg_cms.prom'))
+        m = RunMetrics()
+        m.finish(False)
+        m.write(path)
+        m.write(path)
+        self.assertListEqual(os.listdir(os.path.dirname(path)),
+                             ['gracc_report_osg_cms.prom'])
+        with open(path) as f:
+            self.assertIn('gracc_report_last_run_success 0\n', f.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
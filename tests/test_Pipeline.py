@@ -0,0 +1,175 @@
+"""Unit tests for Pipeline"""
+
+import unittest
+import os
+import csv
+import gzip
+import json
+import tempfile
+from datetime import timedelta
+from shutil import rmtree
+
+from elasticsearch_dsl import Search
+
+import gracc_reporting.Pipeline as Pipeline
+from tests.fake_es import FakeElasticsearch, day, day_range
+
+RECORDS = [{'VOName': 'vo{0}'.format(i % 3), 'Site': 'S{0}'.format(i % 5),
+            'CoreHours': float(i)} for i in range(100)]
+
+
+class Explode(Pipeline.Stage):
+    """Stage that fails on its second batch"""
+    def process(self, batch):
+        if self.stats.batches > 1:
+            raise RuntimeError("boom")
+        self.emit(batch)
+
+
+class TestPipeline(unittest.TestCase):
+    """Tests for Pipeline.Pipeline and its stages"""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def test_reduce_to_columns(self):
+        """Filter, map, and reduce records into columns, with stats for
+        every stage"""
+        p = Pipeline.Pipeline(
+            [Pipeline.Filter(lambda r: r['CoreHours'] >= 10),
+             Pipeline.Map(lambda r: dict(r, CoreHours=r['CoreHours'] * 2)),
+             Pipeline.Reduce(['VOName'], [('CoreHours', 'sum', 'CoreHours'),
+                                          ('Jobs', 'count', None)])],
+            Pipeline.ColumnsSink(['VOName', 'CoreHours', 'Jobs']))
+        columns = p.run(Pipeline.iter_source(RECORDS, batch_size=30))
+        expected = dict(('vo{0}'.format(v), sum(
+            2.0 * i for i in range(10, 100) if i % 3 == v)) for v in range(3))
+        self.assertListEqual(columns['VOName'], ['vo0', 'vo1', 'vo2'])
+        self.assertListEqual(columns['CoreHours'],
+                             [expected[vo] for vo in columns['VOName']])
+        self.assertEqual(sum(columns['Jobs']), 90)
+
+        stats = dict((s.name, s) for s in p.stats)
+        self.assertEqual(stats['source'].batches, 4)
+        self.assertEqual(stats['Filter'].records_in, 100)
+        self.assertEqual(stats['Filter'].records_out, 90)
+        self.assertEqual(stats['Reduce'].records_out, 3)
+        self.assertIn('Reduce', p.stats_table())
+
+    def test_batch(self):
+        """Re-batch records into fixed-size chunks"""
+        batch = Pipeline.Batch(8)
+        p = Pipeline.Pipeline([Pipeline.Filter(lambda r: r['Site'] == 'S0'),
+                               batch],
+                              Pipeline.ColumnsSink(['CoreHours']))
+        p.run(Pipeline.iter_source(RECORDS, batch_size=10))
+        self.assertEqual(batch.stats.records_out, 20)
+        self.assertEqual(p.sink.stats.batches, 3)
+
+    def test_csv_and_cache(self):
+        """Write a CSV file, and a cache that can be read back"""
+        csv_path = os.path.join(self.tmpdir, 'out.csv')
+        cache_path = os.path.join(self.tmpdir, 'out.cache')
+        Pipeline.Pipeline([], Pipeline.CacheSink(cache_path)).run(
+            Pipeline.iter_source(RECORDS, batch_size=7))
+        Pipeline.Pipeline([], Pipeline.CSVSink(csv_path, ['Site', 'VOName']))\
+            .run(Pipeline.cache_source(cache_path))
+        with open(csv_path) as f:
+            rows = list(csv.reader(f))
+        self.assertListEqual(rows[0], ['Site', 'VOName'])
+        self.assertListEqual(rows[1:], [[r['Site'], r['VOName']]
+                                        for r in RECORDS])
+
+    def test_failure_cleans_up(self):
+        """A failing stage aborts the run, and no partial cache is left"""
+        cache_path = os.path.join(self.tmpdir, 'out.cache')
+        p = Pipeline.Pipeline([Explode()], Pipeline.CacheSink(cache_path))
+        self.assertRaises(RuntimeError, p.run,
+                          Pipeline.iter_source(RECORDS, batch_size=10))
+        self.assertListEqual(os.listdir(self.tmpdir), [])
+
+
+class TestNDJSONSink(unittest.TestCase):
+    """Tests for Pipeline.NDJSONSink and ndjson_source"""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'export.ndjson.gz')
+        start = day(2018, 7, 1)
+        self.records = [dict(r, EndTime=(start + timedelta(hours=i))
+                             .isoformat()) for i, r in enumerate(RECORDS)]
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def export(self):
+        sink = Pipeline.NDJSONSink(self.path, ['EndTime', 'CoreHours'],
+                                   chunk_bytes=1000)
+        Pipeline.Pipeline([], sink).run(
+            Pipeline.iter_source(self.records, batch_size=30))
+        return Pipeline.read_ndjson_index(self.path)
+
+    def test_chunks(self):
+        """Records are written in bounded gzip members that read back as
+        one stream, with only the selected fields"""
+        index = self.export()
+        self.assertEqual(index['records'], 100)
+        self.assertGreater(len(index['chunks']), 3)
+        self.assertEqual(sum(c['records'] for c in index['chunks']), 100)
+        self.assertEqual(index['chunks'][1]['offset'],
+                         index['chunks'][0]['length'])
+        f = gzip.open(self.path)
+        lines = [json.loads(line) for line in f]
+        f.close()
+        self.assertEqual(len(lines), 100)
+        self.assertDictEqual(lines[5], {'EndTime': self.records[5]['EndTime'],
+                                        'CoreHours': 5.0})
+
+    def test_time_range(self):
+        """Reading a time range only decompresses the chunks it overlaps"""
+        index = self.export()
+        start, end = day(2018, 7, 2), day(2018, 7, 3)
+        batches = list(Pipeline.ndjson_source(self.path, start, end))
+        records = [r for batch in batches for r in batch]
+        self.assertListEqual([r['CoreHours'] for r in records],
+                             [float(i) for i in range(24, 48)])
+        self.assertLess(len(batches), len(index['chunks']))
+
+    def test_failure_cleans_up(self):
+        """A failed export leaves neither the file nor the index behind"""
+        p = Pipeline.Pipeline([Explode()], Pipeline.NDJSONSink(self.path))
+        self.assertRaises(RuntimeError, p.run,
+                          Pipeline.iter_source(self.records, batch_size=10))
+        self.assertListEqual(os.listdir(self.tmpdir), [])
+
+
+class TestSources(unittest.TestCase):
+    """Tests for Elasticsearch sources"""
+    def setUp(self):
+        t = day_range(day(2018, 7, 1), 1)[0]
+        self.client = FakeElasticsearch([dict(r, EndTime=t) for r in RECORDS])
+
+    def test_scan_source(self):
+        """Scan hits as dicts, in batches"""
+        s = Search(using=self.client, index='fake')
+        batches = list(Pipeline.scan_source(s, batch_size=40))
+        self.assertListEqual([len(b) for b in batches], [40, 40, 20])
+        self.assertIs(type(batches[0][0]), dict)
+
+    def test_terms_pages_source(self):
+        """Page through all terms, with the search's aggregations under
+        each bucket"""
+        s = Search(using=self.client, index='fake')
+        s.aggs.metric('CoreHours', 'sum', field='CoreHours')
+        buckets = [b for page in Pipeline.terms_pages_source(s, 'Site', 3)
+                   for b in page]
+        self.assertListEqual(sorted(b['key'] for b in buckets),
+                             ['S{0}'.format(i) for i in range(5)])
+        self.assertEqual(sum(b['CoreHours']['value'] for b in buckets),
+                         sum(r['CoreHours'] for r in RECORDS))
+        self.assertEqual(len(self.client.calls), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,212 @@
+"""Unit tests for QueryExecutor"""
+
+import unittest
+import json
+import time
+from collections import OrderedDict
+
+from elasticsearch.exceptions import ConnectionTimeout, TransportError
+from elasticsearch_dsl import Search
+
+from gracc_reporting.QueryExecutor import QueryExecutor, HostStats, \
+    ExecutorSearch, is_transient_error
+from gracc_reporting.Governor import Governor, GovernorTimeout
+from gracc_reporting.QueryProfile import LatencyTimer
+from tests.fake_es import FakeElasticsearch
+
+
+class SlowFakeElasticsearch(FakeElasticsearch):
+    """FakeElasticsearch that takes self.delay seconds to answer, and tags
+    its responses with its name"""
+    def __init__(self, name, delay=0.0):
+        super(SlowFakeElasticsearch, self).__init__([{'Site': 'A'}])
+        self.name = name
+        self.delay = delay
+
+    def search(self, **kwargs):
+        time.sleep(self.delay)
+        response = super(SlowFakeElasticsearch, self).search(**kwargs)
+        response['answered_by'] = self.name
+        return response
+
+
+class DecodingFakeElasticsearch(SlowFakeElasticsearch):
+    """SlowFakeElasticsearch that runs its responses through its
+    transport's deserializer, as a real client does"""
+    def __init__(self, name, delay=0.0):
+        super(DecodingFakeElasticsearch, self).__init__(name, delay)
+        self.transport = DecodingFakeElasticsearch.Transport()
+
+    class Transport(object):
+        class Deserializer(object):
+            def loads(self, s, mimetype=None):
+                return json.loads(s)
+
+        def __init__(self):
+            self.deserializer = self.Deserializer()
+
+    def search(self, **kwargs):
+        response = super(DecodingFakeElasticsearch, self).search(**kwargs)
+        return self.transport.deserializer.loads(json.dumps(response),
+                                                 'application/json')
+
+
+class TestQueryExecutorBase(unittest.TestCase):
+    """Base class for QueryExecutor tests"""
+    def setUp(self):
+        self.a = SlowFakeElasticsearch('a')
+        self.b = SlowFakeElasticsearch('b')
+        self.executor = QueryExecutor(OrderedDict([('a', self.a),
+                                                   ('b', self.b)]))
+        self.sleeps = []
+        self.executor._sleep = self.sleeps.append
+
+    def search(self):
+        return Search(using=self.a, index='fake')
+
+
+class TestRetries(TestQueryExecutorBase):
+    """Tests for retries in QueryExecutor.execute"""
+    def test_retry_transient(self):
+        """Transient errors are retried, with backoff no longer than the
+        maximum"""
+        self.executor.retries = 3
+        self.executor.backoff_max = 1.5
+        failures = [ConnectionTimeout('TIMEOUT', 'timed out', None)] * 3
+        self.a.fail_with = lambda body: failures.pop() if failures else None
+        response = self.executor.execute(self.search())
+        self.assertEqual(response.answered_by, 'a')
+        self.assertEqual(len(self.sleeps), 3)
+        self.assertTrue(all(0 <= t <= 1.5 for t in self.sleeps))
+
+    def test_retries_exhausted(self):
+        """Raise the error once retries are used up"""
+        self.executor.retries = 1
+        self.executor.clients.pop('b')
+        self.a.fail_with = lambda body: TransportError(503, 'unavailable', {})
+        self.assertRaises(TransportError, self.executor.execute, self.search())
+        self.assertEqual(len(self.a.calls), 2)
+
+    def test_no_retry_permanent(self):
+        """Non-transient errors are not retried"""
+        self.executor.retries = 3
+        self.a.fail_with = lambda body: TransportError(400, 'bad query', {})
+        self.assertRaises(TransportError, self.executor.execute, self.search())
+        self.assertEqual(len(self.a.calls), 1)
+
+    def test_timeout_param(self):
+        """Per-query timeout is passed to the client"""
+        self.executor.execute(self.search(), timeout=5)
+        self.assertEqual(self.a.calls[0]['params']['request_timeout'], 5)
+
+
+class TestHostSelection(TestQueryExecutorBase):
+    """Tests for host selection and hedging"""
+    def test_fastest_host(self):
+        """Once both hosts are measured, use the faster one"""
+        self.a.delay = 0.02
+        for _ in range(3):
+            self.executor.execute(self.search())
+        self.assertListEqual(self.executor.ranked_hosts(), ['b', 'a'])
+        self.assertEqual(self.executor.execute(self.search()).answered_by, 'b')
+
+    def test_foreign_client(self):
+        """Searches using a client the executor doesn't know are run on it"""
+        other = SlowFakeElasticsearch('other')
+        response = self.executor.execute(Search(using=other, index='fake'))
+        self.assertEqual(response.answered_by, 'other')
+
+    def test_raw(self):
+        """Raw responses are plain dicts, from our hosts or foreign ones"""
+        response = self.executor.execute(self.search(), raw=True)
+        self.assertIs(type(response), dict)
+        self.assertEqual(response['answered_by'], 'a')
+        other = SlowFakeElasticsearch('other')
+        response = self.executor.execute(Search(using=other, index='fake'),
+                                         raw=True)
+        self.assertEqual(response['answered_by'], 'other')
+
+    def test_hedge(self):
+        """If the fastest host is slower than usual, the hedged request
+        to the next host wins"""
+        self.executor.hedge_percentile = 90
+        for _ in range(5):
+            self.executor.stats['a'].record(0.01)
+        self.executor.stats['b'].record(0.05)
+        self.a.delay = 0.5
+        self.assertEqual(self.executor.execute(self.search()).answered_by, 'b')
+
+    def test_hedge_timed(self):
+        """The decode time and size of a hedged response count towards the
+        calling thread's LatencyTimer"""
+        a, b = DecodingFakeElasticsearch('a'), DecodingFakeElasticsearch('b')
+        executor = QueryExecutor(OrderedDict([('a', a), ('b', b)]),
+                                 hedge_percentile=90)
+        with LatencyTimer([a, b]) as timer:
+            response = executor.execute(Search(using=a, index='fake'),
+                                        raw=True)
+        self.assertEqual(timer.response_bytes, len(json.dumps(response)))
+
+    def test_hedge_on_failure(self):
+        """If the first host fails outright, the next host is tried"""
+        self.executor.hedge_percentile = 90
+        self.a.fail_with = lambda body: TransportError(400, 'bad', {})
+        self.assertEqual(self.executor.execute(self.search()).answered_by, 'b')
+
+
+class TestGoverned(TestQueryExecutorBase):
+    """Tests for QueryExecutor with a Governor"""
+    def test_rate_limited(self):
+        """Queries take a token from their host's bucket"""
+        self.executor.governor = Governor(rate=0.001, burst=2)
+        self.executor.execute(self.search())
+        self.assertAlmostEqual(self.executor.governor.bucket('a').tokens, 1,
+                               places=2)
+
+    def test_scan(self):
+        """A scan holds a scroll slot until it's done"""
+        self.executor.governor = Governor(max_scrolls=1, wait_timeout=0.1)
+        hits = self.executor.scan(self.search())
+        self.assertEqual(next(hits).Site, 'A')
+        self.assertRaises(GovernorTimeout, list,
+                          self.executor.scan(self.search()))
+        list(hits)
+        self.assertEqual(len(list(self.executor.scan(self.search()))), 1)
+
+    def test_executor_search(self):
+        """Scans of an ExecutorSearch, and of its copies, hold a scroll
+        slot"""
+        self.executor.governor = Governor(max_scrolls=1, wait_timeout=0.1)
+        s = ExecutorSearch.wrap(self.search().params(request_timeout=5),
+                                self.executor)
+        self.assertDictEqual(s.to_dict(), self.search().to_dict())
+        self.assertEqual(s._params, {'request_timeout': 5})
+        hits = s.scan()
+        self.assertEqual(next(hits).Site, 'A')
+        self.assertRaises(GovernorTimeout, list,
+                          s.filter('term', Site='A').scan())
+        list(hits)
+
+
+class TestHelpers(unittest.TestCase):
+    """Tests for HostStats and is_transient_error"""
+    def test_percentile(self):
+        """Percentile needs enough samples"""
+        stats = HostStats()
+        for latency in (1, 2, 3, 4):
+            stats.record(latency)
+        self.assertIsNone(stats.percentile(50))
+        stats.record(5)
+        self.assertEqual(stats.percentile(50), 3)
+        self.assertEqual(stats.percentile(100), 5)
+
+    def test_transient(self):
+        """Timeouts and 503s are transient, 400s are not"""
+        self.assertTrue(is_transient_error(
+            ConnectionTimeout('TIMEOUT', 'timed out', None)))
+        self.assertTrue(is_transient_error(TransportError(503, 'x', {})))
+        self.assertFalse(is_transient_error(TransportError(400, 'x', {})))
+
+
+if __name__ == '__main__':
+    unittest.main()
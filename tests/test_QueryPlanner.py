@@ -0,0 +1,85 @@
+"""Unit tests for QueryPlanner"""
+
+import unittest
+
+from elasticsearch_dsl import Search
+
+from gracc_reporting.QueryPlanner import QueryPlanner, agg_levels
+from tests.fake_es import FakeElasticsearch, day, day_range
+
+
+class TestAggLevels(unittest.TestCase):
+    """Tests for QueryPlanner.agg_levels"""
+    def test_levels(self):
+        """Bucket aggregations are found at every level, with their bucket
+        counts per parent"""
+        aggs = {'Site': {'terms': {'field': 'Site', 'size': 50},
+                         'aggs': {'CoreHours': {'sum': {'field': 'CoreHours'}},
+                                  'Day': {'date_histogram': {
+                                      'field': 'EndTime', 'interval': '1d'},
+                                      'aggs': {'N': {'value_count': {
+                                          'field': 'CoreHours'}}}}}},
+                'Total': {'sum': {'field': 'CoreHours'}}}
+        levels = agg_levels(aggs, day(2018, 7, 1), day(2018, 7, 8))
+        self.assertListEqual([(l.path, l.atype, l.per_parent, l.metrics)
+                              for l in levels],
+                             [('Site', 'terms', 50, 1),
+                              ('Site>Day', 'date_histogram', 8, 1)])
+
+
+class TestQueryPlanner(unittest.TestCase):
+    """Tests for QueryPlanner.QueryPlanner"""
+    def setUp(self):
+        records = [{'Site': 'S{0}'.format(i % 4), 'VO': 'V{0}'.format(i % 3),
+                    'EndTime': t, 'CoreHours': 1.0}
+                   for i, t in enumerate(day_range(day(2018, 7, 1), 30))]
+        self.client = FakeElasticsearch(records)
+
+    def search(self):
+        s = Search(using=self.client, index='gracc.osg.raw-2018.07')\
+            .filter('range', EndTime={'gte': day(2018, 7, 1).isoformat(),
+                                      'lt': day(2018, 7, 11).isoformat()})[0:0]
+        s.aggs.bucket('Site', 'terms', field='Site', size=100)\
+            .bucket('VO', 'terms', field='VO', size=2)\
+            .metric('CoreHours', 'sum', field='CoreHours')
+        return s
+
+    def test_plan(self):
+        """Hits come from a count, and buckets from cardinalities, without
+        running the aggregations"""
+        plan = QueryPlanner(self.client, max_buckets=5).plan(self.search())
+        self.assertEqual(plan.indices, ['gracc.osg.raw-2018.07'])
+        self.assertEqual(plan.hits, 10)
+        self.assertListEqual([(l.cardinality, l.per_parent, l.buckets)
+                              for l in plan.levels],
+                             [(4, 4, 4), (3, 2, 8)])
+        self.assertEqual(plan.buckets, 12)
+        self.assertEqual(plan.partitions, 3)
+        self.assertGreater(plan.response_bytes, 0)
+
+        # One cardinality probe, and no aggregation query
+        self.assertEqual(len(self.client.calls), 1)
+        probe = self.client.calls[0]['body']
+        self.assertEqual(probe['size'], 0)
+        self.assertListEqual(sorted(a.keys()[0] for a in
+                                    probe['aggs'].itervalues()),
+                             ['cardinality', 'cardinality'])
+
+    def test_buckets_bounded_by_hits(self):
+        """There can't be more buckets than hits"""
+        s = self.search()
+        s.aggs['Site'].aggs['VO']._params['size'] = 100
+        self.client.records = self.client.records[:2]
+        plan = QueryPlanner(self.client).plan(s)
+        self.assertEqual(plan.levels[1].buckets, 2)
+        self.assertEqual(plan.partitions, 1)
+
+    def test_format(self):
+        """Text plan lists the totals and each aggregation"""
+        text = QueryPlanner(self.client).plan(self.search()).format()
+        self.assertIn('Hits: 10', text)
+        self.assertIn('Site>VO', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
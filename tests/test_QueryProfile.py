@@ -0,0 +1,97 @@
+"""Unit tests for QueryProfile"""
+
+import unittest
+import os
+import json
+import tempfile
+from shutil import rmtree
+
+from elasticsearch import Elasticsearch
+
+from gracc_reporting.QueryProfile import LatencyTimer, ProfileLog, \
+    summarize_profile, install
+
+PROFILE = {'shards': [
+    {'id': '[node1][gracc.osg.raw-2018.07][0]',
+     'searches': [{'query': [{'type': 'BooleanQuery', 'description': 'slow',
+                              'time_in_nanos': 3000000, 'children': [
+                                  {'type': 'TermQuery',
+                                   'description': 'ResourceType:Payload',
+                                   'time_in_nanos': 2000000}]}],
+                   'rewrite_time': 1000000,
+                   'collector': [{'name': 'MultiCollector',
+                                  'reason': 'search_multi',
+                                  'time_in_nanos': 500000}]}],
+     'aggregations': [{'type': 'TermsAggregator', 'description': 'Site',
+                       'time_in_nanos': 6000000}]},
+    {'id': '[node2][gracc.osg.raw-2018.07][1]',
+     'searches': [{'query': [{'type': 'BooleanQuery', 'description': 'fast',
+                              'time': '1.5ms'}],
+                   'rewrite_time': 0, 'collector': []}],
+     'aggregations': []}]}
+
+
+class TestSummarizeProfile(unittest.TestCase):
+    """Tests for QueryProfile.summarize_profile"""
+    def test_summary(self):
+        """Shards and components come out slowest first"""
+        summary = summarize_profile(PROFILE, top=3)
+        self.assertListEqual([(s['id'][:7], s['total_ms'])
+                              for s in summary['shards']],
+                             [('[node1]', 10.0), ('[node2]', 1.5)])
+        self.assertEqual(summary['shards'][0]['collector_ms'], 0.5)
+        self.assertListEqual([(c['kind'], c['description'], c['time_ms'])
+                              for c in summary['components']],
+                             [('aggregation', 'Site', 6.0),
+                              ('query', 'slow', 3.0),
+                              ('query', 'ResourceType:Payload', 2.0)])
+
+
+class TestLatencyTimer(unittest.TestCase):
+    """Tests for QueryProfile.LatencyTimer"""
+    def test_decode_timed(self):
+        """Responses decoded inside the timer are counted, and others
+        aren't"""
+        client = Elasticsearch(['localhost:1'])
+        install(client)
+        install(client)     # Only wrapped once
+        deserializer = client.transport.deserializer
+        self.assertFalse(hasattr(deserializer.wrapped, 'wrapped'))
+
+        with LatencyTimer([client]) as timer:
+            self.assertEqual(deserializer.loads('{"took": 5}',
+                                                'application/json'),
+                             {'took': 5})
+        deserializer.loads('{}', 'application/json')
+        timer.took = 5
+        self.assertEqual(timer.response_bytes, 11)
+        breakdown = timer.breakdown()
+        self.assertEqual(breakdown['took'], 5)
+        self.assertGreaterEqual(breakdown['network'], 0)
+        self.assertIn('took 5 ms', timer.format())
+
+
+class TestProfileLog(unittest.TestCase):
+    """Tests for QueryProfile.ProfileLog"""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def test_add(self):
+        """Each query is appended to the file"""
+        path = os.path.join(self.tmpdir, 'logs', 'test.profile.json')
+        log = ProfileLog(path)
+        log.add({'size': 0}, LatencyTimer(), PROFILE)
+        log.add({'size': 1}, LatencyTimer())
+        with open(path) as f:
+            queries = json.load(f)['queries']
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(len(queries[0]['shards']), 2)
+        self.assertNotIn('shards', queries[1])
+        self.assertFalse(os.path.exists(path + '.tmp'))
+
+
+if __name__ == '__main__':
+    unittest.main()
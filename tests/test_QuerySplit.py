@@ -0,0 +1,168 @@
+"""Unit tests for QuerySplit"""
+
+import unittest
+import os
+import tempfile
+import shutil
+from datetime import timedelta
+
+from elasticsearch.exceptions import ConnectionTimeout, TransportError
+from elasticsearch_dsl import Search
+
+import gracc_reporting.QuerySplit as QuerySplit
+from tests.fake_es import FakeElasticsearch, day, day_range
+
+
+def make_search(client, start, end):
+    """Search with nested terms, date_histogram, and metrics"""
+    s = Search(using=client, index='fake')\
+        .filter('range', EndTime={'gte': start.isoformat(),
+                                  'lt': end.isoformat()})[0:0]
+    site = s.aggs.bucket('Site', 'terms', field='Site', size=100)
+    site.metric('CoreHours', 'sum', field='CoreHours')\
+        .metric('MaxWall', 'max', field='Wall')\
+        .bucket('daily', 'date_histogram', field='EndTime', interval='day')\
+        .metric('Jobs', 'value_count', field='Wall')
+    s.aggs.bucket('vos', 'filters', filters={
+        'vo1': {'term': {'VOName': 'vo1'}}})\
+        .metric('MinWall', 'min', field='Wall')
+    return s
+
+
+class TestMergeAggs(unittest.TestCase):
+    """Tests for QuerySplit.merge_aggs"""
+    def setUp(self):
+        records = []
+        for i, t in enumerate(day_range(day(2018, 7, 1), 6)):
+            for site in ('A', 'B', 'C')[:(i % 3) + 1]:
+                records.append({'EndTime': t, 'Site': site,
+                                'VOName': 'vo{0}'.format(i % 2),
+                                'CoreHours': float(i + 1), 'Wall': i * 10})
+        self.client = FakeElasticsearch(records)
+
+    def run_search(self, start, end):
+        return make_search(self.client, start, end).execute().to_dict()[
+            'aggregations']
+
+    def test_halves_equal_whole(self):
+        """Merging the results of two halves of a range gives the result over
+        the whole range"""
+        start, mid, end = day(2018, 7, 1), day(2018, 7, 4), day(2018, 7, 7)
+        spec = make_search(self.client, start, end).to_dict()['aggs']
+        merged = QuerySplit.merge_aggs(spec, self.run_search(start, mid),
+                                       self.run_search(mid, end))
+        self.assertDictEqual(merged, self.run_search(start, end))
+
+    def test_unmergeable(self):
+        """Raise UnmergeableAggregationError for an avg aggregation"""
+        spec = {'avg_wall': {'avg': {'field': 'Wall'}}}
+        part = {'avg_wall': {'value': 1.0}}
+        self.assertRaises(QuerySplit.UnmergeableAggregationError,
+                          QuerySplit.merge_aggs, spec, part, part)
+
+    def test_is_mergeable(self):
+        """Specs are mergeable unless some (sub-)aggregation isn't"""
+        spec = make_search(self.client, day(2018, 7, 1),
+                           day(2018, 7, 7)).to_dict()['aggs']
+        self.assertTrue(QuerySplit.is_mergeable(spec))
+        spec = {'Site': {'terms': {'field': 'Site'}, 'aggs': {
+            'users': {'cardinality': {'field': 'CommonName'}}}}}
+        self.assertFalse(QuerySplit.is_mergeable(spec))
+
+    def test_terms_size(self):
+        """Merged terms buckets are re-sorted and cut down to size"""
+        spec = {'Site': {'terms': {'field': 'Site', 'size': 2}}}
+        a = {'Site': {'buckets': [{'key': 'A', 'doc_count': 3},
+                                  {'key': 'B', 'doc_count': 2}]}}
+        b = {'Site': {'buckets': [{'key': 'C', 'doc_count': 4},
+                                  {'key': 'B', 'doc_count': 2}]}}
+        answer = {'Site': {'buckets': [{'key': 'B', 'doc_count': 4},
+                                       {'key': 'C', 'doc_count': 4}]}}
+        self.assertDictEqual(QuerySplit.merge_aggs(spec, a, b), answer)
+
+
+class TestSplitHelpers(unittest.TestCase):
+    """Tests for QuerySplit.split_range and QuerySplit.is_split_error"""
+    def test_split_range(self):
+        """Split a range into equal consecutive pieces"""
+        start, end = day(2018, 7, 1), day(2018, 7, 5)
+        answer = [(day(2018, 7, 1), day(2018, 7, 3)),
+                  (day(2018, 7, 3), day(2018, 7, 5))]
+        self.assertListEqual(QuerySplit.split_range(start, end, 2), answer)
+
+    def test_split_errors(self):
+        """Timeouts and bucket-limit errors are split errors"""
+        self.assertTrue(QuerySplit.is_split_error(
+            ConnectionTimeout('TIMEOUT', 'read timed out', None)))
+        self.assertTrue(QuerySplit.is_split_error(TransportError(
+            503, 'search_phase_execution_exception',
+            {'error': {'caused_by': {'type': 'too_many_buckets_exception'}}})))
+
+    def test_other_errors(self):
+        """Other errors are not split errors"""
+        self.assertFalse(QuerySplit.is_split_error(TransportError(
+            400, 'parsing_exception', {'error': 'bad query'})))
+        self.assertFalse(QuerySplit.is_split_error(KeyError('x')))
+
+
+class TestSplitHistory(unittest.TestCase):
+    """Tests for QuerySplit.SplitHistory"""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'state', 'history.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_no_history(self):
+        """With no history, don't split up front"""
+        h = QuerySplit.SplitHistory(self.path)
+        self.assertEqual(h.initial_slices('r', day(2018, 7, 1),
+                                          day(2018, 8, 1)), 1)
+
+    def test_roundtrip(self):
+        """Recorded slice length is used to split later runs"""
+        QuerySplit.SplitHistory(self.path).record('r', 2, timedelta(days=7))
+        h = QuerySplit.SplitHistory(self.path)
+        self.assertEqual(h.get_span('r'), timedelta(days=7))
+        self.assertEqual(h.initial_slices('r', day(2018, 7, 1),
+                                          day(2018, 8, 1)), 5)
+
+    def test_depth_zero_clears(self):
+        """Recording depth 0 removes the entry"""
+        h = QuerySplit.SplitHistory(self.path)
+        h.record('r', 2, timedelta(days=7))
+        h.record('r', 0, timedelta(days=31))
+        self.assertIsNone(QuerySplit.SplitHistory(self.path).get_span('r'))
+
+    def test_relax(self):
+        """After relax_after runs at the recorded depth, one level shallower
+        is tried, and kept if it works"""
+        h = QuerySplit.SplitHistory(self.path, relax_after=2)
+        start, end = day(2018, 7, 1), day(2018, 8, 1)
+        h.record('r', 2, timedelta(days=7))
+        h.record('r', 2, timedelta(days=7))
+        self.assertEqual(h.initial_slices('r', start, end), 5)
+        h.record('r', 2, timedelta(days=7))
+        self.assertEqual(h.initial_slices('r', start, end), 3)
+        h.record('r', 1, timedelta(days=14))
+        self.assertEqual(h.get_span('r'), timedelta(days=14))
+        self.assertEqual(h.initial_slices('r', start, end), 3)
+
+    def test_relax_fails(self):
+        """If the shallower depth doesn't work, the recorded depth stays, and
+        runs are counted again"""
+        h = QuerySplit.SplitHistory(self.path, relax_after=1)
+        start, end = day(2018, 7, 1), day(2018, 8, 1)
+        h.record('r', 2, timedelta(days=7))
+        h.record('r', 2, timedelta(days=7))
+        self.assertEqual(h.initial_slices('r', start, end), 3)
+        # The 14-day slices had to be split again
+        h.record('r', 2, timedelta(days=7))
+        self.assertEqual(h.initial_slices('r', start, end), 5)
+        h = QuerySplit.SplitHistory(self.path, relax_after=1)
+        self.assertEqual(h.get_span('r'), timedelta(days=7))
+
+
+if __name__ == '__main__':
+    unittest.main()
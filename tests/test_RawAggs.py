@@ -0,0 +1,51 @@
+"""Unit tests for RawAggs"""
+
+import unittest
+
+from gracc_reporting import RawAggs
+
+AGGS = {'Site': {'buckets': [
+    {'key': 'A', 'doc_count': 3, 'VO': {'buckets': [
+        {'key': 'cms', 'doc_count': 2, 'CoreHours': {'value': 5.0}},
+        {'key': 'atlas', 'doc_count': 1, 'CoreHours': {'value': None}}]}},
+    {'key': 'B', 'doc_count': 1, 'VO': {'buckets': [
+        {'key': 'cms', 'doc_count': 1, 'CoreHours': {'value': 2.0}}]}}]},
+    'Status': {'buckets': {'ok': {'doc_count': 3},
+                           'failed': {'doc_count': 1}}}}
+
+
+class TestRawAggs(unittest.TestCase):
+    """Tests for RawAggs"""
+    def test_buckets(self):
+        """Keyed buckets come back as a list with their keys"""
+        self.assertEqual(len(RawAggs.buckets(AGGS['Site'])), 2)
+        self.assertListEqual([(b['key'], b['doc_count'])
+                              for b in RawAggs.buckets(AGGS['Status'])],
+                             [('failed', 1), ('ok', 3)])
+
+    def test_walk(self):
+        """Walk yields the keys of every level and the innermost bucket"""
+        self.assertListEqual(
+            [(keys, b['doc_count'])
+             for keys, b in RawAggs.walk(AGGS, ['Site', 'VO'])],
+            [(('A', 'cms'), 2), (('A', 'atlas'), 1), (('B', 'cms'), 1)])
+
+    def test_value(self):
+        """Missing and null metrics give the default"""
+        bucket = AGGS['Site']['buckets'][0]['VO']['buckets'][1]
+        self.assertEqual(RawAggs.value(bucket, 'CoreHours', 0), 0)
+        self.assertIsNone(RawAggs.value(bucket, 'WallHours'))
+
+    def test_columns(self):
+        """Columns of keys, metrics, and doc counts"""
+        cols = RawAggs.columns(AGGS, ['Site', 'VO'], ['CoreHours'],
+                               key_names=['Site', 'VO Name'],
+                               doc_count='Jobs')
+        self.assertDictEqual(cols, {'Site': ['A', 'A', 'B'],
+                                    'VO Name': ['cms', 'atlas', 'cms'],
+                                    'CoreHours': [5.0, None, 2.0],
+                                    'Jobs': [2, 1, 1]})
+
+
+if __name__ == '__main__':
+    unittest.main()
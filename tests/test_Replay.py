@@ -0,0 +1,69 @@
+"""Unit tests for Replay"""
+
+import unittest
+import os
+import tempfile
+from shutil import rmtree
+
+from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import TransportError
+
+from gracc_reporting.Replay import Recording, RecordingClient, ReplayClient, \
+    StandInServer
+from tests.fake_es import FakeElasticsearch, day, day_range
+
+BODY = {'size': 0, 'aggs': {'Site': {'terms': {'field': 'Site'},
+                                     'aggs': {'CoreHours': {'sum': {
+                                         'field': 'CoreHours'}}}}}}
+
+
+class TestReplayBase(unittest.TestCase):
+    """Records a search against a fake client"""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'recording.jsonl')
+        records = [{'_id': i, 'Site': 'S{0}'.format(i % 2),
+                    'EndTime': t, 'CoreHours': 1.0}
+                   for i, t in enumerate(day_range(day(2018, 7, 1), 4))]
+        client = RecordingClient(FakeElasticsearch(records), self.path)
+        self.response = client.search(index='gracc.osg.raw-2018.07',
+                                      body=BODY)
+        self.recording = Recording(self.path)
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+
+class TestReplayClient(TestReplayBase):
+    """Tests for Replay.RecordingClient and ReplayClient"""
+    def test_replay(self):
+        """Recorded searches are answered with the recorded response"""
+        self.assertEqual(len(self.recording), 1)
+        client = ReplayClient(self.recording, latency=0)
+        response = client.search(index='gracc.osg.raw-2018.07',
+                                 body=dict(BODY))
+        self.assertDictEqual(response, self.response)
+        self.assertEqual(client.requests, 1)
+
+    def test_not_recorded(self):
+        """Searches that weren't recorded fail with a 404"""
+        client = ReplayClient(self.recording, latency=0)
+        with self.assertRaises(TransportError) as cm:
+            client.search(index='gracc.osg.raw-2018.08', body=BODY)
+        self.assertEqual(cm.exception.status_code, 404)
+
+
+class TestStandInServer(TestReplayBase):
+    """Tests for Replay.StandInServer"""
+    def test_search(self):
+        """A real client gets the recorded response over HTTP"""
+        with StandInServer(self.recording) as server:
+            es = Elasticsearch([server.url])
+            response = es.search(index='gracc.osg.raw-2018.07', body=BODY)
+            self.assertDictEqual(response, self.response)
+            self.assertRaises(TransportError, es.search,
+                              index='gracc.osg.raw-2018.08', body=BODY)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,11 +2,27 @@
 
 import unittest
 import os
-from shutil import copyfile
+import tempfile
+import cPickle
+import copy
+import json
+import logging
+from shutil import copyfile, rmtree
+from datetime import datetime, timedelta
+from collections import OrderedDict
 
 import toml
+from dateutil import tz
+from elasticsearch_dsl import Search, A
 
 import gracc_reporting.ReportUtils as ReportUtils
+from gracc_reporting.TimeUtils import parse_datetime
+from elasticsearch.exceptions import ConnectionError, ConnectionTimeout
+from gracc_reporting.MemProfile import MemoryBudgetExceeded
+from gracc_reporting.Governor import Governor, GovernorTimeout
+from gracc_reporting.IndexCatalog import IndexCatalog
+import gracc_reporting.Pipeline as Pipeline
+from tests.fake_es import FakeElasticsearch, day_range
 
 CONFIG_FILE = 'test_config.toml'
 BAD_CONFIG_FILE = 'test_bad_config.toml'
@@ -16,7 +32,7 @@ BAD_CONFIG_FILE = 'test_bad_config.toml'
 class FakeVOReport(ReportUtils.Reporter):
     """Fake Report class on top of ReportUtils.Reporter"""
     def __init__(self, cfg_file=CONFIG_FILE, vo=None, althost_key=None,
-                 is_test=False):
+                 is_test=False, host_clients=None):
         report = 'test'
         start = '2018-03-28 06:30'
         end = '2018-03-29 06:30'
@@ -26,13 +42,49 @@ class FakeVOReport(ReportUtils.Reporter):
                                            end=end, 
                                            vo=vo,
                                            althost_key=althost_key,
-                                           is_test=is_test)
+                                           is_test=is_test,
+                                           host_clients=host_clients)
 
     # Defined to satisfy abstract class constraints
     def query(self): pass
     def run_report(self): pass
 
 
+class FakeESReport(FakeVOReport):
+    """Fake Report class that queries a FakeElasticsearch client.  The
+    Reporter is given a fake client too, so it never connects to a real
+    cluster"""
+    def __init__(self, fake_client, **kwargs):
+        kwargs.setdefault('host_clients', OrderedDict([(
+            'fake', fake_client if fake_client is not None
+            else FakeElasticsearch())]))
+        super(FakeESReport, self).__init__(**kwargs)
+        self.fake_client = fake_client
+
+    def query(self):
+        s = Search(using=self.fake_client, index=self.indexpattern)\
+            .filter('range', EndTime={'gte': self.start_time.isoformat(),
+                                      'lt': self.end_time.isoformat()})[0:0]
+        s.aggs.bucket('Site', 'terms', field='Site')\
+            .metric('CoreHours', 'sum', field='CoreHours')
+        return s
+
+
+class FakeRenderReport(FakeESReport):
+    """FakeESReport that formats a table of CoreHours by Site"""
+    def __init__(self, fake_client, **kwargs):
+        super(FakeRenderReport, self).__init__(fake_client, **kwargs)
+        self.title = 'Test Report'
+
+    def format_report(self):
+        self.header = ['Site', 'CoreHours']
+        content = {'Site': [], 'CoreHours': []}
+        for bucket in self.run_query().Site.buckets:
+            content['Site'].append(bucket.key)
+            content['CoreHours'].append(bucket.CoreHours.value)
+        return content
+
+
 class TestReportUtilsBase(unittest.TestCase):
     """Base class for ReportUtils tests"""
     def setUp(self):
@@ -115,6 +167,41 @@ class TestParseConfig(TestReportUtilsBase):
         self.assertRaises(toml.TomlDecodeError, self.r._parse_config, junk_file)
 
 
+class TestSetupLogger(unittest.TestCase):
+    """Tests for the Reporter's logger"""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.logfile = os.path.join(self.tmpdir, 'test.log')
+
+    def tearDown(self):
+        logger = logging.getLogger('test')
+        for h in list(logger.handlers):
+            if isinstance(h, logging.FileHandler):
+                logger.removeHandler(h)
+                h.close()
+        rmtree(self.tmpdir)
+
+    def test_one_file_handler(self):
+        """Reports of the same type logging to the same file share one file
+        handler, and each labels its own lines with its VO"""
+        r1 = FakeESReport(None, vo='testVO')
+        r2 = FakeESReport(None)
+        for r in (r1, r2):
+            r.logfile = self.logfile
+            r.logger = r._Reporter__setup_gen_logger()
+        handlers = [h for h in logging.getLogger('test').handlers
+                    if isinstance(h, logging.FileHandler)]
+        self.assertEqual(len(handlers), 1)
+        r1.logger.warning('one')
+        r2.logger.warning('two')
+        handlers[0].flush()
+        with open(self.logfile) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertIn(' - testVO - one', lines[0])
+        self.assertIn(' - None - two', lines[1])
+
+
 class TestCheckVO(TestReportUtilsBase):
     """We're not going to actually test ReportUtils.Reporter.__check_vo
     directly. We're instead going to check for behavior if we pass a valid
@@ -225,6 +312,635 @@ class TestGetEmailInfo(TestReportUtilsBase):
         del test_report_test
 
 
+class TestRunQueryAdaptive(unittest.TestCase):
+    """Tests for ReportUtils.Reporter.run_query_adaptive"""
+    def setUp(self):
+        start = parse_datetime('2018-03-28 06:30')
+        records = [{'EndTime': t - timedelta(hours=12), 'Site': site,
+                    'CoreHours': 1.0}
+                   for t in day_range(start, 1) for site in ('A', 'B')]
+        records += [{'EndTime': start + timedelta(hours=h), 'Site': 'A',
+                     'CoreHours': 2.0} for h in (1, 7, 13, 19)]
+        self.client = FakeElasticsearch(records)
+        self.r = FakeESReport(self.client)
+        self.tmpdir = tempfile.mkdtemp()
+        self.r.config['default_statedir'] = self.tmpdir
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def fail_if_longer_than(self, hours):
+        """Make the fake client time out on ranges longer than hours"""
+        def fail(body):
+            rng = body['query']['bool']['filter'][0]['range']['EndTime']
+            span = parse_datetime(rng['lt'], utc=True) - \
+                parse_datetime(rng['gte'], utc=True)
+            if span > timedelta(hours=hours):
+                return ConnectionTimeout('TIMEOUT', 'timed out', None)
+        self.client.fail_with = fail
+
+    def test_no_split(self):
+        """Query that doesn't fail isn't split"""
+        results = self.r.run_query_adaptive()
+        self.assertEqual(len(self.client.calls), 1)
+        self.assertEqual(results.Site.buckets[0].CoreHours.value, 9.0)
+
+    def test_split_and_remember(self):
+        """Query that times out is split until it succeeds, and the next
+        run starts at that granularity"""
+        self.fail_if_longer_than(6)
+        results = self.r.run_query_adaptive()
+        self.assertDictEqual(
+            dict((b.key, b.CoreHours.value) for b in results.Site.buckets),
+            {'A': 9.0, 'B': 1.0})
+        self.client.calls = []
+        self.r.run_query_adaptive()
+        self.assertEqual(len(self.client.calls), 4)
+
+    def test_min_span(self):
+        """Give up and raise once slices would be smaller than min_span"""
+        self.fail_if_longer_than(6)
+        self.assertRaises(ConnectionTimeout, self.r.run_query_adaptive,
+                          min_span=timedelta(hours=12))
+
+
+class TestGetFanoutVOs(unittest.TestCase):
+    """Tests for ReportUtils.Reporter.get_fanout_vos"""
+    def setUp(self):
+        self.r = FakeESReport(None, vo='testVO')
+        self.r_copy = FakeESReport(None, cfg_file=BAD_CONFIG_FILE)
+
+    def test_fanout_vos_control(self):
+        """Return VOs in configured_vos that have a report config section"""
+        self.assertListEqual(self.r.get_fanout_vos(), ['testvo'])
+
+    def test_fanout_vos_none_configured(self):
+        """Return an empty list if there are no configured_vos"""
+        self.assertListEqual(self.r_copy.get_fanout_vos(), [])
+
+
+class FanoutReport(FakeRenderReport):
+    """FakeRenderReport that records each report it would send"""
+    def __init__(self, fake_client, **kwargs):
+        super(FanoutReport, self).__init__(fake_client, **kwargs)
+        self.config = copy.deepcopy(self.config)
+        self.config['configured_vos'] = ['testvo', 'othervo']
+        self.config['test']['othervo'] = {
+            'to_emails': ['nobody4@example.com', ]}
+        self.sent = []
+
+    def send_report(self, title=None, successmessage=None):
+        self.sent.append((self.vo, self.email_info['to']['email'],
+                          self.logger.extra['vo'], self.format_report()))
+
+
+class TestVOFanout(unittest.TestCase):
+    """Tests for ReportUtils.Reporter.run_vo_fanout"""
+    def setUp(self):
+        self.r = FanoutReport(None)
+        start = self.r.start_time
+        self.r.fake_client = FakeElasticsearch(
+            [{'VOName': vo, 'Site': site, 'CoreHours': hours, 'EndTime': start}
+             for vo, site, hours in [('testvo', 'A', 1.0),
+                                     ('testvo', 'B', 2.0),
+                                     ('othervo', 'A', 4.0),
+                                     ('ignoredvo', 'A', 8.0)]])
+
+    def test_fanout(self):
+        """One query, and one report per VO with that VO's slice and
+        recipients"""
+        other = FakeESReport(None, vo='testVO')
+        self.r.run_vo_fanout()
+        self.assertEqual(len(self.r.fake_client.calls), 1)
+        self.assertListEqual(self.r.sent, [
+            ('testvo', ['nobody1@example.com', 'nobody3@example.com'],
+             'testvo', {'Site': ['A', 'B'], 'CoreHours': [1.0, 2.0]}),
+            ('othervo', ['nobody1@example.com', 'nobody4@example.com'],
+             'othervo', {'Site': ['A'], 'CoreHours': [4.0]})])
+        # Other reports' log lines keep their own VO
+        self.assertEqual(other.logger.extra['vo'], 'testVO')
+
+    def test_fanout_raw(self):
+        """With raw_response, each VO's slice is a plain dict"""
+        self.r.raw_response = True
+        results = self.r.run_query_vo_fanout()
+        self.assertIs(type(results['testvo']), dict)
+        self.assertListEqual(
+            [b['key'] for b in results['testvo']['Site']['buckets']],
+            ['A', 'B'])
+        self.assertEqual(results['othervo']['doc_count'], 1)
+
+    def test_restores_vo(self):
+        """The instance goes back to no VO, and its own recipients"""
+        email_info = self.r.email_info
+        vo_list = getattr(self.r, 'vo_list', None)
+        self.r.run_vo_fanout()
+        self.assertIsNone(self.r.vo)
+        self.assertIsNone(self.r.logger.extra['vo'])
+        self.assertEqual(getattr(self.r, 'vo_list', None), vo_list)
+        self.assertDictEqual(self.r.email_info, email_info)
+
+
+class TestIndexCatalog(unittest.TestCase):
+    """Tests for the index catalog in ReportUtils.Reporter"""
+    def test_indexpattern_narrowed(self):
+        """With a catalog, the index pattern lists the indices with data in
+        the report's range"""
+        start = parse_datetime('2018-03-28 06:30')
+        client = FakeElasticsearch(
+            [{'_index': 'gracc.osg.raw-2018.03', 'EndTime': start},
+             {'_index': 'gracc.osg.raw-2018.04',
+              'EndTime': start + timedelta(days=5)}])
+        r = FakeESReport(client)
+        self.assertIsNone(r.index_catalog)
+        self.assertEqual(r.indexpattern, 'gracc.osg.raw-2018.03')
+        r.index_catalog = IndexCatalog(client)
+        with r.time_window(start, start + timedelta(days=10)):
+            self.assertEqual(r.indexpattern,
+                             'gracc.osg.raw-2018.03,gracc.osg.raw-2018.04')
+
+    def test_catalog_failure(self):
+        """If the catalog can't be fetched, the report goes on with the
+        pattern as-is and stops using the catalog"""
+        start = parse_datetime('2018-03-28 06:30')
+        client = FakeElasticsearch(
+            [{'_index': 'gracc.osg.raw-2018.03', 'EndTime': start}])
+        client.fail_with = lambda body: ConnectionError(
+            'N/A', 'down', None) if 'indices' in body.get('aggs', {}) \
+            else None
+        r = FakeESReport(client)
+        with r.time_window(start, start + timedelta(days=10)):
+            expected = r.indexpattern
+        r.index_catalog = IndexCatalog(client)
+        with r.time_window(start, start + timedelta(days=10)):
+            self.assertEqual(r.indexpattern, expected)
+        self.assertIsNone(r.index_catalog)
+
+
+class TestIndexSources(unittest.TestCase):
+    """Tests for index source selection in ReportUtils.Reporter"""
+    def test_split_between_sources(self):
+        """Whole days come from the summary, the rest from the raw indices,
+        and the merged results match the raw indices alone"""
+        start = parse_datetime('2018-03-25 00:00', utc=True)
+        records = [{'_index': 'gracc.osg.raw-2018.03', 'Site': 'A',
+                    'EndTime': start + timedelta(hours=h), 'CoreHours': 1.0}
+                   for h in range(5 * 24)]
+        records += [{'_index': 'gracc.osg.summary', 'Site': 'A',
+                     'EndTime': start + timedelta(days=d), 'CoreHours': 24.0}
+                    for d in range(5)]
+        client = FakeElasticsearch(records)
+        r = FakeESReport(client)
+        r.config['test']['index_sources'] = [
+            {'pattern': 'gracc.osg.summary', 'granularity': '1d',
+             'fields': ['Site', 'CoreHours'], 'cost': 1},
+            {'pattern': 'gracc.osg.raw-%Y.%m', 'cost': 10}]
+        r.index_sources = r._Reporter__get_index_sources()
+        r.query_fields = ['Site', 'CoreHours']
+
+        window = (start + timedelta(hours=11), start + timedelta(days=4,
+                                                                 hours=11))
+        with r.time_window(*window):
+            self.assertEqual(r.indexpattern, 'gracc.osg.raw-2018.03')
+            results = r.run_query()
+        self.assertEqual(results.Site.buckets[0].CoreHours.value, 96.0)
+        self.assertListEqual([c['index'] for c in client.calls], [
+            ['gracc.osg.raw-2018.03'], ['gracc.osg.summary'],
+            ['gracc.osg.raw-2018.03']])
+
+    def test_unmergeable_single_source(self):
+        """A query with an avg aggregation isn't split between sources, but
+        runs on the one source that covers the whole range"""
+        start = parse_datetime('2018-03-25 00:00', utc=True)
+        records = [{'_index': 'gracc.osg.raw-2018.03', 'Site': 'A',
+                    'EndTime': start + timedelta(hours=h), 'CoreHours': 1.0}
+                   for h in range(5 * 24)]
+        client = FakeElasticsearch(records)
+        r = FakeESReport(client)
+        r.config = copy.deepcopy(r.config)
+        r.config['test']['index_sources'] = [
+            {'pattern': 'gracc.osg.summary', 'granularity': '1d',
+             'fields': ['Site', 'CoreHours'], 'cost': 1},
+            {'pattern': 'gracc.osg.raw-%Y.%m', 'cost': 10}]
+        r.index_sources = r._Reporter__get_index_sources()
+        r.query_fields = ['Site', 'CoreHours']
+
+        def query():
+            s = FakeESReport.query(r)
+            s.aggs['Site'].metric('AvgCoreHours', 'avg', field='CoreHours')
+            return s
+        r.query = query
+
+        with r.time_window(start + timedelta(hours=11),
+                           start + timedelta(days=4, hours=11)):
+            self.assertEqual(len(r._source_plan), 3)
+            results = r.run_query()
+        self.assertEqual(results.Site.buckets[0].AvgCoreHours.value, 1.0)
+        self.assertListEqual([c['index'] for c in client.calls],
+                             [['gracc.osg.raw-2018.03']])
+
+    def test_range_up_to_now(self):
+        """A report whose range ends after now is answered by the raw
+        indices up to its end"""
+        now = datetime.now(tz.tzutc()).replace(microsecond=0)
+        client = FakeElasticsearch([{'Site': 'A', 'CoreHours': 1.0,
+                                     'EndTime': now - timedelta(hours=2)}])
+        r = FakeESReport(client)
+        r.config = copy.deepcopy(r.config)
+        r.config['test']['index_sources'] = [
+            {'pattern': 'gracc.osg.summary', 'granularity': '1d', 'lag': '1d',
+             'fields': ['Site', 'CoreHours'], 'cost': 1},
+            {'pattern': 'gracc.osg.raw-%Y.%m', 'lag': '5m', 'cost': 10}]
+        r.index_sources = r._Reporter__get_index_sources()
+        r.query_fields = ['Site', 'CoreHours']
+        with r.time_window(now - timedelta(hours=3), now + timedelta(hours=1)):
+            self.assertEqual(r._source_plan[-1][2], now + timedelta(hours=1))
+            results = r.run_query()
+        self.assertEqual(results.Site.buckets[0].CoreHours.value, 1.0)
+
+
+class TestPlanQuery(unittest.TestCase):
+    """Tests for the query planner in ReportUtils.Reporter"""
+    def test_plan_raises(self):
+        """With plan set, run_query prints the estimate and raises
+        QueryPlanned without running the aggregation"""
+        r = FakeESReport(None)
+        client = FakeElasticsearch([{'Site': 'A', 'CoreHours': 1.0,
+                                     'EndTime': r.start_time}])
+        r.fake_client = client
+        self.assertEqual(r.plan_query().hits, 1)
+        r.plan = True
+        with self.assertRaises(ReportUtils.QueryPlanned) as cm:
+            r.run_query()
+        self.assertEqual(cm.exception.plan.hits, 1)
+        self.assertTrue(all(a.keys() == ['cardinality']
+                            for c in client.calls
+                            for a in c['body']['aggs'].itervalues()))
+
+    def test_probes_executed(self):
+        """The planner's probe and the index catalog's query run through
+        the report's QueryExecutor"""
+        r = FakeESReport(None)
+        r.fake_client = r.client = FakeElasticsearch(
+            [{'_index': 'gracc.osg.raw-2018.03', 'Site': 'A',
+              'CoreHours': 1.0, 'EndTime': r.start_time}])
+        r.config = copy.deepcopy(r.config)
+        r.config['elasticsearch']['index_catalog'] = True
+        searches = []
+        execute = r.executor.execute
+        r.executor.execute = lambda s, **kwargs: \
+            searches.append(s) or execute(s, **kwargs)
+
+        r.plan_query()
+        r._Reporter__get_index_catalog().fetch()
+        self.assertEqual(len(searches), 2)
+        self.assertEqual(len(r.fake_client.calls), 2)
+
+
+class FakeProfileElasticsearch(FakeElasticsearch):
+    """FakeElasticsearch that returns a profile for profiled searches"""
+    def search(self, index=None, doc_type=None, body=None, **kwargs):
+        response = super(FakeProfileElasticsearch, self).search(
+            index=index, doc_type=doc_type, body=body, **kwargs)
+        if (body or {}).get('profile'):
+            response['profile'] = {'shards': [{
+                'id': '[node1][test][0]', 'searches': [],
+                'aggregations': [{'type': 'TermsAggregator',
+                                  'description': 'Site',
+                                  'time_in_nanos': 2000000}]}]}
+        return response
+
+
+class TestQueryProfile(unittest.TestCase):
+    """Tests for query profiling in ReportUtils.Reporter"""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def test_profile_written(self):
+        """Profiled queries are summarized next to the log file"""
+        r = FakeESReport(None)
+        r.fake_client = FakeProfileElasticsearch(
+            [{'Site': 'A', 'CoreHours': 1.0, 'EndTime': r.start_time}])
+        r.logfile = os.path.join(self.tmpdir, 'test.log')
+        r.run_query()
+        self.assertNotIn('profile', r.fake_client.calls[0]['body'])
+        self.assertIsNone(r._profile_log)
+
+        r.query_profile = True
+        r.run_query()
+        self.assertTrue(r.fake_client.calls[1]['body']['profile'])
+        with open(os.path.join(self.tmpdir, 'test.profile.json')) as f:
+            entry = json.load(f)['queries'][0]
+        self.assertEqual(entry['shards'][0]['aggregation_ms'], 2.0)
+        self.assertEqual(entry['latency_ms']['took'], 1)
+
+
+class TestRunQueryScan(unittest.TestCase):
+    """Tests for scanning the Search that ReportUtils.Reporter.run_query
+    returns"""
+    def test_scan_governed(self):
+        """Scans of the returned Search hold one of the governor's scroll
+        slots"""
+        r = FakeESReport(None)
+        r.fake_client = FakeElasticsearch(
+            [{'Site': 'A', 'CoreHours': 1.0, 'EndTime': r.start_time}])
+        r.executor.governor = Governor(max_scrolls=1, wait_timeout=0.1)
+        s = r.run_query(overridequery=lambda: Search(
+            using=r.fake_client, index=r.indexpattern))
+        hits = s.scan()
+        self.assertEqual(next(hits).Site, 'A')
+        self.assertRaises(GovernorTimeout, list, s.scan())
+        list(hits)
+
+
+class TestExportHits(unittest.TestCase):
+    """Tests for ReportUtils.Reporter.export_hits"""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def test_export(self):
+        """Hits are exported in time order, with the selected fields"""
+        r = FakeESReport(None)
+        r.fake_client = FakeElasticsearch(
+            [{'_id': i, 'Site': 'AB'[i % 2], 'CoreHours': 1.0, 'VO': 'x',
+              'EndTime': r.start_time + timedelta(minutes=(i * 7) % 1000)}
+             for i in range(1000)])
+        query = lambda: Search(using=r.fake_client, index=r.indexpattern)
+        path = os.path.join(self.tmpdir, 'export.ndjson.gz')
+        index = r.export_hits(path, ['Site', 'CoreHours'],
+                              overridequery=query, chunk_bytes=8000)
+        self.assertEqual(index['records'], 1000)
+        chunks = index['chunks']
+        self.assertTrue(all(a['end'] <= b['start']
+                            for a, b in zip(chunks, chunks[1:])))
+        records = [rec for batch in Pipeline.ndjson_source(path)
+                   for rec in batch]
+        self.assertItemsEqual(records[0].keys(),
+                              ['Site', 'CoreHours', 'EndTime'])
+        self.assertIn('_source', r.fake_client.calls[-1]['body'])
+
+
+class TestCheckpointedGroupBy(unittest.TestCase):
+    """Tests for checkpointed scans in ReportUtils.Reporter"""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def test_group_by_resumes(self):
+        """A group-by scan that fails part way resumes from its
+        checkpoint"""
+        r = FakeESReport(None)
+        r.config['default_statedir'] = self.tmpdir
+        r.config['test']['checkpoint_interval'] = 0
+        r.fake_client = FakeElasticsearch(
+            [{'_id': i, 'Site': 'AB'[i % 2], 'CoreHours': 1.0,
+              'EndTime': r.start_time + timedelta(minutes=i)}
+             for i in range(2500)])
+        query = lambda: Search(using=r.fake_client, index=r.indexpattern)
+
+        def fail(body):
+            # Fail on the third page
+            if body.get('search_after', [None, None])[1] == 'doc#1999':
+                return IOError("Connection reset")
+        r.fake_client.fail_with = fail
+        with self.assertRaises(IOError):
+            r.run_query_group_by(['Site'], [('CoreHours', 'sum', 'CoreHours')],
+                                 overridequery=query, checkpoint=True)
+        ckpt_dir = os.path.join(self.tmpdir, 'checkpoints')
+        self.assertEqual(len([f for f in os.listdir(ckpt_dir)
+                              if f.endswith('.ckpt')]), 1)
+
+        r.fake_client.fail_with = None
+        r.fake_client.calls = []
+        with r.run_query_group_by(['Site'], [('CoreHours', 'sum', 'CoreHours')],
+                                  overridequery=query, checkpoint=True) as gb:
+            self.assertDictEqual(gb.columns(), {'Site': ['A', 'B'],
+                                                'CoreHours': [1250.0, 1250.0]})
+        # run_query's own search, and the last page
+        self.assertEqual(len(r.fake_client.calls), 2)
+        self.assertListEqual(os.listdir(ckpt_dir), [])
+
+
+class TestBackfill(unittest.TestCase):
+    """Tests for ReportUtils.Reporter.run_backfill"""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def test_backfill(self):
+        """One query, and one report per period with that period's data"""
+        r = FakeRenderReport(None)
+        start = parse_datetime('2018-03-05 00:00', utc=True)
+        # Site A every day for 3 weeks, except the second week
+        records = [{'Site': 'A', 'CoreHours': 1.0, 'EndTime': t}
+                   for t in day_range(start, 21)
+                   if not 7 <= (t - start).days < 14]
+        records += [{'Site': 'B', 'CoreHours': 5.0,
+                     'EndTime': start + timedelta(days=15)}]
+        r.fake_client = FakeElasticsearch(records)
+        r.start_time, r.end_time = start, start + timedelta(days=21)
+        r.backfill = '1w'
+        r.backfill_dir = self.tmpdir
+        r.send_report(title='{start:%Y-%m-%d} report')
+
+        self.assertEqual(len(r.fake_client.calls), 1)
+        self.assertListEqual(sorted(os.listdir(self.tmpdir)), [
+            'test-201803050000.csv', 'test-201803050000.html',
+            'test-201803050000.txt', 'test-201803190000.csv',
+            'test-201803190000.html', 'test-201803190000.txt'])
+        with open(os.path.join(self.tmpdir, 'test-201803190000.csv')) as f:
+            rows = sorted(f.read().split())
+        self.assertListEqual(rows, ['A,7.0', 'B,5.0', 'Site,CoreHours'])
+        with open(os.path.join(self.tmpdir, 'test-201803050000.html')) as f:
+            self.assertIn('2018-03-05 report', f.read())
+        self.assertEqual(r.start_time, start)
+        self.assertEqual(r.title, 'Test Report')
+
+    def test_gap_skipped(self):
+        """Periods with no data between periods with data get no report"""
+        r = FakeRenderReport(None)
+        start = parse_datetime('2018-03-05 00:00', utc=True)
+        r.fake_client = FakeElasticsearch(
+            [{'Site': 'A', 'CoreHours': 1.0, 'EndTime': t}
+             for t in (start, start + timedelta(days=2))])
+        done = r.run_backfill('1d', start=start, end=start + timedelta(
+            days=3), outdir=self.tmpdir)
+        self.assertListEqual([p for p, _ in done],
+                             [start, start + timedelta(days=2)])
+        self.assertEqual(len(os.listdir(self.tmpdir)), 6)
+
+    def test_needs_aggregations(self):
+        """Queries without aggregations can't be backfilled"""
+        r = FakeRenderReport(FakeElasticsearch([]))
+        r.query = lambda: Search(using=r.fake_client, index=r.indexpattern)
+        self.assertRaises(ValueError, r.run_backfill, '1d')
+
+
+class TestRawResponse(unittest.TestCase):
+    """Tests for raw (plain dict) query results in ReportUtils.Reporter"""
+    def setUp(self):
+        self.r = FakeESReport(None)
+        self.r.fake_client = FakeElasticsearch(
+            [{'Site': 'AB'[i % 2], 'CoreHours': 1.0,
+              'EndTime': self.r.start_time} for i in range(5)])
+
+    def test_raw(self):
+        """Raw results are plain dicts with the same content"""
+        wrapped = self.r.run_query()
+        raw = self.r.run_query(raw=True)
+        self.assertIs(type(raw), dict)
+        self.assertDictEqual(raw, wrapped.to_dict())
+
+    def test_raw_response_attribute(self):
+        """raw_response makes raw results the default, prefetched results
+        included"""
+        self.r.raw_response = True
+        self.assertIs(type(self.r.run_query()), dict)
+        self.r._prefetched = self.r.run_query(raw=False)
+        self.assertIs(type(self.r.run_query()), dict)
+        self.assertEqual(self.r.run_query(raw=False).Site.buckets[0].key, 'A')
+
+
+class MetricsReport(FakeRenderReport):
+    """FakeRenderReport that renders its report in run_report"""
+    def run_report(self):
+        return self.render_report(self.format_report())
+
+
+class TestMetrics(unittest.TestCase):
+    """Tests for run metrics in ReportUtils.Reporter"""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'gracc_report_test.prom')
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def make_report(self, records):
+        r = MetricsReport(None)
+        r.fake_client = FakeElasticsearch(records)
+        r.config['metrics'] = {'textfile_dir': self.tmpdir}
+        r.metrics = r._Reporter__new_metrics()
+        return r
+
+    def read_samples(self):
+        with open(self.path) as f:
+            return dict(l.rsplit(' ', 1) for l in f.read().splitlines()
+                        if not l.startswith('#'))
+
+    def test_success(self):
+        """A successful run records its queries, buckets, rows, and phases"""
+        r = self.make_report([{'Site': s, 'CoreHours': 1.0, 'EndTime':
+                               parse_datetime('2018-03-28 12:00')}
+                              for s in 'ABC'])
+        with r.collect_metrics():
+            r.run_report()
+        samples = self.read_samples()
+        self.assertEqual(samples['gracc_report_last_run_success'
+                                 '{report="test"}'], '1')
+        self.assertEqual(samples['gracc_report_queries{report="test"}'], '1')
+        self.assertEqual(samples['gracc_report_buckets{report="test"}'], '3')
+        self.assertEqual(samples['gracc_report_rows{report="test"}'], '3')
+        self.assertIn('gracc_report_phase_duration_seconds{phase="run_query",'
+                      'report="test"}', samples)
+
+    def test_failure(self):
+        """A failed run is recorded as such"""
+        r = self.make_report([])
+        r.fake_client.fail_with = lambda body: ConnectionTimeout(
+            'TIMEOUT', 'timed out', None)
+        with self.assertRaises(ConnectionTimeout):
+            with r.collect_metrics():
+                r.run_report()
+        self.assertEqual(self.read_samples()['gracc_report_last_run_success'
+                                             '{report="test"}'], '0')
+
+    def test_send_report(self):
+        """send_report writes the metrics of a run that wasn't wrapped,
+        queries made before it included, and nested runs are written once,
+        by the outermost"""
+        r = self.make_report([{'Site': 'A', 'CoreHours': 1.0, 'EndTime':
+                               parse_datetime('2018-03-28 12:00')}])
+        r.no_email = True
+        r.run_query()
+        r.send_report()
+        samples = self.read_samples()
+        self.assertEqual(samples['gracc_report_queries{report="test"}'], '2')
+        self.assertEqual(samples['gracc_report_last_run_success'
+                                 '{report="test"}'], '1')
+
+        os.remove(self.path)
+        with r.collect_metrics():
+            r.send_report()
+            self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(self.read_samples()['gracc_report_queries'
+                                             '{report="test"}'], '1')
+
+
+class TestMemoryBudget(unittest.TestCase):
+    """Tests for memory profiling in ReportUtils.Reporter"""
+    def setUp(self):
+        self.client = FakeElasticsearch([{'Site': 'A', 'CoreHours': 1.0}])
+        self.r = FakeESReport(self.client)
+
+    def test_profiling_off(self):
+        """No profiler unless it's configured"""
+        self.assertIsNone(self.r.memprofiler)
+
+    def test_over_budget(self):
+        """Queries fail once they go over the memory budget"""
+        self.r.config['memory'] = {'budget_mb': 0}
+        self.r.memprofiler = self.r._Reporter__get_memory_profiler()
+        self.assertRaises(MemoryBudgetExceeded, self.r.run_query)
+        self.assertEqual(self.r.memprofiler.phases[0]['phase'], 'run_query')
+
+
+class TestRenderReports(unittest.TestCase):
+    """Tests for rendering reports in a process pool"""
+    def setUp(self):
+        start = parse_datetime('2018-03-28 06:30')
+        records = [{'EndTime': start + timedelta(hours=h), 'Site': site,
+                    'CoreHours': float(h)}
+                   for h in range(24) for site in ('A', 'B', 'C')[:h % 3 + 1]]
+        self.client = FakeElasticsearch(records)
+        self.reports = [FakeRenderReport(self.client) for _ in range(3)]
+
+    def test_render_job_is_plain(self):
+        """Jobs hold the raw aggregations dict, and no clients"""
+        cls, state, raw, title = self.reports[0].render_job(title='x')
+        self.assertIs(cls, FakeRenderReport)
+        self.assertIs(type(raw), dict)
+        self.assertNotIn('client', state)
+        cPickle.loads(cPickle.dumps((cls, state, raw, title)))
+
+    def test_pool_matches_serial(self):
+        """Rendering in a pool gives the same results, in order, as
+        rendering each report here"""
+        titles = ['Report {0}'.format(i) for i in range(3)]
+        jobs = [r.render_job(title=t) for r, t in zip(self.reports, titles)]
+        rendered = ReportUtils.render_reports(jobs, processes=2)
+        for r, t, result in zip(self.reports, titles, rendered):
+            self.assertDictEqual(result,
+                                 r.render_report(r.format_report(), title=t))
+        self.assertListEqual([result['title'] for result in rendered], titles)
+
+    def test_non_aggregation_rejected(self):
+        """Reports that scan hits can't be rendered elsewhere"""
+        r = self.reports[0]
+        r.query = lambda: Search(using=self.client, index='fake')
+        self.assertRaises(ValueError, r.render_job)
+
+
 # Everything besides Reporter
 class TestUtilFuncs(unittest.TestCase):
     """Unit tests for ReportUtils module level functions"""
@@ -237,4 +953,20 @@ class TestUtilFuncs(unittest.TestCase):
             yield value
 
         f = test_func()
-        self.assertEqual(f.send(1), 1)
\ No newline at end of file
+        self.assertEqual(f.send(1), 1)
+
+    def test_nest_aggs(self):
+        """Move top-level aggregations underneath a new outer aggregation"""
+        s = Search()
+        s.aggs.bucket('Site', 'terms', field='OIM_Site')\
+            .metric('CoreHours', 'sum', field='CoreHours')
+        outer = A('filters', filters={'vo1': {'term': {'VOName': 'vo1'}}})
+        nested = ReportUtils.nest_aggs(s, 'vo_fanout', outer)
+        answer = {'vo_fanout': {
+            'filters': {'filters': {'vo1': {'term': {'VOName': 'vo1'}}}},
+            'aggs': {'Site': {
+                'terms': {'field': 'OIM_Site'},
+                'aggs': {'CoreHours': {'sum': {'field': 'CoreHours'}}}}}}}
+        self.assertDictEqual(nested.to_dict()['aggs'], answer)
+        self.assertListEqual(s.to_dict()['aggs'].keys(), ['Site'])
+        self.assertNotIn('aggs', outer.to_dict())
@@ -0,0 +1,155 @@
+"""Unit tests for RollupStore"""
+
+import unittest
+import os
+import tempfile
+import shutil
+from datetime import datetime
+
+from gracc_reporting.RollupStore import RollupStore, day_list, day_batches
+from tests.fake_es import FakeElasticsearch, day
+
+
+def make_records():
+    """Three days of summary records across two sites and VOs"""
+    records = []
+    for dom in (1, 2, 3):
+        for site, vo, hours in (('SiteA', 'vo1', 10.0), ('SiteA', 'vo2', 5.0),
+                                ('SiteB', 'vo1', 1.0)):
+            records.append({'EndTime': day(2018, 7, dom, 12), 'OIM_Site': site,
+                            'VOName': vo, 'CoreHours': hours * dom,
+                            'Njobs': dom})
+    return records
+
+
+class TestRollupStoreBase(unittest.TestCase):
+    """Base class for RollupStore tests"""
+    start = day(2018, 7, 1)
+    end = day(2018, 7, 4)
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.client = FakeElasticsearch(make_records())
+        self.store = RollupStore(os.path.join(self.tmpdir, 'rollups.sqlite'),
+                                 dimensions=['OIM_Site', 'VOName'])
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmpdir)
+
+
+class TestRefresh(TestRollupStoreBase):
+    """Tests for RollupStore.refresh"""
+    def test_initial_refresh(self):
+        """All days get fetched on the first refresh"""
+        self.assertListEqual(
+            self.store.refresh(self.client, self.start, self.end),
+            ['2018-07-01', '2018-07-02', '2018-07-03'])
+
+    def test_no_change(self):
+        """Unchanged days don't get fetched again, and only the fingerprint
+        query is run"""
+        self.store.refresh(self.client, self.start, self.end)
+        ncalls = len(self.client.calls)
+        self.assertListEqual(
+            self.store.refresh(self.client, self.start, self.end), [])
+        self.assertEqual(len(self.client.calls), ncalls + 1)
+
+    def test_batches(self):
+        """Stale days are fetched batch_days at a time"""
+        self.store.batch_days = 2
+        self.store.refresh(self.client, self.start, self.end)
+        # The fingerprint query, and two batches of rollups
+        self.assertEqual(len(self.client.calls), 3)
+        rows = self.store.aggregate(self.start, self.end, ['OIM_Site'],
+                                    ['Njobs'])
+        self.assertListEqual(rows, [('SiteA', 12.0), ('SiteB', 6.0)])
+
+    def test_execute(self):
+        """Queries go through the given execute function"""
+        searches = []
+
+        def execute(s):
+            searches.append(s)
+            return s.execute()
+        self.store.batch_days = 2
+        self.store.refresh(self.client, self.start, self.end, execute=execute)
+        self.assertEqual(len(searches), len(self.client.calls))
+        self.assertEqual(len(searches), 3)
+
+    def test_changed_day(self):
+        """Only the day that changed gets fetched again"""
+        self.store.refresh(self.client, self.start, self.end)
+        self.client.records.append(
+            {'EndTime': day(2018, 7, 2, 6), 'OIM_Site': 'SiteC',
+             'VOName': 'vo3', 'CoreHours': 100.0, 'Njobs': 1})
+        self.assertListEqual(
+            self.store.refresh(self.client, self.start, self.end),
+            ['2018-07-02'])
+        rows = self.store.aggregate(self.start, self.end, ['OIM_Site'],
+                                    ['CoreHours'])
+        self.assertIn(('SiteC', 100.0), rows)
+
+
+class TestAggregate(TestRollupStoreBase):
+    """Tests for RollupStore.aggregate and RollupStore.columns"""
+    def setUp(self):
+        super(TestAggregate, self).setUp()
+        self.store.refresh(self.client, self.start, self.end)
+
+    def test_group_by_site(self):
+        """Sum over all days, grouped by site"""
+        answer = [('SiteA', 90.0, 12.0), ('SiteB', 6.0, 6.0)]
+        self.assertListEqual(
+            self.store.aggregate(self.start, self.end, ['OIM_Site']), answer)
+
+    def test_where_and_subrange(self):
+        """Filter on a dimension and only use part of the stored range"""
+        answer = [('SiteA', 20.0)]
+        self.assertListEqual(
+            self.store.aggregate(day(2018, 7, 2), day(2018, 7, 3),
+                                 ['OIM_Site'], ['CoreHours'],
+                                 where={'VOName': 'vo1', 'OIM_Site': 'SiteA'}),
+            answer)
+
+    def test_columns(self):
+        """Return a dict of columns"""
+        answer = {'VOName': ['vo1', 'vo2'], 'CoreHours': [66.0, 30.0]}
+        self.assertDictEqual(
+            self.store.columns(self.start, self.end, ['VOName'],
+                               ['CoreHours']), answer)
+
+    def test_bad_dimension(self):
+        """Raise ValueError if grouping by something that isn't stored"""
+        self.assertRaises(ValueError, self.store.aggregate, self.start,
+                          self.end, ['ProjectName'])
+
+
+class TestDayList(unittest.TestCase):
+    """Tests for RollupStore.day_list"""
+    def test_partial_days(self):
+        """Days partially covered by the range are included, and the end is
+        exclusive"""
+        self.assertListEqual(
+            day_list(datetime(2018, 7, 1, 6), datetime(2018, 7, 3)),
+            ['2018-07-01', '2018-07-02'])
+
+    def test_empty_range(self):
+        """An empty range touches no days"""
+        self.assertListEqual(day_list(day(2018, 7, 1), day(2018, 7, 1)), [])
+
+
+class TestDayBatches(unittest.TestCase):
+    """Tests for RollupStore.day_batches"""
+    def test_batches(self):
+        """Batches are runs of consecutive days, up to size long"""
+        days = ['2018-07-01', '2018-07-02', '2018-07-03', '2018-07-05',
+                '2018-07-06']
+        self.assertListEqual(day_batches(days, 2), [
+            ['2018-07-01', '2018-07-02'], ['2018-07-03'],
+            ['2018-07-05', '2018-07-06']])
+        self.assertListEqual(day_batches(days, 1), [[d] for d in days])
+
+
+if __name__ == '__main__':
+    unittest.main()
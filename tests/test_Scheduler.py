@@ -0,0 +1,236 @@
+"""Unit tests for Scheduler"""
+
+import unittest
+import os
+import sys
+import logging
+import json
+import tempfile
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from shutil import rmtree
+from datetime import datetime, timedelta
+
+import gracc_reporting.Scheduler as Scheduler
+import gracc_reporting.ReportUtils as ReportUtils
+from gracc_reporting.QueryPlanner import QueryPlan
+
+CONFIG = """
+default_statedir = '{statedir}'
+
+[email]
+    smtphost = 'smtp.invalid'
+    [email.from]
+        name = 'GRACC Operations'
+        email = 'nobody@example.com'
+    [email.test]
+        names = ['Test Recipient', ]
+        emails = ['nobody1@example.com', ]
+
+[elasticsearch]
+    hostname = 'https://es.invalid'
+    other_host = 'https://other.invalid'
+
+[scheduler]
+    workers = 2
+    reuse_smtp = false
+
+[schedule.fast]
+    report = 'tests.test_Scheduler:FakeReport'
+    every = '1h'
+    [schedule.fast.kwargs]
+        vo = 'testvo'
+
+[schedule.daily]
+    report = 'tests.test_Scheduler:FakeReport'
+    every = '1d'
+    at = '06:30'
+    period = '2d'
+"""
+
+
+class FakeReport(object):
+    """Stands in for a Reporter subclass.  Records its runs"""
+    runs = []
+    lock = threading.Lock()
+    delay = 0.0
+    fail = False
+    planned = False
+
+    def __init__(self, config_file, start, end, **kwargs):
+        self.host_clients = kwargs.get('host_clients') or {'host': object()}
+        self.args = (start, end, kwargs)
+
+    @contextmanager
+    def collect_metrics(self):
+        yield
+
+    def run_report(self):
+        time.sleep(self.delay)
+        if self.fail:
+            raise Exception("Report failed")
+        if self.planned:
+            raise ReportUtils.QueryPlanned(QueryPlan(['index'], 1, []))
+        with self.lock:
+            FakeReport.runs.append(self.args)
+
+
+class TestSchedulerBase(unittest.TestCase):
+    """Base class for Scheduler tests"""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cfg = os.path.join(self.tmpdir, 'config.toml')
+        with open(self.cfg, 'w') as f:
+            f.write(CONFIG.format(statedir=self.tmpdir))
+        FakeReport.runs = []
+        FakeReport.delay = 0.0
+        FakeReport.fail = False
+        FakeReport.planned = False
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def history(self):
+        with open(os.path.join(self.tmpdir, 'scheduler_runs.jsonl')) as f:
+            return [json.loads(line) for line in f]
+
+
+class TestScheduler(TestSchedulerBase):
+    """Tests for Scheduler.Scheduler"""
+    def test_run_once(self):
+        """Run a single report, and record its run"""
+        s = Scheduler.Scheduler(self.cfg)
+        record = s.run_once('daily', '2018-07-01 06:30', '2018-07-03 06:30',
+                            is_test=True)
+        self.assertTrue(record['success'])
+        start, end, kwargs = FakeReport.runs[0]
+        self.assertEqual((start, end), ('2018-07-01 06:30', '2018-07-03 06:30'))
+        self.assertTrue(kwargs['is_test'])
+        self.assertEqual(self.history()[0]['name'], 'daily')
+
+    def test_warm_clients(self):
+        """Later reports reuse the first report's clients"""
+        s = Scheduler.Scheduler(self.cfg)
+        s.run_once('fast')
+        s.run_once('fast')
+        self.assertNotIn('host_clients', FakeReport.runs[0][2])
+        self.assertIs(FakeReport.runs[1][2]['host_clients'],
+                      s.warm_clients.get())
+
+    def test_warm_clients_per_host(self):
+        """Reports with a different althost_key don't get the clients of
+        other hosts"""
+        s = Scheduler.Scheduler(self.cfg)
+        s.run_once('fast')
+        s.run_once('fast', althost_key='other_host')
+        s.run_once('fast', althost_key='other_host')
+        self.assertNotIn('host_clients', FakeReport.runs[1][2])
+        self.assertIs(FakeReport.runs[2][2]['host_clients'],
+                      s.warm_clients.get('other_host'))
+        self.assertIsNot(s.warm_clients.get('other_host'),
+                         s.warm_clients.get())
+
+    def test_smtp_unreachable(self):
+        """A dropped SMTP connection that fails with a socket error is
+        replaced, not fatal"""
+        s = Scheduler.Scheduler(self.cfg)
+        s.reuse_smtp = True
+
+        class DeadSMTP(object):
+            def noop(self):
+                raise socket.error(111, 'Connection refused')
+        s._local.smtp = DeadSMTP()
+        record = s.run_once('fast', is_test=True)
+        self.assertTrue(record['success'])
+        self.assertIn('smtp_connection', FakeReport.runs[0][2])
+
+    def test_tick(self):
+        """Due reports are run with the scheduled window, and reports that
+        are still running aren't started again"""
+        FakeReport.delay = 0.2
+        s = Scheduler.Scheduler(self.cfg)
+        now = s.next_runs['fast']
+        first = s.tick(now)
+        self.assertEqual(len(first), 1)
+        self.assertListEqual(s.tick(now + timedelta(hours=1)), [])
+        for r in first:
+            r.get()
+        start, end, kwargs = FakeReport.runs[0]
+        self.assertEqual(end - start, timedelta(hours=1))
+        self.assertEqual(kwargs['vo'], 'testvo')
+        self.assertEqual(s.next_runs['fast'], now + timedelta(hours=1))
+
+    def test_failure_recorded(self):
+        """Failed runs are recorded, and don't stop the scheduler"""
+        FakeReport.fail = True
+        s = Scheduler.Scheduler(self.cfg)
+        record = s.run_once('fast', no_email=True)
+        self.assertFalse(record['success'])
+        self.assertEqual(self.history()[0]['error'], 'Report failed')
+
+    def test_planned_run(self):
+        """A report run with --plan that only printed its query plan counts
+        as a success"""
+        FakeReport.planned = True
+        s = Scheduler.Scheduler(self.cfg)
+        record = s.run_once('fast', no_email=True, plan=True)
+        self.assertTrue(record['success'])
+        self.assertNotIn('error', self.history()[0])
+
+    def test_main_plan(self):
+        """main() passes --plan and the other report options on to the
+        report"""
+        logfile = os.path.join(self.tmpdir, 'scheduler.log')
+        argv = sys.argv
+        sys.argv = ['gracc-scheduler', '-c', self.cfg, '-r', 'fast', '-n',
+                    '-P', '--query-profile', '-L', logfile]
+        try:
+            with self.assertRaises(SystemExit) as cm:
+                Scheduler.main()
+        finally:
+            sys.argv = argv
+            for handler in logging.getLogger('scheduler').handlers[:]:
+                logging.getLogger('scheduler').removeHandler(handler)
+                handler.close()
+        self.assertEqual(cm.exception.code, 0)
+        kwargs = FakeReport.runs[0][2]
+        self.assertTrue(kwargs['plan'])
+        self.assertTrue(kwargs['query_profile'])
+        self.assertNotIn('backfill', kwargs)
+
+    def test_resume_from_history(self):
+        """A restarted scheduler picks up from the last recorded run"""
+        s = Scheduler.Scheduler(self.cfg)
+        s.run_report('daily', None, None, datetime(2018, 7, 1, 6, 30))
+        s2 = Scheduler.Scheduler(self.cfg)
+        self.assertEqual(s2.next_runs['daily'], datetime(2018, 7, 2, 6, 30))
+
+
+class TestScheduleHelpers(unittest.TestCase):
+    """Tests for Scheduler helper functions and ScheduledReport"""
+    def test_parse_duration(self):
+        """Parse durations with different units"""
+        self.assertEqual(Scheduler.parse_duration('30m'),
+                         timedelta(minutes=30))
+        self.assertEqual(Scheduler.parse_duration('1w'), timedelta(days=7))
+        self.assertRaises(ValueError, Scheduler.parse_duration, '1y')
+
+    def test_first_run_at(self):
+        """Daily schedule with 'at' first runs at the next HH:MM"""
+        sched = Scheduler.ScheduledReport('x', FakeReport, '1d', at='06:30')
+        self.assertEqual(sched.first_run(datetime(2018, 7, 1, 7)),
+                         datetime(2018, 7, 2, 6, 30))
+        self.assertEqual(sched.first_run(datetime(2018, 7, 1, 5)),
+                         datetime(2018, 7, 1, 6, 30))
+
+    def test_import_report(self):
+        """Import a report class from a module:class string"""
+        self.assertIs(Scheduler.import_report(
+            'tests.test_Scheduler:FakeReport'), FakeReport)
+        self.assertRaises(ValueError, Scheduler.import_report, 'nocolon')
+
+
+if __name__ == '__main__':
+    unittest.main()
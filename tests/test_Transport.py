@@ -0,0 +1,82 @@
+"""Unit tests for Transport"""
+
+import unittest
+import socket
+import json
+
+from elasticsearch import Elasticsearch
+
+from gracc_reporting.Replay import Recording, StandInServer
+from gracc_reporting.Transport import TunedHttpConnection, client_kwargs, \
+    wire_stats, benchmark
+
+# A large, repetitive body and response, like a big terms aggregation
+BODY = {'query': {'terms': {'VOName': ['vo{0}'.format(i)
+                                       for i in range(200)]}}}
+RESPONSE = {'took': 3, 'timed_out': False,
+            '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+            'hits': {'total': 500, 'hits': []},
+            'aggregations': {'VOName': {'buckets': [
+                {'key': 'vo{0}'.format(i), 'doc_count': i,
+                 'CoreHours': {'value': i * 1.5}} for i in range(500)]}}}
+
+
+class TestTransport(unittest.TestCase):
+    """Tests for Transport.TunedHttpConnection against a stand-in"""
+    def setUp(self):
+        self.recording = Recording()
+        self.recording.add('gracc.osg.raw-*', BODY, RESPONSE)
+        self.server = StandInServer(self.recording).start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def search(self, **options):
+        es = Elasticsearch([self.server.url],
+                           connection_class=TunedHttpConnection, **options)
+        response = es.search(index='gracc.osg.raw-*', body=BODY)
+        self.assertDictEqual(response, RESPONSE)
+        return wire_stats(es)
+
+    def test_plain(self):
+        """Without compression, what's received is what's decoded"""
+        stats = self.search()
+        self.assertEqual(stats.requests, 1)
+        self.assertEqual(stats.bytes_received, stats.decoded_bytes)
+        self.assertEqual(stats.bytes_sent, len(json.dumps(BODY)))
+
+    def test_compressed(self):
+        """Compressed requests and responses are smaller on the wire"""
+        stats = self.search(http_compress=True, compress_requests=True)
+        self.assertLess(stats.bytes_received * 5, stats.decoded_bytes)
+        self.assertLess(stats.bytes_sent * 2, len(json.dumps(BODY)))
+
+    def test_pool_options(self):
+        """maxsize, pool_block and tcp_keepalive reach the urllib3 pool"""
+        conn = TunedHttpConnection(host='127.0.0.1', maxsize=3,
+                                   pool_block=True, tcp_keepalive=30)
+        self.assertEqual(conn.pool.pool.maxsize, 3)
+        self.assertTrue(conn.pool.block)
+        self.assertIn((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+                      conn.pool.conn_kw['socket_options'])
+
+    def test_client_kwargs(self):
+        """Only configs with transport options get TunedHttpConnection"""
+        self.assertDictEqual(client_kwargs({'timeout': 60}), {})
+        kwargs = client_kwargs({'timeout': 60, 'http_compress': True})
+        self.assertDictEqual(kwargs, {'http_compress': True,
+                                      'connection_class': TunedHttpConnection})
+
+    def test_benchmark(self):
+        """Every variant is measured, and gzip shrinks the responses"""
+        results = dict((r['variant'], r)
+                       for r in benchmark(self.recording, repeat=2))
+        self.assertEqual(results['plain']['requests'], 2)
+        self.assertEqual(results['plain']['compression'], 1.0)
+        self.assertGreater(results['gzip responses']['compression'], 5)
+        self.assertLess(results['gzip both']['bytes_sent'],
+                        results['gzip responses']['bytes_sent'])
+
+
+if __name__ == '__main__':
+    unittest.main()